@@ -1,5 +1,5 @@
 """Package initialisation"""
-from importlib.metadata import version
+from importlib.metadata import PackageNotFoundError, version
 from pkgutil import get_data
 
 import yaml
@@ -11,8 +11,14 @@ PARAMETERS = get_data(__package__, PARAMETERS_FILE)
 PARAMETERS = yaml.safe_load(PARAMETERS)
 PARAMETERS = dict_to_decimal(PARAMETERS)
 MULTIMERS = PARAMETERS["multimer"]
+MULTIMER_SEARCH = PARAMETERS["multimer_search"]
 MOD_TYPE = PARAMETERS["mod_type"]
+MOD_COMBINATIONS = PARAMETERS["mod_combinations"]
 MASS_TO_CLEAN = PARAMETERS["mass_to_clean"]
 
-release = version("pgfinder")
+try:
+    release = version("pgfinder")
+except PackageNotFoundError:
+    # Not installed, as while the package itself is being built (see setup.py)
+    from pgfinder._version import version as release
 __version__ = ".".join(release.split("."[:2]))
@@ -0,0 +1,201 @@
+"""Structure by sample abundance matrices built from the results of many samples"""
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Union
+
+import numpy as np
+import pandas as pd
+
+from pgfinder.errors import UserError
+from pgfinder.logs.logs import LOGGER_NAME
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+LAYOUTS = ("wide", "long")
+
+
+class AbundanceMatrix:
+    """Accumulates the consolidated results of samples into a structure by sample abundance matrix.
+
+    Samples are added one at a time, so results can be streamed in (e.g. from ``Analyzer.analyze_many()``) without
+    keeping them around. Only the non-zero cells of the matrix are stored, as (row, sample, intensity) triplets, and
+    the matrix is only assembled when it is asked for.
+
+    Without an RT tolerance there is one row per (consolidated) structure, holding the total intensity of every
+    feature assigned that structure in each sample. With one, features of the same structure are aligned across samples
+    by retention time: each feature joins the row of that structure with the closest mean RT, if it is within
+    ``rt_tolerance`` minutes, otherwise it starts a new row. Isomers eluting at different times therefore get rows of
+    their own.
+
+    Parameters
+    ----------
+    rt_tolerance : float
+        Largest difference in retention time (in minutes) between features aligned to the same row. Optional.
+    """
+
+    def __init__(self, rt_tolerance: float = None):
+        if rt_tolerance is not None and rt_tolerance < 0:
+            raise UserError(f"The RT tolerance must not be negative, but {rt_tolerance} was given.")
+        self.rt_tolerance = rt_tolerance
+        self.samples: List[str] = []
+        self._structures: List[str] = []
+        # For each structure, the rows it has been aligned to and the running RT totals of those rows
+        self._rows_of: Dict[str, List[int]] = {}
+        self._rt_sum: List[float] = []
+        self._rt_count: List[int] = []
+        self._cells: List[tuple] = []
+
+    def __len__(self) -> int:
+        """Number of rows in the matrix."""
+        return len(self._structures)
+
+    def add(self, results_df: pd.DataFrame, sample: str = None) -> None:
+        """Add the results of one sample.
+
+        Parameters
+        ----------
+        results_df : pd.DataFrame
+            Results as returned by ``data_analysis()`` or read by ``results_reader()``.
+        sample : str
+            Column name for the sample. Defaults to the ``file`` the results came from.
+        """
+        sample = sample if sample is not None else str(results_df.attrs.get("file", f"Sample {len(self.samples) + 1}"))
+        if sample in self.samples:
+            raise UserError(f"The sample '{sample}' has already been added to the abundance matrix.")
+        consolidated = results_df.loc[
+            results_df["Inferred structure (consolidated)"].notna(),
+            ["Inferred structure (consolidated)", "RT (min)", "Intensity (consolidated)"],
+        ]
+        column = len(self.samples)
+        self.samples.append(sample)
+
+        rows = np.empty(len(consolidated), dtype=np.int64)
+        structures = consolidated["Inferred structure (consolidated)"].to_numpy(dtype=object)
+        rts = consolidated["RT (min)"].to_numpy(dtype=float)
+        # Align the earliest features first, so the result doesn't depend on the order of the rows
+        for i in np.argsort(rts, kind="stable"):
+            rows[i] = self._row(structures[i], rts[i])
+        intensities = consolidated["Intensity (consolidated)"].to_numpy(dtype=float)
+        # Features of a sample that land in the same row are summed
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        totals = np.bincount(inverse, weights=intensities, minlength=len(unique_rows))
+        self._cells.append((unique_rows, np.full(len(unique_rows), column, dtype=np.int64), totals))
+        LOGGER.info(f"Added {len(consolidated)} structures from '{sample}' to the abundance matrix")
+
+    def _row(self, structure: str, rt: float) -> int:
+        """Row that a feature is aligned to, starting a new row if there isn't one."""
+        rows = self._rows_of.setdefault(structure, [])
+        if self.rt_tolerance is not None:
+            closest, distance = None, None
+            for row in rows:
+                row_distance = abs(self._rt_sum[row] / self._rt_count[row] - rt)
+                if row_distance <= self.rt_tolerance and (distance is None or row_distance < distance):
+                    closest, distance = row, row_distance
+            if closest is not None:
+                self._rt_sum[closest] += rt
+                self._rt_count[closest] += 1
+                return closest
+        elif rows:
+            self._rt_sum[rows[0]] += rt
+            self._rt_count[rows[0]] += 1
+            return rows[0]
+        rows.append(len(self._structures))
+        self._structures.append(structure)
+        self._rt_sum.append(rt)
+        self._rt_count.append(1)
+        return rows[-1]
+
+    def triplets(self) -> pd.DataFrame:
+        """The non-zero cells of the matrix as (row, sample, intensity) triplets."""
+        if self._cells:
+            rows, columns, intensities = (np.concatenate(parts) for parts in zip(*self._cells))
+        else:
+            rows, columns, intensities = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0)
+        return pd.DataFrame({"row": rows, "sample": columns, "intensity": intensities})
+
+    def to_frame(self, sparse: bool = True) -> pd.DataFrame:
+        """Assemble the matrix.
+
+        Parameters
+        ----------
+        sparse : bool
+            Store the sample columns as sparse arrays (with a fill value of 0) rather than dense ones.
+
+        Returns
+        -------
+        pd.DataFrame
+            One row per structure (and retention time, when aligning) and one column per sample.
+        """
+        columns = {}
+        for sample, (rows, _, intensities) in zip(self.samples, self._cells):
+            values = np.zeros(len(self))
+            values[rows] = intensities
+            columns[sample] = pd.arrays.SparseArray(values, fill_value=0.0) if sparse else values
+        return pd.concat([self._row_labels(), pd.DataFrame(columns, index=range(len(self)))], axis=1)
+
+    def _row_labels(self) -> pd.DataFrame:
+        """Structure (and mean retention time, when aligning) of each row."""
+        labels = {"Inferred structure": pd.Series(self._structures, dtype=object)}
+        if self.rt_tolerance is not None:
+            labels["RT (min)"] = np.array(self._rt_sum, dtype=float) / np.array(self._rt_count, dtype=float)
+        return pd.DataFrame(labels)
+
+    def write(self, file: Union[str, Path], layout: str = "wide", float_format: str = "%.4f") -> Union[str, Path]:
+        """Write the matrix to a CSV file in one go.
+
+        Parameters
+        ----------
+        file : Union[str, Path]
+            CSV file to write.
+        layout : str
+            ``wide`` for a structure by sample table, or ``long`` for one line per non-zero cell (structure, sample and
+            intensity), which is much smaller when most structures are only found in a few samples.
+        float_format : str
+            Format for floating point numbers.
+
+        Returns
+        -------
+        Union[str, Path]
+            The file that was written.
+        """
+        if layout not in LAYOUTS:
+            raise UserError(f"Unknown abundance matrix layout '{layout}', expected one of {', '.join(LAYOUTS)}.")
+        if layout == "wide":
+            matrix_df = self.to_frame(sparse=False)
+        else:
+            triplets = self.triplets().sort_values(["row", "sample"], kind="stable")
+            matrix_df = self._row_labels().iloc[triplets["row"]].reset_index(drop=True)
+            matrix_df["Sample"] = np.array(self.samples, dtype=object)[triplets["sample"].to_numpy()]
+            matrix_df["Intensity"] = triplets["intensity"].to_numpy()
+        matrix_df.to_csv(file, index=False, float_format=float_format)
+        LOGGER.info(f"Abundance matrix of {len(self)} rows and {len(self.samples)} samples saved to : {file}")
+        return file
+
+
+def abundance_matrix(
+    results: Iterable[pd.DataFrame], rt_tolerance: float = None, samples: Iterable[str] = None, sparse: bool = True
+) -> pd.DataFrame:
+    """Build a structure by sample abundance matrix from the results of several samples.
+
+    Parameters
+    ----------
+    results : Iterable[pd.DataFrame]
+        Results of each sample, consumed one at a time.
+    rt_tolerance : float
+        Largest difference in retention time (in minutes) between features aligned to the same row. Optional; without
+        it there is one row per structure.
+    samples : Iterable[str]
+        Column names for the samples. Defaults to the files the results came from.
+    sparse : bool
+        Store the sample columns as sparse arrays.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per structure (and retention time, when aligning) and one column per sample.
+    """
+    matrix = AbundanceMatrix(rt_tolerance=rt_tolerance)
+    samples = iter(samples) if samples is not None else None
+    for results_df in results:
+        matrix.add(results_df, sample=next(samples) if samples is not None else None)
+    return matrix.to_frame(sparse=sparse)
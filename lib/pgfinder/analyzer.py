@@ -0,0 +1,889 @@
+"""Reusable analysis sessions"""
+import copy
+import logging
+import time
+from decimal import Decimal
+from pathlib import Path, PurePath
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from pgfinder import MOD_TYPE, MULTIMERS, jit, reference, release
+from pgfinder.checkpoints import CheckpointStore, Stage, hash_frame, hash_settings, run_stages
+from pgfinder.errors import UserError
+from pgfinder.estimate import Estimate, estimate
+from pgfinder.kernels import (
+    grouped_window_matches,
+    isobaric_matches,
+    ppm_windows,
+    read_only,
+    sorted_observed,
+    window_hits,
+    window_matches,
+)
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.matching import (
+    calculate_ppm_delta,
+    clean_up,
+    modification_generator,
+    multimer_builder,
+    pick_most_likely_structures,
+)
+from pgfinder.metrics import REGISTRY
+from pgfinder.modifications import modification_search
+from pgfinder.multimers import multimer_search
+from pgfinder.prefilter import FeatureFilter, with_unmatched
+from pgfinder.recalibration import Calibration, calibrants, fit_calibration
+from pgfinder.search_space import ExpandedSearchSpace, expand_search_space, fingerprint
+from pgfinder.structures import StructureTable
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+SUGAR = Decimal("203.0793")
+SODIUM = Decimal("21.9819")
+POTASSIUM = Decimal("37.9559")
+# Column of the sample each feature comes from while several samples are analysed together
+SAMPLE = "Sample"
+
+
+class Analyzer:
+    """An analysis session configured once and reused across many samples.
+
+    Everything that doesn't depend on the sample being analysed — preparing the mass library, resolving the enabled
+    multimers and modifications against ``parameters.yaml`` and working out the ppm windows of every library structure
+    — is done once when the ``Analyzer`` is created. Instances are immutable and hold no per-sample state, so a single
+    instance can safely be shared between threads.
+
+    Parameters
+    ----------
+    theo_masses_df : pd.DataFrame
+        Theoretical masses as Pandas DataFrame.
+    rt_window : float
+        Set time window for in-source decay and salt adduct cleanup
+    enabled_mod_list : list
+        List of modifications to enable.
+    ppm_tolerance : float
+        The ppm tolerance used when matching the theoretical masses of structures to observed ions
+    consolidation_ppm : float
+        The minimum absolute ppm difference between two matches before one is picked as "most likely" over the other
+    max_multimer : int
+        When set, enabled multimers are searched for by joining observed monomers into chains of up to this many
+        monomers (see ``multimer_search()``) rather than using the fixed donors in ``parameters.yaml``.
+    max_modifications : int
+        When set, structures carrying up to this many of the enabled modifications at once are searched for (see
+        ``modification_search()``) rather than applying each modification on its own.
+    engine : str
+        ``numpy`` (the default) or ``jit`` to run the matching and clean-up loops as compiled kernels (see
+        ``pgfinder.jit``), which needs Numba. Both give identical results. ``reference`` runs the original
+        row-by-row search space building, matching, clean-up and consolidation kept in ``pgfinder.reference`` instead,
+        which is much slower but is what the other engines are checked against (see ``pgfinder.verify``). It builds
+        every search space from scratch, so can't be combined with ``expanded_search_space``.
+    expanded_search_space : Union[ExpandedSearchSpace, str, Path]
+        The whole library expanded once with the same modifications (see ``expand_search_space()``), which each sample's
+        search space is then picked out of rather than being built from scratch. Given a file, the search space saved
+        there is used if it was built for this library and these modifications, otherwise it is expanded and saved
+        there. Optional.
+    feature_filter : FeatureFilter
+        Only analyse the features of each sample that pass this filter (see ``pgfinder.prefilter``). Optional.
+    report_filtered : bool
+        Add the features dropped by ``feature_filter`` to the results as unmatched rows, without analysing them.
+    recalibrated_ppm : float
+        When set, the observed masses of each sample are recalibrated against the library monomers they unambiguously
+        match within ``ppm_tolerance`` (see ``pgfinder.recalibration``), and the analysis is run at this narrower
+        tolerance instead.
+
+    Examples
+    --------
+
+        analyzer = Analyzer(theo_masses_df, 0.5, ["Anhydro-MurNAc (Anh)"], 10, 1)
+        for results in analyzer.analyze_many(ms_file_reader(f) for f in files):
+            ...
+    """
+
+    def __init__(
+        self,
+        theo_masses_df: pd.DataFrame,
+        rt_window: float,
+        enabled_mod_list: list,
+        ppm_tolerance: float,
+        consolidation_ppm: float,
+        max_multimer: int = None,
+        max_modifications: int = None,
+        engine: str = None,
+        expanded_search_space: Union[ExpandedSearchSpace, str, Path] = None,
+        feature_filter: FeatureFilter = None,
+        report_filtered: bool = False,
+        recalibrated_ppm: float = None,
+    ):
+        # Make sure the enabled_mod_list (if empty), is actually represented by an empty list
+        enabled_mod_list = list(enabled_mod_list or [])
+        unknown_mods = [m for m in enabled_mod_list if m not in MULTIMERS and m not in MOD_TYPE]
+        if unknown_mods:
+            raise UserError(
+                f"The modification(s) {unknown_mods} are not recognised. Please check the spelling against the list "
+                "of allowed modifications."
+            )
+
+        if max_multimer is not None and (int(max_multimer) != max_multimer or max_multimer < 2):
+            raise UserError("The largest multimer to search for must be a whole number of at least 2 monomers.")
+        if max_modifications is not None and (int(max_modifications) != max_modifications or max_modifications < 1):
+            raise UserError("The most modifications per structure must be a whole number of at least 1.")
+
+        if recalibrated_ppm is not None and not 0 < recalibrated_ppm <= ppm_tolerance:
+            raise UserError("The tolerance after recalibration must be positive and no wider than the ppm tolerance.")
+
+        self._rt_window = rt_window
+        # Calibrants are matched at the given tolerance, everything else at the recalibrated one
+        self._calibration_ppm = None if recalibrated_ppm is None else ppm_tolerance
+        self._ppm_tolerance = ppm_tolerance if recalibrated_ppm is None else recalibrated_ppm
+        self._consolidation_ppm = consolidation_ppm
+        self._max_multimer = None if max_multimer is None else int(max_multimer)
+        self._max_modifications = None if max_modifications is None else int(max_modifications)
+        self._enabled_mod_list = tuple(enabled_mod_list)
+        self._feature_filter = feature_filter if feature_filter is not None and feature_filter.active else None
+        self._report_filtered = bool(report_filtered)
+        self._use_engine(engine)
+        self._masses_file = theo_masses_df.attrs["file"]
+
+        # NOTE: "Multimers" is a semi-magic keyword here. Multimers and modifications are treated
+        # differently by most of the code and have their own sections in `parameters.yaml`, but
+        # despite this, all of the multimer and modification flags are passed in the same
+        # `enabled_mod_list` variable...
+        self._multimer_mods = tuple(m for m in enabled_mod_list if "Multimers" in m)
+        self._other_mods = tuple(m for m in enabled_mod_list if m not in self._multimer_mods)
+
+        # Prepare the library and the ppm window of every structure in it
+        self._library = theo_masses_df[["Inferred structure", "Theo (Da)"]].astype({"Theo (Da)": float})
+        self._library.reset_index(drop=True, inplace=True)
+        self._library_windows = ppm_windows(self._library["Theo (Da)"].to_numpy(), self._ppm_tolerance)
+        # `matching()` reports theoretical masses rounded to 4 decimal places
+        self._library_rounded = read_only(np.array([round(m, 4) for m in self._library["Theo (Da)"]], dtype=float))
+
+        if isinstance(expanded_search_space, (str, PurePath)):
+            expanded_search_space = self._saved_search_space(Path(expanded_search_space))
+        elif expanded_search_space is not None:
+            self._check_expandable()
+            if expanded_search_space.fingerprint != self.fingerprint:
+                raise UserError(
+                    "The expanded search space was built for a different mass library or list of modifications."
+                )
+        if expanded_search_space is not None and self._engine == "reference":
+            raise UserError("The reference engine builds every search space from scratch, without an expanded one.")
+        self._expanded_search_space = expanded_search_space
+
+    @property
+    def library(self) -> pd.DataFrame:
+        """A copy of the mass library used by this analyzer."""
+        return self._library.copy()
+
+    @property
+    def rt_window(self) -> float:
+        """Time window used for in-source decay and salt adduct cleanup."""
+        return self._rt_window
+
+    @property
+    def enabled_mod_list(self) -> List[str]:
+        """Enabled multimers and modifications."""
+        return list(self._enabled_mod_list)
+
+    @property
+    def ppm_tolerance(self) -> float:
+        """Tolerance used when matching theoretical to observed masses."""
+        return self._ppm_tolerance
+
+    @property
+    def consolidation_ppm(self) -> float:
+        """Minimum absolute ppm difference distinguishing ambiguous matches."""
+        return self._consolidation_ppm
+
+    @property
+    def max_multimer(self) -> int:
+        """Largest multimer searched for, or None to use the fixed multimer donors."""
+        return self._max_multimer
+
+    @property
+    def max_modifications(self) -> int:
+        """Most modifications per structure searched for, or None to apply modifications one at a time."""
+        return self._max_modifications
+
+    @property
+    def feature_filter(self) -> FeatureFilter:
+        """Filter picking the features of each sample to analyse, or None to analyse them all."""
+        return self._feature_filter
+
+    @property
+    def report_filtered(self) -> bool:
+        """Whether features dropped by the filter are added to the results as unmatched rows."""
+        return self._report_filtered
+
+    @property
+    def recalibrated_ppm(self) -> float:
+        """Tolerance used after recalibrating observed masses, or None when they aren't recalibrated."""
+        return None if self._calibration_ppm is None else self._ppm_tolerance
+
+    @property
+    def engine(self) -> str:
+        """Engine running the matching and clean-up loops, ``numpy``, ``jit`` or ``reference``."""
+        return self._engine
+
+    def with_engine(self, engine: str) -> "Analyzer":
+        """A copy of this analyzer with the same settings, running its loops on another engine.
+
+        Parameters
+        ----------
+        engine : str
+            ``numpy``, ``jit`` or ``reference``.
+
+        Returns
+        -------
+        Analyzer
+            The copy, which shares the library, search space and filter of this analyzer. A copy running the
+            ``reference`` engine leaves out the expanded search space, building every search space from scratch.
+        """
+        analyzer = copy.copy(self)
+        analyzer._use_engine(engine)
+        if analyzer._engine == "reference":
+            analyzer._expanded_search_space = None
+        return analyzer
+
+    def _use_engine(self, engine: str) -> None:
+        self._engine = jit.resolve_engine(engine)
+        if self._engine == "jit":
+            self._window_matches, self._clean_up = jit.window_matches, jit.clean_up
+            self._pick_most_likely_structures = jit.pick_most_likely_structures
+        elif self._engine == "reference":
+            self._window_matches, self._clean_up = window_matches, reference.clean_up
+            self._pick_most_likely_structures = reference.pick_most_likely_structures
+        else:
+            self._window_matches, self._clean_up = window_matches, clean_up
+            self._pick_most_likely_structures = pick_most_likely_structures
+
+    @property
+    def fingerprint(self) -> str:
+        """Fingerprint of the mass library and modifications, identifying the search space they expand into."""
+        return fingerprint(self._library, self._enabled_mod_list)
+
+    def expand_search_space(self) -> ExpandedSearchSpace:
+        """Expand the whole library into every candidate structure any sample could be matched against.
+
+        The expansion only depends on the library and the enabled modifications, so it can be saved (see
+        ``ExpandedSearchSpace.write()``) and passed to any ``Analyzer`` with the same library and modifications,
+        whatever its tolerances. Not available when ``max_multimer`` or ``max_modifications`` are set, as those
+        searches depend on each sample's observed masses.
+
+        Returns
+        -------
+        ExpandedSearchSpace
+            The expanded search space.
+        """
+        self._check_expandable()
+        metadata = {
+            "masses_file": self._masses_file,
+            "modifications": list(self._enabled_mod_list),
+            "fingerprint": self.fingerprint,
+        }
+        return expand_search_space(
+            self._library, self._library_rounded, self._multimer_mods, self._other_mods, metadata=metadata
+        )
+
+    def estimate(self, file: Union[str, Path], costs: dict = None) -> Estimate:
+        """Estimate the size, runtime and peak memory of analysing a file, without analysing it.
+
+        Only the number of features in the file and histograms of their masses and retention times are read, see
+        ``pgfinder.estimate``, and only the features that pass the ``feature_filter`` are counted.
+
+        Parameters
+        ----------
+        file : Union[str, Path]
+            Mass spec file to be analysed.
+        costs : dict
+            Per-stage costs overriding the fitted ones of the engine in ``pgfinder.estimate.COSTS``.
+
+        Returns
+        -------
+        Estimate
+            Expected candidate, match and result counts, and projected runtime (in seconds) and peak memory (in MiB).
+        """
+        return estimate(
+            file,
+            self._library,
+            self._multimer_mods,
+            self._other_mods,
+            self._ppm_tolerance,
+            max_multimer=self._max_multimer,
+            max_modifications=self._max_modifications,
+            rt_window=self._rt_window,
+            engine=self._engine,
+            feature_filter=self._feature_filter,
+            costs=costs,
+        )
+
+    def _saved_search_space(self, file: Path) -> ExpandedSearchSpace:
+        """Read the expanded search space saved in a file, (re-)building it if it's missing or out of date."""
+        if file.exists():
+            expanded_search_space = ExpandedSearchSpace.read(file)
+            if expanded_search_space.fingerprint == self.fingerprint:
+                LOGGER.info(f"Expanded search space loaded from : {file}")
+                return expanded_search_space
+            LOGGER.info(f"The expanded search space in {file} is out of date, re-building it")
+        expanded_search_space = self.expand_search_space()
+        expanded_search_space.write(file)
+        return expanded_search_space
+
+    def _check_expandable(self) -> None:
+        if self._max_multimer is not None or self._max_modifications is not None:
+            raise UserError(
+                "The search space can't be expanded in advance when searching for larger multimers or several "
+                "modifications at once."
+            )
+
+    def analyze(
+        self,
+        raw_data_df: pd.DataFrame,
+        search_space: pd.DataFrame = None,
+        checkpoints: Union[CheckpointStore, str, Path] = None,
+        calibration: Calibration = None,
+    ) -> pd.DataFrame:
+        """Analyse a single sample.
+
+        Parameters
+        ----------
+        raw_data_df : pd.DataFrame
+            User data as Pandas DataFrame.
+        search_space : pd.DataFrame
+            Candidate structures to match, as returned by ``search_space()``. Defaults to the search space of the
+            observed masses in ``raw_data_df``; pass the search space of the whole sample when analysing part of it.
+        checkpoints : Union[CheckpointStore, str, Path]
+            Directory (or store) to save the output of each stage to, resuming after the last stage that has already
+            been saved for this sample and these settings (see ``pgfinder.checkpoints``). Optional.
+        calibration : Calibration
+            Recalibration of the observed masses, as returned by ``calibrate()``. Defaults to the recalibration of
+            ``raw_data_df`` when ``recalibrated_ppm`` is set; pass that of the whole sample when analysing part of it.
+
+        Returns
+        -------
+        pd.DataFrame
+
+        Notes
+        -----
+        With a ``feature_filter`` the features that don't pass it are dropped before any stage is run. A sample
+        analysed in parts (with a ``search_space``) isn't filtered here, as filters like ``top_n`` need the whole
+        sample: filter it before splitting it up, as ``analyze_file()`` does. The same goes for recalibration.
+        """
+        start = time.perf_counter()
+        raw_data_df, dropped_df, calibration = self._prepare(raw_data_df, search_space, calibration)
+        stages = self.stages(raw_data_df, search_space, calibration)
+        if checkpoints is None:
+            results_df = run_stages(stages)
+        else:
+            if not isinstance(checkpoints, CheckpointStore):
+                checkpoints = CheckpointStore(checkpoints)
+            # Stages are keyed by the sample and library they start from, the release that ran them and the settings
+            # of each stage up to them
+            key = hash_settings(
+                hash_frame(raw_data_df),
+                "library",
+                {
+                    "release": release,
+                    "masses_file": self._masses_file,
+                    "fingerprint": self.fingerprint,
+                    "search_space": None if search_space is None else hash_frame(search_space),
+                },
+            )
+            results_df = run_stages(stages, key, checkpoints)
+        results_df = self._record(raw_data_df, results_df, dropped_df)
+        REGISTRY.observe("pgfinder_analysis_duration_seconds", time.perf_counter() - start)
+        return results_df
+
+    def _prepare(
+        self, raw_data_df: pd.DataFrame, search_space: pd.DataFrame = None, calibration: Calibration = None
+    ) -> Tuple[pd.DataFrame, Optional[pd.DataFrame], Optional[Calibration]]:
+        """Filter and recalibrate the features of a sample, returning them, those dropped and the recalibration."""
+        dropped_df = None
+        if self._feature_filter is not None and search_space is None:
+            n_features = len(raw_data_df)
+            raw_data_df, dropped_df = self._feature_filter.apply(raw_data_df)
+            LOGGER.info(f"Features kept by the filter        : {len(raw_data_df)} of {n_features}")
+        if self._calibration_ppm is not None:
+            if calibration is None and search_space is None:
+                calibration = self.calibrate(raw_data_df)
+            if calibration is not None:
+                raw_data_df = calibration.apply(raw_data_df)
+        return raw_data_df, dropped_df, calibration
+
+    def _record(self, raw_data_df: pd.DataFrame, results_df: pd.DataFrame, dropped_df: pd.DataFrame) -> pd.DataFrame:
+        """Count the features of a sample in the metrics and add those dropped by the filter, if they're reported."""
+        REGISTRY.inc("pgfinder_features_total", len(raw_data_df))
+        REGISTRY.inc(
+            "pgfinder_features_matched_total", results_df.loc[results_df["Inferred structure"].notna(), "ID"].nunique()
+        )
+        if dropped_df is not None:
+            REGISTRY.inc("pgfinder_features_filtered_total", len(dropped_df))
+        if self._report_filtered and dropped_df is not None:
+            results_df = with_unmatched(results_df, dropped_df)
+        return results_df
+
+    def stages(
+        self, raw_data_df: pd.DataFrame, search_space: pd.DataFrame = None, calibration: Calibration = None
+    ) -> List[Stage]:
+        """The stages ``analyze()`` runs, in order, each on the output of the one before.
+
+        Parameters
+        ----------
+        raw_data_df : pd.DataFrame
+            User data as Pandas DataFrame, already recalibrated if it is to be.
+        search_space : pd.DataFrame
+            Candidate structures to match, if not those of ``search_space()``.
+        calibration : Calibration
+            Recalibration applied to ``raw_data_df``, recorded in the metadata of the results.
+
+        Returns
+        -------
+        List[Stage]
+            The observed-monomer filter, multimer and modification expansions (or the filtering of the expanded search
+            space), matching, the ppm delta, the clean-up of each adduct and consolidation.
+        """
+        if search_space is not None:
+            # Search spaces passed in aren't filtered by the tolerance, so it is only a setting of the matching
+            stages = [Stage("match", {"ppm": self._ppm_tolerance}, lambda _: self._match(raw_data_df, search_space))]
+        else:
+            observed = sorted_observed(raw_data_df)
+            if self._expanded_search_space is not None:
+                stages = [Stage("search_space", {"ppm": self._ppm_tolerance}, lambda _: self.search_space(observed))]
+            else:
+                stages = [
+                    Stage(
+                        "observed_monomers", {"ppm": self._ppm_tolerance}, lambda _: self._observed_monomers(observed)
+                    ),
+                    Stage(
+                        "multimers",
+                        {"multimers": self._multimer_mods, "max_multimer": self._max_multimer},
+                        lambda df: self._with_multimers(df, observed),
+                    ),
+                    Stage(
+                        "modifications",
+                        {"modifications": self._other_mods, "max_modifications": self._max_modifications},
+                        lambda df: self._with_modifications(df, observed),
+                    ),
+                ]
+            stages.append(Stage("match", {}, lambda df: self._match(raw_data_df, df)))
+        stages.append(Stage("ppm_delta", {}, lambda df: calculate_ppm_delta(df=df)))
+
+        # Every structure is parsed and classified once, then parents and adducts are picked out with masks
+        structures = {}
+
+        def clean_up_stage(name, mass):
+            def run(df):
+                categories = df["Inferred structure"].cat.categories
+                if structures.get("categories") is not categories:
+                    structures.update(categories=categories, table=StructureTable(categories))
+                if self._engine == "reference":
+                    # Parents and adducts are picked out by searching the name of every structure
+                    return self._clean_up(df, mass, self._rt_window)
+                return self._clean_up(df, mass, self._rt_window, structures=structures["table"])
+
+            return Stage(name, {"rt_window": self._rt_window, "mass": mass}, run)
+
+        stages.append(clean_up_stage("clean_up_sodium", SODIUM))
+        stages.append(clean_up_stage("clean_up_potassium", POTASSIUM))
+        stages.append(clean_up_stage("clean_up_sugar", SUGAR))
+        stages.append(
+            Stage(
+                "consolidation",
+                {
+                    "consolidation_ppm": self._consolidation_ppm,
+                    "modifications": self._enabled_mod_list,
+                    "feature_filter": self._feature_filter,
+                    "calibration": calibration,
+                },
+                lambda df: self._consolidate(df, raw_data_df.attrs["file"], calibration),
+            )
+        )
+        return stages
+
+    def _consolidate(self, cleaned_data_df: pd.DataFrame, file: str, calibration: Calibration = None) -> pd.DataFrame:
+        self._set_metadata(cleaned_data_df, file, calibration)
+        cleaned_data_df.sort_values(by=["Intensity", "RT (min)"], ascending=[False, True], inplace=True, kind="stable")
+        cleaned_data_df.reset_index(drop=True, inplace=True)
+
+        # Apply some post-processing to the results
+        results_df = self._pick_most_likely_structures(cleaned_data_df, self._consolidation_ppm)
+        # Structures are only decoded from their categorical codes once the results are ready
+        results_df["Inferred structure"] = results_df["Inferred structure"].astype(object)
+        return results_df
+
+    def _set_metadata(self, cleaned_data_df: pd.DataFrame, file: str, calibration: Calibration = None) -> None:
+        cleaned_data_df.attrs["file"] = file
+        cleaned_data_df.attrs["masses_file"] = self._masses_file
+        cleaned_data_df.attrs["rt_window"] = self._rt_window
+        cleaned_data_df.attrs["modifications"] = list(self._enabled_mod_list)
+        cleaned_data_df.attrs["ppm"] = self._ppm_tolerance
+        cleaned_data_df.attrs["consolidation_ppm"] = self._consolidation_ppm
+        if self._max_multimer is not None:
+            cleaned_data_df.attrs["max_multimer"] = self._max_multimer
+        if self._max_modifications is not None:
+            cleaned_data_df.attrs["max_modifications"] = self._max_modifications
+        if self._feature_filter is not None:
+            cleaned_data_df.attrs["feature_filter"] = self._feature_filter.describe()
+        if self._calibration_ppm is not None:
+            cleaned_data_df.attrs["recalibration"] = f"from {self._calibration_ppm} ppm, " + (
+                calibration.describe() if calibration is not None else "not applied as too few calibrants matched"
+            )
+
+    def calibrate(self, raw_data_df: pd.DataFrame) -> Optional[Calibration]:
+        """Fit the mass calibration of a sample, from the features unambiguously matching a library monomer.
+
+        Parameters
+        ----------
+        raw_data_df : pd.DataFrame
+            User data as Pandas DataFrame (or just its ``Obs (Da)`` and ``RT (min)`` columns).
+
+        Returns
+        -------
+        Optional[Calibration]
+            The recalibration (see ``pgfinder.recalibration``), or None when too few features match to fit one.
+        """
+        if self._calibration_ppm is None:
+            raise UserError("Observed masses are only recalibrated when a recalibrated ppm tolerance is set.")
+        observed = raw_data_df["Obs (Da)"].to_numpy(dtype=float)
+        positions, theoretical = calibrants(observed, self._library["Theo (Da)"].to_numpy(), self._calibration_ppm)
+        calibration = fit_calibration(
+            observed[positions], raw_data_df["RT (min)"].to_numpy(dtype=float)[positions], theoretical
+        )
+        if calibration is None:
+            LOGGER.warning(f"Only {len(positions)} features unambiguously match a monomer, too few to recalibrate")
+        else:
+            LOGGER.info(f"Recalibration                      : {calibration.describe()}")
+        return calibration
+
+    def search_space(self, observed: np.ndarray) -> pd.DataFrame:
+        """Build the candidate structures (the "master frame") that observed masses are matched against.
+
+        Library structures, multimers and modified structures are only kept if they match at least one of the
+        observed masses. With an expanded search space, the candidates are picked out of it instead, leaving out those
+        that can't match anything.
+
+        Parameters
+        ----------
+        observed : np.ndarray
+            Observed masses of a sample, sorted in ascending order.
+
+        Returns
+        -------
+        pd.DataFrame
+            Candidate structures and their theoretical masses.
+        """
+        if self._expanded_search_space is not None:
+            LOGGER.info("Filtering the expanded search space by observed masses")
+            return self._expanded_search_space.filter(observed, self._ppm_tolerance)
+
+        obs_monomers_df = self._observed_monomers(observed)
+        obs_theo_df = self._with_multimers(obs_monomers_df, observed)
+        return self._with_modifications(obs_theo_df, observed)
+
+    def _observed_monomers(self, observed: np.ndarray) -> pd.DataFrame:
+        LOGGER.info("Filtering theoretical masses by observed masses")
+        if self._engine == "reference":
+            return reference.filtered_theo(pd.DataFrame({"Obs (Da)": observed}), self._library, self._ppm_tolerance)
+        matched = window_hits(observed, *self._library_windows)
+        return _observed_structures(self._library, self._library_rounded, matched)
+
+    def _with_multimers(self, obs_monomers_df: pd.DataFrame, observed: np.ndarray) -> pd.DataFrame:
+        def build_multimers(mod):
+            if self._max_multimer is not None:
+                LOGGER.info(f"Searching for multimers of up to {self._max_multimer} obs muropeptides")
+                return multimer_search(obs_monomers_df, mod, self._max_multimer, observed, self._ppm_tolerance)
+            LOGGER.info("Building multimers from obs muropeptides")
+            if self._engine == "reference":
+                theo_multimers_df = reference.multimer_builder(obs_monomers_df, mod)
+                LOGGER.info("Filtering theoretical multimers by observed")
+                observed_df = pd.DataFrame({"Obs (Da)": observed})
+                return reference.filtered_theo(observed_df, theo_multimers_df, self._ppm_tolerance)
+            theo_multimers_df = multimer_builder(obs_monomers_df, mod)
+            LOGGER.info("Filtering theoretical multimers by observed")
+            theo_multimers_df = theo_multimers_df.astype({"Theo (Da)": float})
+            masses = theo_multimers_df["Theo (Da)"].to_numpy()
+            rounded = np.array([round(m, 4) for m in masses], dtype=float)
+            hits = window_hits(observed, *ppm_windows(masses, self._ppm_tolerance))
+            return _observed_structures(theo_multimers_df, rounded, hits)
+
+        return pd.concat([obs_monomers_df, *(build_multimers(mod) for mod in self._multimer_mods)])
+
+    def _with_modifications(self, obs_theo_df: pd.DataFrame, observed: np.ndarray) -> pd.DataFrame:
+        def apply_modification(mod):
+            LOGGER.info(f"Generating {mod} variants")
+            if self._engine == "reference":
+                return reference.modification_generator(obs_theo_df, mod)
+            return modification_generator(obs_theo_df, mod)
+
+        LOGGER.info("Building custom search file")
+        if self._max_modifications is not None:
+            LOGGER.info(f"Searching for structures with up to {self._max_modifications} modifications")
+            modified_df = modification_search(
+                obs_theo_df, self._other_mods, self._max_modifications, observed, self._ppm_tolerance
+            )
+            master_frame = pd.concat([obs_theo_df, modified_df])
+        else:
+            master_frame = pd.concat(
+                [
+                    obs_theo_df,
+                    *(apply_modification(mod) for mod in self._other_mods),
+                ]
+            )
+
+        return master_frame.astype({"Theo (Da)": float})
+
+    def _match(self, raw_data_df: pd.DataFrame, master_frame: pd.DataFrame) -> pd.DataFrame:
+        """Vectorised equivalent of ``matching()``.
+
+        Rather than a copy of the structure's name on every matched row, structures are stored as categorical codes
+        into the (sorted, de-duplicated) names of the candidate structures.
+        """
+        names = master_frame["Inferred structure"].to_numpy(dtype=object)
+        REGISTRY.inc("pgfinder_candidates_total", len(master_frame))
+        if self._engine == "reference":
+            matches_df = reference.matching(raw_data_df, master_frame, self._ppm_tolerance)
+            matches_df["Inferred structure"] = pd.Categorical(
+                matches_df["Inferred structure"], categories=np.unique(names)
+            )
+            return matches_df
+        masses = master_frame["Theo (Da)"].to_numpy(dtype=float)
+        observed = raw_data_df["Obs (Da)"].to_numpy(dtype=float)
+        # Observed masses are only looked up once for each group of isobaric candidates
+        unique_masses, isobaric = np.unique(masses, return_inverse=True)
+        candidates, positions = isobaric_matches(
+            *self._window_matches(observed, *ppm_windows(unique_masses, self._ppm_tolerance)), isobaric
+        )
+        unmatched = ~raw_data_df.index.isin(raw_data_df.index[positions])
+        return _matches(raw_data_df, names, masses, candidates, positions, unmatched)
+
+    def _match_joint(self, stacked_df: pd.DataFrame, search_spaces: List[pd.DataFrame]) -> pd.DataFrame:
+        """Match the stacked features of several samples, each against the search space of its own sample."""
+        names = np.concatenate([s["Inferred structure"].to_numpy(dtype=object) for s in search_spaces])
+        masses = np.concatenate([s["Theo (Da)"].to_numpy(dtype=float) for s in search_spaces])
+        candidate_samples = np.repeat(np.arange(len(search_spaces)), [len(s) for s in search_spaces])
+        observed = stacked_df["Obs (Da)"].to_numpy(dtype=float)
+        REGISTRY.inc("pgfinder_candidates_total", len(masses))
+        # Observed masses are only looked up once for each group of isobaric candidates of the same sample
+        by_mass = np.lexsort((masses, candidate_samples))
+        first = np.ones(len(masses), dtype=bool)
+        first[1:] = (np.diff(masses[by_mass]) != 0) | (np.diff(candidate_samples[by_mass]) != 0)
+        isobaric = np.empty(len(masses), dtype=np.intp)
+        isobaric[by_mass] = np.cumsum(first) - 1
+        unique = by_mass[first]
+        windows = ppm_windows(masses[unique], self._ppm_tolerance)
+        candidates, positions = isobaric_matches(
+            *grouped_window_matches(observed, stacked_df[SAMPLE].to_numpy(), *windows, candidate_samples[unique]),
+            isobaric,
+        )
+        unmatched = np.bincount(positions, minlength=len(stacked_df)) == 0
+        return _matches(stacked_df, names, masses, candidates, positions, unmatched)
+
+    def analyze_many(self, raw_data_dfs: Iterable[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+        """Analyse several samples with the same settings, lazily yielding results in order.
+
+        Parameters
+        ----------
+        raw_data_dfs : Iterable[pd.DataFrame]
+            User data, one Pandas DataFrame per sample.
+
+        Returns
+        -------
+        Iterator[pd.DataFrame]
+            Results for each sample, in the order the samples were supplied.
+        """
+        for raw_data_df in raw_data_dfs:
+            yield self.analyze(raw_data_df)
+
+    def analyze_joint(
+        self, raw_data_dfs: Iterable[pd.DataFrame], return_errors: bool = False
+    ) -> List[Union[pd.DataFrame, UserError]]:
+        """Analyse several samples together, matching and consolidating their stacked features in one go.
+
+        Each sample is filtered and recalibrated on its own, then the feature tables are stacked with a sample key
+        and matched, cleaned up and consolidated together, so that the fixed costs of each stage are paid once rather
+        than once per sample. Candidates are only matched to the features of the sample whose search space they are
+        in, adducts are only consolidated with parents of the same sample, and ambiguous matches are grouped by sample
+        and ID. Unless ``max_multimer`` or ``max_modifications`` are set, the library is expanded once (if it hasn't
+        been already, see ``expand_search_space()``) and each sample's search space picked out of it. The stacked
+        results are then split back into those ``analyze()`` would give each sample.
+
+        Parameters
+        ----------
+        raw_data_dfs : Iterable[pd.DataFrame]
+            User data, one Pandas DataFrame per sample.
+        return_errors : bool
+            Return the ``UserError`` of any sample that can't be analysed (such as one with no matches) in place of its
+            results, and analyse the other samples, rather than raising it.
+
+        Returns
+        -------
+        List[Union[pd.DataFrame, UserError]]
+            Results for each sample, in the order the samples were supplied.
+
+        Raises
+        ------
+        UserError
+            If a sample can't be analysed and ``return_errors`` isn't set, naming the file the sample was read from.
+
+        Notes
+        -----
+        Every sample is held in memory at once, which suits many small samples; use ``analyze_many()`` for larger
+        ones. The ``reference`` engine analyses the samples one at a time.
+        """
+        raw_data_dfs = list(raw_data_dfs)
+        results = [None] * len(raw_data_dfs)
+
+        def sample_failed(index: int, error: UserError) -> None:
+            named_error = UserError(f"Analysing '{raw_data_dfs[index].attrs['file']}' failed: {error}")
+            if not return_errors:
+                raise named_error from error
+            results[index] = named_error
+
+        if self._engine == "reference" or len(raw_data_dfs) < 2:
+            for index, raw_data_df in enumerate(raw_data_dfs):
+                try:
+                    results[index] = self.analyze(raw_data_df)
+                except UserError as e:
+                    sample_failed(index, e)
+            return results
+        start = time.perf_counter()
+        # Samples that can't be prepared, or whose search spaces are empty, are left out of the joint analysis
+        prepared = {}
+        for index, raw_data_df in enumerate(raw_data_dfs):
+            try:
+                prepared[index] = self._prepare(raw_data_df)
+            except UserError as e:
+                sample_failed(index, e)
+        search_spaces = {}
+        expanded_search_space = self._joint_expanded_search_space() if prepared else None
+        for index, (raw_data_df, _, _) in prepared.items():
+            try:
+                search_spaces[index] = self._sample_search_space(expanded_search_space, sorted_observed(raw_data_df))
+            except UserError as e:
+                sample_failed(index, e)
+        if not search_spaces:
+            return results
+        indices = list(search_spaces)
+        samples = [prepared[index] for index in indices]
+        search_spaces = [search_spaces[index] for index in indices]
+        LOGGER.info(f"Analysing {len(samples)} samples together")
+        # Stacking the samples widens any columns whose dtypes differ, which are narrowed again for each sample
+        dtypes = [raw_data_df.dtypes.drop(["Inferred structure", "Theo (Da)"]) for raw_data_df, _, _ in samples]
+        stacked_df = pd.concat([raw_data_df for raw_data_df, _, _ in samples])
+        stacked_df[SAMPLE] = np.repeat(np.arange(len(samples)), [len(raw_data_df) for raw_data_df, _, _ in samples])
+        widened = [not dtypes[sample].equals(stacked_df.dtypes[dtypes[sample].index]) for sample in range(len(samples))]
+
+        structures = {}
+
+        def clean_up_stage(name, mass):
+            def run(df):
+                if "table" not in structures:
+                    structures["table"] = StructureTable(df["Inferred structure"].cat.categories)
+                # Adducts are consolidated with parents of the same sample, in the dtypes that sample was read with
+                return pd.concat(
+                    self._clean_up(
+                        sample_df.astype(dtypes[sample]) if widened[sample] else sample_df,
+                        mass,
+                        self._rt_window,
+                        structures=structures["table"],
+                    ).assign(**{SAMPLE: sample})
+                    for sample, sample_df in df.drop(columns=SAMPLE).groupby(df[SAMPLE].to_numpy(), sort=True)
+                )
+
+            return Stage(name, {}, run)
+
+        results_df = run_stages(
+            [
+                Stage("match", {}, lambda _: self._match_joint(stacked_df, search_spaces)),
+                Stage("ppm_delta", {}, lambda df: calculate_ppm_delta(df=df)),
+                clean_up_stage("clean_up_sodium", SODIUM),
+                clean_up_stage("clean_up_potassium", POTASSIUM),
+                clean_up_stage("clean_up_sugar", SUGAR),
+                Stage("consolidation", {}, self._consolidate_joint),
+            ]
+        )
+
+        sample_of = results_df[SAMPLE].to_numpy()
+        for sample, (raw_data_df, dropped_df, calibration) in enumerate(samples):
+            sample_df = results_df[sample_of == sample].drop(columns=SAMPLE).reset_index(drop=True)
+            sample_df = sample_df.astype(dtypes[sample])
+            # Consolidation keeps the dtype of the intensities when every feature matched a single structure
+            if sample_df["Inferred structure"].notna().all() and not sample_df["ID"].duplicated().any():
+                sample_df["Intensity (consolidated)"] = sample_df["Intensity (consolidated)"].astype(
+                    sample_df["Intensity"].dtype
+                )
+            sample_df.attrs = dict(raw_data_df.attrs)
+            self._set_metadata(sample_df, raw_data_df.attrs["file"], calibration)
+            results[indices[sample]] = self._record(raw_data_df, sample_df, dropped_df)
+        REGISTRY.observe("pgfinder_analysis_duration_seconds", time.perf_counter() - start)
+        return results
+
+    def _joint_expanded_search_space(self) -> Optional[ExpandedSearchSpace]:
+        """The expanded search space to pick the search spaces of several samples out of, where there can be one."""
+        if self._expanded_search_space is None and self._max_multimer is None and self._max_modifications is None:
+            # Expanding the whole library costs about as much as building the search spaces of a few samples
+            LOGGER.info("Expanding the search space once for every sample")
+            return self.expand_search_space()
+        return self._expanded_search_space
+
+    def _sample_search_space(
+        self, expanded_search_space: Optional[ExpandedSearchSpace], observed: np.ndarray
+    ) -> pd.DataFrame:
+        """The search space of one of several samples, picked out of the expanded search space if there is one."""
+        if expanded_search_space is None:
+            return self.search_space(observed)
+        return expanded_search_space.filter(observed, self._ppm_tolerance)
+
+    def _consolidate_joint(self, cleaned_data_df: pd.DataFrame) -> pd.DataFrame:
+        """Consolidate the stacked features of several samples, as ``_consolidate()`` does those of each sample."""
+        cleaned_data_df.sort_values(
+            by=[SAMPLE, "Intensity", "RT (min)"], ascending=[True, False, True], inplace=True, kind="stable"
+        )
+        cleaned_data_df.reset_index(drop=True, inplace=True)
+        # Matches are grouped by feature, so features of different samples are told apart while they're consolidated
+        features, ids = pd.factorize(pd.MultiIndex.from_arrays([cleaned_data_df.pop(SAMPLE), cleaned_data_df["ID"]]))
+        cleaned_data_df["ID"] = features
+        results_df = self._pick_most_likely_structures(cleaned_data_df, self._consolidation_ppm)
+        features = results_df["ID"].to_numpy()
+        results_df["ID"] = ids.get_level_values(1).to_numpy()[features]
+        results_df[SAMPLE] = ids.get_level_values(0).to_numpy()[features]
+        results_df["Inferred structure"] = results_df["Inferred structure"].astype(object)
+        return results_df
+
+
+def _matches(
+    raw_data_df: pd.DataFrame,
+    names: np.ndarray,
+    masses: np.ndarray,
+    candidates: np.ndarray,
+    positions: np.ndarray,
+    unmatched: np.ndarray,
+) -> pd.DataFrame:
+    """Matched rows of features followed by the unmatched ones, with structures stored as categorical codes."""
+    categories, codes = np.unique(names, return_inverse=True)
+    matched_candidates, first_match = np.unique(candidates, return_inverse=True)
+    rounded = np.array([round(m, 4) for m in masses[matched_candidates].tolist()], dtype=float)
+
+    matches_df = raw_data_df.iloc[positions].copy()
+    matches_df["Inferred structure"] = pd.Categorical.from_codes(codes[candidates], categories=categories)
+    matches_df["Theo (Da)"] = rounded[first_match]
+    unmatched_df = raw_data_df[unmatched].copy()
+    unmatched_df["Inferred structure"] = pd.Categorical.from_codes(
+        np.full(len(unmatched_df), -1), categories=categories
+    )
+    return pd.concat([matches_df, unmatched_df])
+
+
+def _observed_structures(theo_df: pd.DataFrame, rounded: np.ndarray, hits: np.ndarray) -> pd.DataFrame:
+    """Vectorised equivalent of ``filtered_theo()`` for pre-computed window hits."""
+    filtered_df = pd.DataFrame(
+        {"Inferred structure": theo_df["Inferred structure"].to_numpy()[hits], "Theo (Da)": rounded[hits]}
+    )
+    filtered_df.drop_duplicates(inplace=True)
+
+    if filtered_df.empty:
+        raise UserError("No matches were found for this search. Please check your database or increase mass tolerance.")
+
+    return filtered_df
@@ -0,0 +1,304 @@
+"""On-disk checkpoints of the stages of an analysis, so that interrupted or re-configured runs resume part way.
+
+``Analyzer.analyze()`` runs an analysis as a chain of stages — the observed-monomer filter, multimer expansion,
+modification expansion, matching, the ppm delta, each clean-up and consolidation — after the feature table has been
+read (ingested). Each stage is keyed by a hash of the key of the stage before it and of the settings it uses itself,
+the first by hashes of the feature table and library and by the pgfinder release, so that checkpoints of older
+releases are never reused. With a ``CheckpointStore`` the output of each stage is saved under its key, and a re-run
+starts after the last stage with a saved output: after a crash it picks up where the run stopped, and after changing
+only ``consolidation_ppm`` (or ``rt_window``) it redoes just consolidation (or the clean-up and consolidation).
+
+Each checkpoint is an uncompressed NumPy ``.npz`` archive of a DataFrame's columns:
+
+==================  ==================================================================================
+Array               Contents
+==================  ==================================================================================
+``metadata``        UTF-8 JSON of the stage, its key, the DataFrame's attrs and each column's name and dtype
+``index``           Index values (absent for a ``RangeIndex``, which is kept in the metadata)
+``values_<i>``      Values of numeric column ``i``
+``codes_<i>``       Category codes of categorical and text column ``i`` (-1 for missing values)
+``categories_<i>``  Categories of a categorical column with numeric categories
+``offsets_<i>``     ``uint64`` offsets of each text category in ``text_<i>``
+``text_<i>``        UTF-8 text categories, concatenated
+==================  ==================================================================================
+
+Checkpoints are written to a temporary file and then moved into place, so a run killed mid-write never leaves a
+truncated checkpoint behind; any that can't be read are ignored and their stage is run again.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.metrics import REGISTRY
+from pgfinder.pgio import ms_file_reader
+from pgfinder.prefilter import FeatureFilter
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+FORMAT = "pgfinder checkpoint"
+FORMAT_VERSION = 1
+SUFFIX = ".npz"
+INGEST = "ingest"
+
+
+class Stage(NamedTuple):
+    """A stage of an analysis, run on the output of the stage before it."""
+
+    name: str
+    settings: Dict
+    run: Callable[[pd.DataFrame], pd.DataFrame]
+
+
+class CheckpointStore:
+    """A directory of stage checkpoints.
+
+    Parameters
+    ----------
+    directory : Union[str, Path]
+        Directory to keep checkpoints in, created if it doesn't exist.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, stage: str, key: str) -> Path:
+        """File of the checkpoint of a stage."""
+        return self.directory / f"{stage}-{key[:32]}{SUFFIX}"
+
+    def load(self, stage: str, key: str) -> Optional[pd.DataFrame]:
+        """The saved output of a stage, or ``None`` if there is no (readable) checkpoint of it."""
+        file = self.path(stage, key)
+        if not file.is_file():
+            return None
+        try:
+            df = read_checkpoint(file)
+            if df.attrs.pop("checkpoint_key", None) != key:
+                raise ValueError
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            LOGGER.warning(f"Ignoring the unreadable checkpoint {file.name} ({e.__class__.__name__})")
+            return None
+        LOGGER.info(f"Resuming after stage               : {stage}")
+        return df
+
+    def save(self, stage: str, key: str, df: pd.DataFrame) -> Path:
+        """Save the output of a stage."""
+        file = self.path(stage, key)
+        handle, temporary = tempfile.mkstemp(dir=self.directory, prefix=f".{stage}-", suffix=SUFFIX)
+        try:
+            with os.fdopen(handle, "wb") as f:
+                write_checkpoint(df, f, stage, key)
+            os.replace(temporary, file)
+        except BaseException:
+            Path(temporary).unlink(missing_ok=True)
+            raise
+        return file
+
+
+def run_stages(stages: List[Stage], key: str = None, checkpoints: CheckpointStore = None) -> pd.DataFrame:
+    """Run a chain of stages, starting after the last one with a checkpoint and saving the output of the rest.
+
+    Parameters
+    ----------
+    stages : List[Stage]
+        Stages to run in order; the first is given ``None``.
+    key : str
+        Key of the inputs of the first stage, needed with ``checkpoints``.
+    checkpoints : CheckpointStore
+        Where to look for and save checkpoints, if anywhere.
+
+    Returns
+    -------
+    pd.DataFrame
+        Output of the last stage.
+    """
+    df = None
+    if checkpoints is None:
+        for stage in stages:
+            df = _run_stage(stage, df)
+        return df
+
+    keys = []
+    for stage in stages:
+        key = hash_settings(key, stage.name, stage.settings)
+        keys.append(key)
+    start = 0
+    for i in reversed(range(len(stages))):
+        df = checkpoints.load(stages[i].name, keys[i])
+        if df is not None:
+            start = i + 1
+            break
+    for stage, key in zip(stages[start:], keys[start:]):
+        df = _run_stage(stage, df)
+        checkpoints.save(stage.name, key, df)
+    return df
+
+
+def _run_stage(stage: Stage, df: pd.DataFrame) -> pd.DataFrame:
+    start = time.perf_counter()
+    df = stage.run(df)
+    REGISTRY.observe("pgfinder_stage_duration_seconds", time.perf_counter() - start, stage=stage.name)
+    return df
+
+
+def ingest(
+    file: Union[str, Path], checkpoints: CheckpointStore = None, feature_filter: FeatureFilter = None
+) -> pd.DataFrame:
+    """Read a mass spec file, or its checkpoint if it has been read before.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Mass spec file, as read by ``ms_file_reader()``.
+    checkpoints : CheckpointStore
+        Where to look for and save the checkpoint, if anywhere.
+    feature_filter : FeatureFilter
+        Only read the features that pass this filter.
+
+    Returns
+    -------
+    pd.DataFrame
+        The feature table.
+    """
+    if checkpoints is None:
+        return ms_file_reader(file, feature_filter)
+    settings = {"file": Path(file).name}
+    if feature_filter is not None:
+        settings["feature_filter"] = feature_filter
+    stage = Stage(INGEST, settings, lambda _: ms_file_reader(file, feature_filter))
+    return run_stages([stage], hash_file(file), checkpoints)
+
+
+def hash_settings(key: str, stage: str, settings: Dict) -> str:
+    """Key of a stage, from the key of its inputs and its own settings."""
+    encoded = json.dumps([key, stage, settings], sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def hash_frame(df: pd.DataFrame) -> str:
+    """Hash of the contents, index, columns, dtypes and attrs of a DataFrame."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps([list(map(str, df.columns)), list(map(str, df.dtypes))]).encode("utf-8"))
+    digest.update(json.dumps(df.attrs, sort_keys=True, default=str).encode("utf-8"))
+    digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def hash_file(file: Union[str, Path], block_size: int = 1 << 20) -> str:
+    """Hash of the contents of a file."""
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_checkpoint(df: pd.DataFrame, file, stage: str, key: str) -> None:
+    """Write a DataFrame as a checkpoint (see the module documentation for the layout).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Output of the stage.
+    file
+        File, or open binary file, to write.
+    stage : str
+        Name of the stage.
+    key : str
+        Key of the stage.
+    """
+    arrays = {}
+    columns = []
+    for i, (name, column) in enumerate(df.items()):
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            categories = column.cat.categories
+            columns.append({"name": name, "kind": "categorical", "dtype": str(categories.dtype)})
+            arrays[f"codes_{i}"] = column.cat.codes.to_numpy()
+            _put_categories(arrays, i, categories)
+        elif column.dtype == object:
+            categorical = pd.Categorical(column)
+            columns.append({"name": name, "kind": "text", "dtype": "object"})
+            arrays[f"codes_{i}"] = categorical.codes
+            _put_categories(arrays, i, categorical.categories)
+        else:
+            columns.append({"name": name, "kind": "values", "dtype": str(column.dtype)})
+            arrays[f"values_{i}"] = column.to_numpy()
+    index = None
+    if isinstance(df.index, pd.RangeIndex):
+        index = [df.index.start, df.index.stop, df.index.step]
+    else:
+        arrays["index"] = df.index.to_numpy()
+    metadata = {
+        "format": FORMAT,
+        "format_version": FORMAT_VERSION,
+        "stage": stage,
+        "key": key,
+        "attrs": df.attrs,
+        "columns": columns,
+        "range_index": index,
+    }
+    encoded = json.dumps(metadata, default=str).encode("utf-8")
+    np.savez(file, metadata=np.frombuffer(encoded, dtype=np.uint8), **arrays)
+
+
+def read_checkpoint(file: Union[str, Path]) -> pd.DataFrame:
+    """Read a checkpoint written by ``write_checkpoint()``.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Checkpoint to read.
+
+    Returns
+    -------
+    pd.DataFrame
+        The saved DataFrame, with its key in ``attrs["checkpoint_key"]``.
+    """
+    with np.load(file, allow_pickle=False) as arrays:
+        metadata = json.loads(arrays["metadata"].tobytes().decode("utf-8"))
+        if metadata.get("format") != FORMAT or metadata.get("format_version") != FORMAT_VERSION:
+            raise ValueError(f"{file} is not a checkpoint")
+        if metadata["range_index"] is not None:
+            index = pd.RangeIndex(*metadata["range_index"])
+        else:
+            index = pd.Index(arrays["index"])
+        data = {}
+        for i, column in enumerate(metadata["columns"]):
+            if column["kind"] == "values":
+                data[column["name"]] = arrays[f"values_{i}"]
+                continue
+            categories = _get_categories(arrays, i, column["dtype"])
+            values = pd.Categorical.from_codes(arrays[f"codes_{i}"], categories=categories)
+            data[column["name"]] = values.astype(object) if column["kind"] == "text" else values
+    df = pd.DataFrame(data, index=index, columns=[column["name"] for column in metadata["columns"]])
+    df.attrs = {**metadata["attrs"], "checkpoint_key": metadata["key"]}
+    return df
+
+
+def _put_categories(arrays: Dict[str, np.ndarray], i: int, categories: pd.Index) -> None:
+    if categories.dtype == object:
+        encoded = [str(category).encode("utf-8") for category in categories]
+        arrays[f"offsets_{i}"] = np.cumsum([0] + [len(e) for e in encoded], dtype=np.uint64)
+        arrays[f"text_{i}"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    else:
+        arrays[f"categories_{i}"] = categories.to_numpy()
+
+
+def _get_categories(arrays, i: int, dtype: str) -> pd.Index:
+    if f"offsets_{i}" in arrays:
+        offsets = arrays[f"offsets_{i}"].tolist()
+        blob = arrays[f"text_{i}"].tobytes()
+        return pd.Index(
+            [blob[offsets[j] : offsets[j + 1]].decode("utf-8") for j in range(len(offsets) - 1)], dtype=object
+        )
+    return pd.Index(arrays[f"categories_{i}"], dtype=dtype)
@@ -0,0 +1,483 @@
+"""Out-of-core analysis of feature tables too large to hold in memory.
+
+A file is analysed in four passes, only one of which ever holds more than a partition of features in memory:
+
+1. The retention times and observed masses of every feature are read, a chunk at a time. These are all that's needed
+   to build the search space (which depends on every observed mass) and to plan the partitions.
+2. Features are sorted into partitions by retention time and spilled to temporary files.
+3. Each partition is analysed on its own, against the search space of the whole file.
+4. The results of the partitions are merged, in the order a single in-memory analysis would have produced them, and
+   streamed to the output file.
+
+Matching only ever looks at one feature at a time, but the clean-up of salt adducts and in-source decay products
+combines features that elute within ``rt_window`` of each other and whose masses differ by one of the clean-up masses.
+Partitions are therefore only ever split between retention times where no such pair of features could straddle the
+border, so the results are exactly the same as those of ``Analyzer.analyze()``.
+
+An analyzer's feature filter is applied to the whole file while it is scanned, so only the features it keeps are
+partitioned. When the dropped features are reported, each chunk of them is spilled as a partition of unmatched rows
+of its own, to be merged in with the rest. Observed masses are likewise recalibrated against the whole file, before
+the search space is built and the partitions are planned.
+"""
+import logging
+import pickle
+import tempfile
+from decimal import Decimal
+from pathlib import Path
+from typing import Dict, Iterator, List, Sequence, Union
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from pgfinder.analyzer import POTASSIUM, SODIUM, SUGAR, Analyzer
+from pgfinder.errors import UserError
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.metrics import REGISTRY
+from pgfinder.pgio import blocks_to_csv_metadata, compact_feature_dtypes, ms_file_chunks
+from pgfinder.prefilter import FeatureFilter, as_unmatched, top_n_mask
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+# Features read from the input file at once while scanning and partitioning it
+READ_CHUNK_SIZE = 50_000
+# Rough number of copies of each feature held at once while a partition is analysed (matches, clean-up copies, ...)
+WORKING_COPIES = 12
+# Slack added to the mass tolerance of clean-up pairs, for the rounding of theoretical masses to 4 (then 5) places
+MASS_SLACK = 2e-4
+# Slack added to the RT window, for retention times stored as float32
+RT_SLACK = 1e-6
+
+RESULT_COLUMNS = [
+    "ID",
+    "RT (min)",
+    "Charge",
+    "Obs (Da)",
+    "Theo (Da)",
+    "Delta ppm",
+    "Inferred structure",
+    "Intensity",
+    "Inferred structure (consolidated)",
+    "Intensity (consolidated)",
+]
+
+
+def analyze_file(
+    analyzer: Analyzer,
+    file: Union[str, Path],
+    memory_budget: float,
+    save_filepath: Union[str, Path],
+    filename: Union[str, Path] = None,
+    float_format: str = "%.4f",
+) -> str:
+    """Analyse a mass spec file in partitions, keeping memory use within a budget, and write the results to disk.
+
+    Besides the partitions, the retention time and observed mass of every feature (16 bytes per feature) and the
+    search space are kept in memory throughout.
+
+    Parameters
+    ----------
+    analyzer : Analyzer
+        Analysis settings.
+    file : Union[str, Path]
+        Byos (.ftrs) or MaxQuant (.txt) file to analyse.
+    memory_budget : float
+        Approximate memory (in MiB) that the features of a partition, and their copies made during analysis, may take.
+        Partitions are made as large as this allows.
+    save_filepath : Union[str, Path]
+        Directory to write the results to.
+    filename : Union[str, Path]
+        Results file name.
+    float_format : str
+        Format for floating point numbers.
+
+    Returns
+    -------
+    str
+        The results file that was written.
+    """
+    if memory_budget <= 0:
+        raise UserError(f"The memory budget must be positive, but {memory_budget} MiB was given.")
+    name = Path(file).name
+    rt, observed, dtypes, feature_bytes, keep = _scan(file, analyzer.feature_filter)
+    # Whether retention times can be stored as float32 is decided for the whole file, as `ms_file_reader()` would
+    if not np.array_equal(rt.astype(np.float32).astype(np.float64), rt, equal_nan=True):
+        dtypes["RT (min)"] = np.dtype(np.float64)
+    if keep is not None:
+        LOGGER.info(f"Features kept by the filter        : {keep.sum()} of {len(keep)}")
+        REGISTRY.inc("pgfinder_features_filtered_total", len(keep) - keep.sum())
+        rt, observed = rt[keep], observed[keep]
+    calibration = None
+    if analyzer.recalibrated_ppm is not None:
+        calibration = analyzer.calibrate(pd.DataFrame({"Obs (Da)": observed, "RT (min)": rt}))
+        if calibration is not None:
+            observed = calibration.corrected(observed, rt)
+    max_rows = max(int(memory_budget * 2**20 / (feature_bytes * WORKING_COPIES)), 1)
+    LOGGER.info(f"Analysing {len(rt)} features from '{name}' in partitions of up to {max_rows} features")
+
+    search_space = analyzer.search_space(np.sort(observed))
+    borders = partition_borders(
+        rt, observed, max_rows, analyzer.rt_window, analyzer.ppm_tolerance, [SODIUM, POTASSIUM, SUGAR]
+    )
+    LOGGER.info(f"Split '{name}' into {len(borders) + 1} partitions by retention time")
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        tempdir = Path(tempdir)
+        n_dropped = _spill(file, borders, tempdir, keep, analyzer.report_filtered)
+        partitions = []
+        attrs = None
+        for partition in range(len(borders) + 1):
+            features_df = _load_partition(tempdir / f"features_{partition}.pkl", dtypes, name)
+            results_df = analyzer.analyze(features_df, search_space=search_space, calibration=calibration)
+            attrs = attrs or dict(results_df.attrs)
+            partitions.append(_store_results(results_df, partition, tempdir, max_rows))
+            del features_df, results_df
+        # Dropped features are only ever unmatched, so each chunk of them is a partition needing no analysis
+        for chunk in range(n_dropped):
+            dropped_df = as_unmatched(_load_partition(tempdir / f"dropped_{chunk}.pkl", dtypes, name))
+            partitions.append(_store_results(dropped_df, len(partitions), tempdir, max_rows))
+        attrs["file"] = name
+        blocks = _merged_results(partitions, max_rows)
+        output = blocks_to_csv_metadata(blocks, attrs, save_filepath, filename, float_format=float_format)
+    LOGGER.info(f"Results of all {len(borders) + 1} partitions merged into : {output}")
+    return output
+
+
+def partition_borders(
+    rt: np.ndarray,
+    observed: np.ndarray,
+    max_rows: int,
+    rt_window: float,
+    ppm_tolerance: float,
+    clean_up_masses: Sequence[Decimal],
+) -> np.ndarray:
+    """Retention times at which to split features into partitions of at most ``max_rows`` features.
+
+    Features with retention times below the first border form the first partition, those from the first to the second
+    border the second and so on. No border separates features with the same retention time, or features that the
+    clean-up could combine: those eluting within ``rt_window`` of each other and with observed masses that could match
+    theoretical masses differing by one of ``clean_up_masses``. When there's no such border within ``max_rows``
+    features a partition is made larger than that, with a warning.
+
+    Parameters
+    ----------
+    rt : np.ndarray
+        Retention time of each feature.
+    observed : np.ndarray
+        Observed mass of each feature.
+    max_rows : int
+        Most features to put in a partition.
+    rt_window : float
+        Time window used by the clean-up.
+    ppm_tolerance : float
+        The ppm tolerance used when matching the theoretical masses of structures to observed ions.
+    clean_up_masses : Sequence[Decimal]
+        Mass differences between the features combined by each clean-up.
+
+    Returns
+    -------
+    np.ndarray
+        Sorted retention times of the borders between partitions.
+    """
+    order = np.argsort(rt, kind="stable")
+    rts = np.asarray(rt, dtype=float)[order]
+    masses = np.asarray(observed, dtype=float)[order]
+    if len(rts) <= max_rows:
+        return np.empty(0)
+
+    safe = np.flatnonzero(_safe_borders(rts, masses, rt_window, ppm_tolerance, clean_up_masses))
+
+    borders = []
+    start = 0
+    while len(rts) - start > max_rows:
+        # The last safe border that keeps the partition within budget, or failing that the first one after it
+        candidates = safe[(safe >= start) & (safe < start + max_rows)]
+        if len(candidates):
+            end = int(candidates[-1])
+        else:
+            later = safe[safe >= start]
+            if not len(later):
+                LOGGER.warning(f"The last {len(rts) - start} features can't be split without changing the results")
+                break
+            end = int(later[0])
+            LOGGER.warning(
+                f"A partition of {end + 1 - start} features exceeds the memory budget, as it can't be split without "
+                "changing the results"
+            )
+        borders.append(rts[end + 1])
+        start = end + 1
+    return np.array(borders, dtype=float)
+
+
+def clean_up_components(
+    rt: np.ndarray,
+    observed: np.ndarray,
+    rt_window: float,
+    ppm_tolerance: float,
+    clean_up_masses: Sequence[Decimal],
+) -> np.ndarray:
+    """Label features by the smallest retention time ranges that the clean-up never combines features across.
+
+    Ranges are split wherever ``partition_borders()`` could split them, so each range can be analysed on its own (or
+    together with any other ranges) with exactly the results it has in an analysis of all of the features.
+
+    Parameters
+    ----------
+    rt : np.ndarray
+        Retention time of each feature.
+    observed : np.ndarray
+        Observed mass of each feature.
+    rt_window : float
+        Time window used by the clean-up.
+    ppm_tolerance : float
+        The ppm tolerance used when matching the theoretical masses of structures to observed ions.
+    clean_up_masses : Sequence[Decimal]
+        Mass differences between the features combined by each clean-up.
+
+    Returns
+    -------
+    np.ndarray
+        The range of each feature, numbered from 0 in order of retention time.
+    """
+    order = np.argsort(rt, kind="stable")
+    rts = np.asarray(rt, dtype=float)[order]
+    masses = np.asarray(observed, dtype=float)[order]
+    labels = np.empty(len(rts), dtype=np.int64)
+    safe = _safe_borders(rts, masses, rt_window, ppm_tolerance, clean_up_masses)
+    labels[order] = np.concatenate([[0], np.cumsum(safe)])[: len(rts)]
+    return labels
+
+
+def _safe_borders(
+    rts: np.ndarray, masses: np.ndarray, rt_window: float, ppm_tolerance: float, clean_up_masses: Sequence[Decimal]
+) -> np.ndarray:
+    """For features sorted by RT, whether a border may be placed between each feature and the next."""
+    # For each feature (in RT order) the earliest feature it could be combined with, so that every border in between
+    # must be avoided
+    partner = _earliest_partners(rts, masses, rt_window + RT_SLACK, ppm_tolerance, clean_up_masses)
+    # The border after position p separates the features up to p from those after it
+    reach = np.minimum.accumulate(partner[::-1])[::-1]
+    return (reach[1:] > np.arange(len(rts) - 1)) & (rts[1:] > rts[:-1])
+
+
+def _earliest_partners(
+    rts: np.ndarray,
+    masses: np.ndarray,
+    rt_window: float,
+    ppm_tolerance: float,
+    clean_up_masses: Sequence[Decimal],
+    block_size: int = 4096,
+) -> np.ndarray:
+    """For features sorted by RT, the position of the earliest feature each could be combined with by the clean-up.
+
+    Features without any partner are their own partner.
+    """
+    deltas = np.array([float(m) for m in clean_up_masses], dtype=float)
+    deltas = np.concatenate([deltas, -deltas])
+    # Theoretical masses lie within the ppm tolerance of the observed masses they match
+    tolerance = masses * ppm_tolerance / (1000000 - ppm_tolerance)
+    partner = np.arange(len(rts))
+    for start in range(0, len(rts), block_size):
+        stop = min(start + block_size, len(rts))
+        context = int(np.searchsorted(rts, rts[start] - rt_window, side="left"))
+        by_mass = np.argsort(masses[context:stop], kind="stable")
+        context_masses = masses[context:stop][by_mass]
+        widest = tolerance[context:stop].max() * 2 + MASS_SLACK
+        features = np.arange(start, stop)
+        for delta in deltas:
+            targets = masses[features] - delta
+            lower = np.searchsorted(context_masses, targets - widest, side="left")
+            counts = np.searchsorted(context_masses, targets + widest, side="right") - lower
+            pairs = np.repeat(features, counts)
+            offsets = np.arange(len(pairs)) - np.repeat(np.cumsum(counts) - counts, counts)
+            others = context + by_mass[np.repeat(lower, counts) + offsets]
+            close = (
+                (others < pairs)
+                & (rts[pairs] - rts[others] <= rt_window)
+                & (np.abs(masses[pairs] - masses[others] - delta) <= tolerance[pairs] + tolerance[others] + MASS_SLACK)
+            )
+            np.minimum.at(partner, pairs[close], others[close])
+    return partner
+
+
+def _scan(file: Union[str, Path], feature_filter: FeatureFilter = None):
+    """Read the retention times and observed masses of every feature, the dtypes of each column and what's kept."""
+    rts, masses, chunk_dtypes, keeps, intensities = [], [], [], [], []
+    feature_bytes = None
+    for chunk in ms_file_chunks(file, READ_CHUNK_SIZE):
+        rts.append(chunk["RT (min)"].to_numpy(dtype=float))
+        masses.append(chunk["Obs (Da)"].to_numpy(dtype=float))
+        chunk_dtypes.append(chunk.dtypes)
+        if feature_filter is not None:
+            keeps.append(feature_filter.row_mask(chunk))
+            if feature_filter.top_n is not None:
+                intensities.append(chunk["Intensity"].to_numpy(dtype=float))
+        if feature_bytes is None and len(chunk):
+            feature_bytes = compact_feature_dtypes(chunk).memory_usage(deep=True).sum() / len(chunk)
+    if not chunk_dtypes:
+        raise UserError(f"No features were found in '{Path(file).name}'.")
+    dtypes = {column: _common_dtype([d[column] for d in chunk_dtypes]) for column in chunk_dtypes[0].index}
+    keep = None
+    if feature_filter is not None:
+        keep = np.concatenate(keeps)
+        if feature_filter.top_n is not None:
+            keep = top_n_mask(np.concatenate(intensities), keep, feature_filter.top_n)
+    return np.concatenate(rts), np.concatenate(masses), dtypes, feature_bytes or 1.0, keep
+
+
+def _common_dtype(dtypes: List[np.dtype]):
+    """The dtype that pandas would have inferred for a column had it been read in one go."""
+    if all(dtype == dtypes[0] for dtype in dtypes):
+        return dtypes[0]
+    if all(is_numeric_dtype(dtype) for dtype in dtypes):
+        return np.result_type(*dtypes)
+    return np.dtype(object)
+
+
+def _spill(
+    file: Union[str, Path], borders: np.ndarray, tempdir: Path, keep: np.ndarray = None, report_dropped: bool = False
+) -> int:
+    """Sort the features of a file into partitions, appending each to its own temporary file.
+
+    Features that aren't kept are left out or, when they are reported, spilled to a file per chunk. Returns the
+    number of those files.
+    """
+    n_dropped = 0
+    for chunk in ms_file_chunks(file, READ_CHUNK_SIZE):
+        if keep is not None:
+            chunk_keep = keep[chunk.index]
+            if report_dropped and not chunk_keep.all():
+                with (tempdir / f"dropped_{n_dropped}.pkl").open("wb") as f:
+                    pickle.dump(chunk[~chunk_keep], f, protocol=pickle.HIGHEST_PROTOCOL)
+                n_dropped += 1
+            chunk = chunk[chunk_keep]
+        partitions = np.searchsorted(borders, chunk["RT (min)"].to_numpy(dtype=float), side="right")
+        for partition, features_df in chunk.groupby(partitions, sort=False):
+            with (tempdir / f"features_{partition}.pkl").open("ab") as f:
+                pickle.dump(features_df, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return n_dropped
+
+
+def _load_partition(file: Path, dtypes: Dict, name: str) -> pd.DataFrame:
+    """Read a partition of features back, in the order they appear in the file."""
+    chunks = list(_unpickle(file)) if file.exists() else []
+    features_df = pd.concat(chunks) if chunks else pd.DataFrame({c: pd.Series(dtype=d) for c, d in dtypes.items()})
+    features_df = features_df.sort_index(kind="stable").astype(dtypes)
+    features_df = compact_feature_dtypes(features_df).astype({"RT (min)": dtypes["RT (min)"]})
+    features_df.attrs["file"] = name
+    return features_df
+
+
+def _unpickle(file: Path) -> Iterator:
+    """Every object pickled, one after the other, into a file."""
+    with file.open("rb") as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def _store_results(results_df: pd.DataFrame, partition: int, tempdir: Path, block_size: int) -> Dict:
+    """Spill the results of a partition to disk in blocks, keeping only the keys needed to merge them.
+
+    The results of a partition are groups of rows, one per matched feature, followed by the unmatched rows (each a
+    group of its own). In the results of the whole file the groups are ordered by the intensity and retention time of
+    their first row (matched before unmatched), just as they are within each partition.
+    """
+    results_df = results_df.reindex(columns=RESULT_COLUMNS)
+    file = tempdir / f"results_{partition}.pkl"
+    with file.open("wb") as f:
+        for start in range(0, len(results_df), block_size):
+            pickle.dump(results_df.iloc[start : start + block_size], f, protocol=pickle.HIGHEST_PROTOCOL)
+    return {"file": file, **result_groups(results_df)}
+
+
+def result_groups(results_df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    """The keys that results are ordered by, for each group of rows belonging to the same matched feature.
+
+    Each matched feature's rows are together, and every unmatched row is a group on its own. Groups are ordered by
+    whether they're unmatched, then by the highest known intensity and the retention time of their first row.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        Whether each group is ``unmatched``, and its ``intensity``, ``rt`` and number of rows (``sizes``).
+    """
+    unmatched = results_df["Inferred structure"].isna().to_numpy()
+    ids = results_df["ID"].to_numpy()
+    starts = np.flatnonzero(np.concatenate([[True], unmatched[1:] | unmatched[:-1] | (ids[1:] != ids[:-1])]))
+    starts = starts[starts < len(results_df)]
+    # Sorting puts missing intensities last, so a group is placed by its highest known intensity
+    intensity = np.fmax.reduceat(results_df["Intensity"].to_numpy(dtype=float), starts) if len(starts) else []
+    return {
+        "unmatched": unmatched[starts],
+        "intensity": np.asarray(intensity, dtype=float),
+        "rt": results_df["RT (min)"].to_numpy(dtype=float)[starts],
+        "sizes": np.diff(np.append(starts, len(results_df))),
+    }
+
+
+def _merged_results(partitions: List[Dict], block_size: int) -> Iterator[pd.DataFrame]:
+    """Merge the results of the partitions, yielding blocks of (about) ``block_size`` rows.
+
+    Partitions never share a retention time, so ordering every group by (matched first, intensity, retention time)
+    and then by partition and position gives exactly the order of an analysis of the whole file.
+    """
+    partition = np.concatenate([np.full(len(p["sizes"]), i) for i, p in enumerate(partitions)])
+    position = np.concatenate([np.arange(len(p["sizes"])) for p in partitions])
+    unmatched = np.concatenate([p["unmatched"] for p in partitions])
+    intensity = np.concatenate([p["intensity"] for p in partitions])
+    rt = np.concatenate([p["rt"] for p in partitions])
+    sizes = np.concatenate([p["sizes"] for p in partitions])
+    order = np.lexsort((position, partition, rt, -intensity, unmatched))
+
+    readers = [_BlockReader(p["file"]) for p in partitions]
+    cumulative_rows = np.cumsum(sizes[order])
+    start = 0
+    while start < len(order):
+        done = cumulative_rows[start] - sizes[order[start]]
+        stop = max(int(np.searchsorted(cumulative_rows, done + block_size, side="right")), start + 1)
+        groups = order[start:stop]
+        # Rows are taken from each partition in order, then interleaved
+        taken = {
+            i: readers[i].take(int(sizes[groups][partition[groups] == i].sum())) for i in np.unique(partition[groups])
+        }
+        block_df = pd.concat(taken.values(), ignore_index=True)
+        offsets = dict(zip(taken, np.cumsum([0] + [len(df) for df in taken.values()])[:-1]))
+        group_sizes = sizes[groups]
+        group_starts = np.empty(len(groups), dtype=np.int64)
+        for i in taken:
+            mine = partition[groups] == i
+            group_starts[mine] = offsets[i] + np.cumsum(group_sizes[mine]) - group_sizes[mine]
+        rows = np.repeat(group_starts, group_sizes) + (
+            np.arange(group_sizes.sum()) - np.repeat(np.cumsum(group_sizes) - group_sizes, group_sizes)
+        )
+        yield block_df.iloc[rows]
+        start = stop
+
+
+class _BlockReader:
+    """Reads the rows of a spilled results file in order, however many are asked for at a time.
+
+    The file is only opened while a block is read, so merging many partitions doesn't hold many files open.
+    """
+
+    def __init__(self, file: Path):
+        self._file = file
+        self._offset = 0
+        self._buffer = None
+
+    def take(self, n: int) -> pd.DataFrame:
+        """The next ``n`` rows."""
+        parts = []
+        while n > 0:
+            if self._buffer is None or self._buffer.empty:
+                with self._file.open("rb") as f:
+                    f.seek(self._offset)
+                    self._buffer = pickle.load(f)
+                    self._offset = f.tell()
+            parts.append(self._buffer.iloc[:n])
+            n -= len(parts[-1])
+            self._buffer = self._buffer.iloc[len(parts[-1]) :]
+        return pd.concat(parts) if parts else pd.DataFrame(columns=RESULT_COLUMNS)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""The `pgfinder` command and its sub-commands."""
+import argparse as arg
+import logging
+from typing import List
+
+from pgfinder.abundance import LAYOUTS, AbundanceMatrix
+from pgfinder.errors import UserError
+from pgfinder.library_builder import build_library
+from pgfinder.logs.logs import LOGGER_NAME, setup_logger
+from pgfinder.pgio import results_reader
+from pgfinder.serve import serve
+
+LOGGER = setup_logger()
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+
+def create_parser() -> arg.ArgumentParser:
+    """Create a parser for the `pgfinder` command and its sub-commands."""
+    parser = arg.ArgumentParser(description="PGFinder tools. Use `find_pg` to analyse a single file.")
+    parser.add_argument(
+        "--log_file",
+        dest="log_file",
+        type=str,
+        help="File to also write the log to; {pid} in the name is replaced by the process ID.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser("serve", help="Run a local analysis service that keeps mass libraries warm.")
+    serve.add_argument("--host", dest="host", type=str, default="127.0.0.1", help="Address to listen on.")
+    serve.add_argument("--port", dest="port", type=int, default=8000, help="Port to listen on.")
+    serve.add_argument("--workers", dest="workers", type=int, default=2, help="Number of concurrent jobs.")
+    serve.add_argument(
+        "--queue_size", dest="queue_size", type=int, default=16, help="Number of jobs that can wait for a worker."
+    )
+    serve.add_argument("--masses_file", dest="masses_file", type=str, help="Default theoretical masses file.")
+    serve.add_argument(
+        "--data_dir",
+        dest="data_dirs",
+        type=str,
+        action="append",
+        help="Directory that files named by jobs must lie within; may be given more than once.",
+    )
+
+    build = subparsers.add_parser("build-library", help="Build a mass library from composition rules.")
+    build.add_argument("rules_file", type=str, help="YAML file of composition rules.")
+    build.add_argument("--csv", dest="csv_file", type=str, help="Mass library CSV to write.")
+    build.add_argument("--compiled", dest="compiled_file", type=str, help="Compiled (binary) mass library to write.")
+    build.add_argument(
+        "--mass_range", dest="mass_range", type=float, nargs=2, help="Minimum and maximum mass of structures to keep."
+    )
+    build.add_argument(
+        "--unique_masses", dest="unique_masses", action="store_true", help="Keep only the first structure of each mass."
+    )
+
+    aggregate = subparsers.add_parser(
+        "aggregate", help="Combine the results of several samples into a structure by sample abundance matrix."
+    )
+    aggregate.add_argument("results_files", type=str, nargs="+", help="Results files, one per sample.")
+    aggregate.add_argument("--output", dest="output_file", type=str, required=True, help="Abundance matrix to write.")
+    aggregate.add_argument(
+        "--rt_tolerance",
+        dest="rt_tolerance",
+        type=float,
+        help="Align features of the same structure across samples when their retention times are this close (min).",
+    )
+    aggregate.add_argument(
+        "--layout", dest="layout", choices=LAYOUTS, default="wide", help="Write a wide table or one line per cell."
+    )
+
+    return parser
+
+
+def main(args: List[str] = None):
+    """Run a `pgfinder` sub-command."""
+    args = create_parser().parse_args(args)
+    if args.log_file is not None:
+        setup_logger(log_file=args.log_file)
+    try:
+        if args.command == "serve":
+            serve(
+                host=args.host,
+                port=args.port,
+                workers=args.workers,
+                queue_size=args.queue_size,
+                masses_file=args.masses_file,
+                data_dirs=args.data_dirs,
+            )
+        elif args.command == "build-library":
+            build_library(
+                args.rules_file,
+                csv_file=args.csv_file,
+                compiled_file=args.compiled_file,
+                mass_range=args.mass_range,
+                unique_masses=args.unique_masses,
+            )
+        elif args.command == "aggregate":
+            matrix = AbundanceMatrix(rt_tolerance=args.rt_tolerance)
+            # Samples are read and added one at a time, so only the matrix itself is ever held in memory
+            for results_file in args.results_files:
+                matrix.add(results_reader(results_file))
+            matrix.write(args.output_file, layout=args.layout)
+    except UserError as e:
+        # Avoid dumping a whole stack-trace if it's the user who's done something wrong
+        LOGGER.error(e)
+
+
+if __name__ == "__main__":
+    main()
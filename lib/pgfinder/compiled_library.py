@@ -0,0 +1,422 @@
+"""Compact binary (compiled) mass libraries.
+
+A compiled library holds the same structures and masses as a mass library CSV, laid out so that it can be
+memory-mapped and used without any parsing:
+
+======================  ==================================================================================
+Section                 Contents
+======================  ==================================================================================
+Header                  ``HEADER`` struct — magic number, format version, entry count and section offsets
+Metadata                UTF-8 JSON describing where the library came from
+Masses                  ``float64[count]`` monoisotopic masses, sorted in ascending order
+Order                   ``uint64[count]`` position of each entry in the original (CSV) library
+Name offsets            ``uint64[count + 1]`` offsets of each structure name in the name blob
+Names                   UTF-8 structure names, concatenated
+======================  ==================================================================================
+
+All integers are little-endian and every section starts on an 8-byte boundary.
+
+The built-in libraries in ``masses/`` are kept as CSV, the interchange format, and compiled when the package is built
+(see ``compile_builtin_libraries()``). Their compiled copies are listed under ``Compiled`` in ``masses/index.json``
+and used in place of the CSVs whenever they are present.
+"""
+import heapq
+import json
+import mmap
+import os
+import struct
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path, PurePath
+from typing import BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from pgfinder import __version__
+from pgfinder.errors import UserError
+
+MAGIC = b"PGFLIB\r\n"
+FORMAT_VERSION = 1
+# magic, version, flags, count, metadata offset & length, masses, order and name offset offsets, names offset & length
+HEADER = struct.Struct("<8sIIQQQQQQQQ")
+ALIGNMENT = 8
+SUFFIX = ".pglib"
+MASS_LIB_DIR = Path(__file__).parent / "masses"
+INDEX_FILE = "index.json"
+
+
+class CompiledLibrary:
+    """A memory-mapped compiled mass library.
+
+    Masses, their original order and the name offsets are exposed as read-only NumPy arrays backed directly by the
+    file, so opening a library costs next to nothing and the operating system can share a single cached copy between
+    processes. Names are only decoded when they are asked for.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Compiled library to open.
+    """
+
+    def __init__(self, file: Union[str, Path]):
+        self.file = Path(file)
+        with self.file.open("rb") as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError as e:
+                raise UserError(f"The compiled mass library '{self.file.name}' is empty.") from e
+        try:
+            header = HEADER.unpack_from(self._mmap, 0)
+        except struct.error as e:
+            raise UserError(f"'{self.file.name}' is not a compiled mass library.") from e
+        magic, format_version, _, count, meta_offset, meta_length = header[:6]
+        masses_offset, order_offset, name_offsets_offset, names_offset, names_length = header[6:]
+        if magic != MAGIC:
+            raise UserError(f"'{self.file.name}' is not a compiled mass library.")
+        if format_version != FORMAT_VERSION:
+            raise UserError(
+                f"The compiled mass library '{self.file.name}' uses format version {format_version}, but this version "
+                f"of PGFinder only reads version {FORMAT_VERSION}. Please re-compile it."
+            )
+        self.metadata = json.loads(self._mmap[meta_offset : meta_offset + meta_length].decode("utf-8"))
+        self.masses = np.frombuffer(self._mmap, dtype="<f8", count=count, offset=masses_offset)
+        self.order = np.frombuffer(self._mmap, dtype="<u8", count=count, offset=order_offset)
+        self.name_offsets = np.frombuffer(self._mmap, dtype="<u8", count=count + 1, offset=name_offsets_offset)
+        self._names = memoryview(self._mmap)[names_offset : names_offset + names_length]
+
+    def __len__(self) -> int:
+        return len(self.masses)
+
+    def __enter__(self) -> "CompiledLibrary":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Release the memory-map.
+
+        If arrays taken from the library are still in use the map stays open until they have been garbage collected.
+        """
+        self.masses = self.order = self.name_offsets = None
+        self._names.release()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def name(self, i: int) -> str:
+        """Name of the i-th (mass sorted) structure."""
+        return bytes(self._names[self.name_offsets[i] : self.name_offsets[i + 1]]).decode("utf-8")
+
+    def names(self, start: int = 0, stop: int = None) -> List[str]:
+        """Names of the (mass sorted) structures from ``start`` to ``stop``."""
+        stop = len(self) if stop is None else stop
+        offsets = (self.name_offsets[start : stop + 1] - self.name_offsets[start]).tolist()
+        blob = bytes(self._names[self.name_offsets[start] : self.name_offsets[stop]])
+        if blob.isascii():
+            # Byte and character offsets are the same, so decode everything at once
+            text = blob.decode("ascii")
+            return [text[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+        return [blob[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+    def window(self, lower: float, upper: float) -> Tuple[int, int]:
+        """Index range of the structures with masses within ``[lower, upper]``."""
+        return (
+            int(np.searchsorted(self.masses, lower, side="left")),
+            int(np.searchsorted(self.masses, upper, side="right")),
+        )
+
+    def to_frame(self) -> pd.DataFrame:
+        """The library as a DataFrame in its original order, as ``theo_masses_reader()`` would return it.
+
+        Every name is decoded and the masses are copied into their original order, so the DataFrame doesn't depend on
+        the memory-map and takes as much memory as one read from a CSV.
+        """
+        original = np.argsort(self.order, kind="stable")
+        names = np.array(self.names(), dtype=object)
+        theo_masses_df = pd.DataFrame({"Inferred structure": names[original], "Theo (Da)": self.masses[original]})
+        theo_masses_df.attrs["file"] = self.metadata.get("source") or self.file.name
+        return theo_masses_df
+
+
+def compile_library(
+    theo_masses_df: pd.DataFrame, file: Union[str, Path], metadata: Dict = None, timestamp: bool = True
+) -> Union[str, Path]:
+    """Compile a mass library DataFrame (as read by ``theo_masses_reader()``).
+
+    Parameters
+    ----------
+    theo_masses_df : pd.DataFrame
+        Theoretical masses as Pandas DataFrame.
+    file : Union[str, Path]
+        Compiled library to write.
+    metadata : Dict
+        Extra metadata to store alongside the library.
+    timestamp : bool
+        Record when the library was compiled (see ``write_compiled_library()``).
+
+    Returns
+    -------
+    Union[str, Path]
+        The compiled library that was written.
+    """
+    metadata = {"source": theo_masses_df.attrs.get("file"), **(metadata or {})}
+    entries = zip(theo_masses_df["Inferred structure"], theo_masses_df["Theo (Da)"].astype(float))
+    write_compiled_library(
+        entries, file, metadata=metadata, chunk_size=max(len(theo_masses_df), 1), timestamp=timestamp
+    )
+    return file
+
+
+def write_compiled_library(
+    entries: Iterable[Tuple[str, float]],
+    file: Union[str, Path],
+    metadata: Dict = None,
+    chunk_size: int = 1_000_000,
+    timestamp: bool = True,
+) -> int:
+    """Write (structure, mass) pairs to a compiled library, streaming them so they never need to fit in memory.
+
+    Entries are sorted by mass in chunks of ``chunk_size``; if there is more than one chunk the sorted runs are kept
+    in temporary files and merged, so memory use is bounded by the chunk size rather than the size of the library.
+
+    Parameters
+    ----------
+    entries : Iterable[Tuple[str, float]]
+        Structure names and their monoisotopic masses, in their original order.
+    file : Union[str, Path]
+        Compiled library to write.
+    metadata : Dict
+        Metadata to store alongside the library.
+    chunk_size : int
+        Number of entries sorted in memory at once.
+    timestamp : bool
+        Record when the library was compiled, as ``created`` in its metadata: at ``SOURCE_DATE_EPOCH`` when that is
+        set, as by reproducible builds, otherwise now. Without it, compiling the same entries always gives the same
+        file.
+
+    Returns
+    -------
+    int
+        Number of entries written.
+    """
+    metadata = {
+        "format": "pgfinder compiled mass library",
+        **({"created": _created()} if timestamp else {}),
+        "pgfinder_version": __version__,
+        **(metadata or {}),
+    }
+    with tempfile.TemporaryDirectory() as tempdir:
+        runs = []
+        chunk = []
+        position = 0
+        for name, mass in entries:
+            chunk.append((float(mass), position, name))
+            position += 1
+            if len(chunk) >= chunk_size:
+                runs.append(_write_run(sorted(chunk), Path(tempdir) / f"run_{len(runs)}"))
+                chunk = []
+        if not runs:
+            merged = iter(sorted(chunk))
+        else:
+            if chunk:
+                runs.append(_write_run(sorted(chunk), Path(tempdir) / f"run_{len(runs)}"))
+            merged = heapq.merge(*(_read_run(run) for run in runs))
+        del chunk
+        _assemble(merged, position, Path(file), metadata, Path(tempdir))
+    return position
+
+
+def read_compiled_library(file: Union[str, Path]) -> pd.DataFrame:
+    """Read a compiled library into a DataFrame of theoretical masses.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Compiled library to read.
+
+    Returns
+    -------
+    pd.DataFrame
+        Pandas DataFrame of theoretical masses.
+    """
+    with CompiledLibrary(file) as library:
+        theo_masses_df = library.to_frame()
+    theo_masses_df.attrs["file"] = PurePath(file).name
+    return theo_masses_df
+
+
+def builtin_libraries(masses_dir: Union[str, Path] = None) -> Dict[str, Dict]:
+    """The built-in libraries listed in ``index.json``, by the name of their CSV file.
+
+    Parameters
+    ----------
+    masses_dir : Union[str, Path]
+        Directory of the built-in libraries, ``MASS_LIB_DIR`` by default.
+
+    Returns
+    -------
+    Dict[str, Dict]
+        Index entries (``File``, ``Description`` and ``Compiled``) of each library.
+    """
+    masses_dir = MASS_LIB_DIR if masses_dir is None else Path(masses_dir)
+    index = json.loads((masses_dir / INDEX_FILE).read_text(encoding="utf-8"))
+    return {library["File"]: library for species in index.values() for library in species.values()}
+
+
+def compiled_builtin_library(file: Union[str, Path]) -> Optional[Path]:
+    """The compiled copy of a built-in library CSV, if it is one and its compiled copy has been built.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Mass library CSV.
+
+    Returns
+    -------
+    Optional[Path]
+        Compiled library to read instead, or ``None`` to read the CSV.
+    """
+    file = Path(file)
+    try:
+        if file.resolve().parent != MASS_LIB_DIR.resolve():
+            return None
+        compiled = builtin_libraries().get(file.name, {}).get("Compiled")
+    except OSError:
+        return None
+    if compiled is None or not (MASS_LIB_DIR / compiled).is_file():
+        return None
+    return MASS_LIB_DIR / compiled
+
+
+def compile_builtin_libraries(masses_dir: Union[str, Path] = None, output_dir: Union[str, Path] = None) -> List[Path]:
+    """Compile each built-in library CSV listed in ``index.json`` to its ``Compiled`` file.
+
+    This is run when the package is built, so installed copies of PGFinder read the built-in libraries from their
+    compiled copies rather than parsing their CSVs.
+
+    Parameters
+    ----------
+    masses_dir : Union[str, Path]
+        Directory of the built-in libraries and their index, ``MASS_LIB_DIR`` by default.
+    output_dir : Union[str, Path]
+        Directory to write the compiled libraries to, ``masses_dir`` by default.
+
+    Returns
+    -------
+    List[Path]
+        The compiled libraries that were written.
+    """
+    # Imported here as pgio reads compiled libraries with this module
+    from pgfinder.pgio import theo_masses_reader
+
+    masses_dir = MASS_LIB_DIR if masses_dir is None else Path(masses_dir)
+    output_dir = masses_dir if output_dir is None else Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    compiled = []
+    for file_name, library in builtin_libraries(masses_dir).items():
+        if library.get("Compiled") is None:
+            continue
+        theo_masses_df = theo_masses_reader(masses_dir / file_name, compiled=False)
+        # Left undated, so that building the package twice from the same source gives the same files
+        compiled.append(compile_library(theo_masses_df, output_dir / library["Compiled"], timestamp=False))
+    return compiled
+
+
+def _created() -> str:
+    """When a library is compiled, taken from ``SOURCE_DATE_EPOCH`` if it's set."""
+    source_date = os.environ.get("SOURCE_DATE_EPOCH")
+    if source_date:
+        return datetime.fromtimestamp(int(source_date), tz=timezone.utc).isoformat(timespec="seconds")
+    return datetime.now().isoformat(timespec="seconds")
+
+
+def _write_run(chunk: List[Tuple[float, int, str]], file: Path) -> Path:
+    """Write a sorted run of (mass, position, name) entries to a temporary file."""
+    with file.open("wb") as f:
+        for mass, position, name in chunk:
+            encoded = name.encode("utf-8")
+            f.write(struct.pack("<dQI", mass, position, len(encoded)))
+            f.write(encoded)
+    return file
+
+
+def _read_run(file: Path) -> Iterator[Tuple[float, int, str]]:
+    """Stream (mass, position, name) entries back from a sorted run."""
+    record = struct.Struct("<dQI")
+    with file.open("rb") as f:
+        while header := f.read(record.size):
+            mass, position, length = record.unpack(header)
+            yield mass, position, f.read(length).decode("utf-8")
+
+
+def _assemble(merged: Iterator[Tuple[float, int, str]], count: int, file: Path, metadata: Dict, tempdir: Path) -> None:
+    """Write the sorted entries into the sections of a compiled library."""
+    # Every section is written sequentially to its own temporary file, then the sections are concatenated
+    sections = {name: (tempdir / name).open("w+b") for name in ("masses", "order", "name_offsets", "names")}
+    try:
+        name_offset = 0
+        for block in _blocks(merged):
+            masses, positions, names = zip(*block)
+            encoded = [name.encode("utf-8") for name in names]
+            offsets = np.cumsum([name_offset] + [len(e) for e in encoded], dtype="<u8")
+            sections["masses"].write(np.asarray(masses, dtype="<f8").tobytes())
+            sections["order"].write(np.asarray(positions, dtype="<u8").tobytes())
+            sections["name_offsets"].write(offsets[:-1].tobytes())
+            sections["names"].write(b"".join(encoded))
+            name_offset = int(offsets[-1])
+        sections["name_offsets"].write(np.asarray([name_offset], dtype="<u8").tobytes())
+
+        encoded_metadata = json.dumps(metadata).encode("utf-8")
+        meta_offset = _align(HEADER.size)
+        masses_offset = _align(meta_offset + len(encoded_metadata))
+        order_offset = masses_offset + 8 * count
+        name_offsets_offset = order_offset + 8 * count
+        names_offset = name_offsets_offset + 8 * (count + 1)
+        header = HEADER.pack(
+            MAGIC,
+            FORMAT_VERSION,
+            0,
+            count,
+            meta_offset,
+            len(encoded_metadata),
+            masses_offset,
+            order_offset,
+            name_offsets_offset,
+            names_offset,
+            name_offset,
+        )
+        with file.open("wb") as out:
+            out.write(header.ljust(meta_offset, b"\0"))
+            out.write(encoded_metadata.ljust(masses_offset - meta_offset, b"\0"))
+            for section in sections.values():
+                section.seek(0)
+                _copy(section, out)
+    finally:
+        for section in sections.values():
+            section.close()
+
+
+def _blocks(entries: Iterator, size: int = 65536) -> Iterator[List]:
+    """Group entries into lists of up to ``size``."""
+    block = []
+    for entry in entries:
+        block.append(entry)
+        if len(block) == size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _copy(source: BinaryIO, destination: BinaryIO, block_size: int = 1 << 20) -> None:
+    """Copy the rest of one binary file into another."""
+    while block := source.read(block_size):
+        destination.write(block)
+
+
+def _align(offset: int) -> int:
+    """Round an offset up to the next section boundary."""
+    return -(-offset // ALIGNMENT) * ALIGNMENT
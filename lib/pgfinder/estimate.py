@@ -0,0 +1,457 @@
+"""Resource estimates for an analysis, worked out without running it
+
+Only the number of features in the input file and histograms of their masses and retention times are read. The
+expected number of observed masses within the ppm window of a theoretical mass ``m`` is then
+``density(m) * window(m)``, where the density comes from the histogram bin of ``m``, and the chance that a structure
+is observed follows from that (assuming masses are spread evenly within each bin). Candidate counts for multimers and
+modifications are built up from the chances that the structures they are made from were observed, just as
+``Analyzer.search_space()`` only expands observed structures.
+
+Runtime and peak memory are projected from those counts with the per-stage costs of the engine in ``COSTS`` and with
+``MEMORY_COSTS``. The clean-up of adducts compares each parent with the adducts eluting within the RT window of it, so
+its cost also grows with the pairs of matches that elute that close together, counted from a histogram of retention
+times read alongside the masses. The costs were fitted to analyses of ``pgfinder.verify.synthetic_features()`` tables
+of 500 to 8,000 features (32,000 on the jit engine) on one machine; they can be overridden for other machines, and for
+libraries or settings whose matches are spread differently.
+"""
+import logging
+from itertools import combinations_with_replacement
+from math import factorial
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Tuple, Union
+
+import numpy as np
+import pandas as pd
+
+from pgfinder import MOD_COMBINATIONS, MOD_TYPE, MULTIMER_SEARCH, MULTIMERS
+from pgfinder.errors import UserError
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.pgio import ms_file_chunks
+from pgfinder.prefilter import FeatureFilter, top_n_mask
+from pgfinder.structures import parse_structure
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+# Width (in Da) of the bins of the mass histogram, about the width of a 10 ppm window at 500 Da; observed masses cluster
+# around those of real structures, so coarser bins spread them out and underestimate matches
+BIN_WIDTH = 0.01
+READ_CHUNK_SIZE = 50_000
+# Water lost when monomers are joined into multimers
+WATER = 18.0106
+# Width (in minutes) of the bins of the retention time histogram
+RT_BIN_WIDTH = 0.01
+# Per-stage costs of each engine: seconds per feature read, per candidate structure generated and per match; seconds
+# per match and per pair of matches eluting within the RT window of each other for the clean-up of adducts and
+# in-source decay products; and seconds per match for consolidation
+COSTS = {
+    "numpy": {
+        "read_seconds": 5.0e-6,
+        "expand_seconds": 5.0e-5,
+        "match_seconds": 5.0e-6,
+        "clean_up_match_seconds": 2.6e-3,
+        "clean_up_pair_seconds": 1.2e-5,
+        "consolidate_match_seconds": 1.7e-3,
+    },
+    "jit": {
+        "read_seconds": 5.0e-6,
+        "expand_seconds": 5.0e-5,
+        "match_seconds": 2.5e-6,
+        "clean_up_match_seconds": 7.5e-6,
+        "clean_up_pair_seconds": 3.0e-9,
+        "consolidate_match_seconds": 4.0e-6,
+    },
+    "reference": {
+        "read_seconds": 5.0e-6,
+        "expand_seconds": 7.0e-4,
+        "match_seconds": 1.0e-3,
+        "clean_up_match_seconds": 2.5e-3,
+        "clean_up_pair_seconds": 4.0e-6,
+        "consolidate_match_seconds": 1.8e-3,
+    },
+}
+# Bytes of peak memory per feature, candidate and result row on top of a fixed baseline, whatever the engine
+MEMORY_COSTS = {
+    "baseline_mib": 100.0,
+    "feature_bytes": 500.0,
+    "candidate_bytes": 50.0,
+    "row_bytes": 1500.0,
+}
+
+
+class Estimate(NamedTuple):
+    """Expected size and cost of an analysis."""
+
+    features: int
+    library_structures: int
+    observed_structures: float
+    multimer_candidates: float
+    modified_candidates: float
+    expected_matches: float
+    expected_matched_features: float
+    clean_up_pairs: float
+    result_rows: float
+    runtime_seconds: float
+    peak_memory_mib: float
+    stage_seconds: Dict[str, float]
+
+
+def mass_histogram(
+    file: Union[str, Path],
+    bin_width: float = BIN_WIDTH,
+    chunk_size: int = READ_CHUNK_SIZE,
+    feature_filter: FeatureFilter = None,
+) -> Tuple[int, np.ndarray]:
+    """Count the features of a file and bin their masses, reading it a chunk at a time.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Mass spec file, as read by ``ms_file_reader()``.
+    bin_width : float
+        Width of each bin, in Da.
+    chunk_size : int
+        Most features to read at once.
+    feature_filter : FeatureFilter
+        Only count the features that pass this filter. Optional.
+
+    Returns
+    -------
+    Tuple[int, np.ndarray]
+        The number of features and the number of observed masses in each bin, starting from 0 Da.
+    """
+    features, mass_counts, _ = feature_histograms(file, bin_width, chunk_size=chunk_size, feature_filter=feature_filter)
+    return features, mass_counts
+
+
+def feature_histograms(
+    file: Union[str, Path],
+    bin_width: float = BIN_WIDTH,
+    rt_bin_width: float = RT_BIN_WIDTH,
+    chunk_size: int = READ_CHUNK_SIZE,
+    feature_filter: FeatureFilter = None,
+) -> Tuple[int, np.ndarray, np.ndarray]:
+    """Count the features of a file and bin their masses and retention times, reading it a chunk at a time.
+
+    With a ``feature_filter``, each chunk is narrowed down to the features passing its criteria other than ``top_n``
+    (those failing the intensity, retention time or mass criteria aren't even read from Byos files). With ``top_n``,
+    only the most intense features seen so far are held on to, and those are binned once the whole file has been read.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Mass spec file, as read by ``ms_file_reader()``.
+    bin_width : float
+        Width of each mass bin, in Da.
+    rt_bin_width : float
+        Width of each retention time bin, in minutes.
+    chunk_size : int
+        Most features to read at once.
+    feature_filter : FeatureFilter
+        Only count the features that pass this filter. Optional.
+
+    Returns
+    -------
+    Tuple[int, np.ndarray, np.ndarray]
+        The number of features, the number of observed masses in each bin starting from 0 Da and the number of
+        retention times in each bin starting from 0 minutes.
+    """
+    features = 0
+    mass_counts = np.zeros(0, dtype=np.int64)
+    rt_counts = np.zeros(0, dtype=np.int64)
+    top_n = None if feature_filter is None else feature_filter.top_n
+    # Masses, retention times and intensities of the most intense features so far, in file order
+    most_intense = np.zeros((3, 0))
+    for chunk in ms_file_chunks(file, chunk_size, feature_filter):
+        if feature_filter is not None:
+            chunk = chunk[feature_filter.row_mask(chunk)]
+        columns = np.stack([chunk[c].to_numpy(dtype=float) for c in ["Obs (Da)", "RT (min)", "Intensity"]])
+        if top_n is not None:
+            most_intense = np.concatenate([most_intense, columns], axis=1)
+            keep = top_n_mask(most_intense[2], np.ones(most_intense.shape[1], dtype=bool), top_n)
+            most_intense = most_intense[:, keep]
+            continue
+        features += len(chunk)
+        mass_counts = _add_counts(mass_counts, columns[0], bin_width)
+        rt_counts = _add_counts(rt_counts, columns[1], rt_bin_width)
+    if top_n is not None:
+        features = most_intense.shape[1]
+        mass_counts = _add_counts(mass_counts, most_intense[0], bin_width)
+        rt_counts = _add_counts(rt_counts, most_intense[1], rt_bin_width)
+    return features, mass_counts, rt_counts
+
+
+def _add_counts(counts: np.ndarray, values: np.ndarray, bin_width: float) -> np.ndarray:
+    """Add the (finite, non-negative) values of a chunk to a histogram, growing it as needed."""
+    values = values[np.isfinite(values) & (values >= 0)]
+    chunk_counts = np.bincount((values / bin_width).astype(np.int64))
+    if len(chunk_counts) > len(counts):
+        counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+    counts[: len(chunk_counts)] += chunk_counts
+    return counts
+
+
+def rt_pair_fraction(rt_counts: np.ndarray, rt_bin_width: float, rt_window: float) -> float:
+    """Chance that two features picked at random elute within ``rt_window`` of each other.
+
+    Parameters
+    ----------
+    rt_counts : np.ndarray
+        Number of retention times in each bin, as from ``feature_histograms()``.
+    rt_bin_width : float
+        Width of each retention time bin, in minutes.
+    rt_window : float
+        Retention time window, in minutes.
+
+    Returns
+    -------
+    float
+        The fraction of pairs of features (including each feature with itself) eluting within the window.
+    """
+    total = rt_counts.sum()
+    if total == 0:
+        return 0.0
+    reach = int(round(rt_window / rt_bin_width))
+    cumulative = np.concatenate([[0], np.cumsum(rt_counts)])
+    bins = np.arange(len(rt_counts))
+    nearby = cumulative[np.minimum(bins + reach + 1, len(rt_counts))] - cumulative[np.maximum(bins - reach, 0)]
+    return float((rt_counts * nearby).sum() / total**2)
+
+
+class _Density:
+    """Expected numbers of observed masses within ppm windows, from a mass histogram."""
+
+    def __init__(self, counts: np.ndarray, bin_width: float, ppm_tolerance: float):
+        self.counts = counts.astype(float)
+        self.bin_width = bin_width
+        self.ppm_tolerance = ppm_tolerance
+        # Candidates weighted by their chance of being generated, binned like the observed masses
+        self.windows = np.zeros(len(counts))
+
+    def _bins(self, masses: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        bins = np.floor(masses / self.bin_width).astype(np.int64)
+        inside = (bins >= 0) & (bins < len(self.counts))
+        return np.where(inside, bins, 0), inside
+
+    def expected_hits(self, masses: np.ndarray) -> np.ndarray:
+        """Expected number of observed masses in the ppm window of each mass."""
+        bins, inside = self._bins(masses)
+        width = 2 * masses * self.ppm_tolerance / 1000000
+        return np.where(inside, self.counts[bins] / self.bin_width * width, 0.0)
+
+    def observed(self, masses: np.ndarray) -> np.ndarray:
+        """Chance that at least one observed mass falls in the ppm window of each mass."""
+        return -np.expm1(-self.expected_hits(masses))
+
+    def candidates(self, masses: np.ndarray, weights: np.ndarray) -> float:
+        """Add candidates to the search space, returning their expected number of matches."""
+        bins, inside = self._bins(masses)
+        width = 2 * masses * self.ppm_tolerance / 1000000
+        np.add.at(self.windows, bins[inside], (weights * width)[inside])
+        return float((weights * self.expected_hits(masses)).sum())
+
+    def matched_features(self) -> float:
+        """Expected number of observed masses that fall in the window of at least one candidate."""
+        return float((self.counts * -np.expm1(-self.windows / self.bin_width)).sum())
+
+
+def estimate(
+    file: Union[str, Path],
+    library: pd.DataFrame,
+    multimer_mods: Iterable[str],
+    other_mods: Iterable[str],
+    ppm_tolerance: float,
+    max_multimer: int = None,
+    max_modifications: int = None,
+    rt_window: float = 0.5,
+    engine: str = "numpy",
+    feature_filter: FeatureFilter = None,
+    costs: Dict = None,
+    bin_width: float = BIN_WIDTH,
+) -> Estimate:
+    """Estimate the candidates, matches, runtime and peak memory of an analysis without running it.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Mass spec file to be analysed; only the number of features and histograms of their masses and retention times
+        are read.
+    library : pd.DataFrame
+        Library structures and their masses.
+    multimer_mods : Iterable[str]
+        Enabled multimer types.
+    other_mods : Iterable[str]
+        Enabled modifications.
+    ppm_tolerance : float
+        The ppm tolerance used when matching the theoretical masses of structures to observed ions.
+    max_multimer : int
+        Largest multimers searched for, if searching for multimers of any size.
+    max_modifications : int
+        Most modifications per structure searched for, if searching for several modifications at once.
+    rt_window : float
+        Retention time window (in minutes) of the clean-up of adducts.
+    engine : str
+        Engine the analysis runs on, ``numpy``, ``jit`` or ``reference``, whose costs are used.
+    feature_filter : FeatureFilter
+        Filter the features are put through before the analysis, only those it keeps being counted. Optional.
+    costs : Dict
+        Per-stage costs overriding those of the engine in ``COSTS`` and those in ``MEMORY_COSTS``.
+    bin_width : float
+        Width of the bins of the mass histogram, in Da.
+
+    Returns
+    -------
+    Estimate
+        Expected counts and projected runtime (in seconds) and peak memory (in MiB).
+    """
+    if engine not in COSTS:
+        raise UserError(f"Unknown engine '{engine}', expected one of {', '.join(COSTS)}.")
+    costs = {**COSTS[engine], **MEMORY_COSTS, **(costs or {})}
+    features, counts, rt_counts = feature_histograms(file, bin_width, feature_filter=feature_filter)
+    density = _Density(counts, bin_width, ppm_tolerance)
+
+    names = library["Inferred structure"].to_numpy(dtype=object)
+    masses = library["Theo (Da)"].to_numpy(dtype=float)
+    observed = density.observed(masses)
+    matches = density.candidates(masses, np.ones(len(masses)))
+    # Structures that have been observed (with their chances), which are expanded into modified structures
+    bases = [(np.round(masses, 4), observed)]
+
+    eligible = np.array([len(parse_structure(name).core) > 2 for name in names], dtype=bool)
+    multimer_candidates = 0.0
+    for mod in multimer_mods:
+        if max_multimer is None:
+            chains = _fixed_multimers(masses[eligible], observed[eligible], mod)
+        else:
+            chains = _multimer_chains(names[eligible], masses[eligible], observed[eligible], mod, max_multimer, density)
+        for chain_masses, chain_weights, generated in chains:
+            multimer_candidates += generated
+            matches += density.candidates(chain_masses, chain_weights)
+            bases.append((chain_masses, chain_weights * density.observed(chain_masses)))
+
+    base_masses = np.concatenate([b[0] for b in bases])
+    base_weights = np.concatenate([b[1] for b in bases])
+    modified_candidates = 0.0
+    for deltas, generated in _modification_shifts(list(other_mods), max_modifications, base_weights.sum()):
+        modified_candidates += generated
+        for delta in deltas:
+            matches += density.candidates(base_masses + delta, base_weights)
+
+    matched_features = min(density.matched_features(), features)
+    result_rows = matches + features - matched_features
+    # Every match is counted as both a parent and an adduct, the share of them that are either being in the costs
+    clean_up_pairs = matches**2 * rt_pair_fraction(rt_counts, RT_BIN_WIDTH, rt_window)
+    candidates = len(masses) + multimer_candidates + modified_candidates
+    stage_seconds = {
+        "read": features * costs["read_seconds"],
+        "search_space": candidates * costs["expand_seconds"],
+        "matching": matches * costs["match_seconds"],
+        "clean_up": matches * costs["clean_up_match_seconds"] + clean_up_pairs * costs["clean_up_pair_seconds"],
+        "consolidation": matches * costs["consolidate_match_seconds"],
+    }
+    peak_memory = (
+        costs["baseline_mib"] * 2**20
+        + features * costs["feature_bytes"]
+        + candidates * costs["candidate_bytes"]
+        + result_rows * costs["row_bytes"]
+    )
+    return Estimate(
+        features=features,
+        library_structures=len(masses),
+        observed_structures=float(observed.sum()),
+        multimer_candidates=multimer_candidates,
+        modified_candidates=modified_candidates,
+        expected_matches=matches,
+        expected_matched_features=matched_features,
+        clean_up_pairs=clean_up_pairs,
+        result_rows=result_rows,
+        runtime_seconds=sum(stage_seconds.values()),
+        peak_memory_mib=peak_memory / 2**20,
+        stage_seconds=stage_seconds,
+    )
+
+
+def _fixed_multimers(masses: np.ndarray, observed: np.ndarray, multimer_type: str):
+    """Masses and chances of the multimers ``multimer_builder()`` makes from each library structure."""
+    for features in MULTIMERS[multimer_type].values():
+        chain_masses = np.round(masses + float(features["mass"]) - WATER, 4)
+        yield chain_masses, observed, float(observed.sum())
+
+
+def _multimer_chains(
+    names: np.ndarray,
+    masses: np.ndarray,
+    observed: np.ndarray,
+    multimer_type: str,
+    max_multimer: int,
+    density: _Density,
+):
+    """Binned masses and expected numbers of the chains ``multimer_search()`` grows, one size at a time.
+
+    Chains are binned by mass and extended by convolving with the binned donors. Donors after the first are added in
+    a fixed order, so chains of n monomers are counted as ordered chains divided by (n - 2)!.
+    """
+    if multimer_type not in MULTIMER_SEARCH:
+        raise UserError(f"Searching for '{multimer_type}' of more than two monomers isn't supported.")
+    rules = MULTIMER_SEARCH[multimer_type]
+    donors = np.ones(len(names), dtype=bool)
+    if rules.get("donor_glycan") is not None:
+        donors = np.array([name.startswith(f"{rules['donor_glycan']}-") for name in names], dtype=bool)
+    donor_masses = masses[donors] + float(rules["donor_delta"]) - WATER
+
+    bins = len(density.counts)
+    centres = (np.arange(bins) + 0.5) * density.bin_width
+    # Chains heavier than anything observed are never grown, as in `multimer_search()`
+    binned_chains = _binned(masses, observed, density.bin_width, bins)
+    binned_donors = _binned(donor_masses, observed[donors], density.bin_width, bins)
+    for size in range(2, max_multimer + 1):
+        binned_chains = _convolve(binned_chains, binned_donors)
+        ordered = binned_chains / factorial(size - 2)
+        yield centres, ordered, float(ordered.sum())
+
+
+def _convolve(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Convolution of two binned weights (by FFT, there being many fine bins), truncated to the length of ``a``."""
+    n = 1 << int(len(a) + len(b) - 1).bit_length()
+    convolved = np.fft.irfft(np.fft.rfft(a, n) * np.fft.rfft(b, n), n)[: len(a)]
+    return np.clip(convolved, 0, None)
+
+
+def _binned(masses: np.ndarray, weights: np.ndarray, bin_width: float, bins: int) -> np.ndarray:
+    """Total weight of the masses in each bin."""
+    binned = np.floor(masses / bin_width).astype(np.int64)
+    inside = (binned >= 0) & (binned < bins)
+    return np.bincount(binned[inside], weights=weights[inside], minlength=bins)[:bins]
+
+
+def _modification_shifts(mod_types: List[str], max_modifications: int, bases: float):
+    """Mass shifts of the combinations of modifications applied to each structure, with the candidates generated."""
+    if not mod_types:
+        return
+    if max_modifications is None:
+        for mod in mod_types:
+            yield [float(MOD_TYPE[mod]["mass"])], bases
+        return
+    max_candidates = float(MOD_COMBINATIONS["max_candidates"])
+    generated = 0.0
+    for n, combination in _combinations(mod_types, max_modifications):
+        if generated + len(combination) * bases > max_candidates:
+            LOGGER.info(f"Only estimating structures with up to {n - 1} modifications")
+            return
+        generated += len(combination) * bases
+        yield [sum(float(MOD_TYPE[m]["mass"]) for m in c) for c in combination], len(combination) * bases
+
+
+def _combinations(mod_types: List[str], max_modifications: int):
+    """The combinations of modifications allowed by ``mod_combinations`` in ``parameters.yaml``, by number."""
+    max_count = {m: int(MOD_COMBINATIONS["max_count"].get(m, 1)) for m in mod_types}
+    exclusive = [set(group) for group in MOD_COMBINATIONS["exclusive"]]
+    for n in range(1, max_modifications + 1):
+        allowed = [
+            c
+            for c in combinations_with_replacement(mod_types, n)
+            if all(c.count(m) <= max_count[m] for m in set(c))
+            and all(len(group.intersection(c)) <= 1 for group in exclusive)
+        ]
+        if not allowed:
+            return
+        yield n, allowed
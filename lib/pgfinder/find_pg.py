@@ -3,24 +3,33 @@
 import argparse as arg
 import ast
 import importlib.resources as pkg_resources
+import json
 import logging
 import warnings
+from contextlib import nullcontext
 from pathlib import Path
 from typing import Union
 
 import yaml
 
+from pgfinder.analyzer import Analyzer
+from pgfinder.checkpoints import CheckpointStore, ingest
+from pgfinder.chunked import analyze_file
 from pgfinder.errors import UserError
 from pgfinder.logs.logs import LOGGER_NAME, setup_logger
 from pgfinder.matching import data_analysis
+from pgfinder.metrics import REGISTRY, MetricsWriter
 from pgfinder.pgio import (
     dataframe_to_csv_metadata,
     default_filename,
-    ms_file_reader,
     read_yaml,
     theo_masses_reader,
 )
+from pgfinder.prefilter import FeatureFilter
 from pgfinder.utils import update_config
+from pgfinder.verify import synthetic_features as make_synthetic_features
+from pgfinder.verify import verify_engine as verify_engine_results
+from pgfinder.watch import watch_file
 
 LOGGER = setup_logger()
 LOGGER = logging.getLogger(LOGGER_NAME)
@@ -48,7 +57,171 @@ def create_parser() -> arg.ArgumentParser:
     parser.add_argument(
         "--mod_list", dest="mod_list", type=ast.literal_eval, required=False, help="Modifications to include."
     )
+    parser.add_argument(
+        "--max_multimer",
+        dest="max_multimer",
+        type=int,
+        required=False,
+        help="Search for multimers of up to this many monomers.",
+    )
+    parser.add_argument(
+        "--max_modifications",
+        dest="max_modifications",
+        type=int,
+        required=False,
+        help="Search for structures with up to this many modifications at once.",
+    )
+    parser.add_argument(
+        "--memory_budget",
+        dest="memory_budget",
+        type=float,
+        required=False,
+        help="Analyse the input file in partitions that fit in about this much memory (MiB).",
+    )
+    parser.add_argument(
+        "--engine",
+        dest="engine",
+        type=str,
+        required=False,
+        help="Engine for the matching and clean-up loops, numpy, jit (needs numba) or reference.",
+    )
+    parser.add_argument(
+        "--verify_engine",
+        dest="verify_engine",
+        action="store_true",
+        default=None,
+        help="Analyse the input with both the engine and the reference engine and report any differences.",
+    )
+    parser.add_argument(
+        "--synthetic_features",
+        dest="synthetic_features",
+        type=int,
+        required=False,
+        help="Verify the engine on this many synthetic features made up from the masses file, not the input file.",
+    )
+    parser.add_argument(
+        "--seed",
+        dest="seed",
+        type=int,
+        required=False,
+        help="Seed for making up synthetic features.",
+    )
+    parser.add_argument(
+        "--search_space",
+        dest="search_space",
+        type=str,
+        required=False,
+        help="File of the precomputed expanded search space, built there first if it's missing or out of date.",
+    )
+    parser.add_argument(
+        "--checkpoint_dir",
+        dest="checkpoint_dir",
+        type=str,
+        required=False,
+        help="Directory to checkpoint each stage to, so that re-runs resume after the last stage that is unchanged.",
+    )
+    parser.add_argument(
+        "--min_intensity",
+        dest="min_intensity",
+        type=float,
+        required=False,
+        help="Drop features less intense than this before matching.",
+    )
+    parser.add_argument(
+        "--top_n",
+        dest="top_n",
+        type=int,
+        required=False,
+        help="Only match this many of the most intense features.",
+    )
+    parser.add_argument(
+        "--rt_range",
+        dest="rt_range",
+        type=float,
+        nargs=2,
+        required=False,
+        help="Drop features eluting outside this retention time range (min).",
+    )
+    parser.add_argument(
+        "--mass_range",
+        dest="mass_range",
+        type=float,
+        nargs=2,
+        required=False,
+        help="Drop features with observed masses outside this range (Da).",
+    )
+    parser.add_argument(
+        "--charges",
+        dest="charges",
+        type=int,
+        nargs="+",
+        required=False,
+        help="Drop features not observed with any of these charges.",
+    )
+    parser.add_argument(
+        "--report_filtered",
+        dest="report_filtered",
+        action="store_true",
+        default=None,
+        help="Add the features dropped by the filters to the results as unmatched rows.",
+    )
+    parser.add_argument(
+        "--recalibrated_ppm",
+        dest="recalibrated_ppm",
+        type=float,
+        required=False,
+        help="Recalibrate observed masses, then match them at this narrower ppm tolerance.",
+    )
+    parser.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        default=None,
+        help="Analyse a .ftrs file while it is still being written, updating the results as features are added.",
+    )
+    parser.add_argument(
+        "--poll_interval",
+        dest="poll_interval",
+        type=float,
+        required=False,
+        help="Seconds between checks for new features when watching a file.",
+    )
+    parser.add_argument(
+        "--watch_timeout",
+        dest="watch_timeout",
+        type=float,
+        required=False,
+        help="Stop watching once no features have been added for this many seconds.",
+    )
+    parser.add_argument(
+        "--dry_run",
+        dest="dry_run",
+        action="store_true",
+        default=None,
+        help="Print the expected candidates, matches, runtime and peak memory instead of running the analysis.",
+    )
     parser.add_argument("--output_dir", dest="output_dir", type=str, required=False, help="Output directory.")
+    parser.add_argument(
+        "--metrics_file",
+        dest="metrics_file",
+        type=str,
+        required=False,
+        help="File to write Prometheus metrics of the run to when it finishes.",
+    )
+    parser.add_argument(
+        "--metrics_interval",
+        dest="metrics_interval",
+        type=float,
+        required=False,
+        help="Also update the metrics file every this many seconds while the run goes on.",
+    )
+    parser.add_argument(
+        "--log_file",
+        dest="log_file",
+        type=str,
+        required=False,
+        help="File to also write the log to; {pid} in the name is replaced by the process ID.",
+    )
     parser.add_argument("--warnings", dest="warnings", type=str, required=False, help="Whether to ignore warnings.")
     parser.add_argument("--quiet", dest="quiet", type=bool, required=False, help="Supress output.")
     parser.add_argument(
@@ -68,6 +241,22 @@ def process_file(
     output_dir: Union[str, Path] = "./",
     float_format: int = 4,
     to_csv: dict = None,
+    max_multimer: int = None,
+    max_modifications: int = None,
+    memory_budget: float = None,
+    engine: str = None,
+    search_space: Union[str, Path] = None,
+    dry_run: bool = False,
+    checkpoint_dir: Union[str, Path] = None,
+    feature_filter: FeatureFilter = None,
+    report_filtered: bool = False,
+    recalibrated_ppm: float = None,
+    watch: bool = False,
+    poll_interval: float = 5.0,
+    watch_timeout: float = None,
+    verify_engine: bool = False,
+    synthetic_features: int = None,
+    seed: int = 0,
 ):
     """Process files
 
@@ -89,17 +278,160 @@ def process_file(
        Decimal places to use in CSV files.
     to_csv: dict
        Dictionary of options to pass to pd.to_csv(), primarly used to overwrite existing files.
+    max_multimer : int
+        Search for multimers of up to this many monomers.
+    max_modifications : int
+        Search for structures with up to this many modifications at once.
+    memory_budget : float
+        When set, the input file is analysed in partitions that fit in about this much memory (in MiB) and the results
+        are streamed to disk, see ``analyze_file()``.
+    engine : str
+        Engine for the matching and clean-up loops, ``numpy`` (the default), ``jit`` or ``reference``.
+    search_space : Union[str, Path]
+        File of the library expanded with the enabled modifications (see ``pgfinder.search_space``), which is built and
+        saved first if it is missing or was built for a different library or modifications.
+    dry_run : bool
+        Print an estimate of the analysis as JSON (see ``Analyzer.estimate()``) instead of running it.
+    checkpoint_dir : Union[str, Path]
+        Directory to checkpoint the reading of the input file and each stage of the analysis to, resuming after the
+        last stage whose inputs are unchanged (see ``pgfinder.checkpoints``). Not used with ``memory_budget``.
+    feature_filter : FeatureFilter
+        Only analyse the features that pass this filter (see ``pgfinder.prefilter``). For ``.ftrs`` files the features
+        failing its intensity, retention time and mass criteria aren't read at all, unless ``report_filtered`` is set.
+    report_filtered : bool
+        Add the features dropped by ``feature_filter`` to the results as unmatched rows, without analysing them.
+    recalibrated_ppm : float
+        Recalibrate observed masses against the monomers they unambiguously match within ``ppm_tolerance``, then run
+        the analysis at this narrower tolerance (see ``pgfinder.recalibration``). Not available with ``watch``.
+    watch : bool
+        Analyse a ``.ftrs`` input file while it is still being written, polling it for new features and rewriting the
+        results after each poll that finds some (see ``pgfinder.watch``).
+    poll_interval : float
+        Seconds between polls when watching the input file.
+    watch_timeout : float
+        Stop watching once no features have been added for this many seconds; by default watch until interrupted.
+    verify_engine : bool
+        Analyse the input file with ``engine`` and with the ``reference`` engine and compare the results (see
+        ``pgfinder.verify``), raising an error if they differ. No results are written.
+    synthetic_features : int
+        Verify the engine on this many features made up from ``masses_file`` rather than on the input file.
+    seed : int
+        Seed for making up the synthetic features.
     """
     input_file = Path(input_file)
     masses_file = Path(masses_file)
     output_dir = Path(output_dir)
 
-    df = ms_file_reader(input_file)
-
     masses = theo_masses_reader(masses_file)
     LOGGER.info(f"PPM Tolerance                      : {ppm_tolerance}")
     LOGGER.info(f"Time Delta                         : {time_delta}")
+    if feature_filter is not None:
+        LOGGER.info(f"Feature filter                     : {feature_filter.describe()}")
+
+    if dry_run:
+        analyzer = Analyzer(
+            masses,
+            time_delta,
+            mod_list,
+            ppm_tolerance,
+            consolidation_ppm,
+            max_multimer,
+            max_modifications,
+            engine,
+            feature_filter=feature_filter,
+            recalibrated_ppm=recalibrated_ppm,
+        )
+        estimate = analyzer.estimate(input_file)
+        LOGGER.info(f"Estimated runtime (s)              : {estimate.runtime_seconds:.0f}")
+        LOGGER.info(f"Estimated peak memory (MiB)        : {estimate.peak_memory_mib:.0f}")
+        print(json.dumps(estimate._asdict(), indent=2))
+        return estimate
 
+    if verify_engine:
+        analyzer = Analyzer(
+            masses,
+            time_delta,
+            mod_list,
+            ppm_tolerance,
+            consolidation_ppm,
+            max_multimer,
+            max_modifications,
+            engine,
+            expanded_search_space=search_space,
+            feature_filter=feature_filter,
+            report_filtered=report_filtered,
+            recalibrated_ppm=recalibrated_ppm,
+        )
+        if synthetic_features is not None:
+            LOGGER.info(f"Synthetic features                 : {synthetic_features} (seed {seed})")
+            df = make_synthetic_features(masses, synthetic_features, seed, ppm_tolerance, time_delta)
+        else:
+            df = ingest(input_file, feature_filter=None if report_filtered else feature_filter)
+        verification = verify_engine_results(analyzer, df)
+        if not verification.equivalent:
+            raise UserError(
+                f"The results of the {verification.engine} engine differ from those of the {verification.reference} "
+                f"engine (in at least {len(verification.differences)} places, listed above)."
+            )
+        LOGGER.info(f"The {verification.engine} engine gives the same {verification.rows} results as the reference")
+        return verification
+
+    if watch:
+        analyzer = Analyzer(
+            masses,
+            time_delta,
+            mod_list,
+            ppm_tolerance,
+            consolidation_ppm,
+            max_multimer,
+            max_modifications,
+            engine,
+            expanded_search_space=search_space,
+            feature_filter=feature_filter,
+            report_filtered=report_filtered,
+            recalibrated_ppm=recalibrated_ppm,
+        )
+        output = watch_file(
+            analyzer,
+            input_file,
+            output_dir,
+            poll_interval=poll_interval,
+            idle_timeout=watch_timeout,
+            float_format=f"%.{float_format}f",
+        )
+        LOGGER.info("Processing complete!")
+        LOGGER.info(f"Results with metadata saved to      : {output}")
+        return
+
+    if memory_budget is not None:
+        LOGGER.info(f"Memory budget (MiB)                : {memory_budget}")
+        analyzer = Analyzer(
+            masses,
+            time_delta,
+            mod_list,
+            ppm_tolerance,
+            consolidation_ppm,
+            max_multimer,
+            max_modifications,
+            engine,
+            expanded_search_space=search_space,
+            feature_filter=feature_filter,
+            report_filtered=report_filtered,
+            recalibrated_ppm=recalibrated_ppm,
+        )
+        output = analyze_file(
+            analyzer, input_file, memory_budget, output_dir, default_filename(), float_format=f"%.{float_format}f"
+        )
+        LOGGER.info("Processing complete!")
+        LOGGER.info(f"Results with metadata saved to      : {output}")
+        return
+
+    checkpoints = None
+    if checkpoint_dir is not None:
+        LOGGER.info(f"Checkpoints kept in                : {checkpoint_dir}")
+        checkpoints = CheckpointStore(checkpoint_dir)
+    # Dropped features are only read when they're reported
+    df = ingest(input_file, checkpoints, feature_filter=None if report_filtered else feature_filter)
     results = data_analysis(
         raw_data_df=df,
         theo_masses_df=masses,
@@ -107,6 +439,14 @@ def process_file(
         enabled_mod_list=mod_list,
         ppm_tolerance=ppm_tolerance,
         consolidation_ppm=consolidation_ppm,
+        max_multimer=max_multimer,
+        max_modifications=max_modifications,
+        engine=engine,
+        expanded_search_space=search_space,
+        checkpoint_dir=checkpoints,
+        feature_filter=feature_filter,
+        report_filtered=report_filtered,
+        recalibrated_ppm=recalibrated_ppm,
     )
     LOGGER.info("Processing complete!")
     filename = default_filename()
@@ -134,6 +474,8 @@ def main():
             config = yaml.safe_load(default_config.read())
             LOGGER.info("Default configuration file loaded.")
         config = update_config(config, args)
+        if config.get("log_file") is not None:
+            setup_logger(log_file=config["log_file"])
 
         # Optionally ignore all warnings or just show deprecation warnings
         if config["warnings"] == "ignore":
@@ -150,16 +492,46 @@ def main():
         if config["quiet"]:
             LOGGER.setLevel("ERROR")
 
-        process_file(
-            input_file=config["input_file"],
-            masses_file=config["masses_file"],
-            ppm_tolerance=config["ppm_tolerance"],
-            consolidation_ppm=config["consolidation_ppm"],
-            time_delta=config["time_delta"],
-            mod_list=config["mod_list"],
-            output_dir=config["output_dir"],
-            float_format=config["float_format"],
-        )
+        metrics_file = config.get("metrics_file")
+        with MetricsWriter(metrics_file, config.get("metrics_interval")) if metrics_file else nullcontext():
+            try:
+                process_file(
+                    input_file=config["input_file"],
+                    masses_file=config["masses_file"],
+                    ppm_tolerance=config["ppm_tolerance"],
+                    consolidation_ppm=config["consolidation_ppm"],
+                    time_delta=config["time_delta"],
+                    mod_list=config["mod_list"],
+                    output_dir=config["output_dir"],
+                    float_format=config["float_format"],
+                    max_multimer=config.get("max_multimer"),
+                    max_modifications=config.get("max_modifications"),
+                    memory_budget=config.get("memory_budget"),
+                    engine=config.get("engine"),
+                    search_space=config.get("search_space"),
+                    dry_run=config.get("dry_run", False),
+                    checkpoint_dir=config.get("checkpoint_dir"),
+                    feature_filter=FeatureFilter.from_settings(
+                        min_intensity=config.get("min_intensity"),
+                        top_n=config.get("top_n"),
+                        rt_range=config.get("rt_range"),
+                        mass_range=config.get("mass_range"),
+                        charges=config.get("charges"),
+                    ),
+                    report_filtered=config.get("report_filtered", False),
+                    recalibrated_ppm=config.get("recalibrated_ppm"),
+                    watch=config.get("watch", False),
+                    poll_interval=config.get("poll_interval", 5.0),
+                    watch_timeout=config.get("watch_timeout"),
+                    verify_engine=config.get("verify_engine", False),
+                    synthetic_features=config.get("synthetic_features"),
+                    seed=config.get("seed", 0),
+                )
+            except Exception:
+                REGISTRY.inc("pgfinder_files_failed_total")
+                raise
+            if not config.get("dry_run", False):
+                REGISTRY.inc("pgfinder_files_processed_total")
     except UserError as e:
         # Avoid dumping a whole stack-trace if it's the user who's done something wrong
         LOGGER.error(e)
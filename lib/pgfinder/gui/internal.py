@@ -11,9 +11,9 @@ MASS_LIB_DIR = Path(sys.modules["pgfinder"].__file__).parent / "masses"
 
 
 def theo_masses_upload_reader(upload: dict) -> pd.DataFrame:
-    # Attempt to load a built-in library if no content was uploaded
+    # Load a built-in library (from its compiled copy, if it has been built) if no content was uploaded
     if upload["content"] is None:
-        upload["content"] = open(MASS_LIB_DIR / upload["name"], "rb").read()
+        return pgio.theo_masses_reader(MASS_LIB_DIR / upload["name"])
 
     with uploaded_file(upload) as file:
         return pgio.theo_masses_reader(file)
@@ -1,10 +1,14 @@
-from pgfinder import matching, pgio, validation
+from pgfinder import pgio, validation
+from pgfinder.analyzer import Analyzer
 from pgfinder.gui.internal import (
     MASS_LIB_DIR,
     ms_upload_reader,
     theo_masses_upload_reader,
 )
 
+# The Analyzer for the mass library and settings of the current run, prepared once per worker and run
+_analyzer = None
+
 
 def mass_library_index():
     return open(MASS_LIB_DIR / "index.json").read()
@@ -14,23 +18,33 @@ def allowed_modifications():
     return validation.allowed_modifications()
 
 
-def run_analysis():
+def prepare_analysis():
     from pyio import (
         cleanupWindow,
         consolidationPpm,
         enabledModifications,
         massLibrary,
-        msData,
         ppmTolerance,
     )
 
+    global _analyzer
     theo_masses = theo_masses_upload_reader(massLibrary.to_py())
+    _analyzer = Analyzer(theo_masses, cleanupWindow, enabledModifications, ppmTolerance, consolidationPpm)
+
+
+def analyze_uploads():
+    from pyio import msData
 
+    # Results are returned as memoryviews of their columnar encoding, so JavaScript can copy each out of the Python
+    # heap once and transfer it on, rather than converting a Python string; the page writes the CSV from the columns
     def analyze(virt_file):
         ms_data = ms_upload_reader(virt_file)
-        matched = matching.data_analysis(
-            ms_data, theo_masses, cleanupWindow, enabledModifications, ppmTolerance, consolidationPpm
-        )
-        return pgio.dataframe_to_csv_metadata(matched)
+        matched = _analyzer.analyze(ms_data)
+        return memoryview(pgio.dataframe_to_columns(matched))
 
     return {f["name"]: analyze(f) for f in msData.to_py()}
+
+
+def run_analysis():
+    prepare_analysis()
+    return analyze_uploads()
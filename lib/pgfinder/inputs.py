@@ -0,0 +1,154 @@
+"""Opening input files whatever they were compressed with, and telling mass spec files apart by their content.
+
+Feature tables and mass libraries are often archived compressed. Rather than going by their suffix, files are
+recognised by their leading bytes: gzip, bzip2, xz and zstd files are decompressed as they are read, without writing
+the decompressed data anywhere, and mass spec files are taken to be Byos files when they start with the SQLite header
+and MaxQuant tables when their first line is tab-separated.
+
+SQLite can only read Byos files from disk or from memory, so compressed ``.ftrs`` files are decompressed into an
+in-memory database (which needs Python 3.11 or later). zstd needs the optional ``zstandard`` package
+(``pip install pgfinder[zstd]``).
+"""
+import bz2
+import gzip
+import lzma
+import sqlite3
+from contextlib import closing, contextmanager
+from pathlib import Path, PurePath
+from typing import BinaryIO, Iterator, Optional, Union
+
+from pgfinder.errors import UserError
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the environment
+    zstandard = None
+
+# Leading bytes of each kind of compressed file
+COMPRESSION_MAGIC = {
+    "gzip": b"\x1f\x8b",
+    "bz2": b"BZh",
+    "xz": b"\xfd7zXZ\x00",
+    "zstd": b"\x28\xb5\x2f\xfd",
+}
+# Leading bytes of SQLite databases, and so of Byos files
+SQLITE_MAGIC = b"SQLite format 3\x00"
+# Most bytes read to find the header line of a MaxQuant table
+HEADER_BYTES = 65536
+
+
+def compression(file: Union[str, Path]) -> Optional[str]:
+    """The compression of a file, going by its leading bytes.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        File to check.
+
+    Returns
+    -------
+    Optional[str]
+        ``gzip``, ``bz2``, ``xz`` or ``zstd``, or None for files that aren't compressed.
+    """
+    with open(file, "rb") as f:
+        head = f.read(max(len(magic) for magic in COMPRESSION_MAGIC.values()))
+    return next((name for name, magic in COMPRESSION_MAGIC.items() if head.startswith(magic)), None)
+
+
+def open_input(file: Union[str, Path]) -> BinaryIO:
+    """Open a file for reading, decompressing it as it is read if it is compressed.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        File to open.
+
+    Returns
+    -------
+    BinaryIO
+        Binary stream of the (decompressed) contents, to be closed by the caller.
+    """
+    kind = compression(file)
+    if kind == "gzip":
+        return gzip.open(file, "rb")
+    if kind == "bz2":
+        return bz2.open(file, "rb")
+    if kind == "xz":
+        return lzma.open(file, "rb")
+    if kind == "zstd":
+        if zstandard is None:
+            raise UserError(
+                f"'{PurePath(file).name}' is zstd-compressed, which needs the zstandard package "
+                "(pip install pgfinder[zstd]). Please install it or decompress the file first."
+            )
+        return zstandard.ZstdDecompressor().stream_reader(open(file, "rb"), read_across_frames=True, closefd=True)
+    return open(file, "rb")
+
+
+def ms_file_format(file: Union[str, Path]) -> str:
+    """Tell whether a (possibly compressed) mass spec file is a Byos file or a MaxQuant table.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Mass spec file.
+
+    Returns
+    -------
+    str
+        ``ftrs`` for Byos files and ``maxquant`` for MaxQuant tables, including empty ones (which are reported as
+        having no data when they are read).
+    """
+    with open_input(file) as stream:
+        head = _read_head(stream, HEADER_BYTES)
+    if head.startswith(SQLITE_MAGIC):
+        return "ftrs"
+    if not head.strip() or b"\t" in head.split(b"\n", 1)[0]:
+        return "maxquant"
+    raise UserError(
+        (
+            f"'{PurePath(file).name}' was neither a Byos (.ftrs) nor a MaxQuant (.txt) file. Please ensure that "
+            "you've selected a valid Byos or MaxQuant file, optionally compressed with gzip, bzip2, xz or zstd."
+        )
+    )
+
+
+@contextmanager
+def connect_ftrs(file: Union[str, Path]) -> Iterator[sqlite3.Connection]:
+    """Open a (possibly compressed) Byos file as an SQLite database, closing it afterwards.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        Byos file.
+
+    Yields
+    ------
+    sqlite3.Connection
+        Connection to the database, or to an in-memory copy of it if the file is compressed.
+    """
+    if compression(file) is None:
+        with closing(sqlite3.connect(file)) as db:
+            yield db
+        return
+    if not hasattr(sqlite3.Connection, "deserialize"):
+        raise UserError(
+            f"Reading compressed Byos files such as '{PurePath(file).name}' needs Python 3.11 or later. "
+            "Please decompress the file first."
+        )
+    with open_input(file) as stream:
+        data = stream.read()
+    with closing(sqlite3.connect(":memory:")) as db:
+        db.deserialize(data)
+        yield db
+
+
+def _read_head(stream: BinaryIO, size: int) -> bytes:
+    """Read up to ``size`` bytes, as decompressing streams may return fewer than asked for at a time."""
+    head = b""
+    while len(head) < size:
+        block = stream.read(size - len(head))
+        if not block:
+            break
+        head += block
+    return head
@@ -0,0 +1,289 @@
+"""Compiled kernels for the hot loops of an analysis, used by ``Analyzer(engine="jit")``
+
+The kernels are written as plain loops over NumPy arrays and compiled with Numba when it is installed (``pip install
+pgfinder[jit]``). Without Numba they still run, uncompiled, which is only useful for testing them; ``resolve_engine()``
+falls back to the NumPy engine instead. Each wrapper returns exactly what its NumPy or pandas counterpart does.
+"""
+import logging
+from decimal import Decimal
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from pgfinder.errors import UserError
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.matching import clean_up as numpy_clean_up
+from pgfinder.matching import clean_up_candidates
+from pgfinder.matching import pick_most_likely_structures as numpy_pick_most_likely_structures
+from pgfinder.structures import StructureTable
+
+try:
+    import numba
+except ImportError:  # pragma: no cover - depends on the environment
+    numba = None
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+ENGINES = ("numpy", "jit", "reference")
+JIT_AVAILABLE = numba is not None
+
+
+def _jit(function):
+    """Compile a kernel with Numba, if it's installed."""
+    if numba is None:
+        return function
+    return numba.njit(cache=True, nogil=True)(function)
+
+
+def resolve_engine(engine: str = None) -> str:
+    """Check the name of an engine, falling back to ``numpy`` (with a warning) if ``jit`` isn't available.
+
+    Parameters
+    ----------
+    engine : str
+        ``numpy``, ``jit`` or ``reference``. Defaults to ``numpy``.
+
+    Returns
+    -------
+    str
+        The engine to use.
+    """
+    engine = engine or "numpy"
+    if engine not in ENGINES:
+        raise UserError(f"Unknown engine '{engine}', expected one of {', '.join(ENGINES)}.")
+    if engine == "jit" and not JIT_AVAILABLE:
+        LOGGER.warning("The jit engine needs Numba (pip install pgfinder[jit]), using the numpy engine instead")
+        return "numpy"
+    return engine
+
+
+def window_matches(observed: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Compiled equivalent of ``kernels.window_matches()``."""
+    order = np.argsort(observed, kind="stable")
+    sorted_masses = observed[order]
+    starts = np.searchsorted(sorted_masses, lower, side="left")
+    stops = np.maximum(np.searchsorted(sorted_masses, upper, side="right"), starts)
+    return _window_pairs(order, starts, stops)
+
+
+@_jit
+def _window_pairs(order, starts, stops):
+    """Pairs of window and observed position, with the positions within each window in their original order."""
+    total = 0
+    for w in range(len(starts)):
+        total += stops[w] - starts[w]
+    windows = np.empty(total, dtype=np.intp)
+    positions = np.empty(total, dtype=np.intp)
+    k = 0
+    for w in range(len(starts)):
+        block = np.sort(order[starts[w] : stops[w]])
+        for i in range(len(block)):
+            windows[k] = w
+            positions[k] = block[i]
+            k += 1
+    return windows, positions
+
+
+def clean_up(
+    ftrs_df: pd.DataFrame, mass_to_clean: Decimal, time_delta: float, structures: StructureTable = None
+) -> pd.DataFrame:
+    """Compiled equivalent of ``matching.clean_up()``.
+
+    The parents are swept in order, each against the adducts in its RT window (found with a binary search), with the
+    theoretical masses compared as integers in units of 0.00001 Da — the precision ``clean_up()`` quantizes to.
+    """
+    # Labels can be duplicated, so parents and adducts are picked out by position
+    parent_df, adduct_df = clean_up_candidates(
+        ftrs_df.set_axis(pd.RangeIndex(len(ftrs_df)), copy=False), mass_to_clean, structures
+    )
+    if parent_df.empty or adduct_df.empty:
+        return ftrs_df.copy()
+    parents = parent_df.index.to_numpy()
+    adducts = adduct_df.index.to_numpy()
+
+    rt = ftrs_df["RT (min)"].to_numpy()
+    if rt.dtype.kind != "f":
+        rt = rt.astype(float)
+    # The RT bounds are worked out as Python floats and then compared in the column's own precision, as pandas does
+    parent_rt = rt[parents].astype(float)
+    lower = (parent_rt - time_delta).astype(rt.dtype)
+    upper = (parent_rt + time_delta).astype(rt.dtype)
+    by_rt = np.argsort(rt[adducts], kind="stable")
+
+    theo_q, theo_valid = _quantized(ftrs_df["Theo (Da)"].to_numpy(dtype=float))
+    ids = pd.factorize(ftrs_df["ID"])[0]
+    id_rows, id_starts = _groups(ids)
+    labels = pd.factorize(ftrs_df.index)[0]
+    label_rows, label_starts = _groups(labels)
+    structure_codes = pd.factorize(ftrs_df["Inferred structure"])[0].astype(np.int64)
+    pairs = pd.factorize(ids.astype(np.int64) * (structure_codes.max() + 2) + structure_codes + 1)[0]
+    pair_rows, pair_starts = _groups(pairs)
+
+    snapshot = ftrs_df["Intensity"].to_numpy()
+    intensity = snapshot.copy()
+    alive = np.ones(len(ftrs_df), dtype=bool)
+    alive_per_id = np.bincount(ids, minlength=len(id_starts) - 1).astype(np.int64)
+
+    failed = _adduct_sweep(
+        parents,
+        adducts[by_rt],
+        rt[adducts][by_rt],
+        lower,
+        upper,
+        theo_q,
+        theo_valid,
+        int(mass_to_clean.scaleb(5)),
+        ids,
+        id_rows,
+        id_starts,
+        labels,
+        label_rows,
+        label_starts,
+        pairs,
+        pair_rows,
+        pair_starts,
+        snapshot,
+        intensity,
+        alive,
+        alive_per_id,
+    )
+    if failed:
+        # The feature of a parent has already been removed, which ``clean_up()`` reports as an error
+        return numpy_clean_up(ftrs_df, mass_to_clean, time_delta, structures)
+
+    consolidated_df = ftrs_df.copy()
+    consolidated_df["Intensity"] = intensity
+    return consolidated_df[alive]
+
+
+def _quantized(masses: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Masses quantized to 0.00001 Da (as ``Decimal.quantize()`` rounds them) in units of 0.00001 Da."""
+    values, inverse = np.unique(masses, return_inverse=True)
+    quantized = np.zeros(len(values), dtype=np.int64)
+    valid = np.isfinite(values)
+    for i in np.flatnonzero(valid):
+        quantized[i] = int(Decimal(float(values[i])).quantize(Decimal("0.00001")).scaleb(5))
+    return quantized[inverse], valid[inverse]
+
+
+def _groups(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Rows of each code, in frame order, and the offset of each code's rows."""
+    rows = np.argsort(codes, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=codes.max(initial=-1) + 1))])
+    return rows, starts
+
+
+@_jit
+def _adduct_sweep(
+    parents,
+    adducts_by_rt,
+    adduct_rt,
+    lower,
+    upper,
+    theo_q,
+    theo_valid,
+    delta_q,
+    ids,
+    id_rows,
+    id_starts,
+    labels,
+    label_rows,
+    label_starts,
+    pairs,
+    pair_rows,
+    pair_starts,
+    snapshot,
+    intensity,
+    alive,
+    alive_per_id,
+):
+    """Move the intensity of adducts onto their parents and remove the adducts, returning whether it went wrong."""
+    for k in range(len(parents)):
+        p = parents[k]
+        if not lower[k] <= upper[k]:
+            continue
+        window = np.sort(
+            adducts_by_rt[
+                np.searchsorted(adduct_rt, lower[k], side="left") : np.searchsorted(adduct_rt, upper[k], side="right")
+            ]
+        )
+        for a in window:
+            if not (theo_valid[p] and theo_valid[a]) or abs(theo_q[p] - theo_q[a]) != delta_q:
+                continue
+            # The first remaining row of the parent's feature receives the intensity
+            first = -1
+            for j in range(id_starts[ids[p]], id_starts[ids[p] + 1]):
+                if alive[id_rows[j]]:
+                    first = id_rows[j]
+                    break
+            if first < 0:
+                return True
+            if alive_per_id[ids[a]] == 0:
+                continue
+            # ... along with any other remaining row sharing its label
+            for j in range(label_starts[labels[first]], label_starts[labels[first] + 1]):
+                if alive[label_rows[j]]:
+                    intensity[label_rows[j]] += snapshot[a]
+            for j in range(pair_starts[pairs[a]], pair_starts[pairs[a] + 1]):
+                r = pair_rows[j]
+                if alive[r]:
+                    alive[r] = False
+                    alive_per_id[ids[r]] -= 1
+    return False
+
+
+def pick_most_likely_structures(df: pd.DataFrame, consolidation_ppm: float) -> pd.DataFrame:
+    """Compiled equivalent of ``matching.pick_most_likely_structures()``."""
+    matched = df["Inferred structure"].notna().to_numpy()
+    if not matched.any():
+        return numpy_pick_most_likely_structures(df, consolidation_ppm)
+    matched_df = df[matched]
+
+    groups = pd.factorize(matched_df["ID"])[0]
+    ppm = np.abs(matched_df["Delta ppm"].to_numpy(dtype=float))
+    structures = matched_df["Inferred structure"]
+    if isinstance(structures.dtype, pd.CategoricalDtype):
+        codes = structures.cat.codes.to_numpy().astype(np.int64)
+    else:
+        codes = pd.factorize(structures, sort=True)[0].astype(np.int64)
+    # By group (in order of appearance), then lowest absolute ppm, then structure (descending)
+    order = np.lexsort((-codes, ppm, groups))
+    groups, ppm = groups[order], ppm[order]
+
+    firsts, members = _consolidation(groups, ppm, float(consolidation_ppm))
+    names = structures.to_numpy(dtype=object)[order]
+    consolidated = np.empty(len(firsts), dtype=object)
+    member_groups = groups[members]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(member_groups, minlength=len(firsts)))])
+    member_names = names[members]
+    for g in range(len(firsts)):
+        consolidated[g] = ",   ".join(member_names[bounds[g] : bounds[g + 1]])
+
+    most_likely = matched_df.iloc[order].reset_index(drop=True)
+    structure_column = np.full(len(most_likely), np.nan, dtype=object)
+    structure_column[firsts] = consolidated
+    intensity = most_likely["Intensity"].to_numpy()
+    # Groups of a single row keep the dtype of the intensities, as they do with ``DataFrame.at``
+    single_rows = len(firsts) == len(most_likely) and matched.all()
+    intensity_column = np.full(len(most_likely), np.nan)
+    intensity_column[firsts] = intensity[firsts]
+    most_likely["Inferred structure (consolidated)"] = structure_column
+    most_likely["Intensity (consolidated)"] = intensity[firsts] if single_rows else intensity_column
+
+    merged_df = pd.concat([most_likely, df[~matched]])
+    return merged_df.reset_index(drop=True)
+
+
+@_jit
+def _consolidation(groups, ppm, consolidation_ppm):
+    """First row of each group and the rows within ``consolidation_ppm`` of it, for rows sorted by group and ppm."""
+    firsts = np.empty(groups[-1] + 1, dtype=np.intp)
+    members = np.empty(len(groups), dtype=np.bool_)
+    first = 0
+    for i in range(len(groups)):
+        if i == 0 or groups[i] != groups[i - 1]:
+            first = i
+            firsts[groups[i]] = i
+        members[i] = abs(ppm[first] - ppm[i]) < consolidation_ppm
+    return firsts, members
@@ -0,0 +1,177 @@
+"""Vectorised mass-window kernels shared by the analysis code"""
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def read_only(array: np.ndarray) -> np.ndarray:
+    """Mark an array as read-only so it can be shared safely between threads."""
+    array.flags.writeable = False
+    return array
+
+
+def ppm_windows(masses: np.ndarray, ppm: float):
+    """Lower and upper mass bounds of the ppm window around each theoretical mass.
+
+    The arithmetic mirrors ``calc_ppm_tolerance()`` and ``matching()`` so that the same observed masses fall inside
+    each window.
+
+    Parameters
+    ----------
+    masses : np.ndarray
+        Theoretical masses.
+    ppm : float
+        Tolerance in parts per million.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Read-only arrays of the lower and upper bounds of each window.
+    """
+    tolerance = (masses * ppm) / 1000000
+    return read_only(masses - tolerance), read_only(masses + tolerance)
+
+
+def sorted_observed(raw_data_df: pd.DataFrame) -> np.ndarray:
+    """Sorted observed masses of a sample."""
+    return np.sort(raw_data_df["Obs (Da)"].to_numpy(dtype=float))
+
+
+def window_hits(sorted_observed: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """Whether any observed mass falls within each [lower, upper] window.
+
+    Parameters
+    ----------
+    sorted_observed : np.ndarray
+        Observed masses, sorted in ascending order.
+    lower : np.ndarray
+        Lower bound of each window.
+    upper : np.ndarray
+        Upper bound of each window.
+
+    Returns
+    -------
+    np.ndarray
+        Boolean array, one entry per window.
+    """
+    return np.searchsorted(sorted_observed, upper, side="right") > np.searchsorted(sorted_observed, lower, side="left")
+
+
+def max_matchable_mass(sorted_observed: np.ndarray, ppm: float) -> float:
+    """The largest theoretical mass whose ppm window can still contain an observed mass."""
+    if len(sorted_observed) == 0:
+        return -np.inf
+    return float(sorted_observed[-1] / (1 - ppm / 1000000))
+
+
+def window_matches(observed: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Every pair of a window and an observed mass that falls within it.
+
+    Pairs are ordered by window and then by the position of the observed mass, the order ``matching()`` finds them in.
+
+    Parameters
+    ----------
+    observed : np.ndarray
+        Observed masses, in their original order.
+    lower : np.ndarray
+        Lower bound of each window.
+    upper : np.ndarray
+        Upper bound of each window.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Index of the window and position of the observed mass for each match.
+    """
+    order = np.argsort(observed, kind="stable")
+    sorted_masses = observed[order]
+    starts = np.searchsorted(sorted_masses, lower, side="left")
+    counts = np.maximum(np.searchsorted(sorted_masses, upper, side="right") - starts, 0)
+    windows = np.repeat(np.arange(len(lower)), counts)
+    offsets = np.arange(len(windows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = order[starts[windows] + offsets]
+    by_position = np.lexsort((positions, windows))
+    return windows[by_position], positions[by_position]
+
+
+def grouped_window_matches(
+    observed: np.ndarray, groups: np.ndarray, lower: np.ndarray, upper: np.ndarray, window_groups: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Every pair of a window and an observed mass of the same group (e.g. sample) that falls within it.
+
+    Gives, for each group, the pairs ``window_matches()`` finds for the windows and observed masses of that group
+    alone, in the same order.
+
+    Parameters
+    ----------
+    observed : np.ndarray
+        Observed masses, in their original order.
+    groups : np.ndarray
+        Integer group of each observed mass.
+    lower : np.ndarray
+        Lower bound of each window.
+    upper : np.ndarray
+        Upper bound of each window.
+    window_groups : np.ndarray
+        Integer group of each window.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Index of the window and position of the observed mass for each match.
+    """
+    order = np.lexsort((observed, groups))
+    sorted_groups, sorted_masses = groups[order], observed[order]
+    starts = _grouped_searchsorted(sorted_groups, sorted_masses, window_groups, lower, "left")
+    counts = np.maximum(_grouped_searchsorted(sorted_groups, sorted_masses, window_groups, upper, "right") - starts, 0)
+    windows = np.repeat(np.arange(len(lower)), counts)
+    offsets = np.arange(len(windows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = order[starts[windows] + offsets]
+    by_position = np.lexsort((positions, windows))
+    return windows[by_position], positions[by_position]
+
+
+def _grouped_searchsorted(
+    sorted_groups: np.ndarray, sorted_values: np.ndarray, groups: np.ndarray, values: np.ndarray, side: str
+) -> np.ndarray:
+    """``np.searchsorted()`` of (group, value) pairs among pairs sorted by group and then value."""
+    # Merged with the sorted pairs, queries go before equal pairs when searching from the left and after from the right
+    query_first = side == "left"
+    tags = np.concatenate([np.full(len(sorted_values), query_first), np.full(len(values), not query_first)])
+    merged = np.lexsort((tags, np.concatenate([sorted_values, values]), np.concatenate([sorted_groups, groups])))
+    is_query = merged >= len(sorted_values)
+    # Each query is preceded by as many pairs as its position in the merged order, less the queries before it
+    queries_before = np.cumsum(is_query) - 1
+    positions = np.empty(len(values), dtype=np.intp)
+    positions[merged[is_query] - len(sorted_values)] = np.flatnonzero(is_query) - queries_before[is_query]
+    return positions
+
+
+def isobaric_matches(windows: np.ndarray, positions: np.ndarray, isobaric: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Expand the matches of unique masses into the matches of every structure with one of those masses.
+
+    Structures with the same (isobaric) mass have the same ppm window and so match the same observed masses, which
+    only need to be found once per mass.
+
+    Parameters
+    ----------
+    windows : np.ndarray
+        Unique mass of each match, as returned by ``window_matches()`` for the windows of the unique masses.
+    positions : np.ndarray
+        Position of the observed mass of each match.
+    isobaric : np.ndarray
+        Unique mass of each structure, e.g. the inverse returned by ``np.unique()``.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Index of the structure and position of the observed mass for each match, in the order ``window_matches()``
+        would give them for the windows of every structure.
+    """
+    counts = np.bincount(windows, minlength=isobaric.max(initial=-1) + 1)
+    starts = np.cumsum(counts) - counts
+    structure_counts = counts[isobaric]
+    structures = np.repeat(np.arange(len(isobaric)), structure_counts)
+    offsets = np.arange(len(structures)) - np.repeat(np.cumsum(structure_counts) - structure_counts, structure_counts)
+    return structures, positions[starts[isobaric[structures]] + offsets]
@@ -0,0 +1,378 @@
+"""Build mass libraries by enumerating glycan and stem peptide combinations.
+
+Libraries are described by a YAML file of composition rules. Each entry under ``structures`` describes a family of
+structures as a glycan chain (a list of disaccharide positions) and optionally a stem peptide (a list of residue
+positions). Every position lists the alternatives allowed there, either as a list or as the name of one of the
+``sets`` defined in the rules (or of a single residue). For example, the built-in *Escherichia coli* "Complex"
+library is described by:
+
+.. code-block:: yaml
+
+    sets:
+      X: [A, C, D, E, F, G, H, I, K, L, M, N, P, Q, R, S, T, V, W, Y]
+    structures:
+      - glycan:
+          positions: [gm, gm, gm]
+          min_length: 1
+      - glycan:
+          positions: [gm]
+        stem:
+          positions: [A, E, J, X, X]
+          min_length: 1
+
+Chains and stems can be shortened down to their ``min_length`` (by default they always use every position). Groups of
+positions listed under ``unordered`` (numbered from 1) are treated as interchangeable: only one ordering of each
+combination of residues is generated, which removes the isobaric structures that differ only by swapping those
+residues. Masses are the ``terminal`` mass plus the residue masses from ``config/residue_masses.yaml`` (which can be
+extended with a ``residues`` section in the rules) and structures outside of an optional ``mass_range`` are pruned
+without being enumerated.
+"""
+import csv
+import logging
+import re
+from decimal import Decimal
+from itertools import product
+from pathlib import Path
+from pkgutil import get_data
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import yaml
+from yaml.error import YAMLError
+
+from pgfinder.compiled_library import write_compiled_library
+from pgfinder.errors import UserError
+from pgfinder.logs.logs import LOGGER_NAME
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+RESIDUE_MASSES_FILE = "config/residue_masses.yaml"
+
+
+class Chain:
+    """A glycan chain or stem peptide: the alternatives allowed at each position and their masses.
+
+    Parameters
+    ----------
+    spec : Dict
+        The ``glycan`` or ``stem`` section of a family of structures.
+    sets : Dict
+        Named sets of alternatives that positions can refer to.
+    masses : Dict[str, Decimal]
+        Mass of every allowed alternative.
+    """
+
+    def __init__(self, spec: Dict, sets: Dict, masses: Dict[str, Decimal]):
+        unknown_keys = set(spec) - {"positions", "min_length", "unordered"}
+        if unknown_keys:
+            raise UserError(f"Unknown key(s) {sorted(unknown_keys)} in library rules.")
+        try:
+            positions = list(spec["positions"])
+        except (KeyError, TypeError) as e:
+            raise UserError("Each glycan chain and stem peptide in the library rules needs a list of positions.") from e
+        self.positions = [_alternatives(p, sets) for p in positions]
+        for alternatives in self.positions:
+            for alternative in alternatives:
+                if alternative not in masses:
+                    raise UserError(f"The residue '{alternative}' in the library rules has no known mass.")
+        self.masses = [[masses[a] for a in alternatives] for alternatives in self.positions]
+        self.min_length = int(spec.get("min_length", len(self.positions)))
+        if not 0 <= self.min_length <= len(self.positions):
+            raise UserError(f"min_length must be between 0 and {len(self.positions)} in the library rules.")
+
+        # Each position of an unordered group must use an alternative at or after the one used by the previous position
+        self.previous = [None] * len(self.positions)
+        for group in spec.get("unordered", []):
+            group = sorted(int(p) - 1 for p in group)
+            if group[0] < 0 or group[-1] >= len(self.positions):
+                raise UserError(
+                    f"Unordered positions must be between 1 and {len(self.positions)} in the library rules."
+                )
+            for previous, position in zip(group, group[1:]):
+                if self.positions[previous] != self.positions[position]:
+                    raise UserError("Unordered positions in the library rules must allow the same alternatives.")
+                self.previous[position] = previous
+
+
+def load_rules(file: Union[str, Path]) -> Dict:
+    """Read library composition rules from a YAML file.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        YAML file of composition rules.
+
+    Returns
+    -------
+    Dict
+        Composition rules.
+    """
+    try:
+        with Path(file).open() as f:
+            rules = yaml.safe_load(f)
+    except YAMLError as e:
+        raise UserError(f"The library rules in '{file}' are not valid YAML.") from e
+    if not isinstance(rules, dict) or not isinstance(rules.get("structures"), list):
+        raise UserError(f"The library rules in '{file}' need a list of 'structures'.")
+    return rules
+
+
+def residue_masses(overrides: Dict = None) -> Dict:
+    """Load the table of residue masses, optionally extended or overridden.
+
+    Parameters
+    ----------
+    overrides : Dict
+        Entries to add to (or replace in) the built-in ``terminal``, ``glycan`` and ``amino_acid`` masses.
+
+    Returns
+    -------
+    Dict
+        The ``terminal`` mass and the ``glycan`` and ``amino_acid`` residue masses, as Decimals.
+    """
+    table = yaml.safe_load(get_data(__package__, RESIDUE_MASSES_FILE))
+    for key, value in (overrides or {}).items():
+        if key not in table:
+            raise UserError(f"Unknown residue mass section '{key}' in library rules.")
+        if isinstance(value, dict):
+            table[key].update(value)
+        else:
+            table[key] = value
+    return {
+        "terminal": _decimal(table["terminal"]),
+        "glycan": {unit: _decimal(mass) for unit, mass in table["glycan"].items()},
+        "amino_acid": {residue: _decimal(mass) for residue, mass in table["amino_acid"].items()},
+    }
+
+
+def enumerate_structures(
+    rules: Dict,
+    mass_range: Optional[Tuple[float, float]] = None,
+    unique_masses: bool = False,
+    decimals: int = 6,
+) -> Iterator[Tuple[str, Decimal]]:
+    """Lazily enumerate the structures described by a set of composition rules.
+
+    Parameters
+    ----------
+    rules : Dict
+        Composition rules, as returned by ``load_rules()``.
+    mass_range : Optional[Tuple[float, float]]
+        Only structures with masses in this range are generated; overrides the ``mass_range`` in the rules.
+    unique_masses : bool
+        Only keep the first structure generated for each mass (at ``decimals`` decimal places). Unlike ``unordered``
+        positions this needs to remember every mass generated so far.
+    decimals : int
+        Decimal places masses are rounded to.
+
+    Yields
+    ------
+    Tuple[str, Decimal]
+        Structure name and monoisotopic mass.
+    """
+    masses = residue_masses(rules.get("residues"))
+    sets = rules.get("sets", {})
+    mass_range = mass_range or rules.get("mass_range") or (0, "Infinity")
+    lower, upper = (_decimal(m) for m in mass_range)
+    quantum = Decimal(1).scaleb(-decimals)
+    disaccharide_masses = _DisaccharideMasses(masses["glycan"])
+
+    seen = set()
+    for family in rules["structures"]:
+        unknown_keys = set(family) - {"glycan", "stem"}
+        if unknown_keys or "glycan" not in family:
+            raise UserError("Each of the library 'structures' needs a 'glycan' and, optionally, a 'stem'.")
+        glycan = Chain(family["glycan"], sets, disaccharide_masses)
+        stem = Chain(family["stem"], sets, masses["amino_acid"]) if "stem" in family else None
+
+        stem_lengths = range(stem.min_length, len(stem.positions) + 1) if stem else [0]
+        for glycan_length, stem_length in product(range(glycan.min_length, len(glycan.positions) + 1), stem_lengths):
+            if glycan_length == 0 and stem_length == 0:
+                continue
+            for glycan_units, stem_residues, mass in _combinations(
+                glycan, glycan_length, stem, stem_length, masses["terminal"], lower, upper
+            ):
+                mass = mass.quantize(quantum)
+                if unique_masses:
+                    if mass in seen:
+                        continue
+                    seen.add(mass)
+                name = "-".join(glycan_units)
+                if stem_residues:
+                    name = (name + "-" if name else "") + "".join(stem_residues)
+                yield f"{name}|{1 if stem_residues else 0}", mass
+
+
+def write_library_csv(structures: Iterable[Tuple[str, Decimal]], file: Union[str, Path], decimals: int = 6) -> int:
+    """Stream structures to a mass library CSV.
+
+    Parameters
+    ----------
+    structures : Iterable[Tuple[str, Decimal]]
+        Structure names and masses.
+    file : Union[str, Path]
+        CSV file to write.
+    decimals : int
+        Decimal places masses are written with.
+
+    Returns
+    -------
+    int
+        Number of structures written.
+    """
+    count = 0
+    with Path(file).open("w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["Structure", "Monoisotopicmass"])
+        for name, mass in structures:
+            writer.writerow([name, f"{mass:.{decimals}f}"])
+            count += 1
+    return count
+
+
+def build_library(
+    rules_file: Union[str, Path],
+    csv_file: Union[str, Path] = None,
+    compiled_file: Union[str, Path] = None,
+    mass_range: Optional[Tuple[float, float]] = None,
+    unique_masses: bool = False,
+    decimals: int = 6,
+    chunk_size: int = 1_000_000,
+) -> int:
+    """Build a mass library from composition rules, writing it as CSV and/or in the compiled binary format.
+
+    Structures are streamed from the enumeration straight to the outputs, so arbitrarily large libraries can be
+    built; at most ``chunk_size`` structures are held in memory while sorting the compiled library.
+
+    Parameters
+    ----------
+    rules_file : Union[str, Path]
+        YAML file of composition rules.
+    csv_file : Union[str, Path]
+        Mass library CSV to write.
+    compiled_file : Union[str, Path]
+        Compiled mass library to write.
+    mass_range : Optional[Tuple[float, float]]
+        Only structures with masses in this range are kept; overrides the ``mass_range`` in the rules.
+    unique_masses : bool
+        Only keep the first structure of each mass.
+    decimals : int
+        Decimal places masses are rounded to.
+    chunk_size : int
+        Number of structures sorted in memory at once when writing a compiled library.
+
+    Returns
+    -------
+    int
+        Number of structures in the library.
+    """
+    if csv_file is None and compiled_file is None:
+        raise UserError("Please give a CSV and/or compiled file to write the mass library to.")
+    rules = load_rules(rules_file)
+    structures = enumerate_structures(rules, mass_range=mass_range, unique_masses=unique_masses, decimals=decimals)
+
+    if csv_file is not None and compiled_file is not None:
+        # Write the CSV as a side-effect of streaming the structures into the compiled library
+        csv_path = Path(csv_file)
+        with csv_path.open("w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["Structure", "Monoisotopicmass"])
+
+            def tee(structures):
+                for name, mass in structures:
+                    writer.writerow([name, f"{mass:.{decimals}f}"])
+                    yield name, mass
+
+            count = _write_compiled(tee(structures), compiled_file, rules_file, csv_path.name, chunk_size)
+    elif csv_file is not None:
+        count = write_library_csv(structures, csv_file, decimals=decimals)
+    else:
+        count = _write_compiled(structures, compiled_file, rules_file, None, chunk_size)
+
+    LOGGER.info(f"Mass library built with {count} structures from : {rules_file}")
+    return count
+
+
+def _write_compiled(
+    structures: Iterator, compiled_file: Union[str, Path], rules_file: Union[str, Path], source: str, chunk_size: int
+) -> int:
+    metadata = {"source": source or Path(compiled_file).name, "rules": Path(rules_file).name}
+    return write_compiled_library(structures, compiled_file, metadata=metadata, chunk_size=chunk_size)
+
+
+def _combinations(
+    glycan: Chain,
+    glycan_length: int,
+    stem: Optional[Chain],
+    stem_length: int,
+    terminal: Decimal,
+    lower: Decimal,
+    upper: Decimal,
+) -> Iterator[Tuple[List[str], List[str], Decimal]]:
+    """Depth-first enumeration of every glycan and stem of the given lengths with a mass in [lower, upper]."""
+    alternatives = glycan.positions[:glycan_length] + (stem.positions[:stem_length] if stem else [])
+    masses = glycan.masses[:glycan_length] + (stem.masses[:stem_length] if stem else [])
+    previous = glycan.previous[:glycan_length] + [
+        None if p is None else p + glycan_length for p in (stem.previous[:stem_length] if stem else [])
+    ]
+    depth = len(alternatives)
+
+    # Lightest and heaviest possible mass of the positions after each one, used to prune the search
+    min_after = [Decimal(0)] * (depth + 1)
+    max_after = [Decimal(0)] * (depth + 1)
+    for i in reversed(range(depth)):
+        min_after[i] = min_after[i + 1] + min(masses[i])
+        max_after[i] = max_after[i + 1] + max(masses[i])
+
+    chosen = [0] * depth
+
+    def search(position: int, mass: Decimal):
+        if position == depth:
+            residues = [alternatives[i][chosen[i]] for i in range(depth)]
+            yield residues[:glycan_length], residues[glycan_length:], mass
+            return
+        start = 0 if previous[position] is None else chosen[previous[position]]
+        for i in range(start, len(masses[position])):
+            new_mass = mass + masses[position][i]
+            if new_mass + min_after[position + 1] > upper or new_mass + max_after[position + 1] < lower:
+                continue
+            chosen[position] = i
+            yield from search(position + 1, new_mass)
+
+    yield from search(0, terminal)
+
+
+class _DisaccharideMasses(dict):
+    """Masses of glycan chain positions (e.g. ``gm`` or ``g(-Ac)m``), worked out from their units on demand."""
+
+    def __init__(self, units: Dict[str, Decimal]):
+        super().__init__()
+        self.units = units
+        # Match the longest unit names first so that e.g. `g(-Ac)` isn't read as `g`
+        pattern = "|".join(re.escape(u) for u in sorted(units, key=len, reverse=True))
+        self.pattern = re.compile(f"({pattern})")
+
+    def __contains__(self, name) -> bool:
+        try:
+            self[name]
+        except KeyError:
+            return False
+        return True
+
+    def __missing__(self, name: str) -> Decimal:
+        units = [u for u in self.pattern.split(name) if u]
+        if not units or not all(u in self.units for u in units):
+            raise KeyError(name)
+        self[name] = sum(self.units[u] for u in units)
+        return self[name]
+
+
+def _alternatives(position: Union[str, List[str]], sets: Dict) -> List[str]:
+    """Alternatives allowed at a position, given as a list, the name of a set or a single residue."""
+    if isinstance(position, list):
+        return [str(p) for p in position]
+    return [str(p) for p in sets.get(position, [position])]
+
+
+def _decimal(value) -> Decimal:
+    """Convert a number read from YAML to a Decimal without picking up binary floating point noise."""
+    return Decimal(str(value))
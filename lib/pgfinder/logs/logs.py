@@ -1,17 +1,20 @@
 """
 Standardise logging.
+
+Records are put on a queue by the ``pgfinder`` logger and written out by a ``QueueListener`` thread, so analyses never
+wait on stream or file I/O. Nothing is written to disk unless a log file is asked for.
 """
+import atexit
 import logging
+import os
+import queue
 import sys
-from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
+from typing import Union
 
 # pylint: disable=assignment-from-no-return
 
-start = datetime.now()
-LOG_CONFIG = logging.basicConfig(
-    filename=Path().cwd().stem + f"-{start.strftime('%Y-%m-%d-%H-%M-%S')}.log", filemode="w"
-)
 LOG_FORMATTER = logging.Formatter(
     fmt="[%(asctime)s] [%(levelname)-8s] [%(name)s] %(message)s", datefmt="%a, %d %b %Y %H:%M:%S"
 )
@@ -22,20 +25,27 @@ LOG_ERROR_FORMATTER = logging.Formatter(
 
 LOGGER_NAME = "pgfinder"
 
+# The listener writing out this process's queued records, and the log file it writes to (if any)
+_LISTENER = None
+_LOG_FILE = None
+
 
-def setup_logger(log_name: str = LOGGER_NAME) -> logging.Logger:
+def setup_logger(log_name: str = LOGGER_NAME, log_file: Union[str, Path] = None) -> logging.Logger:
     """Setup a standard logger.
 
     The logger for the module is initialised when the module is loaded (as this functions is called from
-    __init__.py). This creates two stream handlers, one for general output and one for errors which are formatted
-    differently (there is greater information in the error formatter). To use in modules import the 'LOGGER_NAME' and
-    create a logger as shown in the Examples, it will inherit the formatting and direction of messages to the correct
-    stream.
+    __init__.py). Records are handed to a queue and written by a listener thread to two stream handlers, one for
+    general output and one for errors which are formatted differently (there is greater information in the error
+    formatter), and to ``log_file`` if one is given. To use in modules import the 'LOGGER_NAME' and create a logger as
+    shown in the Examples, it will inherit the formatting and direction of messages to the correct stream.
 
     Parameters
     ----------
     log_name : str
         Name under which logging information occurs.
+    log_file : Union[str, Path]
+        File to also write the log to. ``{pid}`` in the name is replaced by the process ID, so that each process of a
+        pool writes its own file. Calling ``setup_logger()`` again with a different file moves the log to it.
 
     Returns
     -------
@@ -48,12 +58,43 @@ def setup_logger(log_name: str = LOGGER_NAME) -> logging.Logger:
     To use the logger in (sub-)modules have the following.
 
         import logging
-        from topostats.logs.logs import LOGGER_NAME
+        from pgfinder.logs.logs import LOGGER_NAME
 
         LOGGER = logging.getLogger(LOGGER_NAME)
 
         LOGGER.info('This is a log message.')
     """
+    global _LOG_FILE  # pylint: disable=global-statement
+
+    logger = logging.getLogger(log_name)
+    logger.setLevel(logging.INFO)
+    if log_file is not None:
+        _LOG_FILE = log_file
+    queue_handler = next((h for h in logger.handlers if isinstance(h, QueueHandler)), None)
+    if queue_handler is None or log_file is not None or _LISTENER is None:
+        if queue_handler is not None:
+            logger.removeHandler(queue_handler)
+        logger.addHandler(_start_listener())
+
+    return logger
+
+
+def stop_logging() -> None:
+    """Write out any queued records and stop the listener thread."""
+    global _LISTENER  # pylint: disable=global-statement
+
+    if _LISTENER is not None:
+        _LISTENER.stop()
+        for handler in _LISTENER.handlers:
+            handler.close()
+        _LISTENER = None
+
+
+def _start_listener() -> QueueHandler:
+    """Start a listener for this process, replacing any running one, and return the handler feeding it."""
+    global _LISTENER  # pylint: disable=global-statement
+
+    stop_logging()
     out_stream_handler = logging.StreamHandler(sys.stdout)
     out_stream_handler.setLevel(logging.DEBUG)
     out_stream_handler.setFormatter(LOG_FORMATTER)
@@ -62,10 +103,32 @@ def setup_logger(log_name: str = LOGGER_NAME) -> logging.Logger:
     err_stream_handler.setLevel(logging.ERROR)
     err_stream_handler.setFormatter(LOG_ERROR_FORMATTER)
 
-    logger = logging.getLogger(log_name)
-    logger.setLevel(logging.INFO)
-    if not logger.handlers:
-        logger.addHandler(out_stream_handler)
-        logger.addHandler(err_stream_handler)
+    handlers = [out_stream_handler, err_stream_handler]
+    if _LOG_FILE is not None:
+        file_handler = logging.FileHandler(str(_LOG_FILE).format(pid=os.getpid()), mode="a", delay=True)
+        file_handler.setLevel(logging.DEBUG)
+        file_handler.setFormatter(LOG_FORMATTER)
+        handlers.append(file_handler)
 
-    return logger
+    records = queue.SimpleQueue()
+    _LISTENER = QueueListener(records, *handlers, respect_handler_level=True)
+    _LISTENER.start()
+    return QueueHandler(records)
+
+
+def _restart_in_child() -> None:
+    """Give a forked process its own queue and listener, as the parent's listener thread isn't copied into it."""
+    global _LISTENER  # pylint: disable=global-statement
+
+    if _LISTENER is None:
+        return
+    _LISTENER = None
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in [h for h in logger.handlers if isinstance(h, QueueHandler)]:
+        logger.removeHandler(handler)
+    logger.addHandler(_start_listener())
+
+
+atexit.register(stop_logging)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_restart_in_child)
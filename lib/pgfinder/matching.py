@@ -2,6 +2,8 @@
 import logging
 import re
 from decimal import Decimal
+from functools import lru_cache
+from typing import Callable, List, Tuple, Union
 
 import pandas as pd
 from pandas.api.types import is_numeric_dtype
@@ -9,6 +11,7 @@ from pandas.api.types import is_numeric_dtype
 from pgfinder import MASS_TO_CLEAN, MOD_TYPE, MULTIMERS
 from pgfinder.errors import UserError
 from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.structures import StructureTable, parse_structure
 
 LOGGER = logging.getLogger(LOGGER_NAME)
 
@@ -84,11 +87,9 @@ def multimer_builder(theo_df, multimer_type: str):
     # Builder sub function - calculates multimer mass and name
     def builder(name, mass, mult_num: int):
         for _, row in theo_df.iterrows():
-            if (
-                len(row["Inferred structure"][: len(row["Inferred structure"]) - 2]) > 2
-            ):  # Prevent dimer creation using just gm (input format is XX|n) X = letters n = number
+            acceptor = parse_structure(row["Inferred structure"]).core
+            if len(acceptor) > 2:  # Prevent dimer creation using just gm
                 mw = row["Theo (Da)"]
-                acceptor = row["Inferred structure"][: len(row["Inferred structure"]) - 2]
                 donor = name
                 donor_mw = mass
                 theo_mw.append(Decimal(mw) + donor_mw + Decimal("-18.0106"))
@@ -124,19 +125,40 @@ def modification_generator(filtered_theo_df: pd.DataFrame, mod_type: str) -> pd.
         Pandas DataFrame of ???
     """
     mod_mass = Decimal(MOD_TYPE[mod_type]["mass"])
-    # NOTE: This regex extracts the modification abbrevation from the end of its full name / type —
-    # it simply extracts the bracketed expression at the end of the line
-    mod_abbr = re.search(r"\(.*\)$", mod_type).group(0)
 
     obs_theo_muropeptides_df = filtered_theo_df.copy()
     # Calculate new mass of modified structure
     obs_theo_muropeptides_df["Theo (Da)"] = obs_theo_muropeptides_df["Theo (Da)"].map(lambda x: Decimal(x) + mod_mass)
 
-    # Add modification tags to structure name — there are some special cases that need handling first!
+    # Add modification tags to structure name
+    base_structure = obs_theo_muropeptides_df["Inferred structure"]
+    structure_updater = modified_structure_namer(mod_type)
+
+    obs_theo_muropeptides_df["Inferred structure"] = base_structure.map(structure_updater)
+    return obs_theo_muropeptides_df
+
+
+def modified_structure_namer(mod_type: str) -> Callable[[str], str]:
+    """Get the function that adds the tag of a modification to structure names.
+
+    Parameters
+    ----------
+    mod_type : str
+        Modification type.
+
+    Returns
+    -------
+    Callable[[str], str]
+        Function taking the name of a structure and returning the name of its modified form.
+    """
+    # NOTE: This regex extracts the modification abbrevation from the end of its full name / type —
+    # it simply extracts the bracketed expression at the end of the line
+    mod_abbr = re.search(r"\(.*\)$", mod_type).group(0)
+
+    # There are some special cases that need handling first!
     # FIXME: Kinda pointless to have a file that the user can use to define custom modifications if
     # we're going to hard-code in special cases anyways? I suppose they can still add their own as
     # long as they don't also want any sort of "special" formatting
-    base_structure = obs_theo_muropeptides_df["Inferred structure"]
     # FIXME: Absolutely no validation that these structures make sense or are chemically possible —
     # even modifications like "Loss of GlcNAc" don't guarantee that a `g` character is removed from
     # the structure's name. It just chops off the first character with reckless abandon...
@@ -148,15 +170,13 @@ def modification_generator(filtered_theo_df: pd.DataFrame, mod_type: str) -> pd.
         "Loss of GlcNAc (-g)": lambda s: s[1:],
     }
 
-    # The silly `len(s) - 2` rubbish here is to preserve the `|x` multimer number at the end of
-    # each structure name
+    # The tag goes before the `|x` multimer number at the end of each structure name (stripping the
+    # space left by any modification tag added before this one)
     def default_case(s):
-        return s[: len(s) - 2] + " " + mod_abbr + " " + s[len(s) - 2 : len(s)]
+        core = parse_structure(s).core
+        return core.rstrip() + " " + mod_abbr + " " + s[len(core) :]
 
-    structure_updater = special_cases.get(mod_type, default_case)
-
-    obs_theo_muropeptides_df["Inferred structure"] = base_structure.map(structure_updater)
-    return obs_theo_muropeptides_df
+    return special_cases.get(mod_type, default_case)
 
 
 def matching(ftrs_df: pd.DataFrame, matching_df: pd.DataFrame, set_ppm: int) -> pd.DataFrame:
@@ -196,22 +216,24 @@ def matching(ftrs_df: pd.DataFrame, matching_df: pd.DataFrame, set_ppm: int) ->
     return pd.concat([matches_df, unmatched])
 
 
-def clean_up(ftrs_df: pd.DataFrame, mass_to_clean: Decimal, time_delta: float) -> pd.DataFrame:
-    """Clean up a DataFrame.
+def clean_up_candidates(
+    ftrs_df: pd.DataFrame, mass_to_clean: Decimal, structures: StructureTable = None
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Select the parent and adduct rows considered by ``clean_up()``.
 
     Parameters
     ----------
     ftrs_df: pd.DataFrame
-        Features dataframe?
+        Matched features.
     mass_to_clean: Decimal
-        Mass to be cleaned.
-    time_delta: float
-        ?
+        Mass to be cleaned, one of the adduct or decay masses.
+    structures: StructureTable
+        Parsed structures of ``ftrs_df``. Optional.
 
     Returns
     -------
-    pd.DataFrame:
-        ?
+    Tuple[pd.DataFrame, pd.DataFrame]
+        The parent and the adduct rows of ``ftrs_df``.
     """
     # Get the type of adduct based on the mass_to_clean (which is a float)
     adducts = {"sodiated": Decimal("21.9819"), "potassated": Decimal("37.9559"), "decay": Decimal("203.0793")}
@@ -222,14 +244,18 @@ def clean_up(ftrs_df: pd.DataFrame, mass_to_clean: Decimal, time_delta: float) -
     parent = MASS_TO_CLEAN[adduct]["parent"]
     target = MASS_TO_CLEAN[adduct]["target"]
 
+    if structures is None:
+        parent_mask = ftrs_df["Inferred structure"].str.contains(parent, na=False)
+        target_mask = ftrs_df["Inferred structure"].str.contains(target, na=False)
+    else:
+        parent_mask = structures.mask(ftrs_df["Inferred structure"], structures.parents[adduct])
+        target_mask = structures.mask(ftrs_df["Inferred structure"], structures.targets[adduct])
+
     # Generate parent dataframe - contains parents
-    parent_muropeptide_df = ftrs_df.loc[ftrs_df["Inferred structure"].str.contains(parent, na=False)]
+    parent_muropeptide_df = ftrs_df.loc[parent_mask]
 
     # Generate adduct dataframe - contains adducts
-    adducted_muropeptide_df = ftrs_df.loc[ftrs_df["Inferred structure"].str.contains(target, na=False)]
-
-    # Generate copy of rawdata dataframe
-    consolidated_decay_df = ftrs_df.copy()
+    adducted_muropeptide_df = ftrs_df.loc[target_mask]
 
     # Status updates (prints to console)
     if parent_muropeptide_df.empty:
@@ -243,64 +269,115 @@ def clean_up(ftrs_df: pd.DataFrame, mass_to_clean: Decimal, time_delta: float) -
     elif mass_to_clean == adducts["decay"]:
         LOGGER.info(f"Processing {adducted_muropeptide_df.size} in source decay products")
 
+    return parent_muropeptide_df, adducted_muropeptide_df
+
+
+def clean_up(
+    ftrs_df: pd.DataFrame, mass_to_clean: Decimal, time_delta: float, structures: StructureTable = None
+) -> pd.DataFrame:
+    """Clean up a DataFrame.
+
+    Parameters
+    ----------
+    ftrs_df: pd.DataFrame
+        Features dataframe?
+    mass_to_clean: Decimal
+        Mass to be cleaned.
+    time_delta: float
+        ?
+    structures: StructureTable
+        Parsed structures of ``ftrs_df``, used to select parents and adducts with their precomputed flags rather
+        than by searching every structure name. Optional.
+
+    Returns
+    -------
+    pd.DataFrame:
+        ?
+    """
+    parent_muropeptide_df, adducted_muropeptide_df = clean_up_candidates(ftrs_df, mass_to_clean, structures)
+
+    # Generate copy of rawdata dataframe
+    consolidated_decay_df = ftrs_df.copy()
+
+    # Isobaric structures matched to the same feature share its retention time and theoretical mass, so the adducts
+    # they can be consolidated with are only looked for once for each retention time and mass
+    partners = {}
+
     # Consolidate adduct intensity with parent ions intensity
     for _y, row in parent_muropeptide_df.iterrows():
         # Get retention time value from row
         rt = row["RT (min)"]
         # Get theoretical monoisotopic mass value from row as list of values
         intact_mw = row["Theo (Da)"]
-
-        # Work out rt window
-        upper_lim_rt = rt + time_delta
-        lower_lim_rt = rt - time_delta
-
-        # Get all adducts within rt window
-        ins_constrained_df = adducted_muropeptide_df[
-            adducted_muropeptide_df["RT (min)"].between(lower_lim_rt, upper_lim_rt, inclusive="both")
-        ]
-        if not ins_constrained_df.empty:
-            # Loop through each of the adducts in the RT window, the adducts
-            # themselves all have structures containing the `target` string
-            for _z, ins_row in ins_constrained_df.iterrows():
-                ins_mw = ins_row["Theo (Da)"]
-
-                # Compare parent masses to adduct masses
-                mass_delta = abs(
-                    Decimal(intact_mw).quantize(Decimal("0.00001")) - Decimal(ins_mw).quantize(Decimal("0.00001"))
-                )
-
-                # Is the mass delta the same mass as the target `mass_to_clean`?
-                # If so, it's the same structure but that gets its charge from
-                # the `target` ion instead of a proton as normal. In this case,
-                # consolidate the intensities of the parent (H+) and adduct
-                # (`target`+) ions so that the parent intensity has all of the
-                # adduct intensities added to it
-                if mass_delta == mass_to_clean:
-                    insDecay_intensity = ins_row["Intensity"]
-                    ID = row.ID
-                    drop_ID = ins_row.ID
-                    # Because long format leads to rows with duplicate IDs, the ["ID"]
-                    # of a row is sometimes different from its index in the dataframe.
-                    # Because this is sometimes but not always the case, we need this
-                    # lookup line:
-                    idx = consolidated_decay_df.loc[consolidated_decay_df["ID"] == ID].index[0]
-                    # Make sure the row we are trying to consolidate hasn't already
-                    # been consolidated and deleted!
-                    if not consolidated_decay_df.loc[consolidated_decay_df["ID"] == drop_ID].empty:
-                        # Transfer adduct intensity to the parent ion
-                        consolidated_decay_df.at[idx, "Intensity"] += insDecay_intensity
-                        # Because long format means both IDs and structures can be duplicated,
-                        # only ID + structure pairs can be considered unique. Find where IDs
-                        # or structures differ and retain only those in the dataframe. This is
-                        # the same as *filtering out* rows in which *both* the ID and structure
-                        # match the target from ins_row
-                        diff_ID = consolidated_decay_df["ID"] != ins_row["ID"]
-                        diff_Structure = consolidated_decay_df["Inferred structure"] != ins_row["Inferred structure"]
-                        consolidated_decay_df = consolidated_decay_df[diff_ID | diff_Structure]
+        if (rt, intact_mw) not in partners:
+            partners[(rt, intact_mw)] = _adduct_partners(
+                adducted_muropeptide_df, rt, intact_mw, mass_to_clean, time_delta
+            )
+
+        for ins_row in partners[(rt, intact_mw)]:
+            insDecay_intensity = ins_row["Intensity"]
+            ID = row.ID
+            drop_ID = ins_row.ID
+            # Because long format leads to rows with duplicate IDs, the ["ID"]
+            # of a row is sometimes different from its index in the dataframe.
+            # Because this is sometimes but not always the case, we need this
+            # lookup line:
+            idx = consolidated_decay_df.loc[consolidated_decay_df["ID"] == ID].index[0]
+            # Make sure the row we are trying to consolidate hasn't already
+            # been consolidated and deleted!
+            if not consolidated_decay_df.loc[consolidated_decay_df["ID"] == drop_ID].empty:
+                # Transfer adduct intensity to the parent ion
+                consolidated_decay_df.at[idx, "Intensity"] += insDecay_intensity
+                # Because long format means both IDs and structures can be duplicated,
+                # only ID + structure pairs can be considered unique. Find where IDs
+                # or structures differ and retain only those in the dataframe. This is
+                # the same as *filtering out* rows in which *both* the ID and structure
+                # match the target from ins_row
+                diff_ID = consolidated_decay_df["ID"] != ins_row["ID"]
+                diff_Structure = consolidated_decay_df["Inferred structure"] != ins_row["Inferred structure"]
+                consolidated_decay_df = consolidated_decay_df[diff_ID | diff_Structure]
 
     return consolidated_decay_df
 
 
+def _adduct_partners(
+    adducted_muropeptide_df: pd.DataFrame, rt: float, intact_mw: float, mass_to_clean: Decimal, time_delta: float
+) -> List[pd.Series]:
+    """Adducts within ``time_delta`` of a parent whose mass differs from it by exactly ``mass_to_clean``."""
+    # Work out rt window
+    upper_lim_rt = rt + time_delta
+    lower_lim_rt = rt - time_delta
+
+    # Get all adducts within rt window
+    ins_constrained_df = adducted_muropeptide_df[
+        adducted_muropeptide_df["RT (min)"].between(lower_lim_rt, upper_lim_rt, inclusive="both")
+    ]
+    partners = []
+    # Loop through each of the adducts in the RT window, the adducts
+    # themselves all have structures containing the `target` string
+    for _z, ins_row in ins_constrained_df.iterrows():
+        ins_mw = ins_row["Theo (Da)"]
+
+        # Compare parent masses to adduct masses
+        mass_delta = abs(_quantized(intact_mw) - _quantized(ins_mw))
+
+        # Is the mass delta the same mass as the target `mass_to_clean`?
+        # If so, it's the same structure but that gets its charge from
+        # the `target` ion instead of a proton as normal. In this case,
+        # consolidate the intensities of the parent (H+) and adduct
+        # (`target`+) ions so that the parent intensity has all of the
+        # adduct intensities added to it
+        if mass_delta == mass_to_clean:
+            partners.append(ins_row)
+    return partners
+
+
+@lru_cache(maxsize=1 << 16)
+def _quantized(mass: float) -> Decimal:
+    """A theoretical mass as a Decimal rounded to 0.00001 Da."""
+    return Decimal(mass).quantize(Decimal("0.00001"))
+
+
 def data_analysis(
     raw_data_df: pd.DataFrame,
     theo_masses_df: pd.DataFrame,
@@ -308,6 +385,14 @@ def data_analysis(
     enabled_mod_list: list,
     ppm_tolerance: float,
     consolidation_ppm: float,
+    max_multimer: int = None,
+    max_modifications: int = None,
+    engine: str = None,
+    expanded_search_space=None,
+    checkpoint_dir=None,
+    feature_filter=None,
+    report_filtered: bool = False,
+    recalibrated_ppm: float = None,
 ) -> pd.DataFrame:
     """Perform analysis.
 
@@ -325,74 +410,137 @@ def data_analysis(
         The ppm tolerance used when matching the theoretical masses of structures to observed ions
     consolidation_ppm : float
         The minimum absolute ppm difference between two matches before one is picked as "most likely" over the other
+    max_multimer : int
+        When set, search for multimers of up to this many observed monomers rather than using the fixed multimer donors.
+    max_modifications : int
+        When set, search for structures carrying up to this many of the enabled modifications at once.
+    engine : str
+        ``numpy`` (the default), ``jit`` to use the compiled kernels in ``pgfinder.jit``, or ``reference`` to run the
+        original row-by-row search space filtering, matching and clean-up (see ``pgfinder.verify``).
+    expanded_search_space : Union[ExpandedSearchSpace, str, Path]
+        Precomputed expansion of the library to pick the search space out of, or the file it is saved in (see
+        ``pgfinder.search_space``). Not available with the ``reference`` engine.
+    checkpoint_dir : Union[CheckpointStore, str, Path]
+        Directory (or store) to checkpoint each stage of the analysis to, so that a re-run resumes after the last
+        stage whose inputs haven't changed (see ``pgfinder.checkpoints``).
+    feature_filter : FeatureFilter
+        Only analyse the features that pass this filter (see ``pgfinder.prefilter``).
+    report_filtered : bool
+        Add the features dropped by ``feature_filter`` to the results as unmatched rows.
+    recalibrated_ppm : float
+        Recalibrate the observed masses against the monomers they unambiguously match within ``ppm_tolerance`` and
+        match at this narrower tolerance instead (see ``pgfinder.recalibration``).
 
     Returns
     -------
     pd.DataFrame
+
+    See Also
+    --------
+    pgfinder.analyzer.Analyzer : Re-uses the same settings across many samples.
     """
-    sugar = Decimal("203.0793")
-    sodium = Decimal("21.9819")
-    potassium = Decimal("37.9559")
-
-    LOGGER.info("Filtering theoretical masses by observed masses")
-    obs_monomers_df = filtered_theo(ftrs_df=raw_data_df, theo_df=theo_masses_df, user_ppm=ppm_tolerance)
-
-    # Make sure the enabled_mod_list (if empty), is actually represented by an empty list
-    enabled_mod_list = enabled_mod_list or []
-
-    # NOTE: "Multimers" is a semi-magic keyword here. Multimers and modifications are treated
-    # differently by most of the code and have their own sections in `parameters.yaml`, but
-    # despite this, all of the multimer and modification flags are passed to `data_analysis()`
-    # in the same `enabled_mod_list` variable... This is the shortest path to getting something
-    # working now.
-    multimer_mods = [m for m in enabled_mod_list if "Multimers" in m]
-    other_mods = [m for m in enabled_mod_list if m not in multimer_mods]
-
-    def build_multimers(mod):
-        LOGGER.info("Building multimers from obs muropeptides")
-        theo_multimers_df = multimer_builder(obs_monomers_df, mod)
-        LOGGER.info("Filtering theoretical multimers by observed")
-        return filtered_theo(raw_data_df, theo_multimers_df, ppm_tolerance)
-
-    obs_theo_df = pd.concat([obs_monomers_df, *(build_multimers(type) for type in multimer_mods)])
-
-    def apply_modification(mod):
-        LOGGER.info(f"Generating {mod} variants")
-        return modification_generator(obs_theo_df, mod)
-
-    LOGGER.info("Building custom search file")
-    master_frame = pd.concat(
-        [
-            obs_theo_df,
-            *(apply_modification(mod) for mod in other_mods),
-        ]
+    # NOTE: Imported here because `pgfinder.analyzer` builds on the functions in this module
+    from pgfinder.analyzer import Analyzer
+
+    analyzer = Analyzer(
+        theo_masses_df,
+        rt_window,
+        enabled_mod_list,
+        ppm_tolerance,
+        consolidation_ppm,
+        max_multimer,
+        max_modifications,
+        engine=engine,
+        expanded_search_space=expanded_search_space,
+        feature_filter=feature_filter,
+        report_filtered=report_filtered,
+        recalibrated_ppm=recalibrated_ppm,
     )
+    return analyzer.analyze(raw_data_df, checkpoints=checkpoint_dir)
 
-    master_frame = master_frame.astype({"Theo (Da)": float})
-    LOGGER.info("Matching")
-    matched_data_df = matching(raw_data_df, master_frame, ppm_tolerance)
-    LOGGER.info("Cleaning data")
 
-    matched_data_df = calculate_ppm_delta(df=matched_data_df)
+def data_analysis_many(
+    raw_data_dfs: List[pd.DataFrame],
+    theo_masses_df: pd.DataFrame,
+    rt_window: float,
+    enabled_mod_list: list,
+    ppm_tolerance: float,
+    consolidation_ppm: float,
+    max_multimer: int = None,
+    max_modifications: int = None,
+    engine: str = None,
+    expanded_search_space=None,
+    feature_filter=None,
+    report_filtered: bool = False,
+    recalibrated_ppm: float = None,
+    return_errors: bool = False,
+) -> List[Union[pd.DataFrame, UserError]]:
+    """Analyse several samples together, stacking their features so that each stage is run once for all of them.
 
-    cleaned_df = clean_up(ftrs_df=matched_data_df, mass_to_clean=sodium, time_delta=rt_window)
-    cleaned_df = clean_up(ftrs_df=cleaned_df, mass_to_clean=potassium, time_delta=rt_window)
-    cleaned_data_df = clean_up(ftrs_df=cleaned_df, mass_to_clean=sugar, time_delta=rt_window)
+    Parameters
+    ----------
+    raw_data_dfs : List[pd.DataFrame]
+        User data, one Pandas DataFrame per sample.
+    theo_masses_df : pd.DataFrame
+        Theoretical masses as Pandas DataFrame.
+    rt_window : float
+        Set time window for in-source decay and salt adduct cleanup
+    enabled_mod_list : list
+        List of modifications to enable.
+    ppm_tolerance : float
+        The ppm tolerance used when matching the theoretical masses of structures to observed ions
+    consolidation_ppm : float
+        The minimum absolute ppm difference between two matches before one is picked as "most likely" over the other
+    max_multimer : int
+        When set, search for multimers of up to this many observed monomers rather than using the fixed multimer donors.
+    max_modifications : int
+        When set, search for structures carrying up to this many of the enabled modifications at once.
+    engine : str
+        ``numpy`` (the default), ``jit`` or ``reference``.
+    expanded_search_space : Union[ExpandedSearchSpace, str, Path]
+        Precomputed expansion of the library to pick the search spaces out of, or the file it is saved in.
+    feature_filter : FeatureFilter
+        Only analyse the features of each sample that pass this filter (see ``pgfinder.prefilter``).
+    report_filtered : bool
+        Add the features dropped by ``feature_filter`` to the results as unmatched rows.
+    recalibrated_ppm : float
+        Recalibrate the observed masses of each sample and match at this narrower tolerance instead.
+    return_errors : bool
+        Return the ``UserError`` of any sample that can't be analysed in place of its results, and analyse the other
+        samples, rather than raising it.
 
-    # set metadata
-    cleaned_data_df.attrs["file"] = raw_data_df.attrs["file"]
-    cleaned_data_df.attrs["masses_file"] = theo_masses_df.attrs["file"]
-    cleaned_data_df.attrs["rt_window"] = rt_window
-    cleaned_data_df.attrs["modifications"] = enabled_mod_list
-    cleaned_data_df.attrs["ppm"] = ppm_tolerance
-    cleaned_data_df.attrs["consolidation_ppm"] = consolidation_ppm
+    Returns
+    -------
+    List[Union[pd.DataFrame, UserError]]
+        Results for each sample, in order, the same as ``data_analysis()`` gives each of them.
 
-    cleaned_data_df.sort_values(by=["Intensity", "RT (min)"], ascending=[False, True], inplace=True, kind="stable")
-    cleaned_data_df.reset_index(drop=True, inplace=True)
+    Raises
+    ------
+    UserError
+        If a sample can't be analysed and ``return_errors`` isn't set, naming the file the sample was read from.
 
-    # Apply some post-processing to the results
-    final_df = pick_most_likely_structures(cleaned_data_df, consolidation_ppm)
-    return final_df
+    See Also
+    --------
+    pgfinder.analyzer.Analyzer.analyze_joint : How the samples are analysed together.
+    """
+    # NOTE: Imported here because `pgfinder.analyzer` builds on the functions in this module
+    from pgfinder.analyzer import Analyzer
+
+    analyzer = Analyzer(
+        theo_masses_df,
+        rt_window,
+        enabled_mod_list,
+        ppm_tolerance,
+        consolidation_ppm,
+        max_multimer,
+        max_modifications,
+        engine=engine,
+        expanded_search_space=expanded_search_space,
+        feature_filter=feature_filter,
+        report_filtered=report_filtered,
+        recalibrated_ppm=recalibrated_ppm,
+    )
+    return analyzer.analyze_joint(raw_data_dfs, return_errors=return_errors)
 
 
 def calculate_ppm_delta(
@@ -0,0 +1,225 @@
+"""Throughput, latency and failure metrics in the Prometheus text format.
+
+Analyses record what they do in a process-wide ``MetricsRegistry``, ``REGISTRY``: how many files were analysed or
+failed, how many features were analysed, filtered and matched, how many candidate structures they were matched
+against, and how long each analysis and each of its stages took. The registry is rendered in the Prometheus text
+exposition format, either to a file (which ``find_pg --metrics_file`` writes when a run finishes, and every
+``--metrics_interval`` seconds during long runs, for a scheduler or the node exporter's textfile collector to pick up)
+or by ``pgfinder serve`` at ``GET /metrics``. Nothing is sent anywhere.
+
+Features per second and the fraction of features matched are reported over the life of the process, alongside the
+counters they are derived from, so that rates over any window can be worked out by Prometheus itself.
+"""
+import math
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Tuple, Union
+
+from pgfinder.errors import UserError
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Upper bounds (in seconds) of the latency histogram buckets
+DURATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, math.inf)
+
+# The type and help text of every metric that can be recorded
+DEFINITIONS = {
+    "pgfinder_files_processed_total": ("counter", "Mass spec files analysed successfully."),
+    "pgfinder_files_failed_total": ("counter", "Mass spec files whose analysis failed."),
+    "pgfinder_features_total": ("counter", "Features analysed."),
+    "pgfinder_features_filtered_total": ("counter", "Features dropped by feature filters before matching."),
+    "pgfinder_features_matched_total": ("counter", "Features matched to at least one structure."),
+    "pgfinder_candidates_total": ("counter", "Candidate structures that features were matched against."),
+    "pgfinder_analysis_duration_seconds": ("histogram", "Time taken by each analysis of a sample, or part of one."),
+    "pgfinder_stage_duration_seconds": ("histogram", "Time taken by each stage of an analysis."),
+    "pgfinder_service_jobs_running": ("gauge", "Jobs being analysed by the service."),
+    "pgfinder_service_jobs_queued": ("gauge", "Jobs waiting for a free worker of the service."),
+    "pgfinder_service_jobs_rejected_total": ("counter", "Jobs turned away by the service because its queue was full."),
+    "pgfinder_service_uptime_seconds": ("gauge", "Time since the service started."),
+}
+
+# Metrics worked out from the others whenever the registry is rendered
+DERIVED = {
+    "pgfinder_features_per_second": "Features analysed per second spent analysing them.",
+    "pgfinder_match_ratio": "Fraction of the features analysed that were matched.",
+    "pgfinder_peak_rss_bytes": "Peak resident set size of the process.",
+}
+
+
+class MetricsRegistry:
+    """Counters, gauges and histograms, safe to update from several threads at once."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, Tuple], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple], List[float]] = {}
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        """Add to a counter."""
+        key = self._key(name, labels, "counter")
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        """Set a gauge."""
+        key = self._key(name, labels, "gauge")
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Add an observation to a histogram."""
+        key = self._key(name, labels, "histogram")
+        with self._lock:
+            # A count per bucket, then the sum and count of all observations
+            histogram = self._histograms.setdefault(key, [0.0] * (len(DURATION_BUCKETS) + 2))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def value(self, name: str, **labels) -> float:
+        """Current value of a counter or gauge, or the number of observations in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][-1]
+            return self._values.get(key, 0.0)
+
+    def reset(self) -> None:
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._values.clear()
+            self._histograms.clear()
+
+    def render(self) -> str:
+        """The metrics in the Prometheus text exposition format."""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(histogram) for key, histogram in self._histograms.items()}
+        lines = []
+        for name, (kind, text) in DEFINITIONS.items():
+            series = sorted(key for key in (histograms if kind == "histogram" else values) if key[0] == name)
+            if not series:
+                continue
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            for key in series:
+                if kind == "histogram":
+                    lines += _histogram_lines(name, dict(key[1]), histograms[key])
+                else:
+                    lines.append(f"{name}{_labels(dict(key[1]))} {_number(values[key])}")
+        for name, value in _derived(values, histograms):
+            lines += [f"# HELP {name} {DERIVED[name]}", f"# TYPE {name} gauge", f"{name} {_number(value)}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, file: Union[str, Path]) -> Path:
+        """Write the metrics to a file, replacing it in one go so that readers never see half a file."""
+        file = Path(file)
+        file.parent.mkdir(parents=True, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=file.parent, prefix=f".{file.name}-")
+        try:
+            with os.fdopen(handle, "w") as f:
+                f.write(self.render())
+            os.replace(temporary, file)
+        except BaseException:
+            Path(temporary).unlink(missing_ok=True)
+            raise
+        return file
+
+    @staticmethod
+    def _key(name: str, labels: Dict, kind: str) -> Tuple[str, Tuple]:
+        if DEFINITIONS.get(name, (None,))[0] != kind:
+            raise KeyError(f"{name} is not a known {kind}")
+        return name, tuple(sorted(labels.items()))
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsWriter:
+    """Write a registry to a file every ``interval`` seconds (if given) and once more on leaving the context.
+
+    Parameters
+    ----------
+    file : Union[str, Path]
+        File to write the metrics to.
+    interval : float
+        Seconds between writes while the context is open, or None to only write on leaving it.
+    registry : MetricsRegistry
+        Registry to write, ``REGISTRY`` by default.
+    """
+
+    def __init__(self, file: Union[str, Path], interval: float = None, registry: MetricsRegistry = None):
+        if interval is not None and interval <= 0:
+            raise UserError(f"The interval between metrics updates must be positive, but {interval} s was given.")
+        self.file = Path(file)
+        self.interval = interval
+        self.registry = registry or REGISTRY
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> "MetricsWriter":
+        if self.interval is not None:
+            self._thread = threading.Thread(target=self._run, name="pgfinder-metrics", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.registry.write(self.file)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.registry.write(self.file)
+
+
+def peak_rss_bytes() -> float:
+    """Peak resident set size of this process, or NaN where it can't be found."""
+    if resource is None:
+        return math.nan
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kibibytes, macOS bytes
+    return float(peak if sys.platform == "darwin" else peak * 1024)
+
+
+def _derived(values: Dict, histograms: Dict) -> Iterator[Tuple[str, float]]:
+    features = values.get(("pgfinder_features_total", ()), 0.0)
+    seconds = sum(h[-2] for key, h in histograms.items() if key[0] == "pgfinder_analysis_duration_seconds")
+    if seconds:
+        yield "pgfinder_features_per_second", features / seconds
+    if features:
+        yield "pgfinder_match_ratio", values.get(("pgfinder_features_matched_total", ()), 0.0) / features
+    yield "pgfinder_peak_rss_bytes", peak_rss_bytes()
+
+
+def _histogram_lines(name: str, labels: Dict, histogram: List[float]) -> List[str]:
+    lines = []
+    for bound, count in zip(DURATION_BUCKETS, histogram):
+        le = "+Inf" if math.isinf(bound) else _number(bound)
+        lines.append(f"{name}_bucket{_labels({**labels, 'le': le})} {_number(count)}")
+    lines.append(f"{name}_sum{_labels(labels)} {_number(histogram[-2])}")
+    lines.append(f"{name}_count{_labels(labels)} {_number(histogram[-1])}")
+    return lines
+
+
+def _labels(labels: Dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def _number(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
@@ -0,0 +1,136 @@
+"""Search for structures carrying several modifications at once"""
+import logging
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from pgfinder import MOD_COMBINATIONS, MOD_TYPE
+from pgfinder.kernels import ppm_windows, window_hits
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.matching import modified_structure_namer
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+
+def modification_search(
+    obs_theo_df: pd.DataFrame,
+    mod_types: List[str],
+    max_modifications: int,
+    sorted_observed: np.ndarray,
+    ppm_tolerance: float,
+    max_candidates: int = None,
+) -> pd.DataFrame:
+    """Find modified structures, carrying up to ``max_modifications`` modifications, that match observed masses.
+
+    ``modification_generator()`` applies one modification at a time to the unmodified structures. Here modifications
+    are stacked breadth-first: every structure with n modifications is extended with each modification that can still
+    be added to it (see ``mod_combinations`` in ``parameters.yaml``) to give the structures with n + 1. Modifications
+    are always added in the order they are listed in ``mod_types``, so each combination is only generated once.
+
+    Before a structure is extended, the largest and smallest mass shifts the remaining modifications could make are
+    used to check, with a binary search of the observed masses, that an extension could still match something.
+    Structures that can't are dropped along with all of their descendants. Only structures that match an observed
+    mass are returned.
+
+    Parameters
+    ----------
+    obs_theo_df : pd.DataFrame
+        Observed (unmodified) structures and their theoretical masses.
+    mod_types : List[str]
+        Modifications to apply, from the ``mod_type`` section of ``parameters.yaml``.
+    max_modifications : int
+        The most modifications any one structure can carry.
+    sorted_observed : np.ndarray
+        Observed masses, sorted in ascending order.
+    ppm_tolerance : float
+        The ppm tolerance used when matching the theoretical masses of structures to observed ions.
+    max_candidates : int
+        The most modified structures to generate in total; the search stops, with a warning, before the level of
+        modifications that would exceed this. Defaults to ``max_candidates`` in ``parameters.yaml``.
+
+    Returns
+    -------
+    pd.DataFrame
+        Modified structures and their masses, in order of the number of modifications carried.
+    """
+    mod_types = list(mod_types)
+    if max_candidates is None:
+        max_candidates = int(MOD_COMBINATIONS["max_candidates"])
+    deltas = np.array([float(MOD_TYPE[m]["mass"]) for m in mod_types], dtype=float)
+    max_count = np.array([int(MOD_COMBINATIONS["max_count"].get(m, 1)) for m in mod_types], dtype=int)
+    exclusive = np.zeros((len(mod_types), len(mod_types)), dtype=bool)
+    for group in MOD_COMBINATIONS["exclusive"]:
+        members = [i for i, m in enumerate(mod_types) if m in group]
+        exclusive[np.ix_(members, members)] = True
+    np.fill_diagonal(exclusive, False)
+    lowest, highest = _shift_bounds(deltas, max_count, max_modifications)
+    namers = [modified_structure_namer(m) for m in mod_types]
+
+    names = obs_theo_df["Inferred structure"].to_numpy(dtype=object)
+    # Each structure is described by the unmodified structure it came from, the modifications applied and its mass
+    structures = np.arange(len(names))
+    applied = np.empty((len(names), 0), dtype=np.intp)
+    masses = obs_theo_df["Theo (Da)"].to_numpy(dtype=float)
+
+    frames = [pd.DataFrame({"Inferred structure": pd.Series(dtype=object), "Theo (Da)": pd.Series(dtype=float)})]
+    if not mod_types:
+        return frames[0]
+    total = 0
+    for n in range(1, max_modifications + 1):
+        # Drop structures that can't be modified into anything that matches
+        first = applied[:, -1] if n > 1 else np.zeros(len(masses), dtype=np.intp)
+        lower = masses + lowest[first, max_modifications - n + 1]
+        upper = masses + highest[first, max_modifications - n + 1]
+        reachable = window_hits(
+            sorted_observed, ppm_windows(lower, ppm_tolerance)[0], ppm_windows(upper, ppm_tolerance)[1]
+        )
+        structures, applied, masses, first = (a[reachable] for a in (structures, applied, masses, first))
+
+        # Add each modification that's allowed to every structure
+        extensions = []
+        for mod in range(len(mod_types)):
+            allowed = first <= mod
+            allowed &= (applied == mod).sum(axis=1) < max_count[mod]
+            allowed &= ~exclusive[mod][applied].any(axis=1)
+            extensions.append(np.flatnonzero(allowed))
+        count = sum(len(e) for e in extensions)
+        if total + count > max_candidates:
+            LOGGER.warning(
+                f"Only searched for structures with up to {n - 1} modifications: searching for {n} would generate more "
+                f"than {max_candidates} candidate structures"
+            )
+            break
+        total += count
+        parents = np.concatenate(extensions)
+        mods = np.repeat(np.arange(len(mod_types)), [len(e) for e in extensions])
+        structures = structures[parents]
+        applied = np.column_stack([applied[parents], mods])
+        masses = masses[parents] + deltas[mods]
+
+        hits = np.flatnonzero(window_hits(sorted_observed, *ppm_windows(masses, ppm_tolerance)))
+        LOGGER.info(f"Searched {len(masses)} structures with {n} modifications, {len(hits)} match observed masses")
+        modified = names[structures[hits]]
+        for column in applied[hits].T:
+            modified = [namers[mod](name) for name, mod in zip(modified, column)]
+        frames.append(pd.DataFrame({"Inferred structure": modified, "Theo (Da)": masses[hits]}))
+        if len(masses) == 0:
+            break
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def _shift_bounds(deltas: np.ndarray, max_count: np.ndarray, max_modifications: int):
+    """The most negative and most positive total mass shifts reachable with up to r more modifications.
+
+    Returns two tables indexed by the first modification that can still be added and r. Modifications that can't be
+    combined are ignored here, so these are bounds rather than exact values.
+    """
+    lowest = np.zeros((max(len(deltas), 1), max_modifications + 1))
+    highest = np.zeros((max(len(deltas), 1), max_modifications + 1))
+    for first in range(len(deltas)):
+        available = np.sort(np.repeat(deltas[first:], max_count[first:]))
+        for r in range(1, max_modifications + 1):
+            lowest[first, r] = np.minimum(available[:r], 0).sum()
+            highest[first, r] = np.maximum(available[::-1][:r], 0).sum()
+    return lowest, highest
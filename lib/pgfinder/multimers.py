@@ -0,0 +1,168 @@
+"""Search for multimers of any size built from observed monomers"""
+import logging
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from pgfinder import MULTIMER_SEARCH
+from pgfinder.errors import UserError
+from pgfinder.kernels import max_matchable_mass, ppm_windows, window_hits
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.structures import parse_structure
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+# Water lost when each bond between monomers is formed
+WATER = 18.0106
+
+
+def multimer_search(
+    obs_monomers_df: pd.DataFrame,
+    multimer_type: str,
+    max_multimer: int,
+    sorted_observed: np.ndarray,
+    ppm_tolerance: float,
+) -> pd.DataFrame:
+    """Find the dimers, trimers, ... up to ``max_multimer``-mers that match observed masses.
+
+    Unlike ``multimer_builder()``, which adds a fixed list of donors from ``parameters.yaml`` to each monomer, every
+    observed monomer can be joined to every other. Chains are grown one monomer at a time, so n-mers are built by
+    extending every (n-1)-mer light enough to still match something. Each extension is bounded with a binary search
+    over the donors (sorted by mass) against the heaviest observed mass, so branches that can only produce masses
+    above it are never generated. Chains are only named once their mass has matched.
+
+    To keep the search tractable, donors after the first are added in a fixed (mass) order: chains that differ only in
+    the order of their donors have identical masses and only one of them is reported.
+
+    Parameters
+    ----------
+    obs_monomers_df : pd.DataFrame
+        Observed monomers, as returned by ``filtered_theo()``.
+    multimer_type : str
+        Multimer type, one of the entries under ``multimer_search`` in ``parameters.yaml``.
+    max_multimer : int
+        The largest multimers to search for, e.g. 4 to search for dimers, trimers and tetramers.
+    sorted_observed : np.ndarray
+        Observed masses, sorted in ascending order.
+    ppm_tolerance : float
+        The ppm tolerance used when matching the theoretical masses of structures to observed ions.
+
+    Returns
+    -------
+    pd.DataFrame
+        Multimers that match at least one observed mass and their masses (rounded to 4 decimal places).
+    """
+    if multimer_type not in MULTIMER_SEARCH:
+        raise UserError(f"Searching for '{multimer_type}' of more than two monomers isn't supported.")
+    rules = MULTIMER_SEARCH[multimer_type]
+
+    names, masses = [], []
+    for name, mass in zip(obs_monomers_df["Inferred structure"], obs_monomers_df["Theo (Da)"].astype(float)):
+        # Prevent multimer creation using just gm, as in `multimer_builder()`
+        core = parse_structure(name).core
+        if len(core) > 2:
+            names.append(core)
+            masses.append(mass)
+    search = _Search(names, np.array(masses, dtype=float), rules, sorted_observed, ppm_tolerance, max_multimer)
+    monomers = (np.arange(len(names)), np.zeros(len(names), dtype=np.intp), search.acceptor_masses)
+    search.grow([monomers])
+    for size in range(2, max_multimer + 1):
+        LOGGER.info(
+            f"Searched {search.searched[size]} {size}-mers, {len(search.structures[size])} match observed masses"
+        )
+
+    multimer_df = pd.DataFrame(
+        {
+            "Inferred structure": [s for size in range(2, max_multimer + 1) for s in search.structures[size]],
+            "Theo (Da)": np.array([m for size in range(2, max_multimer + 1) for m in search.masses[size]], dtype=float),
+        }
+    )
+    return multimer_df.drop_duplicates()
+
+
+class _Search:
+    """State shared while growing chains of monomers.
+
+    Chains are grown depth-first in blocks of at most ``block_size`` candidates, so memory use doesn't depend on how
+    many chains there are in total. A block is described by the chain in the previous block that each candidate extends
+    (its parent), the position of the donor it adds (in mass order) and its mass.
+    """
+
+    def __init__(
+        self,
+        names: List[str],
+        acceptor_masses: np.ndarray,
+        rules: dict,
+        sorted_observed: np.ndarray,
+        ppm_tolerance: float,
+        max_multimer: int,
+        block_size: int = 1_000_000,
+    ):
+        self.names = np.array(names, dtype=object)
+        self.acceptor_masses = acceptor_masses
+        self.joiner = rules["joiner"]
+        donor_names, self.donor_masses = _donors(names, acceptor_masses, rules)
+        self.donor_names = np.array(donor_names, dtype=object)
+        self.sorted_observed = sorted_observed
+        self.ppm_tolerance = ppm_tolerance
+        self.max_multimer = max_multimer
+        self.block_size = block_size
+        self.upper = max_matchable_mass(sorted_observed, ppm_tolerance)
+        self.searched = {size: 0 for size in range(2, max_multimer + 1)}
+        self.structures = {size: [] for size in range(2, max_multimer + 1)}
+        self.masses = {size: [] for size in range(2, max_multimer + 1)}
+
+    def grow(self, stack: list) -> None:
+        """Extend the chains in the last block of ``stack`` by one monomer, then carry on with the longer chains."""
+        size = len(stack) + 1
+        _, last_donors, chain_masses = stack[-1]
+        # Donors are sorted by mass, so the donors light enough to extend each chain are a prefix of them
+        limits = np.searchsorted(self.donor_masses, self.upper - chain_masses + WATER, side="right")
+        counts = np.maximum(limits - last_donors, 0)
+        for start, stop in _split(counts, self.block_size):
+            block_counts = counts[start:stop]
+            parents = np.repeat(np.arange(start, stop), block_counts)
+            offsets = np.arange(len(parents)) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts)
+            donors = last_donors[parents] + offsets
+            masses = chain_masses[parents] + self.donor_masses[donors] - WATER
+            block = (parents, donors, masses)
+            self.searched[size] += len(masses)
+
+            hits = np.flatnonzero(window_hits(self.sorted_observed, *ppm_windows(masses, self.ppm_tolerance)))
+            self.structures[size].extend(f"{name}|{size}" for name in self._names([*stack, block], hits))
+            self.masses[size].extend(round(m, 4) for m in masses[hits].tolist())
+            if size < self.max_multimer:
+                self.grow([*stack, block])
+
+    def _names(self, stack: list, chains: np.ndarray) -> List[str]:
+        """Name chains by following them back to the monomers they were started from."""
+        parts = []
+        for parents, donors, _ in reversed(stack[1:]):
+            parts.append(self.donor_names[donors[chains]])
+            chains = parents[chains]
+        parts.append(self.names[chains])
+        return [self.joiner.join(p) for p in zip(*reversed(parts))]
+
+
+def _split(counts: np.ndarray, block_size: int) -> Iterator[Tuple[int, int]]:
+    """Split chains into ranges that have at most ``block_size`` extensions between them (or a single chain)."""
+    total = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        done = total[start - 1] if start else 0
+        stop = max(int(np.searchsorted(total, done + block_size, side="right")), start + 1)
+        yield start, stop
+        start = stop
+
+
+def _donors(names: List[str], masses: np.ndarray, rules: dict) -> Tuple[List[str], np.ndarray]:
+    """Names and masses of the monomers that can be added to a chain, sorted by mass."""
+    glycan = rules.get("donor_glycan")
+    if glycan is not None:
+        keep = [i for i, name in enumerate(names) if name.startswith(f"{glycan}-")]
+        names = [f"{rules['donor_replacement']}{names[i][len(glycan):]}" for i in keep]
+        masses = masses[keep]
+    masses = masses + float(rules["donor_delta"])
+    order = np.argsort(masses, kind="stable")
+    return [names[i] for i in order], masses[order]
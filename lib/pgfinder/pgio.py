@@ -1,14 +1,17 @@
 """PG Finder I/O operations"""
+import json
 import logging
 import sqlite3
+from contextlib import closing
 from datetime import datetime
 from importlib.metadata import version
 from pathlib import Path, PurePath
-from typing import Dict, Union
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 
 import numpy as np
 import pandas as pd
 import yaml
+from pandas.api.types import is_integer_dtype, is_object_dtype
 from yaml.error import YAMLError
 
 try:
@@ -16,19 +19,39 @@ try:
 except ImportError:
     from yaml import Loader
 
+from pgfinder.compiled_library import SUFFIX, compiled_builtin_library, read_compiled_library
 from pgfinder.errors import UserError
+from pgfinder.inputs import connect_ftrs, ms_file_format, open_input
 from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.prefilter import FeatureFilter
 
 LOGGER = logging.getLogger(LOGGER_NAME)
 
+# Analysis settings written to the metadata column of results only when they are present
+OPTIONAL_METADATA = ["max_multimer", "max_modifications", "feature_filter", "recalibration"]
 
-def ms_file_reader(file) -> pd.DataFrame:
+# Columns of the Features table of Byos 5.2 and 3.11 files, and the PGFinder columns they become
+FTRS_52_COLUMNS = ["Id", "apexRetentionTime", "charges", "mwMonoIsotopicMass", "apexIntensity"]
+FTRS_311_COLUMNS = ["Id", "apexRetentionTimeMinutes", "chargeOrder", "apexMwMonoisotopic", "maxIntensity"]
+FTRS_PGFINDER_COLUMNS = ["ID", "RT (min)", "Charge", "Obs (Da)", "Intensity"]
+
+# Leading bytes and version of the binary results written by dataframe_to_columns()
+COLUMNS_MAGIC = b"PGFR"
+COLUMNS_FORMAT_VERSION = 1
+
+
+def ms_file_reader(file, feature_filter: FeatureFilter = None) -> pd.DataFrame:
     """Read mass spec data.
 
+    Byos and MaxQuant files are told apart by their content rather than their suffix, and may be compressed with gzip,
+    bzip2, xz or zstd (see ``pgfinder.inputs``).
+
     Parameters
     ----------
     file: Union[str, Path]
         Path to be loaded.
+    feature_filter: FeatureFilter
+        Only read the features that pass this filter (see ``pgfinder.prefilter``). Optional.
 
     Returns
     -------
@@ -38,115 +61,239 @@ def ms_file_reader(file) -> pd.DataFrame:
     # If we get a path, we need to convert to a string for `in` to work
     filename = PurePath(file)
 
-    if filename.suffix == ".ftrs":
-        return_df = ftrs_reader(file)
-    elif filename.suffix == ".txt":
-        return_df = maxquant_file_reader(file)
+    if ms_file_format(file) == "ftrs":
+        return_df = ftrs_reader(file, feature_filter)
     else:
-        raise UserError(
-            (
-                "The supplied data file was neither a .ftrs nor a .txt file. Please ensure that "
-                "you've selected a valid Byos (.ftrs) or MaxQuant (.txt) file."
-            )
-        )
+        return_df = maxquant_file_reader(file)
 
+    if feature_filter is not None:
+        n_features = len(return_df)
+        return_df = return_df[feature_filter.mask(return_df)].reset_index(drop=True)
+        LOGGER.info(f"Features kept by the filter        : {len(return_df)} of {n_features} read")
     return_df.attrs["file"] = filename.name
     LOGGER.info(f"Mass spectroscopy file loaded from : {filename.name}")
     return return_df
 
 
-def ftrs_reader(file: Union[str, Path]) -> pd.DataFrame:
+def ms_file_chunks(
+    file: Union[str, Path], chunk_size: int, feature_filter: FeatureFilter = None
+) -> Iterator[pd.DataFrame]:
+    """Read mass spec data a chunk of features at a time.
+
+    Chunks have the same columns as the DataFrames returned by ``ms_file_reader()`` and are indexed by the position of
+    each feature in the whole file (or among the features read, with a ``feature_filter``), but are not converted to
+    compact dtypes: the dtypes that pandas infers can differ between chunks, so callers should reconcile them before
+    combining chunks.
+
+    Parameters
+    ----------
+    file: Union[str, Path]
+        Path to be loaded.
+    chunk_size: int
+        Most features to read at once.
+    feature_filter: FeatureFilter
+        Filter whose intensity, retention time and mass criteria are applied by the query of the ``Features`` table of
+        Byos files, so that features failing them aren't read. Its other criteria, and every criterion for MaxQuant
+        files, are left to the caller. Optional.
+
+    Yields
+    ------
+    pd.DataFrame
+        Chunks of features, in the order they appear in the file.
+    """
+    filename = PurePath(file)
+    if ms_file_format(file) == "ftrs":
+        with connect_ftrs(file) as db:
+            sql, parameters = _ftrs_query(db, feature_filter)
+            chunks = (_ftrs_features(ff) for ff in pd.read_sql(sql, db, params=parameters, chunksize=chunk_size))
+            yield from _reindexed(chunks, filename.name)
+    else:
+        try:
+            with open_input(file) as stream, pd.read_table(stream, chunksize=chunk_size) as reader:
+                # Each chunk keeps the index of its rows in the whole file, which become their IDs
+                yield from _reindexed((_maxquant_features(chunk) for chunk in reader), filename.name)
+        except pd.errors.EmptyDataError as e:
+            raise UserError(
+                (
+                    "No data was found in the supplied .txt file. Have you checked "
+                    "you're using the allPeptides.txt file from MaxQuant?"
+                )
+            ) from e
+
+
+def _reindexed(chunks: Iterator[pd.DataFrame], name: str) -> Iterator[pd.DataFrame]:
+    """Index chunks of features by their position in the whole file."""
+    start = 0
+    for chunk in chunks:
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        chunk.attrs["file"] = name
+        start += len(chunk)
+        yield chunk
+
+
+def ftrs_reader(file: Union[str, Path], feature_filter: FeatureFilter = None) -> pd.DataFrame:
     """Reads Features file from Byos
 
     Parameters
     ----------
     file: Union[str, Path]
-        Feature file to be read.
+        Feature file to be read, compressed or not.
+    feature_filter: FeatureFilter
+        Filter whose intensity, retention time and mass criteria are applied by the query of the ``Features`` table,
+        so that features failing them aren't read. Its other criteria are left to the caller. Optional.
 
     Returns
     -------
     pd.DataFrame
         Pandas DataFrame of features.
     """
-    with sqlite3.connect(file) as db:
-        sql = "SELECT * FROM Features"
+    with connect_ftrs(file) as db:
+        sql, parameters = _ftrs_query(db, feature_filter)
         # Reads sql database into dataframe
-        ff = pd.read_sql(sql, db)
-        # Adds empty "Inferred structure" and "Theo (Da)" columns
-        ff["Inferred structure"] = np.nan
-        ff["Theo (Da)"] = np.nan
-        # Renames columns to expected column heading required for data_analysis function
-        ftrs_52_columns = [
-            "Id",
-            "apexRetentionTime",
-            "charges",
-            "mwMonoIsotopicMass",
-            "apexIntensity",
-        ]
-
-        ftrs_311_columns = [
-            "Id",
-            "apexRetentionTimeMinutes",
-            "chargeOrder",
-            "apexMwMonoisotopic",
-            "maxIntensity",
-        ]
-
-        pgfinder_columns = [
-            "ID",
-            "RT (min)",
-            "Charge",
-            "Obs (Da)",
-            "Intensity",
-        ]
-
-        is_ftrs_52 = set(ftrs_52_columns).issubset(ff.columns)
-        is_ftrs_311 = set(ftrs_311_columns).issubset(ff.columns)
-
-        if is_ftrs_52:
-            ff.rename(
-                columns=dict(zip(ftrs_52_columns, pgfinder_columns)),
-                inplace=True,
-            )
-        elif is_ftrs_311:
-            ff.rename(
-                columns=dict(zip(ftrs_311_columns, pgfinder_columns)),
-                inplace=True,
-            )
-        else:
-            raise UserError(
-                "The supplied FTRS file could not be read. Did it come from an unsupported version of Byos?"
-            )
+        ff = pd.read_sql(sql, db, params=parameters)
+
+    return compact_feature_dtypes(_ftrs_features(ff))
+
+
+def _ftrs_query(db: sqlite3.Connection, feature_filter: FeatureFilter = None) -> Tuple[str, List[float]]:
+    """The query of the ``Features`` table of a Byos file, applying what it can of a filter, and its parameters."""
+    sql = "SELECT * FROM Features"
+    if feature_filter is None:
+        return sql, []
+    table_columns = [row[1] for row in db.execute("PRAGMA table_info(Features)")]
+    # Files of unsupported versions are left to be reported by `_ftrs_features()`
+    versions = [c for c in [FTRS_52_COLUMNS, FTRS_311_COLUMNS] if set(c).issubset(table_columns)]
+    if not versions:
+        return sql, []
+    where, parameters = feature_filter.where(dict(zip(FTRS_PGFINDER_COLUMNS, versions[0])))
+    return sql + where, parameters
+
 
-        # Reorder columns in dataframe to desired order, dropping unwanted columns
-        cols_order = [
-            "ID",
-            "RT (min)",
-            "Charge",
-            "Obs (Da)",
-            "Theo (Da)",
-            "Inferred structure",
-            "Intensity",
-        ]
-        ff = ff[cols_order]
+def ftrs_new_features(file: Union[str, Path], after: int = 0) -> Tuple[pd.DataFrame, int]:
+    """Reads the features added to a Byos file since an earlier read, while the file may still be being written.
 
-        return ff
+    The file is opened read-only, so that it can be polled while Byos is still adding features to it.
 
+    Parameters
+    ----------
+    file: Union[str, Path]
+        Feature file to be read.
+    after: int
+        The ``rowid`` of the last feature read before, 0 to read every feature.
+
+    Returns
+    -------
+    Tuple[pd.DataFrame, int]
+        The features with a higher ``rowid`` (in the order they were added, with their dtypes left as read), and the
+        ``rowid`` to read on from next time.
+    """
+    uri = f"{Path(file).resolve().as_uri()}?mode=ro"
+    with closing(sqlite3.connect(uri, uri=True)) as db:
+        ff = pd.read_sql('SELECT rowid AS "_rowid", * FROM Features WHERE rowid > ? ORDER BY rowid', db, params=[after])
+    last = int(ff["_rowid"].iloc[-1]) if len(ff) else after
+    return _ftrs_features(ff.drop(columns="_rowid")), last
+
+
+def _ftrs_features(ff: pd.DataFrame) -> pd.DataFrame:
+    """Rename and reorder the columns of the Features table of a Byos file into the columns PGFinder uses."""
+    # Adds empty "Inferred structure" and "Theo (Da)" columns
+    ff["Inferred structure"] = np.nan
+    ff["Theo (Da)"] = np.nan
+    # Renames columns to expected column heading required for data_analysis function
+    is_ftrs_52 = set(FTRS_52_COLUMNS).issubset(ff.columns)
+    is_ftrs_311 = set(FTRS_311_COLUMNS).issubset(ff.columns)
+
+    if is_ftrs_52:
+        ff.rename(
+            columns=dict(zip(FTRS_52_COLUMNS, FTRS_PGFINDER_COLUMNS)),
+            inplace=True,
+        )
+    elif is_ftrs_311:
+        ff.rename(
+            columns=dict(zip(FTRS_311_COLUMNS, FTRS_PGFINDER_COLUMNS)),
+            inplace=True,
+        )
+    else:
+        raise UserError("The supplied FTRS file could not be read. Did it come from an unsupported version of Byos?")
+
+    # Reorder columns in dataframe to desired order, dropping unwanted columns
+    cols_order = [
+        "ID",
+        "RT (min)",
+        "Charge",
+        "Obs (Da)",
+        "Theo (Da)",
+        "Inferred structure",
+        "Intensity",
+    ]
+    return ff[cols_order]
+
+
+def compact_feature_dtypes(features_df: pd.DataFrame) -> pd.DataFrame:
+    """Store the columns of a feature table in the most compact dtypes that hold their values exactly.
+
+    IDs and integer charges are narrowed to the smallest integer type that fits them, text charges (e.g. ``"1, 2"``)
+    become categorical and retention times are stored as float32 when doing so loses no precision.
+
+    Parameters
+    ----------
+    features_df : pd.DataFrame
+        Feature table, as read by ``ftrs_reader()`` or ``maxquant_file_reader()``.
 
-def theo_masses_reader(file: Union[str, Path]) -> pd.DataFrame:
+    Returns
+    -------
+    pd.DataFrame
+        The same feature table with compact dtypes.
+    """
+    # Columns are replaced rather than modified, so a shallow copy is enough to leave the original alone
+    features_df = features_df.copy(deep=False)
+    ids = features_df["ID"]
+    int32 = np.iinfo(np.int32)
+    if is_integer_dtype(ids) and (ids.empty or (ids.min() >= int32.min and ids.max() <= int32.max)):
+        features_df["ID"] = ids.astype(np.int32)
+    if is_integer_dtype(features_df["Charge"]):
+        features_df["Charge"] = pd.to_numeric(features_df["Charge"], downcast="integer")
+    elif is_object_dtype(features_df["Charge"]):
+        features_df["Charge"] = features_df["Charge"].astype("category")
+    rt = features_df["RT (min)"].to_numpy()
+    if rt.dtype == np.float64 and np.array_equal(rt.astype(np.float32).astype(np.float64), rt, equal_nan=True):
+        features_df["RT (min)"] = rt.astype(np.float32)
+    return features_df
+
+
+def theo_masses_reader(file: Union[str, Path], compiled: bool = True) -> pd.DataFrame:
     """Reads theoretical masses files (csv) returning a Panda Dataframe
 
+    Compiled libraries (``.pglib``) are read from a memory-map instead of parsed, as are the compiled copies of the
+    built-in libraries when they have been built. The DataFrame returned still holds its own copy of the masses and of
+    every decoded name, so nothing stays mapped once it has been read; use ``CompiledLibrary`` directly to keep a
+    library mapped. CSVs compressed with gzip, bzip2, xz or zstd are decompressed as they are read.
+
     Parameters
     ----------
     file: Union[str, Path]
+    compiled : bool
+        Read the compiled copy of a built-in library CSV, if there is one.
 
     Returns
     -------
     pd.DataFrame
         Pandas DataFrame of theoretical masses.
     """
+    if PurePath(file).suffix == SUFFIX:
+        theo_masses_df = read_compiled_library(file)
+        LOGGER.info(f"Theoretical masses loaded from     : {file}")
+        return theo_masses_df
+    compiled_file = compiled_builtin_library(file) if compiled else None
+    if compiled_file is not None:
+        theo_masses_df = read_compiled_library(compiled_file)
+        theo_masses_df.attrs["file"] = PurePath(file).name
+        LOGGER.info(f"Theoretical masses loaded from     : {compiled_file}")
+        return theo_masses_df
+
     try:
-        theo_masses_df = pd.read_csv(file)
+        with open_input(file) as stream:
+            theo_masses_df = pd.read_csv(stream)
     except (pd.errors.ParserError, UnicodeDecodeError) as e:
         raise UserError(
             (
@@ -176,13 +323,49 @@ def theo_masses_reader(file: Union[str, Path]) -> pd.DataFrame:
     return theo_masses_df
 
 
+def results_reader(file: Union[str, Path]) -> pd.DataFrame:
+    """Read a results CSV, as written by ``dataframe_to_csv_metadata()``, back into a DataFrame.
+
+    The metadata column is removed and its entries (e.g. the ``file`` that was analysed) are stored, as strings, in the
+    DataFrame's ``attrs``.
+
+    Parameters
+    ----------
+    file: Union[str, Path]
+        Results file to read.
+
+    Returns
+    -------
+    pd.DataFrame
+        Pandas DataFrame of results.
+    """
+    try:
+        results_df = pd.read_csv(file)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError, UnicodeDecodeError) as e:
+        raise UserError(f"The results file '{PurePath(file).name}' doesn't contain valid CSV.") from e
+    if "Inferred structure (consolidated)" not in results_df.columns:
+        raise UserError(f"'{PurePath(file).name}' doesn't look like a PGFinder results file.")
+
+    attrs = {"file": PurePath(file).name}
+    if "Metadata" in results_df.columns:
+        for entry in results_df["Metadata"].dropna():
+            key, _, value = str(entry).partition(" : ")
+            attrs[key.strip()] = value.strip()
+        results_df = results_df.drop(columns="Metadata")
+    # Rows padded out by a metadata column longer than the results
+    results_df = results_df.dropna(how="all").reset_index(drop=True)
+    results_df.attrs.update(attrs)
+    LOGGER.info(f"Results loaded from                : {file}")
+    return results_df
+
+
 def maxquant_file_reader(file):
     """Reads maxquant files and outputs data as a dataframe.
 
     Parameters
     ----------
     filepath: Union[str, Path]
-        Path to a text file.
+        Path to a text file, compressed or not.
 
     Returns
     -------
@@ -192,7 +375,8 @@ def maxquant_file_reader(file):
 
     # reads file into dataframe
     try:
-        maxquant_df = pd.read_table(file, low_memory=False)
+        with open_input(file) as stream:
+            maxquant_df = pd.read_table(stream, low_memory=False)
     except pd.errors.EmptyDataError as e:
         raise UserError(
             (
@@ -200,6 +384,14 @@ def maxquant_file_reader(file):
                 "you're using the allPeptides.txt file from MaxQuant?"
             )
         ) from e
+    return compact_feature_dtypes(_maxquant_features(maxquant_df))
+
+
+def _maxquant_features(maxquant_df: pd.DataFrame) -> pd.DataFrame:
+    """Rename and reorder the columns of a MaxQuant allPeptides.txt table into the columns PGFinder uses.
+
+    IDs are taken from the index, so chunks of a file must keep the index of their rows in the whole file.
+    """
     # adds inferredStructure column
     maxquant_df["Inferred structure"] = np.nan
     # adds theo_mwMonoisotopic column
@@ -262,19 +454,8 @@ def dataframe_to_csv_metadata(
     Returns
     -------
     """
-    release = version("pgfinder")
-    _version = ".".join(release.split("."[:2]))
-
-    metadata = [
-        f"file : {str(output_dataframe.attrs['file'])}",
-        f"masses_file : {str(output_dataframe.attrs['masses_file'])}",
-        f"rt_window : {output_dataframe.attrs['rt_window']}",
-        f"modifications : {output_dataframe.attrs['modifications']}",
-        f"ppm : {output_dataframe.attrs['ppm']}",
-        f"consolidation_ppm : {output_dataframe.attrs['consolidation_ppm']}",
-        f"version : {_version}",
-    ]
     # Add Metadata as first column
+    metadata = results_metadata(output_dataframe.attrs)
     output_dataframe = pd.concat([pd.DataFrame({"Metadata": metadata}), output_dataframe], axis=1)
     # Save the file to disk
     if save_filepath:
@@ -290,6 +471,201 @@ def dataframe_to_csv_metadata(
     return output
 
 
+def results_metadata(attrs: Dict) -> List[str]:
+    """Entries of the metadata column written alongside results.
+
+    Parameters
+    ----------
+    attrs: Dict
+        The ``attrs`` of a results DataFrame.
+
+    Returns
+    -------
+    List[str]
+        One ``key : value`` entry per analysis setting.
+    """
+    release = version("pgfinder")
+    _version = ".".join(release.split("."[:2]))
+
+    metadata = [
+        f"file : {str(attrs['file'])}",
+        f"masses_file : {str(attrs['masses_file'])}",
+        f"rt_window : {attrs['rt_window']}",
+        f"modifications : {attrs['modifications']}",
+        f"ppm : {attrs['ppm']}",
+        f"consolidation_ppm : {attrs['consolidation_ppm']}",
+    ]
+    # Optional settings are only recorded when they were used
+    metadata += [f"{key} : {attrs[key]}" for key in OPTIONAL_METADATA if key in attrs]
+    metadata.append(f"version : {_version}")
+    return metadata
+
+
+def blocks_to_csv_metadata(
+    blocks: Iterable[pd.DataFrame],
+    attrs: Dict,
+    save_filepath: Union[str, Path],
+    filename: Union[str, Path] = None,
+    float_format: str = "%.4f",
+) -> str:
+    """Write results to disk a block of rows at a time, as ``dataframe_to_csv_metadata()`` would write them all at once.
+
+    Parameters
+    ----------
+    blocks: Iterable[pd.DataFrame]
+        Consecutive blocks of results rows, all with the same columns.
+    attrs: Dict
+        Analysis settings to record in the metadata column.
+    save_filepath: Union[str, Path]
+        Path to save to.
+    filename: Union[str, Path]
+        Filename to save to.
+    float_format: str
+        Format for floating point numbers (default 4 decimal places)
+
+    Returns
+    -------
+    str
+        The relative path of the output file, including the filename.
+    """
+    metadata = results_metadata(attrs)
+    filename = filename if filename is not None else default_filename()
+    save_filepath = Path(save_filepath)
+    save_filepath.mkdir(parents=True, exist_ok=True)
+    blocks = iter(blocks)
+
+    # The metadata runs down the first rows, so enough rows to hold it are written together
+    head = []
+    while sum(len(block) for block in head) < len(metadata) and (block := next(blocks, None)) is not None:
+        head.append(block)
+    head_df = pd.concat(head, ignore_index=True) if head else pd.DataFrame()
+    head_df.attrs = dict(attrs)
+    if len(head_df) < len(metadata):
+        return dataframe_to_csv_metadata(head_df, save_filepath, filename, float_format=float_format)
+
+    output_dataframe = pd.concat([pd.DataFrame({"Metadata": metadata}), head_df], axis=1)
+    with (save_filepath / filename).open("w", newline="") as f:
+        output_dataframe.to_csv(f, index=False, float_format=float_format)
+        for block in blocks:
+            block = block.reset_index(drop=True)
+            block.insert(0, "Metadata", pd.Series(np.nan, index=block.index, dtype=object))
+            block.to_csv(f, index=False, header=False, float_format=float_format)
+    return str(save_filepath / filename)
+
+
+def dataframe_to_columns(output_dataframe: pd.DataFrame) -> bytes:
+    """Encode results as a compact columnar binary buffer, for handing to JavaScript without a CSV in between.
+
+    The buffer holds, little-endian:
+
+    ===============  =====================================================================================
+    Bytes            Contents
+    ===============  =====================================================================================
+    0–3              ``COLUMNS_MAGIC``
+    4–7              ``uint32`` length of the header
+    8–               UTF-8 JSON header: the format version, the number of rows, the ``attrs``, the entries of
+                     the metadata column written alongside CSV results and, for each column, its name, dtype
+                     and the offset of its data
+    (8-byte aligned) The data of each column, each starting on an 8-byte boundary
+    ===============  =====================================================================================
+
+    Offsets are counted from the start of the data, the first multiple of 8 after the header. Numeric columns are
+    stored as their values (``bool`` as one byte each), so can be viewed in place by a typed array. Text columns (dtype
+    ``"text"``) are stored as ``int32`` codes (-1 for missing values) at ``offset``, ``uint32`` offsets of each of the
+    ``categories`` in the UTF-8 text at ``offsets`` and the text itself at ``text``.
+
+    Parameters
+    ----------
+    output_dataframe: pd.DataFrame
+        Dataframe to output.
+
+    Returns
+    -------
+    bytes
+        The encoded results.
+    """
+    columns = []
+    arrays = []
+    offset = 0
+    for name, column in output_dataframe.items():
+        if isinstance(column.dtype, pd.CategoricalDtype) and column.cat.categories.dtype != object:
+            column = column.astype(column.cat.categories.dtype if column.notna().all() else np.float64)
+        if column.dtype.kind in "biuf":
+            values = column.to_numpy()
+            data = [values.astype(values.dtype.newbyteorder("<"), copy=False)]
+            columns.append({"name": str(name), "dtype": values.dtype.name})
+        else:
+            categorical = pd.Categorical(column.astype(object).where(column.notna(), None))
+            encoded = [str(category).encode("utf-8") for category in categorical.categories]
+            data = [
+                categorical.codes.astype("<i4"),
+                np.cumsum([0] + [len(e) for e in encoded], dtype="<u4"),
+                np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            ]
+            columns.append({"name": str(name), "dtype": "text", "categories": len(encoded)})
+        for key, array in zip(["offset", "offsets", "text"], data):
+            columns[-1][key] = offset
+            offset += _aligned(array.nbytes)
+        arrays += data
+
+    header = {
+        "format_version": COLUMNS_FORMAT_VERSION,
+        "rows": len(output_dataframe),
+        "attrs": output_dataframe.attrs,
+        "metadata": results_metadata(output_dataframe.attrs),
+        "columns": columns,
+    }
+    encoded_header = json.dumps(header, default=str).encode("utf-8")
+    parts = [COLUMNS_MAGIC, np.array([len(encoded_header)], dtype="<u4").tobytes(), encoded_header]
+    parts.append(bytes(_aligned(8 + len(encoded_header)) - 8 - len(encoded_header)))
+    for array in arrays:
+        parts += [array.tobytes(), bytes(_aligned(array.nbytes) - array.nbytes)]
+    return b"".join(parts)
+
+
+def columns_reader(buffer: Union[bytes, memoryview]) -> pd.DataFrame:
+    """Decode results encoded by ``dataframe_to_columns()``.
+
+    Parameters
+    ----------
+    buffer: Union[bytes, memoryview]
+        The encoded results.
+
+    Returns
+    -------
+    pd.DataFrame
+        Pandas DataFrame of results, with text columns as ``object`` columns and the ``attrs`` restored.
+    """
+    buffer = memoryview(buffer).cast("B")
+    if bytes(buffer[:4]) != COLUMNS_MAGIC:
+        raise UserError("The results buffer doesn't contain PGFinder results.")
+    length = int(np.frombuffer(buffer, dtype="<u4", count=1, offset=4)[0])
+    header = json.loads(bytes(buffer[8 : 8 + length]).decode("utf-8"))
+    if header["format_version"] != COLUMNS_FORMAT_VERSION:
+        raise UserError(f"Results of format version {header['format_version']} can't be read by this PGFinder.")
+    start = _aligned(8 + length)
+    rows = header["rows"]
+    data = {}
+    for column in header["columns"]:
+        if column["dtype"] != "text":
+            values = np.frombuffer(buffer, dtype=column["dtype"], count=rows, offset=start + column["offset"])
+            data[column["name"]] = values.copy()
+            continue
+        codes = np.frombuffer(buffer, dtype="<i4", count=rows, offset=start + column["offset"])
+        offsets = np.frombuffer(buffer, dtype="<u4", count=column["categories"] + 1, offset=start + column["offsets"])
+        text = bytes(buffer[start + column["text"] : start + column["text"] + int(offsets[-1])])
+        categories = [text[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(column["categories"])]
+        data[column["name"]] = pd.Categorical.from_codes(codes, categories=categories).astype(object)
+    results_df = pd.DataFrame(data, columns=[column["name"] for column in header["columns"]])
+    results_df.attrs.update(header["attrs"])
+    return results_df
+
+
+def _aligned(n: int) -> int:
+    """``n`` rounded up to a multiple of 8."""
+    return -(-n // 8) * 8
+
+
 def default_filename(prefix: str = "results_") -> str:
     """Generate a default filename based on the current date/time.
 
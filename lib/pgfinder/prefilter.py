@@ -0,0 +1,180 @@
+"""Filtering out the features of a sample that aren't worth matching, before any of the analysis is done.
+
+Most features in a deconvoluted sample are near-noise that never match anything useful. A ``FeatureFilter`` drops
+features below a minimum intensity, outside a retention time or mass range or without one of the allowed charges, and
+can then keep only the most intense of those left. Every later stage — building the search space, matching, the
+clean-up and consolidation — only sees the features that are kept.
+
+Filters are applied with vectorised masks right after a feature table has been read. For Byos (``.ftrs``) files the
+intensity, retention time and mass criteria are pushed down into the query of the ``Features`` table, so that the
+dropped features aren't even read. Dropped features can also be reported alongside the results as unmatched rows,
+without being processed.
+"""
+import re
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from pgfinder.errors import UserError
+
+# Columns of the results that unmatched features have no value for
+RESULT_ONLY_COLUMNS = ["Delta ppm", "Inferred structure (consolidated)", "Intensity (consolidated)"]
+
+
+class FeatureFilter(NamedTuple):
+    """Which features of a sample to analyse, every criterion being optional.
+
+    Parameters
+    ----------
+    min_intensity : float
+        Drop features less intense than this.
+    top_n : int
+        Only keep this many of the most intense features that pass the other criteria (the earliest in the file
+        winning ties).
+    rt_range : Tuple[float, float]
+        Drop features with retention times (in minutes) outside this range, inclusive.
+    mass_range : Tuple[float, float]
+        Drop features with observed masses (in Da) outside this range, inclusive.
+    charges : Tuple[int, ...]
+        Drop features that weren't observed with any of these charges.
+    """
+
+    min_intensity: Optional[float] = None
+    top_n: Optional[int] = None
+    rt_range: Optional[Tuple[float, float]] = None
+    mass_range: Optional[Tuple[float, float]] = None
+    charges: Optional[Tuple[int, ...]] = None
+
+    @classmethod
+    def from_settings(
+        cls,
+        min_intensity: float = None,
+        top_n: int = None,
+        rt_range: List[float] = None,
+        mass_range: List[float] = None,
+        charges: List[int] = None,
+    ) -> Optional["FeatureFilter"]:
+        """A checked filter from settings as given in a configuration file or on the command line.
+
+        Returns
+        -------
+        Optional[FeatureFilter]
+            The filter, or ``None`` when no criterion is set.
+        """
+        if top_n is not None and (int(top_n) != top_n or top_n < 1):
+            raise UserError("The number of most intense features to keep must be a whole number of at least 1.")
+        ranges = {"retention time": rt_range, "mass": mass_range}
+        for name, bounds in ranges.items():
+            if bounds is not None and (len(bounds) != 2 or bounds[0] > bounds[1]):
+                raise UserError(f"The {name} range must be given as a lower and an upper bound, in that order.")
+        if charges is not None and any(int(c) != c for c in charges):
+            raise UserError("Charges to keep must be whole numbers.")
+        feature_filter = cls(
+            min_intensity=None if min_intensity is None else float(min_intensity),
+            top_n=None if top_n is None else int(top_n),
+            rt_range=None if rt_range is None else (float(rt_range[0]), float(rt_range[1])),
+            mass_range=None if mass_range is None else (float(mass_range[0]), float(mass_range[1])),
+            charges=None if charges is None else tuple(sorted({int(c) for c in charges})),
+        )
+        return feature_filter if feature_filter.active else None
+
+    @property
+    def active(self) -> bool:
+        """Whether any criterion is set."""
+        return any(criterion is not None for criterion in self)
+
+    def describe(self) -> str:
+        """The criteria that are set, as recorded in the metadata of results."""
+        return ", ".join(f"{name}={value}" for name, value in self._asdict().items() if value is not None)
+
+    def row_mask(self, features_df: pd.DataFrame) -> np.ndarray:
+        """Which features pass every criterion other than ``top_n``, each judged on its own."""
+        keep = np.ones(len(features_df), dtype=bool)
+        if self.min_intensity is not None:
+            keep &= features_df["Intensity"].to_numpy(dtype=float) >= self.min_intensity
+        for column, bounds in [("RT (min)", self.rt_range), ("Obs (Da)", self.mass_range)]:
+            if bounds is not None:
+                values = features_df[column].to_numpy(dtype=float)
+                keep &= (values >= bounds[0]) & (values <= bounds[1])
+        if self.charges is not None:
+            keep &= _charge_mask(features_df["Charge"], self.charges)
+        return keep
+
+    def mask(self, features_df: pd.DataFrame) -> np.ndarray:
+        """Which features of a whole sample pass the filter."""
+        keep = self.row_mask(features_df)
+        if self.top_n is not None:
+            keep = top_n_mask(features_df["Intensity"].to_numpy(dtype=float), keep, self.top_n)
+        return keep
+
+    def apply(self, features_df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """Split a whole sample into the features that are kept and those that are dropped, each in file order."""
+        keep = self.mask(features_df)
+        return features_df[keep], features_df[~keep]
+
+    def where(self, columns: Dict[str, str]) -> Tuple[str, List[float]]:
+        """A SQL ``WHERE`` clause applying the intensity, retention time and mass criteria.
+
+        Parameters
+        ----------
+        columns : Dict[str, str]
+            Name of the table column holding each of ``Intensity``, ``RT (min)`` and ``Obs (Da)``.
+
+        Returns
+        -------
+        Tuple[str, List[float]]
+            The clause (empty when none of these criteria is set) and its parameters.
+        """
+        conditions, parameters = [], []
+        if self.min_intensity is not None:
+            conditions.append(f'"{columns["Intensity"]}" >= ?')
+            parameters.append(self.min_intensity)
+        for column, bounds in [("RT (min)", self.rt_range), ("Obs (Da)", self.mass_range)]:
+            if bounds is not None:
+                conditions.append(f'"{columns[column]}" BETWEEN ? AND ?')
+                parameters += list(bounds)
+        return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+
+def top_n_mask(intensity: np.ndarray, keep: np.ndarray, n: int) -> np.ndarray:
+    """Narrow ``keep`` down to the ``n`` most intense of the features it keeps, the earliest winning ties."""
+    candidates = np.flatnonzero(keep)
+    if len(candidates) <= n:
+        return keep
+    # Missing intensities sort last
+    most_intense = candidates[np.argsort(-intensity[candidates], kind="stable")[:n]]
+    narrowed = np.zeros_like(keep)
+    narrowed[most_intense] = True
+    return narrowed
+
+
+def as_unmatched(features_df: pd.DataFrame) -> pd.DataFrame:
+    """Features laid out as the unmatched rows of results, ordered by intensity and retention time as those are."""
+    unmatched_df = features_df.assign(**{column: np.nan for column in RESULT_ONLY_COLUMNS})
+    unmatched_df["Inferred structure"] = unmatched_df["Inferred structure"].astype(object)
+    unmatched_df = unmatched_df.sort_values(by=["Intensity", "RT (min)"], ascending=[False, True], kind="stable")
+    return unmatched_df.reset_index(drop=True)
+
+
+def with_unmatched(results_df: pd.DataFrame, dropped_df: pd.DataFrame) -> pd.DataFrame:
+    """Add dropped features to the unmatched rows at the end of results, keeping those in order."""
+    unmatched = results_df["Inferred structure"].isna().to_numpy()
+    tail = pd.concat([results_df[unmatched], as_unmatched(dropped_df).reindex(columns=results_df.columns)])
+    tail = tail.sort_values(by=["Intensity", "RT (min)"], ascending=[False, True], kind="stable")
+    combined = pd.concat([results_df[~unmatched], tail], ignore_index=True)
+    combined.attrs = results_df.attrs
+    return combined
+
+
+def _charge_mask(charges: pd.Series, allowed: Tuple[int, ...]) -> np.ndarray:
+    """Which features were observed with any of the allowed charges, be they integers or lists like ``"1, 2"``."""
+    if is_numeric_dtype(charges.dtype) and not isinstance(charges.dtype, pd.CategoricalDtype):
+        return np.isin(charges.to_numpy(), allowed)
+    # Text charges are parsed once per distinct value, with missing charges (code -1) picking the final False
+    categorical = pd.Categorical(charges)
+    allowed_categories = [
+        set(map(int, re.findall(r"\d+", str(category)))) & set(allowed) for category in categorical.categories
+    ]
+    return np.array([bool(c) for c in allowed_categories] + [False])[categorical.codes]
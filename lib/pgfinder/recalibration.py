@@ -0,0 +1,176 @@
+"""Correcting systematic drift in the mass calibration of a sample, so that it can be matched at a narrower tolerance.
+
+Mass spectrometers drift out of calibration in ways that vary smoothly with mass and over the course of a run. Left
+uncorrected, the drift forces ``ppm_tolerance`` well above the instrument's real accuracy, which brings in spurious
+candidates for every feature. Recalibration takes the features that match a single library monomer — with no other
+library mass within twice the tolerance — as calibrants, fits their ppm errors with a low-order polynomial of mass and
+retention time, and divides the fitted offset out of every observed mass. The rest of the analysis is then run at the
+narrower tolerance.
+
+The fit is robust: calibrants with residuals more than ``CLIP`` scaled median absolute deviations from the fit are
+left out and the fit repeated until no more are. Fewer calibrants give simpler fits (quadratic, then linear, then a
+constant offset), and the polynomial is held constant beyond the masses and retention times of the calibrants rather
+than extrapolated.
+"""
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+# Fewest calibrants needed for a constant, linear and quadratic fit
+MIN_CALIBRANTS = {0: 5, 1: 20, 2: 60}
+# Residuals further than this many (normal-scaled) median absolute deviations from the fit are outliers
+CLIP = 3.0
+MAX_ITERATIONS = 10
+# Exponents of the scaled mass and retention time in each term of the polynomial, by degree
+TERMS = {0: ((0, 0),), 1: ((0, 0), (1, 0), (0, 1)), 2: ((0, 0), (1, 0), (0, 1), (2, 0), (1, 1), (0, 2))}
+
+
+class Calibration(NamedTuple):
+    """A fitted ppm offset of observed masses, as a polynomial of scaled mass and retention time.
+
+    Parameters
+    ----------
+    coefficients : Tuple[float, ...]
+        Coefficient (in ppm) of each of the ``TERMS`` of the degree of the fit.
+    mass_range : Tuple[float, float]
+        Lowest and highest mass (Da) of the calibrants, scaled to [-1, 1].
+    rt_range : Tuple[float, float]
+        Earliest and latest retention time (min) of the calibrants, scaled to [-1, 1].
+    calibrants : int
+        Number of calibrants the fit was made with, after outliers were left out.
+    spread_ppm : float
+        Scaled median absolute deviation of the calibrants from the fit.
+    """
+
+    coefficients: Tuple[float, ...]
+    mass_range: Tuple[float, float]
+    rt_range: Tuple[float, float]
+    calibrants: int
+    spread_ppm: float
+
+    def offset_ppm(self, observed: np.ndarray, rt: np.ndarray) -> np.ndarray:
+        """Fitted ppm error of observed masses at their retention times."""
+        m, t = _scaled(observed, self.mass_range), _scaled(rt, self.rt_range)
+        # Summed term by term, so that each mass is corrected the same way however many are corrected at once
+        offset = np.zeros(len(m))
+        for c, (i, j) in zip(self.coefficients, TERMS[_degree(self.coefficients)]):
+            offset += c * m**i * t**j
+        return offset
+
+    def corrected(self, observed: np.ndarray, rt: np.ndarray) -> np.ndarray:
+        """Observed masses with the fitted offset divided out."""
+        observed = np.asarray(observed, dtype=float)
+        return observed / (1 + self.offset_ppm(observed, rt) / 1000000)
+
+    def apply(self, features_df: pd.DataFrame) -> pd.DataFrame:
+        """A copy of a feature table with recalibrated observed masses."""
+        corrected_df = features_df.copy()
+        corrected_df["Obs (Da)"] = self.corrected(features_df["Obs (Da)"], features_df["RT (min)"])
+        return corrected_df
+
+    def describe(self) -> str:
+        """The fitted offset, as recorded in the metadata of results."""
+        terms = ""
+        for c, powers in zip(self.coefficients, TERMS[_degree(self.coefficients)]):
+            sign = ("-" if c < 0 else "") if not terms else (" - " if c < 0 else " + ")
+            terms += (
+                sign
+                + f"{abs(c):.4g}"
+                + "".join(f"*{v}" + (f"^{p}" if p > 1 else "") for v, p in zip("mt", powers) if p)
+            )
+        # How the mass and retention time are scaled, when the fit depends on them
+        variables = {"m": ("mass", self.mass_range), "t": ("rt", self.rt_range)} if len(self.coefficients) > 1 else {}
+        scales = "".join(
+            f"; {v} = ({name} - {(high + low) / 2:.4g}) / {max((high - low) / 2, 1e-9):.4g}"
+            for v, (name, (low, high)) in variables.items()
+        )
+        return f"offset_ppm = {terms}{scales}; {self.calibrants} calibrants, residual spread {self.spread_ppm:.3g} ppm"
+
+
+def fit_calibration(observed: np.ndarray, rt: np.ndarray, theoretical: np.ndarray) -> Optional[Calibration]:
+    """Fit the ppm errors of calibrants, with the highest degree of polynomial that there are enough of them for.
+
+    Parameters
+    ----------
+    observed : np.ndarray
+        Observed mass of each calibrant.
+    rt : np.ndarray
+        Retention time of each calibrant.
+    theoretical : np.ndarray
+        Theoretical mass of the structure each calibrant matched.
+
+    Returns
+    -------
+    Optional[Calibration]
+        The fit, or None when there are too few calibrants for even a constant offset.
+    """
+    observed, rt, theoretical = (np.asarray(a, dtype=float) for a in (observed, rt, theoretical))
+    degrees = [d for d, n in MIN_CALIBRANTS.items() if len(observed) >= n]
+    if not degrees:
+        return None
+    degree = max(degrees)
+    error_ppm = (observed - theoretical) / theoretical * 1000000
+    mass_range = (float(observed.min()), float(observed.max()))
+    rt_range = (float(np.nanmin(rt)), float(np.nanmax(rt))) if np.isfinite(rt).any() else (0.0, 0.0)
+    terms = _terms(_scaled(observed, mass_range), _scaled(rt, rt_range), degree)
+
+    inliers = np.ones(len(observed), dtype=bool)
+    for _ in range(MAX_ITERATIONS):
+        coefficients = np.linalg.lstsq(terms[inliers], error_ppm[inliers], rcond=None)[0]
+        residuals = error_ppm - terms @ coefficients
+        spread = 1.4826 * np.median(np.abs(residuals[inliers] - np.median(residuals[inliers])))
+        kept = np.abs(residuals) <= max(CLIP * spread, 1e-6)
+        if kept.sum() < MIN_CALIBRANTS[degree] or np.array_equal(kept, inliers):
+            break
+        inliers = kept
+    return Calibration(
+        coefficients=tuple(float(c) for c in coefficients),
+        mass_range=mass_range,
+        rt_range=rt_range,
+        calibrants=int(inliers.sum()),
+        spread_ppm=float(spread),
+    )
+
+
+def calibrants(observed: np.ndarray, library_masses: np.ndarray, ppm_tolerance: float) -> Tuple[np.ndarray, np.ndarray]:
+    """Pick out the observed masses that unambiguously match a single library mass.
+
+    Parameters
+    ----------
+    observed : np.ndarray
+        Observed masses of a sample.
+    library_masses : np.ndarray
+        Theoretical masses of the library structures.
+    ppm_tolerance : float
+        Tolerance (in ppm) the observed masses are matched within; no other library mass may lie within twice this.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        Positions of the calibrants among ``observed``, and the library mass each matched.
+    """
+    masses = np.unique(np.asarray(library_masses, dtype=float))
+    observed = np.asarray(observed, dtype=float)
+    width = observed * ppm_tolerance / 1000000
+    lower = np.searchsorted(masses, observed - 2 * width, side="left")
+    upper = np.searchsorted(masses, observed + 2 * width, side="right")
+    single = np.flatnonzero(upper - lower == 1)
+    theoretical = masses[lower[single]]
+    matched = np.abs(observed[single] - theoretical) <= theoretical * ppm_tolerance / 1000000
+    return single[matched], theoretical[matched]
+
+
+def _degree(coefficients: Tuple[float, ...]) -> int:
+    return next(d for d, terms in TERMS.items() if len(terms) == len(coefficients))
+
+
+def _scaled(values: np.ndarray, bounds: Tuple[float, float]) -> np.ndarray:
+    """Values scaled so that the bounds become -1 and 1, held at those beyond them (and 0 where missing)."""
+    low, high = bounds
+    scaled = (np.asarray(values, dtype=float) - (high + low) / 2) / max((high - low) / 2, 1e-9)
+    return np.nan_to_num(np.clip(scaled, -1, 1))
+
+
+def _terms(m: np.ndarray, t: np.ndarray, degree: int) -> np.ndarray:
+    return np.column_stack([m**i * t**j for i, j in TERMS[degree]])
@@ -0,0 +1,318 @@
+"""Expanded search spaces, precomputed once per configuration and filtered per sample.
+
+``Analyzer.search_space()`` expands the library of every sample afresh: the library structures observed in the sample
+are joined into multimers and every observed structure is modified. That expansion only depends on the library and the
+enabled modifications, so it can instead be done once for the whole library and saved. Each candidate remembers the
+structure it was built from, so a sample's search space is picked out of it with a few vectorised masks, giving the
+candidates ``Analyzer.search_space()`` would have built (and that can match) in the same order.
+
+An expanded search space is saved as an uncompressed NumPy ``.npz`` archive, sorted by mass, of these arrays:
+
+==================  ==================================================================================
+Array               Contents
+==================  ==================================================================================
+``metadata``        UTF-8 JSON describing the configuration the space was built for
+``masses``          ``float64`` theoretical mass of each candidate, as it is matched, in ascending order
+``order``           ``int64`` position of each candidate in the order they were generated
+``window_masses``   ``float64`` mass used to check whether a library structure or multimer was observed
+``blocks``          ``int16`` 0 for library structures, then one block per multimer type and modification
+``sources``         ``int64`` candidate a multimer or modified structure was built from (-1 for the library)
+``keys``            ``int64`` code shared by library structures and multimers of the same name and mass
+``name_offsets``    ``uint64`` offsets of each name in ``names``
+``names``           UTF-8 structure names, concatenated
+==================  ==================================================================================
+"""
+import hashlib
+import json
+import logging
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterable, Union
+
+import numpy as np
+import pandas as pd
+
+from pgfinder import release
+from pgfinder.errors import UserError
+from pgfinder.kernels import ppm_windows, read_only, window_hits
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.matching import modification_generator, multimer_builder
+from pgfinder.structures import parse_structure
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+FORMAT = "pgfinder expanded search space"
+FORMAT_VERSION = 1
+SUFFIX = ".npz"
+NO_MATCHES = "No matches were found for this search. Please check your database or increase mass tolerance."
+
+
+class ExpandedSearchSpace:
+    """Every candidate structure a library can be expanded into, with the structure each was built from.
+
+    Parameters
+    ----------
+    names : np.ndarray
+        Candidate names, sorted by mass.
+    masses : np.ndarray
+        Theoretical masses of the candidates as they are matched, in ascending order.
+    order : np.ndarray
+        Position of each candidate in the order they were generated.
+    window_masses : np.ndarray
+        Masses checked against the observed masses to decide whether library structures and multimers were observed.
+    blocks : np.ndarray
+        0 for library structures, 1 to ``multimer_blocks`` for each multimer type, then one block per modification.
+    sources : np.ndarray
+        Index of the candidate each multimer or modified structure was built from, -1 for library structures.
+    keys : np.ndarray
+        Codes identifying library structures and multimers with the same name and mass, which are only kept once.
+    metadata : Dict
+        Configuration the space was built for, including its ``fingerprint``.
+    """
+
+    def __init__(
+        self,
+        names: np.ndarray,
+        masses: np.ndarray,
+        order: np.ndarray,
+        window_masses: np.ndarray,
+        blocks: np.ndarray,
+        sources: np.ndarray,
+        keys: np.ndarray,
+        metadata: Dict,
+    ):
+        self.names = read_only(np.asarray(names, dtype=object))
+        self.masses = read_only(np.asarray(masses, dtype=float))
+        self.order = read_only(np.asarray(order, dtype=np.int64))
+        self.window_masses = read_only(np.asarray(window_masses, dtype=float))
+        self.blocks = read_only(np.asarray(blocks, dtype=np.int16))
+        self.sources = read_only(np.asarray(sources, dtype=np.int64))
+        self.keys = read_only(np.asarray(keys, dtype=np.int64))
+        self.metadata = metadata
+        self.multimer_blocks = int(metadata["multimer_blocks"])
+        # Library structures and multimers of each block in the order they were generated
+        generated = np.argsort(self.order, kind="stable")
+        self._block_rows = [
+            read_only(generated[self.blocks[generated] == block]) for block in range(self.multimer_blocks + 1)
+        ]
+        self._modified = read_only(np.flatnonzero(self.blocks > self.multimer_blocks))
+
+    def __len__(self) -> int:
+        return len(self.masses)
+
+    @property
+    def fingerprint(self) -> str:
+        """Fingerprint of the library and modifications the space was built for."""
+        return self.metadata["fingerprint"]
+
+    def filter(self, observed: np.ndarray, ppm_tolerance: float) -> pd.DataFrame:
+        """Pick out the candidates of a sample, as ``Analyzer.search_space()`` would build them.
+
+        Library structures are kept if they were observed, multimers if they were observed and built from a kept
+        library structure, and modified structures if they were built from a kept structure. Of those, only candidates
+        that match an observed mass are returned, as the others can't change the results.
+
+        Parameters
+        ----------
+        observed : np.ndarray
+            Observed masses of a sample, sorted in ascending order.
+        ppm_tolerance : float
+            The ppm tolerance used when matching the theoretical masses of structures to observed ions.
+
+        Returns
+        -------
+        pd.DataFrame
+            Candidate structures and their theoretical masses.
+        """
+        observed_candidates = window_hits(observed, *ppm_windows(self.window_masses, ppm_tolerance))
+        kept = np.zeros(len(self), dtype=bool)
+        for block, rows in enumerate(self._block_rows):
+            rows = rows[observed_candidates[rows]]
+            if block:
+                rows = rows[kept[self.sources[rows]]]
+            # Structures with the same name and mass are only kept the first time they're generated
+            _, first = np.unique(self.keys[rows], return_index=True)
+            if len(first) == 0:
+                raise UserError(NO_MATCHES)
+            kept[rows[np.sort(first)]] = True
+        kept[self._modified] = kept[self.sources[self._modified]]
+
+        kept &= window_hits(observed, *ppm_windows(self.masses, ppm_tolerance))
+        rows = np.flatnonzero(kept)
+        rows = rows[np.argsort(self.order[rows], kind="stable")]
+        return pd.DataFrame({"Inferred structure": self.names[rows], "Theo (Da)": self.masses[rows]})
+
+    def write(self, file: Union[str, Path]) -> Union[str, Path]:
+        """Save the expanded search space.
+
+        Parameters
+        ----------
+        file : Union[str, Path]
+            File to write, conventionally with an ``.npz`` suffix.
+
+        Returns
+        -------
+        Union[str, Path]
+            The file that was written.
+        """
+        encoded = [name.encode("utf-8") for name in self.names]
+        with open(file, "wb") as f:
+            np.savez(
+                f,
+                metadata=np.frombuffer(json.dumps(self.metadata).encode("utf-8"), dtype=np.uint8),
+                masses=self.masses,
+                order=self.order,
+                window_masses=self.window_masses,
+                blocks=self.blocks,
+                sources=self.sources,
+                keys=self.keys,
+                name_offsets=np.cumsum([0] + [len(e) for e in encoded], dtype=np.uint64),
+                names=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            )
+        LOGGER.info(f"Expanded search space of {len(self)} candidates saved to : {file}")
+        return file
+
+    @classmethod
+    def read(cls, file: Union[str, Path]) -> "ExpandedSearchSpace":
+        """Load a saved expanded search space.
+
+        Parameters
+        ----------
+        file : Union[str, Path]
+            File written by ``write()``.
+
+        Returns
+        -------
+        ExpandedSearchSpace
+            The expanded search space.
+        """
+        try:
+            with np.load(file, allow_pickle=False) as arrays:
+                metadata = json.loads(arrays["metadata"].tobytes().decode("utf-8"))
+                if metadata.get("format") != FORMAT:
+                    raise ValueError
+                if metadata.get("format_version") != FORMAT_VERSION:
+                    raise UserError(
+                        f"The expanded search space '{Path(file).name}' uses format version "
+                        f"{metadata.get('format_version')}, but this version of PGFinder only reads version "
+                        f"{FORMAT_VERSION}. Please re-build it."
+                    )
+                offsets = arrays["name_offsets"].tolist()
+                blob = arrays["names"].tobytes()
+                names = [blob[offsets[i] : offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+                return cls(
+                    names,
+                    arrays["masses"],
+                    arrays["order"],
+                    arrays["window_masses"],
+                    arrays["blocks"],
+                    arrays["sources"],
+                    arrays["keys"],
+                    metadata,
+                )
+        except (OSError, ValueError, KeyError) as e:
+            raise UserError(f"'{Path(file).name}' is not an expanded search space.") from e
+
+
+def fingerprint(library: pd.DataFrame, enabled_mod_list: Iterable[str]) -> str:
+    """Fingerprint of a library and the enabled modifications, identifying the search space they expand into."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(list(enabled_mod_list)).encode("utf-8"))
+    digest.update("\n".join(library["Inferred structure"]).encode("utf-8"))
+    digest.update(library["Theo (Da)"].to_numpy(dtype="<f8").tobytes())
+    return digest.hexdigest()
+
+
+def expand_search_space(
+    library: pd.DataFrame,
+    library_rounded: np.ndarray,
+    multimer_mods: Iterable[str],
+    other_mods: Iterable[str],
+    metadata: Dict = None,
+) -> ExpandedSearchSpace:
+    """Expand a whole library into every candidate a sample could need.
+
+    The same functions as ``Analyzer.search_space()`` are used, applied to every library structure rather than only to
+    those observed in a sample, so the candidates have exactly the same names and masses.
+
+    Parameters
+    ----------
+    library : pd.DataFrame
+        Library structures and their (unrounded) masses.
+    library_rounded : np.ndarray
+        Library masses rounded to 4 decimal places.
+    multimer_mods : Iterable[str]
+        Enabled multimer types.
+    other_mods : Iterable[str]
+        Enabled modifications.
+    metadata : Dict
+        Configuration the space is built for.
+
+    Returns
+    -------
+    ExpandedSearchSpace
+        The expanded search space.
+    """
+    multimer_mods, other_mods = list(multimer_mods), list(other_mods)
+    monomers_df = pd.DataFrame(
+        {"Inferred structure": library["Inferred structure"].to_numpy(), "Theo (Da)": library_rounded}
+    )
+    names = [monomers_df["Inferred structure"].to_numpy(dtype=object)]
+    masses = [library_rounded]
+    window_masses = [library["Theo (Da)"].to_numpy(dtype=float)]
+    sources = [np.full(len(monomers_df), -1, dtype=np.int64)]
+
+    # `multimer_builder()` joins each donor in turn to every library structure that isn't just a disaccharide
+    acceptors = np.flatnonzero([len(parse_structure(name).core) > 2 for name in names[0]])
+    for mod in multimer_mods:
+        LOGGER.info(f"Building {mod} of every library structure")
+        multimers_df = multimer_builder(monomers_df, mod).astype({"Theo (Da)": float})
+        unrounded = multimers_df["Theo (Da)"].to_numpy()
+        names.append(multimers_df["Inferred structure"].to_numpy(dtype=object))
+        masses.append(np.array([round(m, 4) for m in unrounded.tolist()], dtype=float))
+        window_masses.append(unrounded)
+        sources.append(np.tile(acceptors, len(unrounded) // max(len(acceptors), 1)))
+
+    base_df = pd.DataFrame({"Inferred structure": np.concatenate(names), "Theo (Da)": np.concatenate(masses)})
+    for mod in other_mods:
+        LOGGER.info(f"Generating {mod} variants of every library structure and multimer")
+        modified_df = modification_generator(base_df, mod).astype({"Theo (Da)": float})
+        names.append(modified_df["Inferred structure"].to_numpy(dtype=object))
+        masses.append(modified_df["Theo (Da)"].to_numpy())
+        window_masses.append(masses[-1])
+        sources.append(np.arange(len(base_df), dtype=np.int64))
+
+    # Multimers are built from library structures and modified structures from either, which all come first, so
+    # sources are already positions in the whole expansion
+    blocks = np.repeat(np.arange(len(names), dtype=np.int16), [len(n) for n in names])
+    names, masses, window_masses = np.concatenate(names), np.concatenate(masses), np.concatenate(window_masses)
+    sources = np.concatenate(sources)
+
+    base = blocks <= len(multimer_mods)
+    keys = np.full(len(names), -1, dtype=np.int64)
+    keys[base] = pd.MultiIndex.from_arrays([blocks[base], names[base], masses[base]]).factorize()[0]
+
+    # Store the candidates sorted by mass, keeping track of the order they were generated in
+    by_mass = np.argsort(masses, kind="stable")
+    position = np.empty(len(by_mass), dtype=np.int64)
+    position[by_mass] = np.arange(len(by_mass))
+    sources = np.where(sources >= 0, position[np.maximum(sources, 0)], -1)
+    metadata = {
+        "format": FORMAT,
+        "format_version": FORMAT_VERSION,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "pgfinder_version": release,
+        **(metadata or {}),
+        "multimer_blocks": len(multimer_mods),
+    }
+    LOGGER.info(f"Expanded the library into {len(names)} candidates")
+    return ExpandedSearchSpace(
+        names[by_mass],
+        masses[by_mass],
+        by_mass,
+        window_masses[by_mass],
+        blocks[by_mass],
+        sources[by_mass],
+        keys[by_mass],
+        metadata,
+    )
@@ -0,0 +1,623 @@
+"""Long-running local analysis service"""
+import base64
+import binascii
+import ipaddress
+import itertools
+import json
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+import pandas as pd
+
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
+from pgfinder.gui.internal import MASS_LIB_DIR, ms_upload_reader
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.metrics import REGISTRY
+from pgfinder.pgio import dataframe_to_csv_metadata, default_filename, ms_file_reader, theo_masses_reader
+from pgfinder.prefilter import FeatureFilter
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+DEFAULT_PARAMETERS = {
+    "masses_file": None,
+    "ppm_tolerance": 10,
+    "consolidation_ppm": 1,
+    "time_delta": 0.5,
+    "mod_list": None,
+    "output_dir": None,
+    "float_format": 4,
+    "max_multimer": None,
+    "max_modifications": None,
+    "engine": None,
+    "search_space": None,
+    "min_intensity": None,
+    "top_n": None,
+    "rt_range": None,
+    "mass_range": None,
+    "charges": None,
+    "report_filtered": False,
+    "recalibrated_ppm": None,
+}
+
+# What each job parameter must be, checked when a job is submitted so that mistakes are reported to the client
+PARAMETER_TYPES = {
+    "input_file": "path",
+    "masses_file": "path",
+    "ppm_tolerance": "number",
+    "consolidation_ppm": "number",
+    "time_delta": "number",
+    "mod_list": "strings",
+    "output_dir": "path",
+    "float_format": "whole",
+    "max_multimer": "whole",
+    "max_modifications": "whole",
+    "engine": "string",
+    "search_space": "path",
+    "min_intensity": "number",
+    "top_n": "whole",
+    "rt_range": "numbers",
+    "mass_range": "numbers",
+    "charges": "wholes",
+    "report_filtered": "bool",
+    "recalibrated_ppm": "number",
+}
+TYPE_DESCRIPTIONS = {
+    "path": "a path",
+    "string": "a string",
+    "number": "a number",
+    "whole": "a whole number",
+    "strings": "a list of strings",
+    "numbers": "a list of numbers",
+    "wholes": "a list of whole numbers",
+    "bool": "true or false",
+}
+# Job parameters naming files or directories, which are restricted to the service's data directories
+PATH_PARAMETERS = ("input_file", "masses_file", "output_dir", "search_space")
+
+# Media types of scrapes that want metrics in the Prometheus text format, and the type they're sent as
+PROMETHEUS_ACCEPT = re.compile(r"text/plain|application/openmetrics-text")
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class QueueFullError(RuntimeError):
+    """Raised when a job is submitted while every worker is busy and the queue is full."""
+
+
+class Job:
+    """An analysis job and its outcome.
+
+    Parameters
+    ----------
+    job_id : str
+        Identifier of the job.
+    name : str
+        Name of the mass spectrometry file being analysed.
+    """
+
+    def __init__(self, job_id: str, name: str):
+        self.id = job_id
+        self.name = name
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.error = None
+        self.result = None
+        self.result_file = None
+        self.done = threading.Event()
+
+    def to_dict(self) -> Dict:
+        """Summarise the job as a JSON-serialisable dictionary."""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "result_file": self.result_file,
+        }
+
+
+class AnalysisService:
+    """Run analysis jobs on a bounded pool of workers while keeping mass libraries and analyzers warm.
+
+    Mass libraries are loaded once per file (and re-loaded only if the file changes) and an ``Analyzer`` is kept for
+    each distinct combination of library and parameters, so repeated jobs with the same settings skip all of the
+    setup work.
+
+    Parameters
+    ----------
+    workers : int
+        Number of jobs that are analysed concurrently.
+    queue_size : int
+        Number of jobs that can wait for a free worker before new submissions are rejected.
+    masses_file : Union[str, Path]
+        Mass library used by jobs that don't specify their own; loaded when the service starts.
+    max_analyzers : int
+        Number of analyzers (distinct parameter combinations) that are kept warm.
+    max_jobs : int
+        Number of finished jobs (and in-memory results) that are retained.
+    data_dirs : Iterable[Union[str, Path]]
+        Directories that the input files, mass libraries, output directories and search spaces of jobs must lie
+        within; built-in mass libraries can always be used. Jobs may name any path when this isn't given, unless the
+        service is served beyond the local machine (see ``create_server()``).
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        queue_size: int = 16,
+        masses_file: Union[str, Path] = None,
+        max_analyzers: int = 32,
+        max_jobs: int = 1024,
+        data_dirs: Iterable[Union[str, Path]] = None,
+    ):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.default_masses_file = masses_file
+        self.max_analyzers = max_analyzers
+        self.max_jobs = max_jobs
+        self.data_dirs = None if data_dirs is None else tuple(Path(d).resolve() for d in data_dirs)
+        self.started = time.time()
+
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pgfinder-worker")
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._libraries: Dict[Tuple[str, float], pd.DataFrame] = {}
+        self._analyzers: "OrderedDict[Tuple, Analyzer]" = OrderedDict()
+        self._pending = 0
+        self._running = 0
+        self._counts = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0}
+        self._processing_seconds = 0.0
+
+        if masses_file is not None:
+            self._library(masses_file)
+
+    def submit(self, request: Dict) -> Job:
+        """Queue an analysis job.
+
+        Parameters
+        ----------
+        request : Dict
+            Either ``input_file`` (the path to a ``.ftrs`` or ``.txt`` file) or ``upload`` (a dictionary with the
+            ``name`` of the file and its base64-encoded ``content``), plus any of the ``find_pg`` parameters
+            ``masses_file``, ``ppm_tolerance``, ``consolidation_ppm``, ``time_delta``, ``mod_list``, ``output_dir``,
+            ``float_format``, ``max_multimer``, ``max_modifications``, ``engine``, ``search_space``, the feature
+            filters ``min_intensity``, ``top_n``, ``rt_range``, ``mass_range`` and ``charges``,
+            ``report_filtered`` and ``recalibrated_ppm``.
+
+        Returns
+        -------
+        Job
+            The queued job.
+
+        Raises
+        ------
+        UserError
+            If a parameter is unknown or of the wrong type, or names a path outside the service's ``data_dirs``.
+        """
+        unknown = set(request) - set(DEFAULT_PARAMETERS) - {"input_file", "upload"}
+        if unknown:
+            raise UserError(f"Unknown job parameter(s): {sorted(unknown)}")
+        if ("input_file" in request) == ("upload" in request):
+            raise UserError("Jobs must supply exactly one of 'input_file' or 'upload'.")
+        parameters = {**DEFAULT_PARAMETERS, **{k: v for k, v in request.items() if k in DEFAULT_PARAMETERS}}
+        parameters = {name: _checked_parameter(name, value) for name, value in parameters.items()}
+        # Filters are cheap to check here, rather than failing the job once it has been queued
+        FeatureFilter.from_settings(
+            min_intensity=parameters["min_intensity"],
+            top_n=parameters["top_n"],
+            rt_range=parameters["rt_range"],
+            mass_range=parameters["mass_range"],
+            charges=parameters["charges"],
+        )
+        input_file = _checked_parameter("input_file", request["input_file"]) if "input_file" in request else None
+        paths = {**parameters, "input_file": input_file}
+        for name in PATH_PARAMETERS:
+            if paths[name] is not None:
+                self._check_path(name, _library_path(paths[name]) if name == "masses_file" else paths[name])
+        if parameters["masses_file"] is None:
+            parameters["masses_file"] = self.default_masses_file
+        if parameters["masses_file"] is None:
+            raise UserError("No mass library was supplied and the service has no default 'masses_file'.")
+
+        if "upload" in request:
+            source = _decode_upload(request["upload"])
+            name = source["name"]
+        else:
+            source = Path(request["input_file"])
+            name = source.name
+
+        with self._lock:
+            if self._pending >= self.workers + self.queue_size:
+                self._counts["rejected"] += 1
+                REGISTRY.inc("pgfinder_service_jobs_rejected_total")
+                raise QueueFullError("The job queue is full, please try again later.")
+            job = Job(str(next(self._ids)), name)
+            self._jobs[job.id] = job
+            self._pending += 1
+            self._counts["submitted"] += 1
+            self._evict_jobs()
+
+        self._executor.submit(self._run, job, source, parameters)
+        LOGGER.info(f"Job {job.id} queued                       : {name}")
+        return job
+
+    def _check_path(self, name: str, path: Union[str, Path]) -> None:
+        """Refuse paths outside the data directories, when the service has them."""
+        if self.data_dirs is None:
+            return
+        resolved = Path(path).resolve()
+        roots = self.data_dirs + ((MASS_LIB_DIR.resolve(),) if name == "masses_file" else ())
+        if not any(resolved == root or root in resolved.parents for root in roots):
+            raise UserError(f"The '{name}' of jobs must lie within the service's data directories.")
+
+    def job(self, job_id: str) -> Optional[Job]:
+        """Look up a job by its identifier."""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def health(self) -> Dict:
+        """Report whether the service is accepting jobs."""
+        with self._lock:
+            accepting = self._pending < self.workers + self.queue_size
+            return {
+                "status": "ok" if accepting else "busy",
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._pending - self._running,
+            }
+
+    def metrics(self) -> Dict:
+        """Counters describing the work done by the service so far."""
+        with self._lock:
+            finished = self._counts["completed"] + self._counts["failed"]
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "jobs": dict(self._counts),
+                "running": self._running,
+                "queued": self._pending - self._running,
+                "processing_seconds_total": self._processing_seconds,
+                "processing_seconds_mean": self._processing_seconds / finished if finished else None,
+                "libraries_cached": len(self._libraries),
+                "analyzers_cached": len(self._analyzers),
+            }
+
+    def prometheus_metrics(self) -> str:
+        """Metrics of the service and of every analysis run by this process, in the Prometheus text format."""
+        with self._lock:
+            REGISTRY.set("pgfinder_service_jobs_running", self._running)
+            REGISTRY.set("pgfinder_service_jobs_queued", self._pending - self._running)
+            REGISTRY.set("pgfinder_service_uptime_seconds", time.time() - self.started)
+        return REGISTRY.render()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop the workers, optionally waiting for queued jobs to finish."""
+        self._executor.shutdown(wait=wait)
+
+    def _run(self, job: Job, source: Union[Path, Dict], parameters: Dict) -> None:
+        """Analyse a single job on a worker thread."""
+        with self._lock:
+            self._running += 1
+        job.status = "running"
+        job.started = time.time()
+        try:
+            analyzer = self._analyzer(parameters)
+            if isinstance(source, dict):
+                ms_data = ms_upload_reader(source)
+            else:
+                # Dropped features are only read when they're reported
+                ms_data = ms_file_reader(source, None if analyzer.report_filtered else analyzer.feature_filter)
+            results = analyzer.analyze(ms_data)
+            float_format = f"%.{parameters['float_format']}f"
+            if parameters["output_dir"] is not None:
+                filename = Path(job.name).stem + "_" + default_filename()
+                job.result_file = dataframe_to_csv_metadata(
+                    results, save_filepath=parameters["output_dir"], filename=filename, float_format=float_format
+                )
+            else:
+                job.result = dataframe_to_csv_metadata(results, float_format=float_format)
+            job.status = "completed"
+        except Exception as e:
+            # Jobs report their own failure, the service itself carries on regardless
+            job.status = "failed"
+            job.error = str(e) if isinstance(e, UserError) else f"{type(e).__name__}: {e}"
+            if not isinstance(e, UserError):
+                LOGGER.exception(f"Job {job.id} failed")
+        finally:
+            job.finished = time.time()
+            with self._lock:
+                self._running -= 1
+                self._pending -= 1
+                self._counts[job.status] += 1
+                self._processing_seconds += job.finished - job.started
+            REGISTRY.inc(
+                "pgfinder_files_processed_total" if job.status == "completed" else "pgfinder_files_failed_total"
+            )
+            job.done.set()
+            LOGGER.info(f"Job {job.id} {job.status:<24} : {job.name}")
+
+    def _library(self, masses_file: Union[str, Path]) -> Tuple[Tuple[str, float], pd.DataFrame]:
+        """Load a mass library, re-using it if it has already been loaded and hasn't changed since."""
+        path = _library_path(masses_file)
+        try:
+            key = (str(path.resolve()), path.stat().st_mtime)
+        except FileNotFoundError as e:
+            raise UserError(f"The mass library '{masses_file}' could not be found.") from e
+        with self._lock:
+            library = self._libraries.get(key)
+        if library is None:
+            library = theo_masses_reader(path)
+            with self._lock:
+                self._libraries = {k: v for k, v in self._libraries.items() if k[0] != key[0]}
+                self._libraries[key] = library
+        return key, library
+
+    def _analyzer(self, parameters: Dict) -> Analyzer:
+        """Fetch the warm analyzer for a set of parameters, creating it if needed."""
+        library_key, library = self._library(parameters["masses_file"])
+        feature_filter = FeatureFilter.from_settings(
+            min_intensity=parameters["min_intensity"],
+            top_n=parameters["top_n"],
+            rt_range=parameters["rt_range"],
+            mass_range=parameters["mass_range"],
+            charges=parameters["charges"],
+        )
+        key = (
+            library_key,
+            parameters["time_delta"],
+            tuple(parameters["mod_list"] or []),
+            parameters["ppm_tolerance"],
+            parameters["consolidation_ppm"],
+            parameters["max_multimer"],
+            parameters["max_modifications"],
+            parameters["engine"],
+            parameters["search_space"],
+            feature_filter,
+            bool(parameters["report_filtered"]),
+            parameters["recalibrated_ppm"],
+        )
+        with self._lock:
+            analyzer = self._analyzers.get(key)
+            if analyzer is not None:
+                self._analyzers.move_to_end(key)
+                return analyzer
+        analyzer = Analyzer(
+            library,
+            parameters["time_delta"],
+            parameters["mod_list"],
+            parameters["ppm_tolerance"],
+            parameters["consolidation_ppm"],
+            parameters["max_multimer"],
+            parameters["max_modifications"],
+            parameters["engine"],
+            expanded_search_space=parameters["search_space"],
+            feature_filter=feature_filter,
+            report_filtered=parameters["report_filtered"],
+            recalibrated_ppm=parameters["recalibrated_ppm"],
+        )
+        with self._lock:
+            self._analyzers[key] = analyzer
+            while len(self._analyzers) > self.max_analyzers:
+                self._analyzers.popitem(last=False)
+        return analyzer
+
+    def _evict_jobs(self) -> None:
+        """Forget the oldest finished jobs once more than ``max_jobs`` are retained (caller holds the lock)."""
+        excess = len(self._jobs) - self.max_jobs
+        for job_id in [j.id for j in self._jobs.values() if j.done.is_set()][: max(excess, 0)]:
+            del self._jobs[job_id]
+
+
+def _library_path(masses_file: Union[str, Path]) -> Path:
+    """The path of a mass library, falling back to the built-in libraries, referred to by their file name."""
+    path = Path(masses_file)
+    if not path.exists() and (MASS_LIB_DIR / path.name).exists():
+        path = MASS_LIB_DIR / path.name
+    return path
+
+
+def _checked_parameter(name: str, value):
+    """Check that a job parameter is of the type it must be, returning whole numbers as integers."""
+    kind = PARAMETER_TYPES[name]
+    # Parameters without a default (and so optional) may be null
+    if value is None and name in DEFAULT_PARAMETERS and DEFAULT_PARAMETERS[name] is None:
+        return None
+    is_list = kind in ("strings", "numbers", "wholes")
+    values = value if is_list and isinstance(value, list) else [value]
+    if is_list and not isinstance(value, list):
+        valid = False
+    elif kind in ("path", "string", "strings"):
+        valid = all(isinstance(v, str) for v in values)
+    elif kind == "bool":
+        valid = isinstance(value, bool)
+    else:
+        valid = all(_is_number(v) and (kind in ("number", "numbers") or int(v) == v) for v in values)
+    if not valid:
+        raise UserError(f"Job parameter '{name}' must be {TYPE_DESCRIPTIONS[kind]}, not {json.dumps(value)}.")
+    if kind == "whole":
+        return int(value)
+    if kind == "wholes":
+        return [int(v) for v in value]
+    return value
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def _decode_upload(upload: Dict) -> Dict:
+    """Convert an uploaded file with base64-encoded content into the format used by the GUI readers."""
+    try:
+        return {"name": Path(upload["name"]).name, "content": base64.b64decode(upload["content"], validate=True)}
+    except (KeyError, TypeError, binascii.Error) as e:
+        raise UserError("Uploads must have a 'name' and base64-encoded 'content'.") from e
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """Map HTTP requests onto an ``AnalysisService``.
+
+    ``GET /health`` and ``GET /metrics`` report on the service, ``POST /jobs`` submits a job (add ``"wait": true`` to
+    the JSON body to block until it has finished), ``GET /jobs/<id>`` reports the status of a job and
+    ``GET /jobs/<id>/result`` returns its CSV results. ``GET /metrics`` answers in the Prometheus text format rather
+    than JSON when the request accepts ``text/plain`` or OpenMetrics, as Prometheus scrapes do.
+    """
+
+    service: AnalysisService = None
+    server_version = "pgfinder"
+
+    def do_GET(self) -> None:
+        """Handle GET requests."""
+        parts = self.path.strip("/").split("/")
+        if parts == ["health"]:
+            health = self.service.health()
+            self._send_json(200 if health["status"] == "ok" else 503, health)
+        elif parts == ["metrics"] and PROMETHEUS_ACCEPT.search(self.headers.get("Accept", "")):
+            self._send(200, PROMETHEUS_CONTENT_TYPE, self.service.prometheus_metrics().encode("utf-8"))
+        elif parts == ["metrics"]:
+            self._send_json(200, self.service.metrics())
+        elif len(parts) in (2, 3) and parts[0] == "jobs" and parts[2:] in ([], ["result"]):
+            job = self.service.job(parts[1])
+            if job is None:
+                self._send_json(404, {"error": f"No job with id '{parts[1]}'."})
+            elif len(parts) == 2:
+                self._send_json(200, job.to_dict())
+            else:
+                self._send_result(job)
+        else:
+            self._send_json(404, {"error": f"Unknown endpoint '{self.path}'."})
+
+    def do_POST(self) -> None:
+        """Handle POST requests."""
+        if self.path.strip("/") != "jobs":
+            self._send_json(404, {"error": f"Unknown endpoint '{self.path}'."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            if not isinstance(request, dict):
+                raise UserError("Jobs must be submitted as a JSON object.")
+            wait = request.pop("wait", False)
+            job = self.service.submit(request)
+        except (UserError, json.JSONDecodeError, ValueError) as e:
+            self._send_json(400, {"error": str(e)})
+            return
+        except QueueFullError as e:
+            self._send_json(503, {"error": str(e)})
+            return
+        if wait:
+            job.done.wait()
+            self._send_result(job)
+        else:
+            self._send_json(202, job.to_dict())
+
+    def log_message(self, format: str, *args) -> None:
+        """Route request logs through the pgfinder logger."""
+        LOGGER.debug(f"{self.address_string()} {format % args}")
+
+    def _send_result(self, job: Job) -> None:
+        if job.status == "completed" and job.result is not None:
+            self._send(200, "text/csv; charset=utf-8", job.result.encode("utf-8"))
+        elif job.status == "completed":
+            self._send_json(200, job.to_dict())
+        elif job.status == "failed":
+            self._send_json(422, job.to_dict())
+        else:
+            self._send_json(409, job.to_dict())
+
+    def _send_json(self, status: int, body: Dict) -> None:
+        self._send(status, "application/json", json.dumps(body).encode("utf-8"))
+
+    def _send(self, status: int, content_type: str, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def create_server(service: AnalysisService, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    """Create an HTTP server for a service; use port 0 to pick a free port.
+
+    Served beyond the local machine, a service without ``data_dirs`` refuses jobs naming paths (other than built-in
+    mass libraries), so that remote clients can't read or write arbitrary files.
+
+    Parameters
+    ----------
+    service : AnalysisService
+        Service handling the requests.
+    host : str
+        Address to listen on, only the local machine by default.
+    port : int
+        Port to listen on.
+
+    Returns
+    -------
+    ThreadingHTTPServer
+        Server, call ``serve_forever()`` to start handling requests.
+    """
+    if service.data_dirs is None and not _is_loopback(host):
+        LOGGER.warning(
+            f"Serving beyond the local machine on {host}, jobs may only upload files or use built-in libraries"
+        )
+        service.data_dirs = ()
+    handler = type("BoundServiceRequestHandler", (ServiceRequestHandler,), {"service": service})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def _is_loopback(host: str) -> bool:
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 8000,
+    workers: int = 2,
+    queue_size: int = 16,
+    masses_file: Union[str, Path] = None,
+    data_dirs: Iterable[Union[str, Path]] = None,
+) -> None:
+    """Run the analysis service until interrupted.
+
+    Parameters
+    ----------
+    host : str
+        Address to listen on.
+    port : int
+        Port to listen on.
+    workers : int
+        Number of jobs that are analysed concurrently.
+    queue_size : int
+        Number of jobs that can wait for a free worker.
+    masses_file : Union[str, Path]
+        Default mass library, loaded at start-up.
+    data_dirs : Iterable[Union[str, Path]]
+        Directories that the paths named by jobs must lie within.
+    """
+    service = AnalysisService(workers=workers, queue_size=queue_size, masses_file=masses_file, data_dirs=data_dirs)
+    server = create_server(service, host, port)
+    LOGGER.info(f"Serving on                         : http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        LOGGER.info("Shutting down...")
+    finally:
+        server.server_close()
+        service.shutdown(wait=False)
@@ -0,0 +1,119 @@
+"""Parsing and classification of structure names"""
+import re
+from functools import lru_cache
+from typing import Iterable, NamedTuple, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from pgfinder import MASS_TO_CLEAN
+from pgfinder.kernels import read_only
+
+# Modification tags are added to names with a space before them, e.g. `gm-AEJ (Anh) (Am) |1`, unlike the brackets
+# within residue names such as `g(-Ac)m`
+MODIFICATION_TAG = re.compile(r" \(([^()]*)\)")
+MULTIMER_SUFFIX = re.compile(r"\|(\d+)$")
+# Hyphens that aren't inside brackets separate the residues of a chain
+CHAIN_SEPARATOR = re.compile(r"-(?![^(]*\))")
+STEM = re.compile(r"[A-Z]+")
+
+
+class Structure(NamedTuple):
+    """A structure name broken down into its parts.
+
+    The glycan and stem are those of the first monomer of multimers.
+    """
+
+    name: str
+    core: str
+    glycan: str
+    stem: str
+    modifications: Tuple[str, ...]
+    multimer: Optional[int]
+    adduct: Optional[str]
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_structure(name: str) -> Structure:
+    """Break a structure name down into its parts.
+
+    Parameters
+    ----------
+    name : str
+        Structure name, e.g. ``gm-AEJ=gm-AEJ (Na+) |2``.
+
+    Returns
+    -------
+    Structure
+        The name without its ``|n`` multimer suffix (``core``), the glycan and stem peptide of its first monomer, its
+        modification tags, multimer number and adduct (the first modification tag that is a cation, if any).
+    """
+    suffix = MULTIMER_SUFFIX.search(name)
+    core = name[: suffix.start()] if suffix else name
+    modifications = tuple(MODIFICATION_TAG.findall(core))
+    first_monomer = MODIFICATION_TAG.sub("", core).strip().split("=")[0]
+
+    glycan, stem = [], ""
+    for part in CHAIN_SEPARATOR.split(first_monomer):
+        if STEM.fullmatch(part):
+            stem = part
+            break
+        glycan.append(part)
+
+    return Structure(
+        name=name,
+        core=core,
+        glycan="-".join(glycan),
+        stem=stem,
+        modifications=modifications,
+        multimer=int(suffix.group(1)) if suffix else None,
+        adduct=next((m for m in modifications if m.endswith("+")), None),
+    )
+
+
+@lru_cache(maxsize=1 << 16)
+def _clean_up_flags(name: str) -> Tuple[Tuple[bool, bool], ...]:
+    """Whether a structure is a parent and/or a target of each of the clean-ups in ``MASS_TO_CLEAN``."""
+    return tuple(
+        (re.search(rule["parent"], name) is not None, re.search(rule["target"], name) is not None)
+        for rule in MASS_TO_CLEAN.values()
+    )
+
+
+class StructureTable:
+    """Parsed structures with their classification flags precomputed as boolean arrays.
+
+    Each name is parsed and classified once (and cached across tables), so stages working on many rows that share a
+    few structures can select rows with boolean masks rather than scanning the strings again.
+
+    Parameters
+    ----------
+    names : Iterable[str]
+        Unique structure names, such as the categories of a categorical ``Inferred structure`` column.
+    """
+
+    def __init__(self, names: Iterable[str]):
+        self.names = pd.Index(list(names), dtype=object)
+        self.structures = [parse_structure(name) for name in self.names]
+        self.multimer = read_only(np.array([s.multimer or 0 for s in self.structures], dtype=np.int16))
+        self.has_stem = read_only(np.array([bool(s.stem) for s in self.structures], dtype=bool))
+        self.has_adduct = read_only(np.array([s.adduct is not None for s in self.structures], dtype=bool))
+
+        flags = np.array([_clean_up_flags(name) for name in self.names], dtype=bool).reshape(
+            len(self.names), len(MASS_TO_CLEAN), 2
+        )
+        self.parents = {key: read_only(flags[:, i, 0].copy()) for i, key in enumerate(MASS_TO_CLEAN)}
+        self.targets = {key: read_only(flags[:, i, 1].copy()) for i, key in enumerate(MASS_TO_CLEAN)}
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def codes(self, structures: pd.Series) -> np.ndarray:
+        """Positions of the names in a column of structures, or -1 where they're missing or unknown."""
+        if isinstance(structures.dtype, pd.CategoricalDtype) and structures.cat.categories.equals(self.names):
+            return structures.cat.codes.to_numpy()
+        return self.names.get_indexer(structures.where(structures.notna(), None))
+
+    def mask(self, structures: pd.Series, flags: np.ndarray) -> np.ndarray:
+        """Look up per-structure flags for every row of a column of structures (False where there is no structure)."""
+        return np.append(flags, False)[self.codes(structures)]
@@ -0,0 +1,223 @@
+"""Checking that the fast engines give the results of the reference engine.
+
+The ``numpy`` and ``jit`` engines replace the row-by-row loops of ``matching()`` and ``clean_up()`` with vectorised
+and compiled kernels that are meant to give exactly the same results. ``verify_engine()`` analyses a sample with both
+an engine and the original loops kept in ``pgfinder.reference`` (``engine="reference"``) and lists every way the
+results differ: missing or extra columns, a different number of rows, and any cell that differs — beyond a relative
+and absolute tolerance for numbers, so that the order floating point sums are worked out in doesn't count as a
+difference.
+
+Samples can be real ones or ones made up by ``synthetic_features()`` from a mass library: monomers observed with
+random ppm errors (some just outside the tolerance), multimers, their sodium and potassium adducts and in-source decay
+products eluting close by, and noise. ``find_pg --verify_engine`` does either from the command line.
+"""
+import logging
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_numeric_dtype
+
+from pgfinder import MULTIMERS
+from pgfinder.analyzer import POTASSIUM, SODIUM, SUGAR, Analyzer
+from pgfinder.errors import UserError
+from pgfinder.logs.logs import LOGGER_NAME
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+# Numbers closer than atol + rtol * |reference| are taken to be the same
+RTOL = 1e-9
+ATOL = 1e-9
+# Most differences listed, as a handful is enough to track down where engines diverge
+MAX_DIFFERENCES = 20
+
+WATER = 18.0106
+
+
+class Verification(NamedTuple):
+    """How the results of an engine compare with those of the reference engine.
+
+    Parameters
+    ----------
+    engine : str
+        Engine that was verified.
+    reference : str
+        Engine it was compared with.
+    rows : int
+        Number of rows in the reference results.
+    differences : Tuple[str, ...]
+        Description of each difference found, at most ``MAX_DIFFERENCES`` of them.
+    """
+
+    engine: str
+    reference: str
+    rows: int
+    differences: Tuple[str, ...]
+
+    @property
+    def equivalent(self) -> bool:
+        """Whether the results were the same."""
+        return not self.differences
+
+
+def compare_results(
+    expected: pd.DataFrame,
+    actual: pd.DataFrame,
+    rtol: float = RTOL,
+    atol: float = ATOL,
+    max_differences: int = MAX_DIFFERENCES,
+) -> List[str]:
+    """List the differences between two sets of results.
+
+    Parameters
+    ----------
+    expected : pd.DataFrame
+        Reference results.
+    actual : pd.DataFrame
+        Results to check against them, row by row.
+    rtol : float
+        Relative tolerance for numbers.
+    atol : float
+        Absolute tolerance for numbers.
+    max_differences : int
+        Stop after finding this many differing cells.
+
+    Returns
+    -------
+    List[str]
+        Description of each difference, empty when the results are the same.
+    """
+    differences = []
+    missing = [c for c in expected.columns if c not in actual.columns]
+    extra = [c for c in actual.columns if c not in expected.columns]
+    if missing:
+        differences.append(f"Columns missing: {missing}")
+    if extra:
+        differences.append(f"Unexpected columns: {extra}")
+    if len(expected) != len(actual):
+        differences.append(f"{len(actual)} rows rather than {len(expected)}")
+        return differences
+    for key in sorted(set(expected.attrs) | set(actual.attrs)):
+        if expected.attrs.get(key) != actual.attrs.get(key):
+            differences.append(f"Metadata '{key}' is {actual.attrs.get(key)!r} rather than {expected.attrs.get(key)!r}")
+
+    for column in (c for c in expected.columns if c in actual.columns):
+        e, a = expected[column], actual[column]
+        if is_numeric_dtype(e) and is_numeric_dtype(a):
+            same = np.isclose(a.to_numpy(dtype=float), e.to_numpy(dtype=float), rtol=rtol, atol=atol, equal_nan=True)
+        else:
+            e, a = e.astype(object), a.astype(object)
+            same = ((e.to_numpy() == a.to_numpy()) | (e.isna().to_numpy() & a.isna().to_numpy())).astype(bool)
+        for row in np.flatnonzero(~same):
+            if len(differences) >= max_differences:
+                return differences
+            differences.append(
+                f"Row {row} (ID {expected['ID'].iloc[row]}): '{column}' is {a.iloc[row]!r} rather than {e.iloc[row]!r}"
+            )
+    return differences
+
+
+def verify_engine(
+    analyzer: Analyzer,
+    raw_data_df: pd.DataFrame,
+    reference: str = "reference",
+    rtol: float = RTOL,
+    atol: float = ATOL,
+) -> Verification:
+    """Analyse a sample with an analyzer and with a copy of it running the reference engine, and compare the results.
+
+    Parameters
+    ----------
+    analyzer : Analyzer
+        Analyzer whose engine is to be verified.
+    raw_data_df : pd.DataFrame
+        User data as Pandas DataFrame, real or made by ``synthetic_features()``.
+    reference : str
+        Engine to compare with.
+    rtol : float
+        Relative tolerance for numbers.
+    atol : float
+        Absolute tolerance for numbers.
+
+    Returns
+    -------
+    Verification
+        The differences found, if any.
+    """
+    if analyzer.engine == reference:
+        raise UserError(f"The {reference} engine can't be verified against itself, please pick another engine.")
+    LOGGER.info(f"Analysing {len(raw_data_df)} features with the {reference} engine")
+    expected = analyzer.with_engine(reference).analyze(raw_data_df.copy())
+    LOGGER.info(f"Analysing {len(raw_data_df)} features with the {analyzer.engine} engine")
+    actual = analyzer.analyze(raw_data_df.copy())
+    differences = compare_results(expected, actual, rtol, atol)
+    for difference in differences:
+        LOGGER.warning(f"{analyzer.engine} engine : {difference}")
+    return Verification(analyzer.engine, reference, len(expected), tuple(differences))
+
+
+def synthetic_features(
+    theo_masses_df: pd.DataFrame,
+    n_features: int = 1000,
+    seed: int = 0,
+    ppm_tolerance: float = 10,
+    rt_window: float = 0.5,
+) -> pd.DataFrame:
+    """Make up a feature table from a mass library, for comparing engines on.
+
+    Parameters
+    ----------
+    theo_masses_df : pd.DataFrame
+        Theoretical masses as Pandas DataFrame.
+    n_features : int
+        Number of features, about half of them monomers and a tenth multimers; the rest are adducts, decay products and
+        noise.
+    seed : int
+        Seed of the random number generator, the same seed always giving the same features.
+    ppm_tolerance : float
+        Monomers and multimers are observed with ppm errors of up to 1.2 times this.
+    rt_window : float
+        Adducts and decay products elute within 1.5 times this of their parents.
+
+    Returns
+    -------
+    pd.DataFrame
+        Features in the format of ``ms_file_reader()``.
+    """
+    if n_features < 10:
+        raise UserError("At least 10 synthetic features are needed.")
+    rng = np.random.default_rng(seed)
+    library = theo_masses_df["Theo (Da)"].to_numpy(dtype=float)
+    n_monomers, n_dimers = n_features // 2, n_features // 10
+    n_related = (n_features - n_monomers - n_dimers) * 2 // 3
+    n_noise = n_features - n_monomers - n_dimers - n_related
+
+    monomers = rng.choice(library, n_monomers)
+    # Monomers joined to the donors that multimers are built from
+    donors = np.array([float(d["mass"]) for multimer in MULTIMERS.values() for d in multimer.values()])
+    dimers = rng.choice(library, n_dimers) + rng.choice(donors, n_dimers) - WATER
+    theoretical = np.concatenate([monomers, dimers])
+    parents_rt = rng.uniform(1, 60, len(theoretical))
+    parents = theoretical * (1 + rng.uniform(-1.2, 1.2, len(theoretical)) * ppm_tolerance / 1000000)
+
+    # Each adduct or decay product of a parent, with the mass of the same structure and so the same ppm error
+    related = rng.integers(0, len(theoretical), n_related)
+    shifts = rng.choice(np.array([float(SODIUM), float(POTASSIUM), -float(SUGAR)]), n_related)
+    related_masses = parents[related] + shifts * parents[related] / theoretical[related]
+    related_rt = parents_rt[related] + rng.uniform(-1.5, 1.5, n_related) * rt_window
+
+    features_df = pd.DataFrame(
+        {
+            "RT (min)": np.concatenate([parents_rt, related_rt, rng.uniform(1, 60, n_noise)]).round(3),
+            "Charge": rng.integers(1, 4, n_features),
+            "Obs (Da)": np.concatenate([parents, related_masses, rng.uniform(200, 3000, n_noise)]).round(4),
+            "Intensity": rng.lognormal(13, 2, n_features).round(0),
+        }
+    )
+    # Shuffled, so that related features aren't next to each other
+    features_df = features_df.iloc[rng.permutation(n_features)].reset_index(drop=True)
+    features_df.insert(0, "ID", np.arange(1, n_features + 1))
+    features_df.insert(4, "Theo (Da)", np.nan)
+    features_df.insert(5, "Inferred structure", np.nan)
+    features_df.attrs["file"] = f"synthetic_{seed}.txt"
+    return features_df
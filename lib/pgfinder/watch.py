@@ -0,0 +1,227 @@
+"""Analysing a Byos (``.ftrs``) file while features are still being added to it.
+
+A ``LiveAnalysis`` polls the ``Features`` table of a file read-only and only reads the rows added since its last poll
+(those with a higher ``rowid``). New features are matched against the search space of every feature read so far, which
+for an analyzer with an expanded search space is just picked out of the warm index. The clean-up and consolidation are
+then re-run only for the retention time ranges around the new features, and for those around any earlier features
+that could match candidates added to the search space by the new ones: the ranges are those of
+``chunked.clean_up_components()``, which the clean-up never combines features across, so the results of every other
+range are kept as they were. After each poll the results are exactly those of analysing every feature read so far at
+once.
+
+``watch_file()`` keeps polling a file, writing the latest results after every poll that found new features, until no
+features have been added for a while. Feature filters are applied to each new feature on its own, so ``top_n`` (which
+needs the whole sample) can't be used.
+"""
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+from pgfinder.analyzer import POTASSIUM, SODIUM, SUGAR, Analyzer
+from pgfinder.chunked import MASS_SLACK, clean_up_components, result_groups
+from pgfinder.errors import UserError
+from pgfinder.logs.logs import LOGGER_NAME
+from pgfinder.pgio import compact_feature_dtypes, dataframe_to_csv_metadata, default_filename, ftrs_new_features
+from pgfinder.prefilter import with_unmatched
+
+LOGGER = logging.getLogger(LOGGER_NAME)
+
+
+class LiveAnalysis:
+    """The analysis of a Byos file that is still being written, brought up to date by each call to ``update()``.
+
+    Parameters
+    ----------
+    analyzer : Analyzer
+        Analyzer to analyse the features with.
+    file : Union[str, Path]
+        Byos (``.ftrs``) file to poll.
+    """
+
+    def __init__(self, analyzer: Analyzer, file: Union[str, Path]):
+        if Path(file).suffix != ".ftrs":
+            raise UserError("Only Byos (.ftrs) files can be analysed while they are being written.")
+        if analyzer.feature_filter is not None and analyzer.feature_filter.top_n is not None:
+            raise UserError("The most intense features can't be picked out of a file that is still being written.")
+        if analyzer.recalibrated_ppm is not None:
+            raise UserError("Observed masses can't be recalibrated while features are still being added to a file.")
+        self.analyzer = analyzer
+        self.file = Path(file)
+        self._rowid = 0
+        self._features = None
+        # Features from this position on haven't been analysed yet
+        self._analysed = 0
+        self._dropped = None
+        self._candidates = set()
+        self._results = None
+
+    @property
+    def features_read(self) -> int:
+        """Number of features read so far, including any dropped by the analyzer's feature filter."""
+        kept = 0 if self._features is None else len(self._features)
+        return kept + (0 if self._dropped is None else len(self._dropped))
+
+    @property
+    def results(self) -> Optional[pd.DataFrame]:
+        """Results of every feature read so far, or None until any have been matched."""
+        if self._results is None or not self.analyzer.report_filtered or self._dropped is None:
+            return self._results
+        return with_unmatched(self._results, compact_feature_dtypes(self._dropped))
+
+    def update(self) -> int:
+        """Read the features added to the file since the last update and bring the results up to date.
+
+        Returns
+        -------
+        int
+            Number of features added, 0 if there were none or the file couldn't be read yet.
+        """
+        try:
+            new_df, self._rowid = ftrs_new_features(self.file, self._rowid)
+        except (sqlite3.OperationalError, pd.errors.DatabaseError) as e:
+            # The file may not have been created yet, or may be locked while Byos writes to it
+            LOGGER.debug(f"'{self.file.name}' couldn't be read yet: {e}")
+            return 0
+        if new_df.empty:
+            return 0
+        n_new = len(new_df)
+        feature_filter = self.analyzer.feature_filter
+        if feature_filter is not None:
+            keep = feature_filter.mask(new_df)
+            self._dropped = _appended(self._dropped, new_df[~keep])
+            new_df = new_df[keep]
+        self._features = _appended(self._features, new_df)
+        if len(self._features) > self._analysed:
+            self._analyze()
+        return n_new
+
+    def _analyze(self) -> None:
+        """Re-analyse the ranges of retention time holding features that haven't been analysed yet."""
+        features_df = self._features
+        observed = features_df["Obs (Da)"].to_numpy(dtype=float)
+        try:
+            search_space = self.analyzer.search_space(np.sort(observed))
+        except UserError:
+            # Too few features have been read to match any structure yet
+            LOGGER.info(f"No structures match the {len(features_df)} features read so far")
+            return
+        candidates = set(zip(search_space["Inferred structure"].tolist(), search_space["Theo (Da)"].tolist()))
+
+        changed = np.zeros(len(features_df), dtype=bool)
+        changed[self._analysed :] = True
+        # Earlier features that could match candidates that have been added or removed need re-analysing too
+        differing = np.sort(np.array([mass for _, mass in candidates ^ self._candidates], dtype=float))
+        tolerance = differing * self.analyzer.ppm_tolerance / 1000000 + MASS_SLACK
+        lower, upper = differing - tolerance, np.sort(differing + tolerance)
+        changed |= np.searchsorted(lower, observed, side="right") > np.searchsorted(upper, observed, side="left")
+        self._candidates = candidates
+
+        components = clean_up_components(
+            features_df["RT (min)"].to_numpy(dtype=float),
+            observed,
+            self.analyzer.rt_window,
+            self.analyzer.ppm_tolerance,
+            [SODIUM, POTASSIUM, SUGAR],
+        )
+        redo = np.isin(components, np.unique(components[changed]))
+        redo_df = compact_feature_dtypes(features_df[redo].reset_index(drop=True))
+        redo_df.attrs["file"] = self.file.name
+        results_df = self.analyzer.analyze(redo_df, search_space=search_space)
+        if self._results is not None:
+            kept_ids = features_df.loc[~redo, "ID"]
+            results_df = _ordered(
+                pd.concat([self._results[self._results["ID"].isin(kept_ids)], results_df], ignore_index=True),
+                results_df.attrs,
+            )
+        self._results = results_df
+        self._analysed = len(features_df)
+        LOGGER.info(f"Re-analysed {redo.sum()} of the {len(features_df)} features read from '{self.file.name}'")
+
+
+def watch_file(
+    analyzer: Analyzer,
+    file: Union[str, Path],
+    save_filepath: Union[str, Path],
+    filename: str = None,
+    poll_interval: float = 5.0,
+    idle_timeout: float = None,
+    float_format: str = "%.4f",
+) -> Optional[str]:
+    """Analyse a Byos file while it's being written, writing the results so far after each poll that found features.
+
+    Parameters
+    ----------
+    analyzer : Analyzer
+        Analyzer to analyse the features with.
+    file : Union[str, Path]
+        Byos (``.ftrs``) file to poll, which needn't exist yet.
+    save_filepath : Union[str, Path]
+        Directory to write the results to.
+    filename : str
+        Name of the results file, by default the name of ``file`` followed by a timestamp.
+    poll_interval : float
+        Seconds between polls.
+    idle_timeout : float
+        Stop once no features have been added for this many seconds; by default keep polling until interrupted.
+    float_format : str
+        Format for floating point numbers.
+
+    Returns
+    -------
+    Optional[str]
+        The results file, or None if no structures were ever matched.
+    """
+    if poll_interval <= 0:
+        raise UserError(f"The interval between polls must be positive, but {poll_interval} s was given.")
+    live = LiveAnalysis(analyzer, file)
+    filename = filename or Path(file).stem + "_" + default_filename()
+    output = None
+    LOGGER.info(f"Watching '{Path(file).name}' for new features every {poll_interval} s")
+    last_change = time.monotonic()
+    try:
+        while True:
+            if live.update():
+                last_change = time.monotonic()
+                if live.results is not None:
+                    output = _replace_results(live.results, save_filepath, filename, float_format)
+                    LOGGER.info(f"Results of {live.features_read} features saved to : {output}")
+            elif idle_timeout is not None and time.monotonic() - last_change >= idle_timeout:
+                LOGGER.info(f"No features added to '{Path(file).name}' for {idle_timeout} s, stopping")
+                break
+            time.sleep(poll_interval)
+    except KeyboardInterrupt:
+        LOGGER.info(f"Stopped watching '{Path(file).name}'")
+    return output
+
+
+def _appended(df: Optional[pd.DataFrame], new_df: pd.DataFrame) -> pd.DataFrame:
+    return new_df.reset_index(drop=True) if df is None else pd.concat([df, new_df], ignore_index=True)
+
+
+def _ordered(results_df: pd.DataFrame, attrs: dict) -> pd.DataFrame:
+    """Put groups of results in the order of an analysis of all of them at once.
+
+    Ranges of retention time never share one, so ties between groups only come from the same range, and their order
+    within it is kept by sorting stably.
+    """
+    groups = result_groups(results_df)
+    order = np.lexsort((np.arange(len(groups["sizes"])), groups["rt"], -groups["intensity"], groups["unmatched"]))
+    starts = np.cumsum(groups["sizes"]) - groups["sizes"]
+    sizes = groups["sizes"][order]
+    rows = np.repeat(starts[order], sizes) + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    ordered_df = results_df.iloc[rows].reset_index(drop=True)
+    ordered_df.attrs = dict(attrs)
+    return ordered_df
+
+
+def _replace_results(results_df: pd.DataFrame, save_filepath: Union[str, Path], filename: str, float_format: str):
+    """Write results in place of the last ones, in one go so that readers never see half a file."""
+    partial = dataframe_to_csv_metadata(results_df, save_filepath, f".{filename}.partial", float_format=float_format)
+    os.replace(partial, Path(save_filepath) / filename)
+    return str(Path(save_filepath) / filename)
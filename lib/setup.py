@@ -0,0 +1,20 @@
+"""Build hooks; the package itself is configured in pyproject.toml."""
+import sys
+from pathlib import Path
+
+from setuptools import setup
+from setuptools.command.build_py import build_py
+
+
+class BuildPy(build_py):
+    """Also compile the built-in mass libraries, see ``pgfinder.compiled_library.compile_builtin_libraries()``."""
+
+    def run(self):
+        super().run()
+        sys.path.insert(0, str(Path(__file__).parent))
+        from pgfinder.compiled_library import compile_builtin_libraries
+
+        compile_builtin_libraries(output_dir=Path(self.build_lib) / "pgfinder" / "masses")
+
+
+setup(cmdclass={"build_py": BuildPy})
@@ -49,6 +49,46 @@ def theo_masses(theo_masses_filename):
     return my_theo_masses
 
 
+@pytest.fixture
+def synthetic_raw_data(theo_masses) -> pd.DataFrame:
+    """A small feature table built from the theoretical masses, including sodium adducts and decay products."""
+    structures = theo_masses.iloc[::7]
+    structures = pd.concat([structures, theo_masses[theo_masses["Inferred structure"] == "gm-AEJ|1"]])
+    structures = structures.drop_duplicates().reset_index(drop=True)
+    n = len(structures)
+    parents = pd.DataFrame(
+        {
+            "RT (min)": np.linspace(2.0, 30.0, n).round(3),
+            "Charge": 1,
+            "Obs (Da)": (structures["Theo (Da)"] * (1 + 2e-6)).round(4),
+            "Intensity": np.linspace(1e6, 1e7, n).round(0),
+        }
+    )
+    sodiated = parents.iloc[::3].assign(**{"Obs (Da)": lambda df: df["Obs (Da)"] + 21.9819, "Intensity": 1e5})
+    decayed = parents.iloc[1::4].assign(**{"Obs (Da)": lambda df: df["Obs (Da)"] - 203.0793, "Intensity": 1e5})
+    # A gm-AEJ=gm-AEJ|2 dimer and some unmatchable noise
+    others = pd.DataFrame(
+        {"RT (min)": [20.0, 5.0, 15.0], "Charge": 2, "Obs (Da)": [1722.7331, 123.4567, 4321.0987], "Intensity": 1e3}
+    )
+
+    raw_data = pd.concat([parents, sodiated, decayed, others], ignore_index=True)
+    raw_data.insert(0, "ID", raw_data.index)
+    raw_data.insert(4, "Theo (Da)", np.nan)
+    raw_data.insert(5, "Inferred structure", np.nan)
+    raw_data.attrs["file"] = "synthetic.txt"
+    validation.validate_raw_data_df(raw_data)
+    return raw_data
+
+
+@pytest.fixture
+def synthetic_mq_file(synthetic_raw_data, tmp_path) -> Path:
+    """The synthetic feature table written out in the MaxQuant allPeptides.txt format."""
+    file = tmp_path / "synthetic_allPeptides.txt"
+    columns = {"RT (min)": "Retention time", "Obs (Da)": "Mass", "Charge": "Charge", "Intensity": "Intensity"}
+    synthetic_raw_data[list(columns)].rename(columns=columns).to_csv(file, sep="\t", index=False)
+    return file
+
+
 @pytest.fixture
 def ipywidgets_upload_output(ftrs_file_name):
     return {
@@ -0,0 +1,71 @@
+"""Test building abundance matrices from the results of several samples"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder.abundance import AbundanceMatrix, abundance_matrix
+from pgfinder.cli import main
+from pgfinder.errors import UserError
+from pgfinder.pgio import dataframe_to_csv_metadata, results_reader
+
+
+def results(file: str, rows: list) -> pd.DataFrame:
+    """Results with one consolidated (structure, RT, intensity) row per entry, plus an unmatched row."""
+    results_df = pd.DataFrame(
+        {
+            "ID": np.arange(len(rows) + 1),
+            "RT (min)": [rt for _, rt, _ in rows] + [1.0],
+            "Inferred structure": [s for s, _, _ in rows] + [None],
+            "Intensity": [i for _, _, i in rows] + [5.0],
+            "Inferred structure (consolidated)": [s for s, _, _ in rows] + [None],
+            "Intensity (consolidated)": [i for _, _, i in rows] + [None],
+        }
+    )
+    results_df.attrs.update(
+        file=file, masses_file="masses.csv", rt_window=0.5, modifications=[], ppm=10, consolidation_ppm=1
+    )
+    return results_df
+
+
+SAMPLES = [
+    results("a.ftrs", [("gm-AEJ|1", 10.0, 100.0), ("gm-AEJA|1", 12.0, 50.0), ("gm-AEJ|1", 20.0, 30.0)]),
+    results("b.ftrs", [("gm-AEJ|1", 10.2, 80.0), ("gm-AE|1", 8.0, 10.0)]),
+]
+
+
+def test_abundance_matrix_totals_structures() -> None:
+    """Test that without an RT tolerance every feature of a structure is summed into one row."""
+    matrix_df = abundance_matrix(SAMPLES)
+    assert list(matrix_df.columns) == ["Inferred structure", "a.ftrs", "b.ftrs"]
+    assert isinstance(matrix_df["a.ftrs"].dtype, pd.SparseDtype)
+    matrix_df = matrix_df.set_index("Inferred structure").sparse.to_dense()
+    assert matrix_df.loc["gm-AEJ|1"].tolist() == [130.0, 80.0]
+    assert matrix_df.loc["gm-AE|1"].tolist() == [0.0, 10.0]
+
+
+def test_abundance_matrix_aligns_by_rt() -> None:
+    """Test that features are only aligned across samples when their retention times are close enough."""
+    matrix_df = abundance_matrix(SAMPLES, rt_tolerance=0.5, sparse=False)
+    assert list(matrix_df.columns) == ["Inferred structure", "RT (min)", "a.ftrs", "b.ftrs"]
+    aej = matrix_df[matrix_df["Inferred structure"] == "gm-AEJ|1"]
+    assert aej["RT (min)"].tolist() == pytest.approx([10.1, 20.0])
+    assert aej[["a.ftrs", "b.ftrs"]].values.tolist() == [[100.0, 80.0], [30.0, 0.0]]
+
+
+def test_abundance_matrix_rejects_duplicate_samples() -> None:
+    """Test that the same sample can't be added twice."""
+    matrix = AbundanceMatrix()
+    matrix.add(SAMPLES[0])
+    with pytest.raises(UserError):
+        matrix.add(SAMPLES[0])
+
+
+def test_aggregate_results_files(tmp_path) -> None:
+    """Test that results files are read back and written out as a long abundance matrix."""
+    files = [dataframe_to_csv_metadata(df, save_filepath=tmp_path, filename=f"{i}.csv") for i, df in enumerate(SAMPLES)]
+    assert results_reader(files[0]).attrs["file"] == "a.ftrs"
+    main(["aggregate", *files, "--output", str(tmp_path / "matrix.csv"), "--layout", "long"])
+    matrix_df = pd.read_csv(tmp_path / "matrix.csv")
+    assert list(matrix_df.columns) == ["Inferred structure", "Sample", "Intensity"]
+    assert len(matrix_df) == 4
+    assert matrix_df["Intensity"].sum() == 270.0
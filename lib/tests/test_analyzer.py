@@ -0,0 +1,177 @@
+"""Test reusable analysis sessions"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import reference
+from pgfinder.analyzer import POTASSIUM, SODIUM, SUGAR, Analyzer
+from pgfinder.errors import UserError
+from pgfinder.kernels import grouped_window_matches, window_matches
+from pgfinder.matching import (
+    calculate_ppm_delta,
+    data_analysis,
+    data_analysis_many,
+    matching,
+)
+from pgfinder.pgio import compact_feature_dtypes
+from pgfinder.prefilter import FeatureFilter
+from pgfinder.verify import synthetic_features
+
+MODS = ["Cross-Linked Multimers (=)", "Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)"]
+
+
+def baseline_analysis(raw_data_df: pd.DataFrame, theo_masses_df: pd.DataFrame) -> pd.DataFrame:
+    """The analysis ``data_analysis()`` ran before it was built on Analyzer, with 0.5 min, ``MODS``, 10 and 1 ppm."""
+    obs_monomers_df = reference.filtered_theo(raw_data_df, theo_masses_df, 10)
+    theo_multimers_df = reference.multimer_builder(obs_monomers_df, MODS[0])
+    obs_theo_df = pd.concat([obs_monomers_df, reference.filtered_theo(raw_data_df, theo_multimers_df, 10)])
+    master_frame = pd.concat([obs_theo_df, *(reference.modification_generator(obs_theo_df, mod) for mod in MODS[1:])])
+    master_frame = master_frame.astype({"Theo (Da)": float})
+    matched_df = calculate_ppm_delta(df=reference.matching(raw_data_df, master_frame, 10))
+    for mass in [SODIUM, POTASSIUM, SUGAR]:
+        matched_df = reference.clean_up(ftrs_df=matched_df, mass_to_clean=mass, time_delta=0.5)
+    matched_df.sort_values(by=["Intensity", "RT (min)"], ascending=[False, True], inplace=True, kind="stable")
+    matched_df.reset_index(drop=True, inplace=True)
+    return reference.pick_most_likely_structures(matched_df, 1)
+
+
+def test_data_analysis_matches_baseline(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that data_analysis() (and so Analyzer) gives the results of the original step-by-step pipeline."""
+    results = data_analysis(synthetic_raw_data, theo_masses, 0.5, MODS, 10, 1)
+
+    pd.testing.assert_frame_equal(results, baseline_analysis(synthetic_raw_data, theo_masses))
+    assert results.attrs["modifications"] == MODS
+    assert (results.attrs["ppm"], results.attrs["rt_window"]) == (10, 0.5)
+
+
+def test_match_is_compact(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that matching stores structures as categorical codes, without changing the matches."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    expected = matching(synthetic_raw_data, analyzer.library, 10)
+
+    matched = analyzer._match(synthetic_raw_data, analyzer.library)
+
+    assert isinstance(matched["Inferred structure"].dtype, pd.CategoricalDtype)
+    pd.testing.assert_frame_equal(matched.astype({"Inferred structure": object}), expected)
+
+
+def test_match_isobaric_structures(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that matching each unique mass once still gives every isobaric structure its matches, in order."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    library = analyzer.library
+    isomers = library.assign(**{"Inferred structure": library["Inferred structure"] + "'"})
+    search_space = pd.concat([library, isomers, library.iloc[::3]]).sort_index(kind="stable")
+    expected = matching(synthetic_raw_data, search_space, 10)
+
+    matched = analyzer._match(synthetic_raw_data, search_space)
+
+    pd.testing.assert_frame_equal(matched.astype({"Inferred structure": object}), expected)
+
+
+def test_analyze_many(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that samples are analysed lazily and in order, including from several threads at once."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    samples = [synthetic_raw_data, synthetic_raw_data.iloc[1:], synthetic_raw_data]
+
+    serial = list(analyzer.analyze_many(samples))
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        threaded = list(pool.map(analyzer.analyze, samples))
+
+    assert len(serial) == 3
+    for a, b in zip(serial, threaded):
+        pd.testing.assert_frame_equal(a, b)
+
+
+def test_grouped_window_matches() -> None:
+    """Test that matching several groups at once finds the pairs of matching each group on its own, in order."""
+    rng = np.random.default_rng(0)
+    observed = np.round(rng.uniform(0, 100, 500), 1)
+    groups = rng.integers(0, 4, 500)
+    lower = rng.uniform(0, 100, 200)
+    upper = lower + rng.uniform(-1, 2, 200)
+    window_groups = rng.integers(0, 4, 200)
+
+    expected_windows, expected_positions = [], []
+    for window in range(200):
+        in_group = np.flatnonzero(groups == window_groups[window])
+        _, positions = window_matches(observed[in_group], lower[window : window + 1], upper[window : window + 1])
+        expected_windows += [window] * len(positions)
+        expected_positions += in_group[positions].tolist()
+
+    windows, positions = grouped_window_matches(observed, groups, lower, upper, window_groups)
+    np.testing.assert_array_equal(windows, expected_windows)
+    np.testing.assert_array_equal(positions, expected_positions)
+
+
+@pytest.mark.parametrize(
+    "settings",
+    [{}, {"engine": "jit"}, {"max_multimer": 3}, {"feature_filter": FeatureFilter(top_n=100), "report_filtered": True}],
+)
+def test_analyze_joint(theo_masses: pd.DataFrame, settings: dict) -> None:
+    """Test that analysing samples together gives the results of analysing each of them on its own."""
+    samples = [synthetic_features(theo_masses, 150, seed) for seed in range(4)]
+    # The retention times of one sample can be stored as float32, which stacking it with the others widens
+    samples[0]["RT (min)"] = (samples[0]["RT (min)"] * 64).round() / 64
+    samples = [compact_feature_dtypes(sample) for sample in samples]
+    assert samples[0]["RT (min)"].dtype == np.float32
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1, **settings)
+
+    joint = analyzer.analyze_joint(samples)
+
+    assert len(joint) == len(samples)
+    for sample, results in zip(samples, joint):
+        expected = analyzer.analyze(sample)
+        pd.testing.assert_frame_equal(results, expected)
+        assert results.attrs == expected.attrs
+
+
+def test_analyze_joint_errors(theo_masses: pd.DataFrame) -> None:
+    """Test that a sample with no matches is named in its error, and that the others can still be analysed."""
+    samples = [synthetic_features(theo_masses, 150, seed) for seed in range(3)]
+    unmatched = samples[1].assign(**{"Obs (Da)": samples[1]["Obs (Da)"] + 0.37})
+    unmatched.attrs = samples[1].attrs
+    samples[1] = unmatched
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+
+    with pytest.raises(UserError, match="Analysing 'synthetic_1.txt' failed: No matches were found"):
+        analyzer.analyze_joint(samples)
+
+    joint = analyzer.analyze_joint(samples, return_errors=True)
+
+    assert isinstance(joint[1], UserError)
+    assert "synthetic_1.txt" in str(joint[1])
+    for sample in [0, 2]:
+        pd.testing.assert_frame_equal(joint[sample], analyzer.analyze(samples[sample]))
+
+
+def test_data_analysis_many(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that samples with the same IDs, retention times and masses are kept apart."""
+    samples = [synthetic_raw_data, synthetic_raw_data.iloc[1:], synthetic_raw_data.assign(Intensity=1e4)]
+    results = data_analysis_many(samples, theo_masses, 0.5, MODS, 10, 1)
+
+    for sample, sample_results in zip(samples, results):
+        pd.testing.assert_frame_equal(sample_results, data_analysis(sample, theo_masses, 0.5, MODS, 10, 1))
+
+
+def test_analyzer_is_isolated_from_its_inputs(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that changing the library or modification list after construction doesn't change the Analyzer."""
+    mods = list(MODS)
+    library = theo_masses.copy()
+    library.attrs = theo_masses.attrs
+    analyzer = Analyzer(library, 0.5, mods, 10, 1)
+    expected = analyzer.analyze(synthetic_raw_data)
+
+    library["Theo (Da)"] += 100
+    mods.clear()
+    analyzer.library["Theo (Da)"] += 100
+
+    pd.testing.assert_frame_equal(analyzer.analyze(synthetic_raw_data), expected)
+    assert analyzer.enabled_mod_list == MODS
+
+
+def test_analyzer_unknown_modification(theo_masses: pd.DataFrame) -> None:
+    """Test that unknown modifications are rejected up front."""
+    with pytest.raises(UserError, match="not recognised"):
+        Analyzer(theo_masses, 0.5, ["Phosphorylation (P)"], 10, 1)
@@ -0,0 +1,82 @@
+"""Test resumable analyses with stage checkpoints"""
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from pgfinder import analyzer as analyzer_module
+from pgfinder.analyzer import Analyzer
+from pgfinder.checkpoints import CheckpointStore, ingest, read_checkpoint, write_checkpoint
+from pgfinder.pgio import ms_file_reader
+
+MODS = ["Cross-Linked Multimers (=)", "Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)"]
+
+
+def test_checkpoint_round_trip(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame, tmp_path: Path) -> None:
+    """Test that categorical, text and numeric columns, the index and attrs all survive a checkpoint."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    matched = analyzer._match(synthetic_raw_data, analyzer.search_space(synthetic_raw_data["Obs (Da)"].sort_values()))
+    matched["Text"] = matched["Inferred structure"].astype(object)
+
+    write_checkpoint(matched, tmp_path / "match.npz", "match", "key")
+    restored = read_checkpoint(tmp_path / "match.npz")
+
+    assert restored.attrs.pop("checkpoint_key") == "key"
+    assert restored.attrs == matched.attrs
+    pd.testing.assert_frame_equal(restored, matched)
+
+
+def test_analyze_resumes(synthetic_mq_file: Path, theo_masses: pd.DataFrame, tmp_path: Path, monkeypatch) -> None:
+    """Test that checkpointed analyses give the same results and that changing consolidation only re-consolidates."""
+    store = CheckpointStore(tmp_path / "checkpoints")
+    raw_data = ingest(synthetic_mq_file, store)
+    pd.testing.assert_frame_equal(ingest(synthetic_mq_file, store), ms_file_reader(synthetic_mq_file))
+    expected = Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(raw_data)
+
+    results = Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(raw_data, checkpoints=store)
+    pd.testing.assert_frame_equal(results, expected)
+    assert len(list(store.directory.glob("*.npz"))) == 10
+
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 5)
+    monkeypatch.setattr(analyzer, "_match", lambda *args: pytest.fail("Matched again"))
+    results = analyzer.analyze(raw_data, checkpoints=store)
+    pd.testing.assert_frame_equal(results, Analyzer(theo_masses, 0.5, MODS, 10, 5).analyze(raw_data))
+    assert results.attrs["consolidation_ppm"] == 5
+    assert len(list(store.directory.glob("consolidation-*.npz"))) == 2
+
+
+def test_unreadable_checkpoint(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame, tmp_path: Path) -> None:
+    """Test that a damaged checkpoint is ignored and its stage run again."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    expected = analyzer.analyze(synthetic_raw_data, checkpoints=tmp_path)
+    (consolidated,) = tmp_path.glob("consolidation-*.npz")
+    consolidated.write_bytes(consolidated.read_bytes()[:100])
+
+    results = analyzer.analyze(synthetic_raw_data, checkpoints=tmp_path)
+
+    pd.testing.assert_frame_equal(results, expected)
+    assert results.attrs == expected.attrs
+
+
+def test_search_space_tolerance(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame, tmp_path: Path) -> None:
+    """Test that changing ppm_tolerance re-matches against a search space that was passed in."""
+    search_space = Analyzer(theo_masses, 0.5, MODS, 20, 1).search_space(synthetic_raw_data["Obs (Da)"].sort_values())
+    Analyzer(theo_masses, 0.5, MODS, 20, 1).analyze(synthetic_raw_data, search_space, checkpoints=tmp_path)
+
+    results = Analyzer(theo_masses, 0.5, MODS, 2, 1).analyze(synthetic_raw_data, search_space, checkpoints=tmp_path)
+
+    expected = Analyzer(theo_masses, 0.5, MODS, 2, 1).analyze(synthetic_raw_data, search_space)
+    pd.testing.assert_frame_equal(results, expected)
+    assert len(list(tmp_path.glob("match-*.npz"))) == 2
+
+
+def test_release_invalidates(
+    synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame, tmp_path: Path, monkeypatch
+) -> None:
+    """Test that checkpoints saved by another release of pgfinder aren't reused."""
+    Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(synthetic_raw_data, checkpoints=tmp_path)
+    monkeypatch.setattr(analyzer_module, "release", "0.0.1")
+
+    Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(synthetic_raw_data, checkpoints=tmp_path)
+
+    assert len(list(tmp_path.glob("consolidation-*.npz"))) == 2
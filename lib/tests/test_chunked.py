@@ -0,0 +1,51 @@
+"""Test out-of-core analysis in partitions"""
+from decimal import Decimal
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder.analyzer import POTASSIUM, SODIUM, SUGAR, Analyzer
+from pgfinder.chunked import analyze_file, partition_borders
+from pgfinder.errors import UserError
+from pgfinder.pgio import dataframe_to_csv_metadata, ms_file_chunks, ms_file_reader
+
+MODS = ["Cross-Linked Multimers (=)", "Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)"]
+
+
+def test_ms_file_chunks(synthetic_mq_file: Path) -> None:
+    """Test that reading a file in chunks gives the same features, with the same IDs, as reading it at once."""
+    chunks = list(ms_file_chunks(synthetic_mq_file, 10))
+    assert len(chunks) > 1
+    features_df = ms_file_reader(synthetic_mq_file)
+    pd.testing.assert_frame_equal(pd.concat(chunks), features_df, check_dtype=False, check_categorical=False)
+
+
+def test_partition_borders_keep_clean_up_pairs_together() -> None:
+    """Test that borders never separate a parent from its adduct, or features with the same retention time."""
+    rt = np.array([1.0, 1.2, 1.2, 2.0, 2.1, 3.0, 4.0])
+    observed = np.array([500.0, 600.0, 700.0, 800.0, 800.0 + float(SODIUM), 900.0, 1000.0])
+
+    borders = partition_borders(rt, observed, 2, 0.5, 10, [SODIUM, POTASSIUM, SUGAR])
+
+    assert np.searchsorted(borders, rt, side="right").tolist() == [0, 1, 1, 2, 2, 3, 3]
+    # Without any clean-up masses the parent and adduct may be split
+    assert len(np.unique(np.searchsorted(partition_borders(rt, observed, 1, 0.5, 10, []), rt, side="right"))) == 6
+
+
+@pytest.mark.parametrize("memory_budget", [0.002, 1000])
+def test_analyze_file_matches_analyze(synthetic_mq_file: Path, theo_masses: pd.DataFrame, tmp_path, memory_budget):
+    """Test that analysing a file in partitions writes exactly the results of analysing it in one go."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    expected = dataframe_to_csv_metadata(analyzer.analyze(ms_file_reader(synthetic_mq_file)))
+
+    output = analyze_file(analyzer, synthetic_mq_file, memory_budget, tmp_path, "results.csv")
+
+    assert Path(output).read_text() == expected
+
+
+def test_analyze_file_rejects_empty_budget(synthetic_mq_file: Path, theo_masses: pd.DataFrame, tmp_path) -> None:
+    """Test that a memory budget must be positive."""
+    with pytest.raises(UserError):
+        analyze_file(Analyzer(theo_masses, 0.5, [], 10, 1), synthetic_mq_file, Decimal(0), tmp_path)
@@ -0,0 +1,89 @@
+"""Test compiled mass libraries"""
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import compiled_library
+from pgfinder.compiled_library import (
+    CompiledLibrary,
+    compile_builtin_libraries,
+    compile_library,
+    read_compiled_library,
+    write_compiled_library,
+)
+from pgfinder.errors import UserError
+from pgfinder.gui import internal
+from pgfinder.pgio import theo_masses_reader
+
+
+def test_compile_library_round_trip(theo_masses: pd.DataFrame, tmp_path: Path) -> None:
+    """Test that compiling and reading a library gives back the original library."""
+    compile_library(theo_masses, tmp_path / "library.pglib")
+
+    pd.testing.assert_frame_equal(read_compiled_library(tmp_path / "library.pglib"), theo_masses)
+
+
+def test_compiled_library(theo_masses: pd.DataFrame, tmp_path: Path) -> None:
+    """Test that masses are sorted and memory-mapped and that lookups by mass work."""
+    entries = zip(theo_masses["Inferred structure"], theo_masses["Theo (Da)"])
+    assert write_compiled_library(entries, tmp_path / "library.pglib", metadata={"source": "x"}, chunk_size=10) == len(
+        theo_masses
+    )
+
+    with CompiledLibrary(tmp_path / "library.pglib") as library:
+        assert len(library) == len(theo_masses)
+        assert library.metadata["source"] == "x"
+        assert np.all(np.diff(library.masses) >= 0)
+        assert not library.masses.flags.writeable
+        start, stop = library.window(870.37, 870.38)
+        assert library.names(start, stop) == ["gm-AEJ|1"]
+        assert library.name(start) == "gm-AEJ|1"
+        pd.testing.assert_frame_equal(library.to_frame(), theo_masses, check_index_type=False, check_names=False)
+
+
+def test_compiled_library_invalid(tmp_path: Path) -> None:
+    """Test that files that aren't compiled libraries are rejected."""
+    (tmp_path / "library.pglib").write_text("Structure,Monoisotopicmass\ngm|0,498.206090\n" * 4)
+    with pytest.raises(UserError, match="not a compiled mass library"):
+        CompiledLibrary(tmp_path / "library.pglib")
+
+
+def test_compiled_builtin_libraries(tmp_path: Path, monkeypatch) -> None:
+    """Test that built-in libraries are read from their compiled copies once built, giving the same library."""
+    masses_dir = tmp_path / "masses"
+    shutil.copytree(compiled_library.MASS_LIB_DIR, masses_dir, ignore=shutil.ignore_patterns("*.pglib"))
+    monkeypatch.setattr(compiled_library, "MASS_LIB_DIR", masses_dir)
+    monkeypatch.setattr(internal, "MASS_LIB_DIR", masses_dir)
+    csv_file = masses_dir / "e_coli_monomers_simple.csv"
+    expected = theo_masses_reader(csv_file)
+
+    assert len(compile_builtin_libraries()) == 6
+    compiled = theo_masses_reader(csv_file)
+    uploaded = internal.theo_masses_upload_reader({"name": csv_file.name, "content": None})
+    (masses_dir / "e_coli_monomers_simple.pglib").write_bytes(b"")
+
+    pd.testing.assert_frame_equal(compiled, expected)
+    assert compiled.attrs == expected.attrs
+    pd.testing.assert_frame_equal(uploaded, expected)
+    with pytest.raises(UserError, match="empty"):
+        theo_masses_reader(csv_file)
+    pd.testing.assert_frame_equal(theo_masses_reader(csv_file, compiled=False), expected)
+
+
+def test_compiled_library_reproducible(theo_masses: pd.DataFrame, tmp_path: Path, monkeypatch) -> None:
+    """Test that built-in libraries compile to identical files, and that SOURCE_DATE_EPOCH dates other libraries."""
+    masses_dir = tmp_path / "masses"
+    shutil.copytree(compiled_library.MASS_LIB_DIR, masses_dir, ignore=shutil.ignore_patterns("*.pglib"))
+    first = [f.read_bytes() for f in compile_builtin_libraries(masses_dir, tmp_path / "first")]
+    second = [f.read_bytes() for f in compile_builtin_libraries(masses_dir, tmp_path / "second")]
+    assert first == second
+    with CompiledLibrary(tmp_path / "first" / "e_coli_monomers_simple.pglib") as library:
+        assert "created" not in library.metadata
+
+    monkeypatch.setenv("SOURCE_DATE_EPOCH", "1700000000")
+    compile_library(theo_masses, tmp_path / "library.pglib")
+    with CompiledLibrary(tmp_path / "library.pglib") as library:
+        assert library.metadata["created"] == "2023-11-14T22:13:20+00:00"
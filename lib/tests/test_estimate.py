@@ -0,0 +1,151 @@
+"""Test resource estimates and dry runs"""
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import jit
+from pgfinder.analyzer import Analyzer
+from pgfinder.estimate import RT_BIN_WIDTH, feature_histograms, mass_histogram, rt_pair_fraction
+from pgfinder.find_pg import process_file
+from pgfinder.kernels import sorted_observed
+from pgfinder.pgio import ms_file_reader
+from pgfinder.prefilter import FeatureFilter
+from pgfinder.verify import synthetic_features
+
+MODS = ["Cross-Linked Multimers (=)", "Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)"]
+
+
+def test_mass_histogram(synthetic_mq_file: Path) -> None:
+    """Test that the histogram counts every feature, in the bin of its mass, when read in chunks."""
+    masses = ms_file_reader(synthetic_mq_file)["Obs (Da)"].to_numpy(dtype=float)
+
+    features, counts = mass_histogram(synthetic_mq_file, 10.0, chunk_size=7)
+
+    assert features == len(masses)
+    assert counts.sum() == len(masses)
+    np.testing.assert_array_equal(counts, np.bincount((masses // 10).astype(int)))
+
+
+@pytest.mark.parametrize("max_multimer", [None, 3])
+def test_estimate_is_close(synthetic_mq_file: Path, theo_masses: pd.DataFrame, max_multimer) -> None:
+    """Test that the expected counts are within a loose factor of those of the analysis."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1, max_multimer=max_multimer)
+    raw_data = ms_file_reader(synthetic_mq_file)
+    matched = analyzer._match(raw_data, analyzer.search_space(sorted_observed(raw_data)))
+    matched = matched[matched["Inferred structure"].notna()]
+
+    estimate = analyzer.estimate(synthetic_mq_file)
+
+    assert estimate.features == len(raw_data)
+    assert estimate.library_structures == len(theo_masses)
+    assert len(matched) / 3 < estimate.expected_matches < len(matched) * 3
+    assert matched["ID"].nunique() / 3 < estimate.expected_matched_features <= estimate.features
+    assert estimate.runtime_seconds == pytest.approx(sum(estimate.stage_seconds.values()))
+    assert estimate.peak_memory_mib > 0
+
+
+def test_filtered_histograms(synthetic_mq_file: Path, tmp_path: Path) -> None:
+    """Test that only the features a filter keeps are counted, read in chunks from MaxQuant and Byos files."""
+    ftrs_file = tmp_path / "features.ftrs"
+    features = ms_file_reader(synthetic_mq_file)
+    with sqlite3.connect(ftrs_file) as db:
+        pd.DataFrame(
+            {
+                "Id": np.arange(1, len(features) + 1),
+                "apexRetentionTime": features["RT (min)"],
+                "charges": features["Charge"].astype(str),
+                "mwMonoIsotopicMass": features["Obs (Da)"],
+                "apexIntensity": features["Intensity"],
+            }
+        ).to_sql("Features", db, index=False)
+    intensity = features["Intensity"].to_numpy(dtype=float)
+    feature_filter = FeatureFilter.from_settings(
+        min_intensity=np.quantile(intensity, 0.2), top_n=len(features) // 2, mass_range=[0, 1500]
+    )
+
+    for file in [synthetic_mq_file, ftrs_file]:
+        kept = ms_file_reader(file, feature_filter)
+        features, mass_counts, rt_counts = feature_histograms(
+            file, 10.0, 1.0, chunk_size=7, feature_filter=feature_filter
+        )
+
+        assert 0 < features == len(kept) < len(ms_file_reader(file))
+        np.testing.assert_array_equal(mass_counts, np.bincount((kept["Obs (Da)"] // 10).astype(int)))
+        np.testing.assert_array_equal(rt_counts, np.bincount((kept["RT (min)"] // 1).astype(int)))
+
+
+def test_rt_pair_fraction(synthetic_mq_file: Path) -> None:
+    """Test that the fraction of pairs eluting together is that counted from the retention times themselves."""
+    rt = ms_file_reader(synthetic_mq_file)["RT (min)"].to_numpy(dtype=float)
+    # Retention times are binned, so pairs are only counted exactly for a window of whole bins
+    binned = np.floor(rt / RT_BIN_WIDTH)
+    expected = (np.abs(binned[:, None] - binned[None, :]) <= 50).mean()
+
+    features, _, rt_counts = feature_histograms(synthetic_mq_file, chunk_size=7)
+
+    assert features == len(rt)
+    assert rt_pair_fraction(rt_counts, RT_BIN_WIDTH, 0.5) == pytest.approx(expected)
+    assert rt_pair_fraction(rt_counts[:0], RT_BIN_WIDTH, 0.5) == 0
+
+
+def test_runtime_is_close(theo_masses: pd.DataFrame, tmp_path: Path) -> None:
+    """Test that the projected runtime stays within a bounded factor of the analysis as the number of features grows.
+
+    A wide RT window puts many matches within the window of each other, so clean-up grows faster than the features.
+    Runtimes are only compared loosely, as tracing the tests for coverage slows the analysis down.
+    """
+    columns = {"RT (min)": "Retention time", "Obs (Da)": "Mass", "Charge": "Charge", "Intensity": "Intensity"}
+    for n_features in (400, 1600):
+        file = tmp_path / f"synthetic_{n_features}.txt"
+        features = synthetic_features(theo_masses, n_features, rt_window=5)
+        features[list(columns)].rename(columns=columns).to_csv(file, sep="\t", index=False)
+        analyzer = Analyzer(theo_masses, 5, MODS, 10, 1)
+        raw_data = ms_file_reader(file)
+        matched = analyzer._match(raw_data, analyzer.search_space(sorted_observed(raw_data)))
+        rt = np.sort(matched.loc[matched["Inferred structure"].notna(), "RT (min)"].to_numpy(dtype=float))
+        pairs = (np.searchsorted(rt, rt + 5, side="right") - np.searchsorted(rt, rt - 5, side="left")).sum()
+        start = time.perf_counter()
+        analyzer.analyze(raw_data)
+        runtime = time.perf_counter() - start
+
+        estimate = analyzer.estimate(file)
+
+        assert pairs / 2 < estimate.clean_up_pairs < pairs * 2
+        assert estimate.runtime_seconds / 4 < runtime < estimate.runtime_seconds * 4
+
+
+def test_estimate_engine(synthetic_mq_file: Path, theo_masses: pd.DataFrame, monkeypatch) -> None:
+    """Test that runtime is projected with the costs of the analyzer's engine."""
+    monkeypatch.setattr(jit, "JIT_AVAILABLE", True)
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+
+    numpy_estimate = analyzer.estimate(synthetic_mq_file)
+    jit_estimate = analyzer.with_engine("jit").estimate(synthetic_mq_file)
+
+    assert jit_estimate.expected_matches == numpy_estimate.expected_matches
+    assert jit_estimate.runtime_seconds < numpy_estimate.runtime_seconds / 10
+
+
+def test_dry_run(synthetic_mq_file: Path, theo_masses_filename: str, tmp_path: Path, capsys) -> None:
+    """Test that a dry run prints the estimate as JSON without writing any results."""
+    process_file(synthetic_mq_file, theo_masses_filename, MODS, output_dir=tmp_path, dry_run=True)
+
+    estimate = json.loads(capsys.readouterr().out)
+    assert estimate["features"] == len(ms_file_reader(synthetic_mq_file))
+    assert not list(tmp_path.glob("*.csv"))
+
+
+def test_dry_run_filtered(synthetic_mq_file: Path, theo_masses_filename: str, tmp_path: Path, capsys) -> None:
+    """Test that a dry run only counts the features that the feature filter keeps."""
+    feature_filter = FeatureFilter.from_settings(top_n=10)
+
+    process_file(
+        synthetic_mq_file, theo_masses_filename, MODS, output_dir=tmp_path, feature_filter=feature_filter, dry_run=True
+    )
+
+    assert json.loads(capsys.readouterr().out)["features"] == 10
@@ -0,0 +1,68 @@
+"""Test the compiled kernels against the NumPy engine (uncompiled when Numba isn't installed)"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import jit
+from pgfinder.analyzer import POTASSIUM, SODIUM, SUGAR, Analyzer
+from pgfinder.errors import UserError
+from pgfinder.kernels import window_matches
+from pgfinder.matching import calculate_ppm_delta, clean_up, pick_most_likely_structures
+from pgfinder.structures import StructureTable
+
+MODS = ["Cross-Linked Multimers (=)", "Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)", "Loss of GlcNAc (-g)"]
+
+
+@pytest.fixture
+def matched_df(theo_masses: pd.DataFrame, synthetic_raw_data: pd.DataFrame) -> pd.DataFrame:
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    return calculate_ppm_delta(
+        analyzer._match(synthetic_raw_data, analyzer.search_space(np.sort(synthetic_raw_data["Obs (Da)"])))
+    )
+
+
+def test_window_matches() -> None:
+    """Test that the kernel finds the same pairs, in the same order, as the NumPy version."""
+    rng = np.random.default_rng(0)
+    observed = np.round(rng.uniform(0, 100, 500), 1)
+    lower = rng.uniform(0, 100, 200)
+    upper = lower + rng.uniform(-1, 2, 200)
+
+    for expected, actual in zip(window_matches(observed, lower, upper), jit.window_matches(observed, lower, upper)):
+        np.testing.assert_array_equal(actual, expected)
+
+
+def test_clean_up(matched_df: pd.DataFrame) -> None:
+    """Test that the adduct sweep consolidates and removes exactly the rows that ``clean_up()`` does."""
+    structures = StructureTable(matched_df["Inferred structure"].cat.categories)
+    expected = actual = matched_df
+    for mass in (SODIUM, POTASSIUM, SUGAR):
+        expected = clean_up(expected, mass, 0.5, structures=structures)
+        actual = jit.clean_up(actual, mass, 0.5, structures=structures)
+        pd.testing.assert_frame_equal(actual, expected)
+    assert len(actual) < len(matched_df)
+
+
+@pytest.mark.parametrize("consolidation_ppm", [0, 1, 10])
+def test_pick_most_likely_structures(matched_df: pd.DataFrame, consolidation_ppm: float) -> None:
+    """Test that consolidation picks and joins the same structures as ``pick_most_likely_structures()``."""
+    pd.testing.assert_frame_equal(
+        jit.pick_most_likely_structures(matched_df, consolidation_ppm),
+        pick_most_likely_structures(matched_df, consolidation_ppm),
+    )
+
+
+def test_engine(theo_masses: pd.DataFrame, synthetic_raw_data: pd.DataFrame, monkeypatch) -> None:
+    """Test that the jit engine gives the results of the numpy engine, and falls back to it without Numba."""
+    with pytest.raises(UserError):
+        Analyzer(theo_masses, 0.5, MODS, 10, 1, engine="fortran")
+
+    monkeypatch.setattr(jit, "JIT_AVAILABLE", False)
+    assert Analyzer(theo_masses, 0.5, MODS, 10, 1, engine="jit").engine == "numpy"
+
+    monkeypatch.setattr(jit, "JIT_AVAILABLE", True)
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1, engine="jit")
+    assert analyzer.engine == "jit"
+    pd.testing.assert_frame_equal(
+        analyzer.analyze(synthetic_raw_data), Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(synthetic_raw_data)
+    )
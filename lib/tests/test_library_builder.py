@@ -0,0 +1,99 @@
+"""Test building mass libraries from composition rules"""
+from decimal import Decimal
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from pgfinder.cli import main
+from pgfinder.compiled_library import read_compiled_library
+from pgfinder.errors import UserError
+from pgfinder.library_builder import build_library, enumerate_structures, load_rules
+
+RULES_DIR = Path("pgfinder/config/library_rules")
+MASSES_DIR = Path("pgfinder/masses")
+
+RULES = {
+    "sets": {"X": ["A", "G", "S"]},
+    "structures": [
+        {"glycan": {"positions": ["gm", "gm"], "min_length": 1}},
+        {"glycan": {"positions": ["gm"]}, "stem": {"positions": ["A", "E", "X", "X"], "min_length": 3}},
+    ],
+}
+
+
+@pytest.mark.parametrize("library", [f.stem for f in sorted(RULES_DIR.glob("*.yaml"))])
+def test_rules_reproduce_built_in_libraries(library: str) -> None:
+    """Test that the shipped rules reproduce each built-in library."""
+    built = {(name, f"{mass:.6f}") for name, mass in enumerate_structures(load_rules(RULES_DIR / f"{library}.yaml"))}
+    expected = pd.read_csv(MASSES_DIR / f"{library}.csv", dtype=str)
+
+    assert built == set(zip(expected["Structure"], expected["Monoisotopicmass"]))
+
+
+def test_enumerate_structures() -> None:
+    """Test enumeration order, naming and masses."""
+    structures = list(enumerate_structures(RULES))
+
+    assert [name for name, _ in structures[:5]] == ["gm|0", "gm-gm|0", "gm-AEA|1", "gm-AEG|1", "gm-AES|1"]
+    assert len(structures) == 2 + 3 + 9
+    # Matches gm-AE|1 in the built-in libraries plus one alanine
+    assert dict(structures)["gm-AEA|1"] == Decimal("769.322911")
+
+
+def test_enumerate_structures_pruning_and_isobaric() -> None:
+    """Test mass range pruning and the two ways of removing isobaric structures."""
+    full = dict(enumerate_structures(RULES))
+    in_range = dict(enumerate_structures(RULES, mass_range=(700, 850)))
+    assert in_range == {name: mass for name, mass in full.items() if 700 <= mass <= 850}
+
+    unordered = {**RULES, "structures": [{**RULES["structures"][1], "stem": {**RULES["structures"][1]["stem"]}}]}
+    unordered["structures"][0]["stem"]["unordered"] = [[3, 4]]
+    names = [name for name, _ in enumerate_structures(unordered)]
+    assert "gm-AEAG|1" in names and "gm-AEGA|1" not in names
+    assert len(names) == 3 + 6
+
+    unique = list(enumerate_structures(RULES, unique_masses=True))
+    assert len(unique) == len({mass for _, mass in full.items()})
+
+
+def test_enumerate_structures_invalid_rules() -> None:
+    """Test that mistakes in the rules are reported to the user."""
+    with pytest.raises(UserError, match="no known mass"):
+        list(enumerate_structures({"structures": [{"glycan": {"positions": ["gm"]}, "stem": {"positions": ["B"]}}]}))
+    with pytest.raises(UserError, match="same alternatives"):
+        rules = {
+            "structures": [{"glycan": {"positions": ["gm"]}, "stem": {"positions": ["A", "E"], "unordered": [[1, 2]]}}]
+        }
+        list(enumerate_structures(rules))
+
+
+def test_build_library(tmp_path: Path) -> None:
+    """Test that the CSV and compiled outputs hold the same library, however many chunks it was sorted in."""
+    csv_file = tmp_path / "library.csv"
+    compiled_file = tmp_path / "library.pglib"
+    count = build_library(
+        RULES_DIR / "e_coli_monomers_complex.yaml", csv_file=csv_file, compiled_file=compiled_file, chunk_size=50
+    )
+
+    from_csv = pd.read_csv(csv_file)
+    from_compiled = read_compiled_library(compiled_file)
+    assert count == len(from_csv) == len(from_compiled) == 426
+    assert from_compiled["Inferred structure"].to_list() == from_csv["Structure"].to_list()
+    assert from_compiled["Theo (Da)"].to_list() == from_csv["Monoisotopicmass"].to_list()
+
+
+def test_build_library_cli(tmp_path: Path) -> None:
+    """Test the build-library sub-command."""
+    main(
+        [
+            "build-library",
+            str(RULES_DIR / "e_coli_monomers_simple.yaml"),
+            "--csv",
+            str(tmp_path / "simple.csv"),
+            "--mass_range",
+            "0",
+            "1000",
+        ]
+    )
+    assert (pd.read_csv(tmp_path / "simple.csv")["Monoisotopicmass"] <= 1000).all()
@@ -0,0 +1,32 @@
+"""Test logging"""
+import logging
+import os
+import subprocess
+import sys
+from logging.handlers import QueueHandler
+from pathlib import Path
+
+from pgfinder.logs import logs
+from pgfinder.logs.logs import LOGGER_NAME, setup_logger, stop_logging
+
+
+def test_import_writes_no_log_file(tmp_path: Path) -> None:
+    """Test that importing the package and its command line tools leaves no log files behind."""
+    subprocess.run([sys.executable, "-c", "import pgfinder.cli, pgfinder.find_pg"], cwd=tmp_path, check=True)
+
+    assert not list(tmp_path.iterdir())
+
+
+def test_log_file(tmp_path: Path, monkeypatch) -> None:
+    """Test that records are queued to a single handler and written to a per-process log file once flushed."""
+    try:
+        logger = setup_logger(log_file=tmp_path / "pgfinder-{pid}.log")
+        assert [type(h) for h in logger.handlers] == [QueueHandler]
+
+        logging.getLogger(LOGGER_NAME).info("Written by the listener")
+        stop_logging()
+
+        assert "Written by the listener" in (tmp_path / f"pgfinder-{os.getpid()}.log").read_text()
+    finally:
+        monkeypatch.setattr(logs, "_LOG_FILE", None)
+        setup_logger()
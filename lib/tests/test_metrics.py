@@ -0,0 +1,64 @@
+"""Test the Prometheus metrics of analyses"""
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
+from pgfinder.metrics import REGISTRY, MetricsRegistry, MetricsWriter
+
+
+def test_render() -> None:
+    """Test that counters, labelled histograms and derived gauges are rendered in the Prometheus text format."""
+    registry = MetricsRegistry()
+    registry.inc("pgfinder_features_total", 200)
+    registry.inc("pgfinder_features_matched_total", 50)
+    registry.observe("pgfinder_analysis_duration_seconds", 2.0)
+    registry.observe("pgfinder_stage_duration_seconds", 0.03, stage="match")
+    registry.observe("pgfinder_stage_duration_seconds", 0.2, stage='odd "name"')
+
+    lines = registry.render().splitlines()
+
+    assert "# TYPE pgfinder_features_total counter" in lines
+    assert "pgfinder_features_total 200" in lines
+    assert 'pgfinder_stage_duration_seconds_bucket{stage="match",le="0.01"} 0' in lines
+    assert 'pgfinder_stage_duration_seconds_bucket{stage="match",le="0.05"} 1' in lines
+    assert 'pgfinder_stage_duration_seconds_bucket{stage="match",le="+Inf"} 1' in lines
+    assert 'pgfinder_stage_duration_seconds_count{stage="odd \\"name\\""} 1' in lines
+    assert "pgfinder_analysis_duration_seconds_sum 2" in lines
+    assert "pgfinder_features_per_second 100" in lines
+    assert "pgfinder_match_ratio 0.25" in lines
+    assert any(line.startswith("pgfinder_peak_rss_bytes ") for line in lines)
+    with pytest.raises(KeyError):
+        registry.inc("pgfinder_stage_duration_seconds")
+
+
+def test_writer(tmp_path: Path) -> None:
+    """Test that metrics are written when the context is left, even when it is left by an error."""
+    registry = MetricsRegistry()
+    file = tmp_path / "metrics" / "pgfinder.prom"
+    with pytest.raises(RuntimeError), MetricsWriter(file, interval=60, registry=registry):
+        registry.inc("pgfinder_files_failed_total")
+        raise RuntimeError
+    assert "pgfinder_files_failed_total 1" in file.read_text().splitlines()
+    assert list(file.parent.iterdir()) == [file]
+    with pytest.raises(UserError):
+        MetricsWriter(file, interval=0)
+
+
+def test_analyze_records_metrics(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that analysing a sample counts its features, matches and candidates and times each stage."""
+    before = {
+        name: REGISTRY.value(name)
+        for name in ["pgfinder_features_total", "pgfinder_features_matched_total", "pgfinder_candidates_total"]
+    }
+    match_before = REGISTRY.value("pgfinder_stage_duration_seconds", stage="match")
+
+    results = Analyzer(theo_masses, 0.5, ["Sodium Adduct (Na+)"], 10, 1).analyze(synthetic_raw_data)
+
+    matched = results.loc[results["Inferred structure"].notna(), "ID"].nunique()
+    assert REGISTRY.value("pgfinder_features_total") - before["pgfinder_features_total"] == len(synthetic_raw_data)
+    assert REGISTRY.value("pgfinder_features_matched_total") - before["pgfinder_features_matched_total"] == matched
+    assert REGISTRY.value("pgfinder_candidates_total") > before["pgfinder_candidates_total"]
+    assert REGISTRY.value("pgfinder_stage_duration_seconds", stage="match") == match_before + 1
@@ -0,0 +1,95 @@
+"""Test searching for structures with several modifications"""
+import logging
+from itertools import combinations_with_replacement
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import MOD_TYPE
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
+from pgfinder.kernels import ppm_windows, sorted_observed, window_hits
+from pgfinder.matching import data_analysis, filtered_theo, modification_generator
+from pgfinder.modifications import modification_search
+
+STRUCTURES = pd.DataFrame({"Inferred structure": ["gm-AEJ|1", "gm-AEJA|1"], "Theo (Da)": [870.3704, 941.4075]})
+MODS = ["Anhydro-MurNAc (Anh)", "Amidation (Am)", "Sodium Adduct (Na+)", "Potassium Adduct (K+)"]
+
+
+def modified_mass(mass: float, *mods: str) -> float:
+    for mod in mods:
+        mass += float(MOD_TYPE[mod]["mass"])
+    return mass
+
+
+def test_single_modifications_match_modification_generator(
+    synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame
+) -> None:
+    """Test that with one modification per structure the matching structures are those modification_generator finds."""
+    structures = filtered_theo(synthetic_raw_data, theo_masses, 10)
+    observed = sorted_observed(synthetic_raw_data)
+    expected = pd.concat([modification_generator(structures, mod) for mod in MODS]).astype({"Theo (Da)": float})
+    expected = expected[window_hits(observed, *ppm_windows(expected["Theo (Da)"].to_numpy(), 10))]
+
+    searched = modification_search(structures, MODS, 1, observed, 10)
+
+    pd.testing.assert_frame_equal(searched, expected.reset_index(drop=True))
+
+
+def test_stacked_modifications() -> None:
+    """Test naming of stacked modifications, repeated modifications and exclusive modifications."""
+    observed = np.sort(
+        [
+            modified_mass(870.3704, "Anhydro-MurNAc (Anh)", "Amidation (Am)"),
+            modified_mass(941.4075, "Amidation (Am)", "Amidation (Am)", "Sodium Adduct (Na+)"),
+            modified_mass(870.3704, "Sodium Adduct (Na+)", "Potassium Adduct (K+)"),
+        ]
+    )
+
+    searched = modification_search(STRUCTURES, MODS, 3, observed, 1)
+
+    assert searched["Inferred structure"].to_list() == ["gm-AEJ (Anh) (Am) |1", "gm-AEJA (Am) (Am) (Na+) |1"]
+
+
+def test_pruning_finds_everything() -> None:
+    """Test that pruning doesn't lose any matches compared to trying every combination of modifications."""
+    rng = np.random.default_rng(42)
+    structures = pd.DataFrame(
+        {"Inferred structure": [f"gm-S{i}|1" for i in range(50)], "Theo (Da)": rng.uniform(500, 2000, 50)}
+    )
+    mods = ["Anhydro-MurNAc (Anh)", "Amidation (Am)", "O-Acetylation (+Ac)", "Extra Disaccharide (+gm)"]
+    observed = np.sort(rng.uniform(400, 2500, 300))
+
+    expected = set()
+    for structure, mass in zip(structures["Inferred structure"], structures["Theo (Da)"]):
+        for n in (1, 2, 3):
+            for combination in combinations_with_replacement(mods, n):
+                if any(combination.count(m) > (2 if m == "Amidation (Am)" else 1) for m in mods):
+                    continue
+                theo = modified_mass(mass, *combination)
+                if window_hits(observed, *ppm_windows(np.array([theo]), 10))[0]:
+                    expected.add((structure, combination))
+
+    searched = modification_search(structures, mods, 3, observed, 10)
+
+    assert len(searched) == len(expected) > 0
+
+
+def test_max_candidates(caplog) -> None:
+    """Test that the search stops before generating too many candidates."""
+    observed = np.array([modified_mass(870.3704, "Anhydro-MurNAc (Anh)", "Amidation (Am)")])
+    with caplog.at_level(logging.WARNING):
+        searched = modification_search(STRUCTURES, MODS, 3, observed, 1, max_candidates=5)
+
+    assert searched.empty
+    assert "up to 1 modifications" in caplog.text
+
+
+def test_data_analysis_max_modifications(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that max_modifications is validated and recorded."""
+    results = data_analysis(synthetic_raw_data, theo_masses, 0.5, MODS, 10, 1, max_modifications=2)
+    assert results.attrs["max_modifications"] == 2
+
+    with pytest.raises(UserError, match="at least 1"):
+        Analyzer(theo_masses, 0.5, MODS, 10, 1, max_modifications=0)
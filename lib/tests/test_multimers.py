@@ -0,0 +1,88 @@
+"""Test searching for multimers of any size"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import MULTIMER_SEARCH
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
+from pgfinder.kernels import sorted_observed
+from pgfinder.matching import data_analysis, filtered_theo, multimer_builder
+from pgfinder.multimers import WATER, _Search, multimer_search
+from pgfinder.pgio import dataframe_to_csv_metadata
+
+MONOMERS = pd.DataFrame(
+    {
+        "Inferred structure": ["gm|0", "gm-AEJ|1", "gm-AEJA|1", "gm-AE|1"],
+        "Theo (Da)": [498.2061, 870.3704, 941.4075, 698.2858],
+    }
+)
+CROSS_LINKED = "Cross-Linked Multimers (=)"
+
+
+def chain_mass(*masses: float) -> float:
+    return round(sum(masses) - WATER * (len(masses) - 1), 4)
+
+
+def test_multimer_search_finds_larger_multimers() -> None:
+    """Test that tetramers are found and that chains heavier than any observed mass aren't."""
+    tetramer = chain_mass(870.3704, 870.3704, 941.4075, 941.4075)
+    observed = np.array([chain_mass(870.3704, 698.2858), tetramer])
+
+    multimers = multimer_search(MONOMERS, CROSS_LINKED, 6, observed, 10)
+
+    assert multimers.to_dict("list") == {
+        "Inferred structure": [
+            "gm-AEJ=gm-AE|2",
+            "gm-AE=gm-AEJ|2",
+            "gm-AEJ=gm-AEJ=gm-AEJA=gm-AEJA|4",
+            "gm-AEJA=gm-AEJ=gm-AEJ=gm-AEJA|4",
+        ],
+        "Theo (Da)": [chain_mass(870.3704, 698.2858)] * 2 + [tetramer] * 2,
+    }
+
+
+def test_multimer_search_donor_renaming() -> None:
+    """Test that Lactyl multimers take their donors' stems and lose their glycan mass."""
+    observed = np.array([chain_mass(870.3704, 462.1962)])
+
+    multimers = multimer_search(MONOMERS, "Lactyl Multimers (=Lac)", 3, observed, 10)
+
+    assert multimers["Inferred structure"].to_list() == ["gm-AEJ=Lac-AEJ|2"]
+
+
+def test_multimer_search_covers_fixed_dimers(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that the search finds the dimers built from the fixed donors, however the chains are split into blocks."""
+    monomers = filtered_theo(synthetic_raw_data, theo_masses, 10)
+    fixed = filtered_theo(synthetic_raw_data, multimer_builder(monomers, CROSS_LINKED), 10)
+    observed = sorted_observed(synthetic_raw_data)
+    searched = multimer_search(monomers, CROSS_LINKED, 3, observed, 10)
+
+    fixed_dimers = fixed[fixed["Inferred structure"].str.endswith("|2")]
+    assert len(fixed_dimers) > 0
+    # Masses can differ slightly, as the search uses the library's masses for donors rather than those in the parameters
+    assert set(fixed_dimers["Inferred structure"]) <= set(searched["Inferred structure"])
+
+    names = ["gm-AEJ", "gm-AEJA", "gm-AE"]
+    masses = np.array([870.3704, 941.4075, 698.2858])
+    results = []
+    for block_size in (1, 5, 1_000_000):
+        search = _Search(names, masses, MULTIMER_SEARCH[CROSS_LINKED], observed, 10, 4, block_size=block_size)
+        search.grow([(np.arange(3), np.zeros(3, dtype=np.intp), masses)])
+        results.append({size: sorted(search.structures[size]) for size in search.structures})
+    assert results[0] == results[1] == results[2]
+
+
+def test_data_analysis_max_multimer(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that the multimer search is used and recorded when max_multimer is given."""
+    results = data_analysis(synthetic_raw_data, theo_masses, 0.5, [CROSS_LINKED], 10, 1, max_multimer=3)
+
+    assert results["Inferred structure"].str.contains(r"=.*\|2", na=False).any()
+    assert results.attrs["max_multimer"] == 3
+    assert "max_multimer : 3" in dataframe_to_csv_metadata(results)
+
+
+def test_max_multimer_validation(theo_masses: pd.DataFrame) -> None:
+    """Test that the largest multimer has to be at least a dimer."""
+    with pytest.raises(UserError, match="at least 2"):
+        Analyzer(theo_masses, 0.5, [CROSS_LINKED], 10, 1, max_multimer=1)
@@ -1,11 +1,30 @@
 """Test pgio functions."""
+import bz2
+import gzip
+import lzma
+import sqlite3
 from pathlib import Path
 from unittest import TestCase
 
+import numpy as np
 import pandas as pd
+import pytest
 
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
 from pgfinder.gui.internal import ms_upload_reader, theo_masses_upload_reader
-from pgfinder.pgio import ms_file_reader, read_yaml
+from pgfinder.inputs import compression, ms_file_format
+from pgfinder.pgio import (
+    FTRS_52_COLUMNS,
+    FTRS_PGFINDER_COLUMNS,
+    columns_reader,
+    compact_feature_dtypes,
+    dataframe_to_columns,
+    ms_file_chunks,
+    ms_file_reader,
+    read_yaml,
+    theo_masses_reader,
+)
 
 BASE_DIR = Path.cwd()
 RESOURCES = BASE_DIR / "tests" / "resources"
@@ -23,6 +42,94 @@ def test_theo_masses_upload_reader(ipywidgets_upload_output_theo):
     assert isinstance(theo_masses_upload_reader(ipywidgets_upload_output_theo), pd.DataFrame)
 
 
+def test_compact_feature_dtypes(synthetic_mq_file: Path) -> None:
+    """Test that MaxQuant feature tables are read with compact dtypes."""
+    features = ms_file_reader(synthetic_mq_file)
+
+    assert features["ID"].dtype == np.int32
+    assert features["Charge"].dtype == np.int8
+    # These retention times can't be stored as float32 without losing precision
+    assert features["RT (min)"].dtype == np.float64
+
+
+def test_compact_feature_dtypes_lossless() -> None:
+    """Test that float32 retention times and categorical charges are used when they hold the values exactly."""
+    features = pd.DataFrame({"ID": [1, 2, 3], "RT (min)": [10.5, 11.25, np.nan], "Charge": ["1", "1, 2", "1"]})
+
+    features = compact_feature_dtypes(features)
+
+    assert features["RT (min)"].dtype == np.float32
+    assert isinstance(features["Charge"].dtype, pd.CategoricalDtype)
+    assert features["Charge"].to_list() == ["1", "1, 2", "1"]
+
+
+def test_dataframe_to_columns(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that results survive the columnar encoding, with each column's data aligned for typed arrays."""
+    results = Analyzer(theo_masses, 0.5, ["Sodium Adduct (Na+)"], 10, 1).analyze(synthetic_raw_data)
+    results["Flag"] = results["Intensity"] > 1e6
+    results["Charge"] = results["Charge"].astype("category")
+
+    encoded = dataframe_to_columns(results)
+    decoded = columns_reader(memoryview(encoded))
+
+    assert encoded[:4] == b"PGFR"
+    pd.testing.assert_frame_equal(decoded, results.assign(Charge=results["Charge"].astype(np.int64)))
+    assert decoded.attrs == results.attrs
+
+
+def compress(file: Path, kind: str) -> Path:
+    """Write a compressed copy of a file, with a misleading suffix so that only its content gives it away."""
+    data = file.read_bytes()
+    if kind == "gzip":
+        data = gzip.compress(data)
+    elif kind == "bz2":
+        data = bz2.compress(data)
+    elif kind == "xz":
+        data = lzma.compress(data)
+    elif kind == "zstd":
+        data = pytest.importorskip("zstandard").ZstdCompressor().compress(data)
+    compressed = file.with_name(f"{kind}_{file.stem}.dat")
+    compressed.write_bytes(data)
+    return compressed
+
+
+@pytest.mark.parametrize("kind", ["gzip", "bz2", "xz", "zstd"])
+def test_compressed_inputs(synthetic_mq_file: Path, theo_masses_file_name: str, tmp_path: Path, kind: str) -> None:
+    """Test that compressed feature tables, Byos files and mass libraries read as their uncompressed originals."""
+    ftrs_file = tmp_path / "synthetic.ftrs"
+    with sqlite3.connect(ftrs_file) as db:
+        ms_file_reader(synthetic_mq_file)[FTRS_PGFINDER_COLUMNS].set_axis(FTRS_52_COLUMNS, axis=1).to_sql(
+            "Features", db, index=False
+        )
+    library_file = tmp_path / "library.csv"
+    library_file.write_bytes(Path(theo_masses_file_name).read_bytes())
+
+    for file in [synthetic_mq_file, ftrs_file]:
+        compressed = compress(file, kind)
+        assert compression(compressed) == kind
+        assert ms_file_format(compressed) == ("ftrs" if file == ftrs_file else "maxquant")
+        expected = ms_file_reader(file)
+        pd.testing.assert_frame_equal(ms_file_reader(compressed), expected)
+        pd.testing.assert_frame_equal(
+            pd.concat(ms_file_chunks(compressed, 7)), pd.concat(ms_file_chunks(file, 7)), check_dtype=False
+        )
+    pd.testing.assert_frame_equal(
+        theo_masses_reader(compress(library_file, kind)), theo_masses_reader(library_file, compiled=False)
+    )
+
+
+def test_ms_file_format(synthetic_mq_file: Path, theo_masses_file_name: str, tmp_path: Path) -> None:
+    """Test that mass spec files are recognised by their content rather than their suffix."""
+    renamed = tmp_path / "allPeptides.ftrs"
+    renamed.write_bytes(synthetic_mq_file.read_bytes())
+    assert compression(renamed) is None
+    assert ms_file_format(renamed) == "maxquant"
+    pd.testing.assert_frame_equal(ms_file_reader(renamed), ms_file_reader(synthetic_mq_file), check_like=True)
+
+    with pytest.raises(UserError, match="neither a Byos"):
+        ms_file_reader(theo_masses_file_name)
+
+
 CONFIG = {
     "this": "is",
     "a": "test",
@@ -0,0 +1,99 @@
+"""Test filtering features before matching"""
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import chunked
+from pgfinder.analyzer import Analyzer
+from pgfinder.chunked import analyze_file
+from pgfinder.errors import UserError
+from pgfinder.pgio import dataframe_to_csv_metadata, ms_file_reader
+from pgfinder.prefilter import FeatureFilter
+
+MODS = ["Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)"]
+
+
+def test_feature_filter_mask() -> None:
+    """Test each criterion, with text charges, missing values and ties for the most intense features."""
+    features = pd.DataFrame(
+        {
+            "RT (min)": [1.0, 2.0, 3.0, 4.0, 5.0, np.nan],
+            "Charge": ["1", "1, 2", "3", None, "2", "1"],
+            "Obs (Da)": [500.0, 600.0, 700.0, 800.0, 900.0, 1000.0],
+            "Intensity": [10.0, 30.0, 20.0, 30.0, np.nan, 40.0],
+        }
+    )
+
+    def kept(**settings):
+        return np.flatnonzero(FeatureFilter.from_settings(**settings).mask(features)).tolist()
+
+    assert kept(min_intensity=20) == [1, 2, 3, 5]
+    assert kept(rt_range=[2, 4]) == [1, 2, 3]
+    assert kept(mass_range=[600, 800]) == [1, 2, 3]
+    assert kept(charges=[2]) == [1, 4]
+    assert kept(top_n=2) == [1, 5]
+    assert kept(top_n=2, rt_range=[1, 5]) == [1, 3]
+    assert FeatureFilter.from_settings() is None
+    with pytest.raises(UserError):
+        FeatureFilter.from_settings(rt_range=[5, 1])
+
+
+def test_ftrs_filter_pushed_down(tmp_path: Path) -> None:
+    """Test that filtering a .ftrs file in its query reads exactly the features that filtering afterwards keeps."""
+    n = 50
+    rng = np.random.default_rng(42)
+    file = tmp_path / "features.ftrs"
+    with sqlite3.connect(file) as db:
+        pd.DataFrame(
+            {
+                "Id": np.arange(1, n + 1),
+                "apexRetentionTime": rng.uniform(0, 30, n).round(3),
+                "charges": rng.choice(["1", "1, 2", "2", "3"], n),
+                "mwMonoIsotopicMass": rng.uniform(300, 3000, n).round(4),
+                "apexIntensity": rng.uniform(0, 1e7, n).round(0),
+            }
+        ).to_sql("Features", db, index=False)
+    feature_filter = FeatureFilter.from_settings(
+        min_intensity=2e6, top_n=20, rt_range=[5, 25], mass_range=[500, 2500], charges=[2]
+    )
+
+    filtered = ms_file_reader(file, feature_filter)
+    features = ms_file_reader(file)
+    expected = features[feature_filter.mask(features)].reset_index(drop=True)
+
+    assert 0 < len(filtered) < n
+    pd.testing.assert_frame_equal(filtered, expected, check_categorical=False)
+
+
+def test_analyze_filtered(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that only the kept features are analysed, and that dropped features can be reported as unmatched."""
+    feature_filter = FeatureFilter.from_settings(min_intensity=5e5)
+    kept = synthetic_raw_data[feature_filter.mask(synthetic_raw_data)]
+
+    results = Analyzer(theo_masses, 0.5, MODS, 10, 1, feature_filter=feature_filter).analyze(synthetic_raw_data)
+    reported = Analyzer(theo_masses, 0.5, MODS, 10, 1, feature_filter=feature_filter, report_filtered=True).analyze(
+        synthetic_raw_data
+    )
+
+    expected = Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(kept)
+    pd.testing.assert_frame_equal(results, expected)
+    assert results.attrs["feature_filter"] == "min_intensity=500000.0"
+    assert len(reported) == len(results) + len(synthetic_raw_data) - len(kept)
+    dropped = reported[~reported["ID"].isin(kept["ID"])]
+    assert dropped["Inferred structure"].isna().all()
+    pd.testing.assert_frame_equal(reported[reported["ID"].isin(kept["ID"])].reset_index(drop=True), results)
+
+
+def test_analyze_file_filtered(synthetic_mq_file: Path, theo_masses: pd.DataFrame, tmp_path, monkeypatch) -> None:
+    """Test that filtering a file analysed in partitions writes exactly the results of filtering it in one go."""
+    monkeypatch.setattr(chunked, "READ_CHUNK_SIZE", 10)
+    feature_filter = FeatureFilter.from_settings(top_n=40, rt_range=[3, 30])
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1, feature_filter=feature_filter, report_filtered=True)
+    expected = dataframe_to_csv_metadata(analyzer.analyze(ms_file_reader(synthetic_mq_file)))
+
+    output = analyze_file(analyzer, synthetic_mq_file, 0.002, tmp_path, "results.csv")
+
+    assert Path(output).read_text() == expected
@@ -0,0 +1,88 @@
+"""Test recalibrating observed masses before matching"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import chunked
+from pgfinder.analyzer import Analyzer
+from pgfinder.chunked import analyze_file
+from pgfinder.errors import UserError
+from pgfinder.pgio import dataframe_to_csv_metadata, ms_file_reader
+from pgfinder.recalibration import calibrants, fit_calibration
+
+MODS = ["Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)"]
+
+
+def drifted(features_df: pd.DataFrame) -> pd.DataFrame:
+    """Features whose observed masses drift from 6 to 10 ppm too high over the run."""
+    drift_ppm = 6 + 4 * features_df["RT (min)"] / 30
+    return features_df.assign(**{"Obs (Da)": features_df["Obs (Da)"] * (1 + drift_ppm / 1000000)})
+
+
+def test_fit_calibration() -> None:
+    """Test that a smooth drift in mass and retention time is recovered despite noise and outliers."""
+    rng = np.random.default_rng(42)
+    n = 300
+    theoretical = rng.uniform(400, 2500, n)
+    rt = rng.uniform(1, 60, n)
+    drift_ppm = 4 + 3 * (theoretical - 1450) / 1050 - 2 * ((rt - 30) / 30) ** 2
+    error_ppm = drift_ppm + rng.normal(0, 0.3, n)
+    error_ppm[:15] += rng.choice([-8, 8], 15)
+    observed = theoretical * (1 + error_ppm / 1000000)
+
+    calibration = fit_calibration(observed, rt, theoretical)
+
+    corrected_ppm = (calibration.corrected(observed, rt) - theoretical) / theoretical * 1000000
+    assert len(calibration.coefficients) == 6
+    assert np.abs(corrected_ppm[15:]).max() < 1.5
+    assert calibration.calibrants <= n - 15
+    assert calibration.describe().startswith("offset_ppm = ")
+    assert fit_calibration(observed[:4], rt[:4], theoretical[:4]) is None
+    assert len(fit_calibration(observed[:10], rt[:10], theoretical[:10]).coefficients) == 1
+
+
+def test_calibrants() -> None:
+    """Test that only observed masses matching a single, isolated library mass are picked as calibrants."""
+    library = np.array([500.0, 800.0, 800.004, 1200.0])
+    observed = np.array([500.002, 800.002, 1200.05, 1200.003])
+
+    positions, theoretical = calibrants(observed, library, 10)
+
+    assert positions.tolist() == [0, 3]
+    assert theoretical.tolist() == [500.0, 1200.0]
+
+
+def test_analyze_recalibrated(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame) -> None:
+    """Test that drifted masses are matched at a narrow tolerance once recalibrated, as they are without the drift."""
+    features = drifted(synthetic_raw_data)
+
+    def matched(results_df):
+        return set(results_df.loc[results_df["Inferred structure"].notna(), "ID"])
+
+    expected = Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(synthetic_raw_data)
+    narrow = Analyzer(theo_masses, 0.5, MODS, 3, 1).analyze(features)
+    results = Analyzer(theo_masses, 0.5, MODS, 20, 1, recalibrated_ppm=3).analyze(features)
+
+    assert len(matched(narrow)) < len(matched(expected)) / 2
+    assert matched(results) == matched(expected)
+    assert results["Delta ppm"].abs().max() <= 3
+    assert results.attrs["ppm"] == 3
+    assert results.attrs["recalibration"].startswith("from 20 ppm, offset_ppm = ")
+    with pytest.raises(UserError):
+        Analyzer(theo_masses, 0.5, MODS, 10, 1, recalibrated_ppm=20)
+
+
+def test_analyze_file_recalibrated(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame, tmp_path, monkeypatch):
+    """Test that recalibrating a file analysed in partitions writes exactly the results of analysing it in one go."""
+    monkeypatch.setattr(chunked, "READ_CHUNK_SIZE", 10)
+    file = tmp_path / "drifted_allPeptides.txt"
+    columns = {"RT (min)": "Retention time", "Obs (Da)": "Mass", "Charge": "Charge", "Intensity": "Intensity"}
+    drifted(synthetic_raw_data)[list(columns)].rename(columns=columns).to_csv(file, sep="\t", index=False)
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 20, 1, recalibrated_ppm=3)
+    expected = dataframe_to_csv_metadata(analyzer.analyze(ms_file_reader(file)))
+
+    output = analyze_file(analyzer, file, 0.002, tmp_path, "results.csv")
+
+    assert Path(output).read_text() == expected
@@ -0,0 +1,52 @@
+"""Test precomputed expanded search spaces"""
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
+from pgfinder.kernels import ppm_windows, sorted_observed, window_hits
+from pgfinder.search_space import ExpandedSearchSpace
+
+MODS = ["Cross-Linked Multimers (=)", "Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)", "Loss of GlcNAc (-g)"]
+
+
+@pytest.mark.parametrize("mods", [[], MODS])
+def test_expanded_search_space_matches_search_space(
+    theo_masses: pd.DataFrame, synthetic_raw_data: pd.DataFrame, mods
+) -> None:
+    """Test that filtering the expanded space gives the candidates of ``search_space()`` that can match."""
+    analyzer = Analyzer(theo_masses, 0.5, mods, 10, 1)
+    expanded = Analyzer(theo_masses, 0.5, mods, 10, 1, expanded_search_space=analyzer.expand_search_space())
+    observed = sorted_observed(synthetic_raw_data)
+
+    expected = analyzer.search_space(observed)
+    expected = expected[window_hits(observed, *ppm_windows(expected["Theo (Da)"].to_numpy(), 10))]
+    pd.testing.assert_frame_equal(expanded.search_space(observed), expected.reset_index(drop=True))
+    pd.testing.assert_frame_equal(expanded.analyze(synthetic_raw_data), analyzer.analyze(synthetic_raw_data))
+
+
+def test_expanded_search_space_file(theo_masses: pd.DataFrame, synthetic_raw_data: pd.DataFrame, tmp_path: Path):
+    """Test that a saved search space is re-used, and re-built when the modifications change."""
+    file = tmp_path / "space.npz"
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1, expanded_search_space=file)
+    saved = ExpandedSearchSpace.read(file)
+    assert saved.fingerprint == analyzer.fingerprint
+    assert np.array_equal(saved.masses, np.sort(saved.masses))
+    assert list(saved.names) == list(analyzer.expand_search_space().names)
+
+    Analyzer(theo_masses, 0.5, MODS[:2], 10, 1, expanded_search_space=file)
+    assert ExpandedSearchSpace.read(file).fingerprint != saved.fingerprint
+    with pytest.raises(UserError):
+        Analyzer(theo_masses, 0.5, MODS, 10, 1, expanded_search_space=ExpandedSearchSpace.read(file))
+
+
+def test_expanded_search_space_errors(theo_masses: pd.DataFrame, tmp_path: Path) -> None:
+    """Test that searches depending on the sample's masses can't be expanded, and that other files are rejected."""
+    with pytest.raises(UserError):
+        Analyzer(theo_masses, 0.5, MODS, 10, 1, max_multimer=3).expand_search_space()
+    (tmp_path / "space.npz").write_bytes(b"not a search space")
+    with pytest.raises(UserError):
+        ExpandedSearchSpace.read(tmp_path / "space.npz")
@@ -0,0 +1,160 @@
+"""Test the local analysis service"""
+import base64
+import json
+import threading
+import urllib.error
+import urllib.request
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from pgfinder.errors import UserError
+from pgfinder.serve import AnalysisService, QueueFullError, create_server
+
+
+@pytest.fixture
+def service_url(theo_masses_filename):
+    """Run a service with a warm default library on a free local port."""
+    service = AnalysisService(workers=2, queue_size=4, masses_file=theo_masses_filename)
+    server = create_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+
+def request(url: str, body: dict = None):
+    data = None if body is None else json.dumps(body).encode()
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data)) as response:
+            return response.status, response.read().decode()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode()
+
+
+def test_health_and_metrics(service_url: str) -> None:
+    """Test the health and metrics endpoints."""
+    status, body = request(f"{service_url}/health")
+    assert status == 200
+    assert json.loads(body)["status"] == "ok"
+
+    status, body = request(f"{service_url}/metrics")
+    assert status == 200
+    assert json.loads(body)["libraries_cached"] == 1
+
+
+def test_submit_and_wait(service_url: str, synthetic_mq_file: Path) -> None:
+    """Test that a job submitted with a path returns CSV results, and that the analyzer is kept warm."""
+    job = {"input_file": str(synthetic_mq_file), "mod_list": ["Sodium Adduct (Na+)"], "wait": True}
+    status, body = request(f"{service_url}/jobs", job)
+    assert status == 200
+    assert body.startswith("Metadata,ID,RT (min)")
+
+    request(f"{service_url}/jobs", job)
+    metrics = json.loads(request(f"{service_url}/metrics")[1])
+    assert metrics["jobs"]["completed"] == 2
+    assert metrics["analyzers_cached"] == 1
+
+
+def test_submit_upload_and_poll(service_url: str, synthetic_mq_file: Path, tmp_path: Path) -> None:
+    """Test that uploaded files are analysed in the background and results stored in the output directory."""
+    upload = {"name": synthetic_mq_file.name, "content": base64.b64encode(synthetic_mq_file.read_bytes()).decode()}
+    status, body = request(f"{service_url}/jobs", {"upload": upload, "output_dir": str(tmp_path / "output")})
+    assert status == 202
+    job_id = json.loads(body)["id"]
+
+    status, body = request(f"{service_url}/jobs/{job_id}/result")
+    while status == 409:
+        status, body = request(f"{service_url}/jobs/{job_id}/result")
+    result = json.loads(body)
+    assert result["status"] == "completed"
+    assert isinstance(pd.read_csv(result["result_file"]), pd.DataFrame)
+
+
+def test_failed_job(service_url: str, raw_data_no_match_filename: str) -> None:
+    """Test that failures are reported for the job without taking down the service."""
+    status, body = request(f"{service_url}/jobs", {"input_file": raw_data_no_match_filename, "wait": True})
+    assert status == 422
+    assert "No matches were found" in json.loads(body)["error"]
+
+    status, body = request(f"{service_url}/jobs", {"input_file": raw_data_no_match_filename, "ppm": 10})
+    assert status == 400
+
+
+@pytest.mark.parametrize(
+    "parameters",
+    [
+        {"ppm_tolerance": "10"},
+        {"ppm_tolerance": None},
+        {"report_filtered": "yes"},
+        {"mod_list": "Sodium Adduct (Na+)"},
+        {"top_n": 2.5},
+        {"rt_range": [30, 10]},
+        {"charges": 1},
+    ],
+)
+def test_invalid_parameters(theo_masses_filename, synthetic_mq_file: Path, parameters: dict) -> None:
+    """Test that parameters of the wrong type are refused when the job is submitted, not when it runs."""
+    service = AnalysisService(workers=1, masses_file=theo_masses_filename)
+    try:
+        with pytest.raises(UserError, match="must be|range"):
+            service.submit({"input_file": str(synthetic_mq_file), **parameters})
+    finally:
+        service.shutdown()
+    assert service.metrics()["jobs"]["submitted"] == 0
+
+
+def test_data_dirs(theo_masses_filename, synthetic_mq_file: Path, tmp_path: Path) -> None:
+    """Test that jobs can only name paths within the data directories, and none when served beyond localhost."""
+    service = AnalysisService(workers=1, masses_file=theo_masses_filename, data_dirs=[synthetic_mq_file.parent])
+    try:
+        service.submit({"input_file": str(synthetic_mq_file), "output_dir": str(tmp_path / "output")}).done.wait()
+        service.submit({"input_file": str(synthetic_mq_file), "masses_file": "e_coli_monomers_simple.csv"}).done.wait()
+        for parameters in [{"masses_file": theo_masses_filename}, {"output_dir": "/tmp"}]:
+            with pytest.raises(UserError, match="data directories"):
+                service.submit({"input_file": str(synthetic_mq_file), **parameters})
+        with pytest.raises(UserError, match="data directories"):
+            service.submit({"input_file": str(tmp_path / ".." / "elsewhere.txt")})
+    finally:
+        service.shutdown()
+    assert service.metrics()["jobs"]["completed"] == 2
+
+    remote = AnalysisService(workers=1, masses_file=theo_masses_filename)
+    create_server(remote, "0.0.0.0", 0).server_close()
+    with pytest.raises(UserError, match="data directories"):
+        remote.submit({"input_file": str(synthetic_mq_file)})
+    remote.shutdown()
+
+
+def test_queue_full(theo_masses_filename, synthetic_mq_file: Path) -> None:
+    """Test that jobs are rejected once every worker is busy and the queue is full."""
+    service = AnalysisService(workers=1, queue_size=0, masses_file=theo_masses_filename)
+    release = threading.Event()
+    service._executor.submit(release.wait)
+    try:
+        service.submit({"input_file": str(synthetic_mq_file)})
+        with pytest.raises(QueueFullError):
+            service.submit({"input_file": str(synthetic_mq_file)})
+        with pytest.raises(UserError):
+            AnalysisService().submit({"input_file": str(synthetic_mq_file)})
+    finally:
+        release.set()
+        service.shutdown()
+    assert service.metrics()["jobs"] == {"submitted": 1, "completed": 1, "failed": 0, "rejected": 1}
+
+
+def test_prometheus_metrics(service_url: str, synthetic_mq_file: Path) -> None:
+    """Test that Prometheus scrapes of the metrics endpoint get the text format, counting the jobs analysed."""
+    job = {"input_file": str(synthetic_mq_file), "mod_list": ["Sodium Adduct (Na+)"], "wait": True}
+    request(f"{service_url}/jobs", job)
+
+    scrape = urllib.request.Request(f"{service_url}/metrics", headers={"Accept": "text/plain;version=0.0.4"})
+    with urllib.request.urlopen(scrape) as response:
+        assert response.headers["Content-Type"].startswith("text/plain")
+        body = response.read().decode()
+    assert "# TYPE pgfinder_files_processed_total counter" in body
+    assert 'pgfinder_stage_duration_seconds_count{stage="match"}' in body
+    assert "pgfinder_service_jobs_running 0" in body
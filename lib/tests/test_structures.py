@@ -0,0 +1,67 @@
+"""Test parsing and classifying structure names"""
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import MASS_TO_CLEAN
+from pgfinder.matching import clean_up, modified_structure_namer
+from pgfinder.structures import StructureTable, parse_structure
+
+
+@pytest.mark.parametrize(
+    "name, core, glycan, stem, modifications, multimer, adduct",
+    [
+        ("gm-AEJ|1", "gm-AEJ", "gm", "AEJ", (), 1, None),
+        ("gm|0", "gm", "gm", "", (), 0, None),
+        ("g(-Ac)m-AEJ (Anh) (Am) |1", "g(-Ac)m-AEJ (Anh) (Am) ", "g(-Ac)m", "AEJ", ("Anh", "Am"), 1, None),
+        ("gm-AEJ=gm-AEJ (Na+) |2", "gm-AEJ=gm-AEJ (Na+) ", "gm", "AEJ", ("Na+",), 2, "Na+"),
+        ("gm-gm-AEJ|1", "gm-gm-AEJ", "gm-gm", "AEJ", (), 1, None),
+        ("Lac-AEJ|10", "Lac-AEJ", "Lac", "AEJ", (), 10, None),
+        ("gm-AEJ", "gm-AEJ", "gm", "AEJ", (), None, None),
+    ],
+)
+def test_parse_structure(name, core, glycan, stem, modifications, multimer, adduct) -> None:
+    """Test that names are broken down into their parts."""
+    structure = parse_structure(name)
+    assert (structure.core, structure.glycan, structure.stem) == (core, glycan, stem)
+    assert (structure.modifications, structure.multimer, structure.adduct) == (modifications, multimer, adduct)
+
+
+def test_modified_names_keep_long_multimer_numbers() -> None:
+    """Test that modification tags go before multimer numbers with more than one digit."""
+    assert modified_structure_namer("Anhydro (Anh)")("gm-AEJ|12") == "gm-AEJ (Anh) |12"
+    assert modified_structure_namer("Anhydro (Anh)")("gm-AEJ (Am) |1") == "gm-AEJ (Am) (Anh) |1"
+
+
+def test_structure_table_matches_substring_search() -> None:
+    """Test that the precomputed flags select the same rows as searching the names."""
+    names = pd.Series(["gm-AEJ|1", "gm-AEJ (Na+) |1", "m-AEJ|1", "gm-AEJ (K+) |1", None, "gm-AEJ|1"])
+    for column in (names, names.astype("category")):
+        structures = StructureTable(column.dropna().unique())
+        for adduct, rule in MASS_TO_CLEAN.items():
+            np.testing.assert_array_equal(
+                structures.mask(column, structures.parents[adduct]), column.str.contains(rule["parent"], na=False)
+            )
+            np.testing.assert_array_equal(
+                structures.mask(column, structures.targets[adduct]), column.str.contains(rule["target"], na=False)
+            )
+
+
+def test_clean_up_with_structures() -> None:
+    """Test that cleaning up with a structure table gives the same results as without one."""
+    ftrs_df = pd.DataFrame(
+        {
+            "ID": [1, 2, 3],
+            "RT (min)": [10.0, 10.1, 20.0],
+            "Intensity": [100.0, 50.0, 10.0],
+            "Inferred structure": pd.Categorical(["gm-AEJ|1", "gm-AEJ (Na+) |1", "m-AEJ|1"]),
+            "Theo (Da)": [870.3704, 892.3523, 667.2910],
+        }
+    )
+    structures = StructureTable(ftrs_df["Inferred structure"].cat.categories)
+    expected = clean_up(ftrs_df, Decimal("21.9819"), 0.5)
+    cleaned = clean_up(ftrs_df, Decimal("21.9819"), 0.5, structures=structures)
+    pd.testing.assert_frame_equal(cleaned, expected)
+    assert cleaned["Intensity"].tolist() == [150.0, 10.0]
@@ -0,0 +1,121 @@
+"""Test the reference engine and the verification of the other engines against it"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder import analyzer as analyzer_module
+from pgfinder import jit, matching
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
+from pgfinder.validation import validate_raw_data_df
+from pgfinder.verify import compare_results, synthetic_features, verify_engine
+
+MODS = [
+    "Cross-Linked Multimers (=)",
+    "Anhydro-MurNAc (Anh)",
+    "Sodium Adduct (Na+)",
+    "Potassium Adduct (K+)",
+    "Loss of GlcNAc (-g)",
+]
+
+
+def test_reference_engine(theo_masses: pd.DataFrame, synthetic_raw_data: pd.DataFrame) -> None:
+    """Test that the original row-by-row loops give the results of the numpy engine."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    reference = analyzer.with_engine("reference")
+    assert (reference.engine, analyzer.engine) == ("reference", "numpy")
+    pd.testing.assert_frame_equal(reference.analyze(synthetic_raw_data), analyzer.analyze(synthetic_raw_data))
+
+    with pytest.raises(UserError):
+        verify_engine(reference, synthetic_raw_data)
+    with pytest.raises(UserError):
+        Analyzer(
+            theo_masses, 0.5, MODS, 10, 1, engine="reference", expanded_search_space=analyzer.expand_search_space()
+        )
+
+
+def test_reference_engine_is_original(theo_masses: pd.DataFrame, synthetic_raw_data: pd.DataFrame, monkeypatch) -> None:
+    """Test that the reference engine runs the original functions rather than the rewritten ones it checks."""
+    expected = Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(synthetic_raw_data)
+
+    def rewritten(*args, **kwargs):
+        pytest.fail("The reference engine ran a rewritten function")
+
+    for name in ["clean_up", "multimer_builder", "modification_generator", "pick_most_likely_structures"]:
+        monkeypatch.setattr(analyzer_module, name, rewritten)
+    for name in ["_adduct_partners", "_quantized", "parse_structure", "modified_structure_namer"]:
+        monkeypatch.setattr(matching, name, rewritten)
+    results = Analyzer(theo_masses, 0.5, MODS, 10, 1, engine="reference").analyze(synthetic_raw_data)
+
+    pd.testing.assert_frame_equal(results, expected)
+
+
+def test_reference_search_space(theo_masses: pd.DataFrame, monkeypatch) -> None:
+    """Test that the reference engine builds its search spaces with the original filtering, so that a faster engine
+    whose observed structures (or expanded search space) went wrong would be caught."""
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+    features_df = synthetic_features(theo_masses, 300, seed=5)
+    expanded = Analyzer(theo_masses, 0.5, MODS, 10, 1, expanded_search_space=analyzer.expand_search_space())
+    observed = np.sort(features_df["Obs (Da)"].to_numpy())
+    reference = analyzer.with_engine("reference").search_space(observed)
+    pd.testing.assert_frame_equal(expanded.with_engine("reference").search_space(observed), reference)
+    assert verify_engine(expanded, features_df).equivalent
+
+    observed_structures = analyzer_module._observed_structures
+
+    def without_multimers(theo_df, rounded, hits):
+        # Leaves out every multimer that is observed, as a broken rewrite of the filtering might
+        filtered_df = observed_structures(theo_df, rounded, hits)
+        return filtered_df[~filtered_df["Inferred structure"].str.contains("=", regex=False)]
+
+    monkeypatch.setattr(analyzer_module, "_observed_structures", without_multimers)
+    verification = verify_engine(analyzer, features_df)
+    assert not verification.equivalent
+    # Features matching only a multimer lose the rows of their matches
+    assert verification.differences[0].endswith(f"rather than {verification.rows}")
+
+
+def test_compare_results(theo_masses: pd.DataFrame, synthetic_raw_data: pd.DataFrame) -> None:
+    """Test that differences beyond the tolerance are found, and those within it aren't."""
+    expected = Analyzer(theo_masses, 0.5, MODS, 10, 1).analyze(synthetic_raw_data)
+    assert compare_results(expected, expected.copy()) == []
+
+    actual = expected.copy()
+    actual["Intensity"] *= 1 + 1e-12
+    assert compare_results(expected, actual) == []
+
+    actual.loc[3, "Intensity"] += 1
+    actual.loc[5, "Inferred structure"] = "gm-AEJA|1"
+    differences = compare_results(expected, actual)
+    assert differences == [
+        f"Row 5 (ID {expected.loc[5, 'ID']}): 'Inferred structure' is 'gm-AEJA|1' rather than "
+        f"{expected.loc[5, 'Inferred structure']!r}",
+        f"Row 3 (ID {expected.loc[3, 'ID']}): 'Intensity' is {actual.loc[3, 'Intensity']!r} rather than "
+        f"{expected.loc[3, 'Intensity']!r}",
+    ]
+    assert compare_results(expected, actual.iloc[:-1]) == [f"{len(expected) - 1} rows rather than {len(expected)}"]
+    assert compare_results(expected, actual.drop(columns="Delta ppm"))[0] == "Columns missing: ['Delta ppm']"
+
+
+def test_synthetic_features(theo_masses: pd.DataFrame) -> None:
+    """Test that synthetic features are valid and reproducible."""
+    features_df = synthetic_features(theo_masses, 200, seed=1)
+    validate_raw_data_df(features_df)
+    assert len(features_df) == 200
+    pd.testing.assert_frame_equal(features_df, synthetic_features(theo_masses, 200, seed=1))
+    assert not features_df.equals(synthetic_features(theo_masses, 200, seed=2))
+
+
+@pytest.mark.parametrize("engine", ["numpy", "jit"])
+@pytest.mark.parametrize("seed", range(4))
+def test_engines_match_reference(theo_masses: pd.DataFrame, engine: str, seed: int, monkeypatch) -> None:
+    """Test on random feature tables that each engine (the jit one uncompiled without Numba) matches the reference."""
+    monkeypatch.setattr(jit, "JIT_AVAILABLE", True)
+    rng = np.random.default_rng(seed)
+    analyzer = Analyzer(theo_masses, rng.uniform(0.1, 1), MODS, rng.uniform(2, 20), rng.uniform(0, 2), engine=engine)
+    features_df = synthetic_features(theo_masses, 150, seed, analyzer.ppm_tolerance, analyzer.rt_window)
+
+    verification = verify_engine(analyzer, features_df)
+    assert verification.engine == engine
+    assert verification.rows >= len(features_df)
+    assert verification.equivalent, verification.differences
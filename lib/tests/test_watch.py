@@ -0,0 +1,71 @@
+"""Test analysing Byos files while they are being written"""
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pgfinder.analyzer import Analyzer
+from pgfinder.errors import UserError
+from pgfinder.pgio import dataframe_to_csv_metadata, ms_file_reader
+from pgfinder.prefilter import FeatureFilter
+from pgfinder.watch import LiveAnalysis, watch_file
+
+MODS = ["Cross-Linked Multimers (=)", "Anhydro-MurNAc (Anh)", "Sodium Adduct (Na+)"]
+FTRS_COLUMNS = {
+    "ID": "Id",
+    "RT (min)": "apexRetentionTime",
+    "Charge": "charges",
+    "Obs (Da)": "mwMonoIsotopicMass",
+    "Intensity": "apexIntensity",
+}
+
+
+def add_features(file: Path, features_df: pd.DataFrame) -> None:
+    """Append features to the Features table of a Byos 5.2 file, as Byos does while processing a sample."""
+    with sqlite3.connect(file) as db:
+        features_df[list(FTRS_COLUMNS)].rename(columns=FTRS_COLUMNS).to_sql(
+            "Features", db, index=False, if_exists="append"
+        )
+
+
+@pytest.mark.parametrize("report_filtered", [False, True])
+def test_live_analysis(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame, tmp_path, report_filtered) -> None:
+    """Test that after each batch of features the results are exactly those of analysing the whole file so far."""
+    # Features are added out of order of retention time, so adducts often arrive before or long after their parents
+    features = synthetic_raw_data.sample(frac=1, random_state=7).reset_index(drop=True)
+    features["ID"] = np.arange(1, len(features) + 1)
+    file = tmp_path / "live.ftrs"
+    feature_filter = FeatureFilter.from_settings(min_intensity=5e3)
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1, feature_filter=feature_filter, report_filtered=report_filtered)
+    live = LiveAnalysis(analyzer, file)
+    assert live.update() == 0
+
+    for batch in np.array_split(np.arange(len(features)), 5):
+        add_features(file, features.iloc[batch])
+        assert live.update() == len(batch)
+        assert live.update() == 0
+        features_df = ms_file_reader(file, None if report_filtered else feature_filter)
+        try:
+            expected = analyzer.analyze(features_df)
+        except UserError:
+            assert live.results is None
+            continue
+        assert dataframe_to_csv_metadata(live.results) == dataframe_to_csv_metadata(expected)
+    assert live.features_read == len(features)
+
+
+def test_watch_file(synthetic_raw_data: pd.DataFrame, theo_masses: pd.DataFrame, tmp_path) -> None:
+    """Test that watching a finished file writes its results and stops once no more features are added."""
+    file = tmp_path / "sample.ftrs"
+    features = synthetic_raw_data.assign(ID=synthetic_raw_data["ID"] + 1)
+    add_features(file, features)
+    analyzer = Analyzer(theo_masses, 0.5, MODS, 10, 1)
+
+    output = watch_file(analyzer, file, tmp_path / "output", "results.csv", poll_interval=0.01, idle_timeout=0.05)
+
+    assert Path(output).read_text() == dataframe_to_csv_metadata(analyzer.analyze(ms_file_reader(file)))
+    assert [p.name for p in (tmp_path / "output").iterdir()] == ["results.csv"]
+    with pytest.raises(UserError):
+        LiveAnalysis(Analyzer(theo_masses, 0.5, MODS, 10, 1, feature_filter=FeatureFilter(top_n=10)), file)
@@ -9,11 +9,12 @@ declare type Pyio = {
 	consolidationPpm: number;
 };
 
-declare type MsgType = 'Ready' | 'Result';
+declare type MsgType = 'Ready' | 'Result' | 'Error' | 'Done';
 declare type MassLibraryIndex = {
 	[index: string]: {
 		[index: string]: {
 			File: string;
+			Compiled?: string;
 			Description: string;
 		};
 	};
@@ -25,10 +26,12 @@ declare type ReadyMsg = {
 };
 declare type ResultMsg = {
 	filename: string;
-	blob: Blob;
+	// Results in the columnar binary encoding of pgfinder.pgio.dataframe_to_columns()
+	buffer: ArrayBuffer;
 };
 declare type ErrorMsg = {
 	message: string;
+	fatal: boolean;
 };
 declare type Msg = {
 	type: MsgType;
@@ -0,0 +1,124 @@
+// Reads results in the columnar binary encoding written by pgfinder.pgio.dataframe_to_columns(),
+// viewing each numeric column and the codes of each text column in place, without copying them, and
+// writes them out as CSV when they're downloaded
+
+type NumericArray =
+	| Float64Array
+	| Float32Array
+	| Int32Array
+	| Int16Array
+	| Int8Array
+	| Uint32Array
+	| Uint16Array
+	| Uint8Array
+	| BigInt64Array
+	| BigUint64Array;
+
+export type TextColumn = {
+	// Index into the categories of each row, or -1 where it's missing
+	codes: Int32Array;
+	categories: Array<string>;
+};
+
+export type Columns = {
+	rows: number;
+	// The entries of the metadata column of CSV results
+	metadata: Array<string>;
+	columns: Map<string, NumericArray | TextColumn>;
+	// The NumPy dtype of each column, or 'text'
+	dtypes: Map<string, string>;
+};
+
+type NumericArrayConstructor = new (
+	buffer: ArrayBuffer,
+	offset: number,
+	length: number
+) => NumericArray;
+
+const typedArrays: { [dtype: string]: NumericArrayConstructor } = {
+	float64: Float64Array,
+	float32: Float32Array,
+	int64: BigInt64Array,
+	int32: Int32Array,
+	int16: Int16Array,
+	int8: Int8Array,
+	uint64: BigUint64Array,
+	uint32: Uint32Array,
+	uint16: Uint16Array,
+	uint8: Uint8Array,
+	bool: Uint8Array
+};
+
+const aligned = (n: number) => Math.ceil(n / 8) * 8;
+
+export function readColumns(buffer: ArrayBuffer): Columns {
+	const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4));
+	if (magic !== 'PGFR') {
+		throw new Error("The results buffer doesn't contain PGFinder results.");
+	}
+	const length = new DataView(buffer).getUint32(4, true);
+	const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, length)));
+	if (header.format_version !== 1) {
+		throw new Error(
+			`Results of format version ${header.format_version} can't be read by this PGFinder.`
+		);
+	}
+	const start = aligned(8 + length);
+	const columns = new Map();
+	const dtypes = new Map();
+	for (const column of header.columns) {
+		dtypes.set(column.name, column.dtype);
+		if (column.dtype !== 'text') {
+			const values = new typedArrays[column.dtype](buffer, start + column.offset, header.rows);
+			columns.set(column.name, values);
+			continue;
+		}
+		const offsets = new Uint32Array(buffer, start + column.offsets, column.categories + 1);
+		const text = new Uint8Array(buffer, start + column.text, offsets[column.categories]);
+		const decoder = new TextDecoder();
+		const categories = Array.from({ length: column.categories }, (_, i) =>
+			decoder.decode(text.subarray(offsets[i], offsets[i + 1]))
+		);
+		columns.set(column.name, {
+			codes: new Int32Array(buffer, start + column.offset, header.rows),
+			categories
+		});
+	}
+	return { rows: header.rows, metadata: header.metadata, columns, dtypes };
+}
+
+// Quote a field only where it needs it, as Python's csv module does by default
+function csvField(field: string): string {
+	return /[",\r\n]/.test(field) ? `"${field.replace(/"/g, '""')}"` : field;
+}
+
+// Writes decoded results as the CSV written by pgfinder.pgio.dataframe_to_csv_metadata(): the
+// metadata column first, then every column with floats to four decimal places. As in pandas, when
+// there are more metadata entries than rows, the padded integer columns are written as floats too.
+// Floats are rounded by toFixed(), which can differ from Python in the last place on exact ties.
+export function columnsToCsv({ rows, metadata, columns, dtypes }: Columns): string {
+	const length = Math.max(rows, metadata.length);
+	const formatters = [(i: number) => csvField(metadata[i] ?? '')];
+	columns.forEach((values, name) => {
+		const dtype = dtypes.get(name);
+		if (dtype === 'text') {
+			const { codes, categories } = values as TextColumn;
+			const text = categories.map(csvField);
+			formatters.push((i) => (i < rows && codes[i] >= 0 ? text[codes[i]] : ''));
+		} else if (dtype === 'bool') {
+			formatters.push((i) => (i < rows ? (values[i] ? 'True' : 'False') : ''));
+		} else if (dtype?.startsWith('float') || length > rows) {
+			formatters.push((i) => {
+				const value = i < rows ? Number(values[i]) : NaN;
+				return Number.isNaN(value) ? '' : value.toFixed(4);
+			});
+		} else {
+			formatters.push((i) => String(values[i]));
+		}
+	});
+	const lines = [['Metadata', ...columns.keys()].map(csvField).join(',')];
+	for (let i = 0; i < length; i++) {
+		lines.push(formatters.map((format) => format(i)).join(','));
+	}
+	return lines.join('\n') + '\n';
+}
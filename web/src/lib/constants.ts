@@ -1,3 +1,6 @@
+// Most workers (each with its own copy of Pyodide) analysing files at once
+export const maxWorkers = 8;
+
 export const defaultPyio = {
 	msData: undefined,
 	massLibrary: undefined,
@@ -1,4 +1,4 @@
-import type { PyProxy, PythonError } from 'pyodide/ffi';
+import type { PyBuffer, PyProxy, PythonError } from 'pyodide/ffi';
 import { loadPyodide, type PyodideInterface } from 'pyodide';
 import { defaultPyio } from '$lib/constants';
 
@@ -40,34 +40,77 @@ let pyodide: PyodideInterface;
 })();
 
 function postResult(proxy: PyProxy) {
-	const csvFiles = proxy.toJs();
+	// Only the dict itself is converted: each result is a memoryview of the columnar encoding that's
+	// read in place, copied once out of the Python heap (which can't be transferred) and then
+	// transferred to the page, which writes the CSV that's downloaded
+	const results: Map<string, PyBuffer> = proxy.toJs({ depth: 1 });
 	proxy.destroy();
-	csvFiles.forEach((csv: string, file: string) => {
-		const blob = new Blob([csv], { type: 'text/csv' });
+	results.forEach((view: PyBuffer, file: string) => {
+		const pyBuffer = view.getBuffer('u8');
+		const buffer = pyBuffer.data.slice().buffer;
+		pyBuffer.release();
+		view.destroy();
 		const fileparts = file.split('.');
 		fileparts[fileparts.length - 1] = 'csv';
 		const filename = fileparts.join('.');
-		postMessage({
-			type: 'Result',
-			content: {
-				filename,
-				blob
-			}
-		});
+		postMessage(
+			{
+				type: 'Result',
+				content: {
+					filename,
+					buffer
+				}
+			},
+			[buffer]
+		);
 	});
 }
 
-function postError(error: PythonError) {
+function postError(error: PythonError, fatal = false) {
 	const message = error.message;
 	postMessage({
 		type: 'Error',
 		content: {
-			message
+			message,
+			fatal
 		}
 	});
 }
 
-onmessage = async ({ data }) => {
-	Object.assign(pyio, data);
-	pyodide.runPythonAsync('run_analysis()').then(postResult).catch(postError);
+// Messages are handled one at a time, in the order they arrive, so that a file is only analysed
+// once the settings sent before it have been prepared
+let tasks: Promise<void> = Promise.resolve();
+let prepared = false;
+
+async function prepare(settings: Pyio) {
+	Object.assign(pyio, settings, { msData: undefined });
+	prepared = false;
+	try {
+		await pyodide.runPythonAsync('prepare_analysis()');
+		prepared = true;
+	} catch (error) {
+		postError(error as PythonError, true);
+	}
+}
+
+async function analyze(file: VirtFile) {
+	// If the settings couldn't be prepared, the error has already been reported
+	if (prepared) {
+		pyio.msData = [file];
+		try {
+			postResult(await pyodide.runPythonAsync('analyze_uploads()'));
+		} catch (error) {
+			postError(error as PythonError);
+		}
+		pyio.msData = undefined;
+	}
+	postMessage({ type: 'Done' });
+}
+
+onmessage = ({ data: { type, content } }) => {
+	if (type === 'Prepare') {
+		tasks = tasks.then(() => prepare(content));
+	} else if (type === 'Analyze') {
+		tasks = tasks.then(() => analyze(content));
+	}
 };
@@ -0,0 +1,116 @@
+import PGFinder from '$lib/pgfinder.ts?worker';
+import { maxWorkers } from '$lib/constants';
+
+type PoolWorker = {
+	worker: Worker;
+	ready: boolean;
+	busy: boolean;
+	// The run whose settings this worker has been sent
+	run: number;
+};
+
+type PoolCallbacks = {
+	onReady: (content: ReadyMsg) => void;
+	onResult: (content: ResultMsg) => void;
+	onError: (content: ErrorMsg) => void;
+	onProgress: (finished: number, total: number) => void;
+};
+
+// Leave one core for the page itself. Every worker loads its own copy of Pyodide and pandas, so the
+// pool is also capped to keep memory use reasonable on machines with many cores.
+export function defaultPoolSize(): number {
+	const cores = navigator.hardwareConcurrency || 2;
+	return Math.max(1, Math.min(cores - 1, maxWorkers));
+}
+
+// A pool of PGFinder workers that analyses the files of a run in parallel. The first worker is
+// started straight away; the others are only started once a run has more files than there are idle
+// workers, and are then kept for later runs. Each worker prepares the mass library and settings of
+// a run once, then analyses files one at a time until none are left, with each result passed on as
+// soon as it's ready.
+export class PGFinderPool {
+	private workers: Array<PoolWorker> = [];
+	private queue: Array<VirtFile> = [];
+	private settings: Pyio | undefined;
+	private run = 0;
+	private failedRun = 0;
+	private finished = 0;
+	private total = 0;
+
+	constructor(
+		private callbacks: PoolCallbacks,
+		private size: number = defaultPoolSize()
+	) {
+		this.spawn();
+	}
+
+	analyze(pyio: Pyio) {
+		this.run += 1;
+		this.settings = { ...pyio, msData: undefined };
+		this.queue = [...(pyio.msData ?? [])];
+		this.finished = 0;
+		this.total = this.queue.length;
+		this.callbacks.onProgress(this.finished, this.total);
+		const idle = this.workers.filter((w) => !w.busy).length;
+		for (let i = idle; i < this.queue.length && this.workers.length < this.size; i++) {
+			this.spawn();
+		}
+		this.dispatch();
+	}
+
+	terminate() {
+		this.workers.forEach((w) => w.worker.terminate());
+		this.workers = [];
+	}
+
+	private spawn() {
+		const poolWorker: PoolWorker = { worker: new PGFinder(), ready: false, busy: false, run: 0 };
+		poolWorker.worker.onmessage = ({ data: { type, content } }) => {
+			if (type === 'Ready') {
+				poolWorker.ready = true;
+				// The first worker to start tells the page what is available
+				if (this.workers.filter((w) => w.ready).length === 1) {
+					this.callbacks.onReady(content);
+				}
+				this.dispatch();
+			} else if (type === 'Result') {
+				this.callbacks.onResult(content);
+			} else if (type === 'Error') {
+				// The settings can't be prepared, so none of the remaining files can be analysed either,
+				// and there's no need to hear the same from every worker
+				if (content.fatal) {
+					this.finished += this.queue.length;
+					this.queue = [];
+					if (this.failedRun === this.run) {
+						return;
+					}
+					this.failedRun = this.run;
+				}
+				this.callbacks.onError(content);
+			} else if (type === 'Done') {
+				poolWorker.busy = false;
+				this.finished += 1;
+				this.callbacks.onProgress(this.finished, this.total);
+				this.dispatch();
+			}
+		};
+		this.workers.push(poolWorker);
+	}
+
+	private dispatch() {
+		for (const poolWorker of this.workers) {
+			if (this.queue.length === 0) {
+				return;
+			}
+			if (!poolWorker.ready || poolWorker.busy) {
+				continue;
+			}
+			if (poolWorker.run !== this.run) {
+				poolWorker.worker.postMessage({ type: 'Prepare', content: this.settings });
+				poolWorker.run = this.run;
+			}
+			poolWorker.busy = true;
+			poolWorker.worker.postMessage({ type: 'Analyze', content: this.queue.shift() });
+		}
+	}
+}
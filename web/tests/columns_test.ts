@@ -0,0 +1,61 @@
+import { readFileSync } from 'fs';
+import { expect, test } from '@playwright/test';
+import { columnsToCsv, readColumns, type TextColumn } from '../src/lib/columns';
+
+function readResults() {
+	const file = readFileSync('tests/data/results.pgfr');
+	return readColumns(file.buffer.slice(file.byteOffset, file.byteOffset + file.byteLength));
+}
+
+test('decode results written by pgfinder.pgio.dataframe_to_columns()', () => {
+	const results = readResults();
+
+	expect(results.rows).toEqual(3);
+	expect(results.metadata[0]).toEqual('file : µ-sample.txt');
+	expect([...results.columns.keys()]).toEqual([
+		'ID',
+		'RT (min)',
+		'Obs (Da)',
+		'Inferred structure',
+		'Charge',
+		'Intensity',
+		'Matched'
+	]);
+	expect(Array.from(results.columns.get('ID') as Int32Array)).toEqual([3, 1, 2]);
+	expect(Array.from(results.columns.get('RT (min)') as Float32Array)).toEqual([10.5, 11.25, 12]);
+	expect(Array.from(results.columns.get('Obs (Da)') as Float64Array)).toEqual([
+		941.4188, 1864.8123, 123.4567
+	]);
+	expect(Array.from(results.columns.get('Intensity') as BigInt64Array)).toEqual([
+		1000000n,
+		2500n,
+		40n
+	]);
+	expect(Array.from(results.columns.get('Matched') as Uint8Array)).toEqual([1, 1, 0]);
+
+	const structures = results.columns.get('Inferred structure') as TextColumn;
+	const decoded = Array.from(structures.codes, (code) =>
+		code < 0 ? null : structures.categories[code]
+	);
+	expect(decoded).toEqual(['gm-AEJA|1', 'gm-AEJ=gm-AEJA|2', null]);
+	const charges = results.columns.get('Charge') as TextColumn;
+	expect(Array.from(charges.codes, (code) => charges.categories[code])).toEqual([
+		'1',
+		'1, 2',
+		'2'
+	]);
+});
+
+test('write the same CSV as pgfinder.pgio.dataframe_to_csv_metadata()', () => {
+	// The metadata column is longer than the results, so pandas writes the integers as floats
+	expect(columnsToCsv(readResults())).toEqual(readFileSync('tests/data/results.csv', 'utf8'));
+
+	const lines = columnsToCsv({ ...readResults(), metadata: ['file : µ-sample.txt'] }).split('\n');
+	expect(lines).toEqual([
+		'Metadata,ID,RT (min),Obs (Da),Inferred structure,Charge,Intensity,Matched',
+		'file : µ-sample.txt,3,10.5000,941.4188,gm-AEJA|1,1,1000000,True',
+		',1,11.2500,1864.8123,gm-AEJ=gm-AEJA|2,"1, 2",2500,True',
+		',2,12.0000,123.4567,,2,40,False',
+		''
+	]);
+});
@@ -18,5 +18,6 @@ test('run a search with two datasets', async ({ page }) => {
 	await page.getByRole('button', { name: 'Run Analysis' }).click();
 	await page.waitForEvent('download');
 	await page.waitForEvent('download');
-	expect(downloads).toEqual(['C. difficile WT (Bern et al).csv', 'E. coli WT (Patel et al).csv']);
+	// Files are analysed in parallel, so their results can arrive in either order
+	expect(downloads.sort()).toEqual(['C. difficile WT (Bern et al).csv', 'E. coli WT (Patel et al).csv']);
 });